@@ -37,3 +37,100 @@ MAIL_PORT = 25
 
 
 # Settings specific to Stuffr
+
+# Number of input rows committed per transaction during bulk imports
+STUFFR_IMPORT_CHUNK_SIZE = 500
+# Number of items per page in the simple HTML interface
+STUFFR_SIMPLE_PAGE_SIZE = 50
+# Maximum number of rendered list rows cached by the simple HTML interface
+STUFFR_FRAGMENT_CACHE_SIZE = 10000
+# Serve the API's swagger.json from this file in the instance folder instead
+# of generating it at startup. Create it with "flask apispec".
+STUFFR_API_SPEC_FILE = None
+# Queue outgoing email in the database and send it in the background. Ignored
+# when MAIL_SUPPRESS_SEND is set.
+STUFFR_MAIL_OUTBOX = True
+# Run the outbox sender as a thread in each server process. Set to False if
+# "flask sendmail" is run as a separate process instead.
+STUFFR_MAIL_SENDER_THREAD = True
+# Maximum number of messages claimed at a time by the sender
+STUFFR_MAIL_BATCH_SIZE = 20
+# Seconds between checks for messages due to be retried
+STUFFR_MAIL_POLL_INTERVAL = 30
+# Attempts before giving up on a message
+STUFFR_MAIL_MAX_ATTEMPTS = 8
+# Seconds before the first retry, doubled for each further attempt
+STUFFR_MAIL_RETRY_DELAY = 30
+STUFFR_MAIL_RETRY_MAX_DELAY = 3600
+# Maximum number of background jobs running at once, across all workers
+STUFFR_JOB_CONCURRENCY = 4
+# Seconds a running job is hidden from other workers before it is retried
+STUFFR_JOB_TIMEOUT = 300
+# Attempts before giving up on a job
+STUFFR_JOB_MAX_ATTEMPTS = 5
+# Seconds before the first retry of a failed job, doubled for each further attempt
+STUFFR_JOB_RETRY_DELAY = 10
+STUFFR_JOB_RETRY_MAX_DELAY = 3600
+# Seconds an idle worker thread waits before checking for new jobs
+STUFFR_JOB_POLL_INTERVAL = 1
+# API rate limits: each client's allowance refills at STUFFR_RATE_LIMIT
+# requests per second, up to STUFFR_RATE_LIMIT_BURST. Set to None to disable.
+STUFFR_RATE_LIMIT = 20
+STUFFR_RATE_LIMIT_BURST = 100
+# Cost of requests to expensive endpoints, the default cost is 1. Batches
+# cost the sum of their operations' costs, the batch endpoint's cost is only
+# charged for invalid batches.
+STUFFR_RATE_LIMIT_COSTS = {
+    'stuffrapi.get_things': 2,
+    'stuffrapi.get_bootstrap': 5,
+    'stuffrapi.get_things_for_inventories': 5,
+    'stuffrapi.export_inventory': 20,
+    'stuffrapi.export_inventories': 50,
+    'stuffrapi.post_import': 50,
+    'stuffrapi.post_batch': 10
+}
+# Path of a SQLite database used to share rate limits between processes. By
+# default each process has its own limits.
+STUFFR_RATE_LIMIT_DB = None
+# Maximum API requests handled at once by each process, including streamed
+# responses still being sent, None for no limit
+STUFFR_MAX_CONCURRENT_REQUESTS = 32
+# Retry-After in seconds sent when the server is at its concurrency limit
+STUFFR_OVERLOAD_RETRY_AFTER = 1
+# Seconds responses to requests with an Idempotency-Key header are kept
+STUFFR_IDEMPOTENCY_KEY_TTL = 24 * 60 * 60
+# Seconds a repeated request waits for the original one to finish
+STUFFR_IDEMPOTENCY_WAIT = 5
+# Seconds after which a request that has not stored its response is assumed
+# to have died, and a repeat may take over its key. Should be longer than the
+# longest a request can take.
+STUFFR_IDEMPOTENCY_LEASE = 120
+# Maximum number of users whose thing counts are cached by each process
+STUFFR_COUNT_CACHE_SIZE = 10000
+# Seconds thing counts are cached, limiting how out of date they can be after
+# changes made through another process
+STUFFR_COUNT_CACHE_TTL = 60
+# Seconds between heartbeat comments sent on idle event streams
+STUFFR_EVENTS_HEARTBEAT = 15
+# Number of recent events each process keeps so clients can resume streams
+STUFFR_EVENTS_HISTORY_SIZE = 1000
+# Maximum events buffered for a client, its stream is ended if it falls behind
+STUFFR_EVENTS_BUFFER_SIZE = 100
+# Directory of the sockets used to share events between the server's
+# processes. By default events are only sent to clients of the same process.
+STUFFR_EVENTS_SOCKET_DIR = None
+# Bind keys (from SQLALCHEMY_BINDS) of shard databases that users'
+# inventories and things are split between, None to keep all data in the main
+# database. New shards must be added at the end. See stuffrapp/api/shards.py.
+STUFFR_SHARDS = None
+# Retries of writes that fail because another process is writing to the
+# database, after a random delay of up to STUFFR_WRITE_RETRY_DELAY seconds,
+# doubled for each further retry
+STUFFR_WRITE_RETRIES = 3
+STUFFR_WRITE_RETRY_DELAY = 0.05
+# Commit small concurrent writes of each process together in one transaction,
+# waiting up to STUFFR_GROUP_COMMIT_WINDOW seconds for up to
+# STUFFR_GROUP_COMMIT_SIZE writes. See stuffrapp/api/transactions.py.
+STUFFR_GROUP_COMMIT = False
+STUFFR_GROUP_COMMIT_WINDOW = 0.002
+STUFFR_GROUP_COMMIT_SIZE = 50
@@ -1,5 +1,57 @@
 """Provides the database object to the application."""
 
-from flask_sqlalchemy import SQLAlchemy
+from typing import Optional
+from flask_sqlalchemy import SignallingSession, SQLAlchemy, get_state
+import sqlalchemy
+from sqlalchemy.sql.util import find_tables
 
-db = SQLAlchemy()
+# Key of the selected shard in a session's info dict
+SHARD_KEY = 'stuffr_shard'
+
+
+class RoutingSession(SignallingSession):
+    """Session sending statements on sharded tables to the selected shard.
+
+    Tables are sharded by setting "sharded" in their info dict. Statements
+    using them go to the bind selected with use_shard() until the session is
+    closed, and to the main database if none was selected.
+    """
+
+    @property
+    def current_shard(self) -> Optional[str]:
+        """Bind key of the selected shard, None for the main database."""
+        return self.info.get(SHARD_KEY)
+
+    def use_shard(self, bind_key: Optional[str]) -> None:
+        """Select the shard used for sharded tables.
+
+        Pending changes are flushed to the previously selected shard first.
+        """
+        if bind_key != self.current_shard:
+            self.flush()
+            self.info[SHARD_KEY] = bind_key
+
+    def get_bind(self, mapper=None, clause=None):
+        """Return the shard's engine for statements on sharded tables."""
+        bind_key = self.current_shard
+        if bind_key is not None:
+            if mapper is not None:
+                tables = [sqlalchemy.inspect(mapper).mapped_table]
+            elif clause is not None:
+                tables = find_tables(clause, include_crud=True)
+            else:
+                tables = []
+            if any(t.info.get('sharded') for t in tables):
+                return get_state(self.app).db.get_engine(self.app, bind=bind_key)
+        return super().get_bind(mapper, clause)
+
+
+class StuffrSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy extension using RoutingSession."""
+
+    def create_session(self, options):
+        """Create the session factory."""
+        return sqlalchemy.orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+db = StuffrSQLAlchemy()
@@ -0,0 +1,52 @@
+"""Gunicorn settings for serving Stuffr in production.
+
+Start the server with:
+
+    gunicorn -c gunicorn.conf.py wsgi:application
+
+The app is loaded once in the master process, which warms its caches
+before forking the workers, see stuffrapp/server.py. The number of workers
+is recommended from the available CPU cores; set WEB_CONCURRENCY to
+override it. Other settings, such as bind or threads, can be given on the
+command line. Each open event stream holds one of its worker's threads.
+
+With more than one worker, set STUFFR_RATE_LIMIT_DB and
+STUFFR_EVENTS_SOCKET_DIR so the workers share rate limits and events; a
+warning is logged at startup for each one that is missing.
+
+Background jobs, such as setting up new users, are not run by the server.
+Run at least one "flask worker" process alongside it.
+"""
+
+import os
+
+from stuffrapp import server as stuffr_server
+
+recommended_workers, threads = stuffr_server.recommended_workers()
+workers = int(os.environ.get('WEB_CONCURRENCY', recommended_workers))
+# Threaded workers, so event streams don't block other requests
+worker_class = 'gthread'
+preload_app = True
+
+
+def _application():
+    """Return the app loaded by the master process."""
+    # Imported by gunicorn before the hooks are called
+    import wsgi
+    return wsgi.application
+
+
+def when_ready(server):
+    """Prepare the app once the master process is ready to fork workers."""
+    application = _application()
+    stuffr_server.before_fork(application)
+    for warning in stuffr_server.process_warnings(application, server.cfg.workers):
+        server.log.warning(warning)
+    server.log.info('Starting %d workers with %d threads each', server.cfg.workers,
+                    server.cfg.threads)
+    server.log.info('Background jobs (e.g. new user setup) need a separate "flask worker"')
+
+
+def post_fork(server, _worker):
+    """Open the new worker's own database connections."""
+    stuffr_server.after_fork(_application(), server.cfg.threads)
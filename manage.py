@@ -0,0 +1,497 @@
+#!/usr/bin/env python3
+"""Development server and CLI commands for Stuffr's backend.
+
+Use with the flask command, e.g. FLASK_APP=manage.py flask init. This module
+loads development and maintenance tooling (migrations, debug toolbar, test
+email server) that is not needed to serve requests. To serve the app use
+wsgi.py instead.
+"""
+
+import sys
+import os
+import asyncore
+import datetime
+import json
+import time
+import timeit
+import click
+from flask import render_template
+import flask_migrate
+from flask_mail import email_dispatched
+from sqlalchemy.orm.exc import MultipleResultsFound
+
+from stuffrapp import create_app, backup as stuffr_backup, jobs, seed as stuffr_seed
+from stuffrapp.api import errors, export as stuffr_export, formats, importer, models, shards, spec
+from stuffrapp.api.views_common import serialize_object
+from stuffrapp.devsmtp import DummySMTP
+from database import db
+
+# Manager setup
+################
+
+if not os.environ.get('STUFFR_SETTINGS'):
+    print('Set the STUFFR_SETTINGS environment variable before using this tool.')
+    sys.exit(1)
+
+app = create_app()
+
+# Alembic/Flask-Migrate
+flask_migrate.Migrate(app, db)
+
+
+# Development server setup
+###########################
+
+# Display emails sent by flask
+def report_email(message, **_):
+    """Take an outgoing message and print it to the screen."""
+    print(f"===== Email sent by Stuffr =====")
+    print(f"From: {message.sender}")
+    print(f"To: {','.join(message.recipients)}")
+    print(f"Subject: {message.subject}")
+    print(f"Body:\n{message.body.strip()}")
+
+
+def debug_root():
+    """Serve index.html when using the debug server."""
+    # Using render_template so flask_debugtoolbar can do its thing
+    return render_template('index.html')
+
+
+if app.debug:
+    email_dispatched.connect(report_email)
+
+    # Only imported when needed, the toolbar is slow to load
+    from flask_debugtoolbar import DebugToolbarExtension
+    # TODO: Figure out why this stopped working
+    DebugToolbarExtension(app)
+
+    # Show root HTML with debug toolbar
+    app.add_url_rule('/', 'debug_root', debug_root)
+
+
+def db_created():
+    """Return status of creation of database tables."""
+    return db.engine.dialect.has_table(db.engine, 'database_info')
+
+
+# CLI commands
+###############
+
+@app.cli.command()
+def init():
+    """Set up the database with default data."""
+    if not db_created():
+        print("Creating database tables...")
+        # Using Alembic to manage database migration (via Flask-Migrate)
+        flask_migrate.upgrade()
+    for shard in models.UserShard.get_shards():
+        created = shards.create_tables(shard)
+        if created:
+            print(f"Created tables in shard {shard}: {', '.join(created)}")
+
+    try:
+        db_info = models.DatabaseInfo.query.one_or_none()
+    except MultipleResultsFound:
+        print("Multiple DatabaseInfo entries found. This shouldn't happen.")
+        return
+    else:
+        # If no DatabaseInfo table, database has not been initialized
+        if db_info:
+            print('Stuffr already initialized')
+        else:
+            print('Performing first-time database initialization...')
+            info = models.DatabaseInfo(
+                creator_name='Stuffr',
+                creator_version='alpha')
+            db.session.add(info)
+            db.session.commit()
+
+
+@app.cli.command()
+def dbinfo():
+    """Display information about database."""
+    if not db_created():
+        print("Database has not been created, run 'flask init'")
+        return
+
+    try:
+        db_info = models.DatabaseInfo.query.one_or_none()
+    except MultipleResultsFound:
+        print("Multiple DatabaseInfo entries found. This shouldn't happen.")
+    else:
+        if db_info:
+            print(f"Database version: {db_info.database_version}")
+            print(f"Creation date: {db_info.date_created}")
+            print(f"Creator name: {db_info.creator_name}")
+            print(f"Creator version: {db_info.creator_version}")
+        else:
+            print("Database has not been initialized, run 'flask init'")
+
+
+@app.cli.command()
+def listroutes():
+    """List all views defined by the app."""
+    for rule in sorted(app.url_map.iter_rules(),
+                       key=lambda r: r.endpoint):
+        endpoint = rule.endpoint
+        methods = ', '.join(r for r in rule.methods if r not in ['OPTIONS', 'HEAD'])
+        path = rule.rule
+        print(f'{endpoint}: ({methods}) {path}')
+
+
+@app.cli.command()
+@click.option('--output', type=click.Path(dir_okay=False, writable=True),
+              help='File to write to. Writes to stdout if not given.')
+def apispec(output):
+    """Write the API's Swagger spec to a file.
+
+    Set STUFFR_API_SPEC_FILE to serve the generated file instead of
+    generating the spec on startup.
+    """
+    data = spec.encode_spec(spec.generate_spec(app))
+    with click.open_file(output or '-', 'wb') as out_file:
+        out_file.write(data)
+
+
+@app.cli.command()
+def showconfig():
+    """Output the current configuration."""
+    for key in sorted(app.config):
+        print(f"{key}: {app.config[key]}")
+
+
+@app.cli.command()
+@click.option('--things', default=1000, help='Number of things in the encoded list.')
+@click.option('--repeat', default=20, help='Times each encoding is timed.')
+def formatbench(things, repeat):
+    """Compare encoding a thing list as JSON and MessagePack.
+
+    Shows the time to encode and decode a list like GET /things returns,
+    and its size, for JSON and each available MessagePack implementation.
+    """
+    date = datetime.datetime(2017, 1, 1, tzinfo=datetime.timezone.utc)
+    data = [{'id': i, 'inventory_id': 1, 'name': f'Thing {i}', 'location': 'Shelf',
+             'details': 'Some details ' * 4, 'date_created': date,
+             'date_modified': date + datetime.timedelta(seconds=i, microseconds=i)}
+            for i in range(things)]
+    implementations = [
+        ('JSON', lambda d: json.dumps(d, default=serialize_object), json.loads),
+        ('MessagePack (pure Python)', formats.py_pack, formats.py_unpack)]
+    if formats.msgpack is not None:
+        implementations.append(('MessagePack (msgpack)', formats.pack, formats.unpack))
+    for name, encode, decode in implementations:
+        encoded = encode(data)
+        encode_time = min(timeit.repeat(lambda: encode(data), number=1, repeat=repeat))
+        decode_time = min(timeit.repeat(lambda: decode(encoded), number=1, repeat=repeat))
+        print(f"{name}: encode {encode_time * 1000:.2f} ms, decode {decode_time * 1000:.2f} ms, "
+              f"{len(encoded)} bytes")
+
+
+@app.cli.command()
+@click.option('--users', default=10, help='Total number of seed users.')
+@click.option('--inventories', default=2, help='Inventories per user.')
+@click.option('--things', default=100, help='Things per inventory.')
+@click.option('--batch-size', default=stuffr_seed.DEFAULT_BATCH_SIZE,
+              help='Rows inserted per transaction.')
+@click.option('--seed', 'random_seed', default=0, help='Seed for generated content.')
+def seed(users, inventories, things, batch_size, random_seed):
+    """Fill the database with generated test data.
+
+    Creates seed users (seed0@example.com, seed1@example.com, ...) with the
+    given number of inventories and things. Rows that already exist are
+    skipped, so an interrupted run can be resumed by running it again with
+    the same parameters.
+    """
+    if not db_created():
+        print("Database has not been created, run 'flask init'")
+        return
+    print(f"Seeding {users} users, {inventories} inventories per user, "
+          f"{things} things per inventory...")
+    created = stuffr_seed.seed_database(
+        users, inventories, things, batch_size=batch_size, seed=random_seed,
+        progress=stuffr_seed.make_progress_printer())
+    print("Created {users} users, {inventories} inventories, {things} things".format(
+        **created))
+
+
+@app.cli.command()
+@click.argument('email')
+@click.option('--inventory', 'inventory_id', type=int,
+              help='ID of inventory to export. Exports all inventories if not given.')
+@click.option('--format', 'export_format', default='ndjson',
+              type=click.Choice(sorted(stuffr_export.EXPORT_FORMATS)))
+@click.option('--output', type=click.Path(dir_okay=False, writable=True),
+              help='File to write to. Writes to stdout if not given.')
+@click.option('--gzip', 'use_gzip', is_flag=True, help='Compress output with gzip.')
+def export(email, inventory_id, export_format, output, use_gzip):
+    """Export a user's inventories as NDJSON or CSV."""
+    user = models.User.query.filter_by(email=email).one_or_none()
+    if user is None:
+        print(f"No user with email {email}", file=sys.stderr)
+        return
+    if inventory_id is not None:
+        try:
+            models.Inventory.check_user_access(inventory_id, user.id)
+        except (errors.ItemNotFoundError, errors.UserPermissionError) as e:
+            print(e.args[0], file=sys.stderr)
+            return
+    chunks = stuffr_export.generate_export(export_format, user.id, inventory_id)
+    if use_gzip:
+        chunks = stuffr_export.gzip_chunks(chunks)
+    with click.open_file(output or '-', 'wb' if use_gzip else 'w') as out_file:
+        for chunk in chunks:
+            out_file.write(chunk)
+
+
+@app.cli.command('import')
+@click.argument('email')
+@click.argument('inventory_id', type=int)
+@click.argument('input_file', type=click.File('rb'))
+@click.option('--format', 'import_format', default='ndjson',
+              type=click.Choice(sorted(importer.IMPORT_FORMATS)))
+@click.option('--chunk-size', type=int, help='Rows committed per transaction.')
+@click.option('--import-id', help='ID of a previous import to resume.')
+def import_things(email, inventory_id, input_file, import_format, chunk_size, import_id):
+    """Import things into an inventory from NDJSON or CSV.
+
+    If the import fails, run the command again with --import-id set to the
+    ID shown in the progress output to resume it.
+    """
+    user = models.User.query.filter_by(email=email).one_or_none()
+    if user is None:
+        print(f"No user with email {email}", file=sys.stderr)
+        return
+
+    def report_progress(checkpoint):
+        """Print the number of rows handled so far."""
+        print(f"Import {checkpoint.import_key}: {checkpoint.rows_processed} rows processed, "
+              f"{checkpoint.rows_imported} imported, {checkpoint.num_errors} errors")
+
+    try:
+        result = importer.import_things(input_file, import_format, inventory_id, user.id,
+                                        import_key=import_id, chunk_size=chunk_size,
+                                        progress=report_progress)
+    except (errors.ItemNotFoundError, errors.UserPermissionError,
+            errors.InvalidDataError) as e:
+        print(e.args[0], file=sys.stderr)
+        return
+    for row_error in result['errors']:
+        print(f"Row {row_error['row']}: {row_error['message']}", file=sys.stderr)
+    if result['num_errors'] > len(result['errors']):
+        print(f"...and {result['num_errors'] - len(result['errors'])} more errors",
+              file=sys.stderr)
+
+
+@app.cli.command()
+@click.argument('destination', required=False, type=click.Path(dir_okay=False))
+@click.option('--dir', 'directory', type=click.Path(file_okay=False, exists=True),
+              help='Write a timestamped snapshot to this directory instead.')
+@click.option('--gzip', 'use_gzip', is_flag=True, help='Compress the snapshot.')
+@click.option('--keep', type=int,
+              help='With --dir, delete all but this many of the newest snapshots.')
+@click.option('--pages', default=stuffr_backup.DEFAULT_PAGES_PER_STEP,
+              help='Database pages copied per step.')
+@click.option('--sleep', 'step_sleep', default=stuffr_backup.DEFAULT_STEP_SLEEP,
+              help='Seconds to wait between steps.')
+def backup(destination, directory, use_gzip, keep, pages, step_sleep):
+    """Take a snapshot of the live database.
+
+    Safe to run while the server is running. Intended to be run on a
+    schedule with --dir and --keep.
+    """
+    if (destination is None) == (directory is None):
+        print("Specify either a destination file or --dir", file=sys.stderr)
+        return
+    if models.UserShard.get_shards():
+        print("Backups only cover the main database, not shards, disable STUFFR_SHARDS "
+              "or copy each database file while the server is stopped", file=sys.stderr)
+        return
+    if directory is not None:
+        destination = os.path.join(
+            directory, stuffr_backup.snapshot_filename(compress=use_gzip))
+
+    def report_progress(done, total):
+        """Print number of pages copied."""
+        print(f"Copied {done}/{total} pages", end='\r')
+
+    try:
+        source = stuffr_backup.sqlite_database_path(db.engine)
+        stuffr_backup.backup_database(source, destination, compress=use_gzip,
+                                      pages_per_step=pages, step_sleep=step_sleep,
+                                      progress=report_progress)
+        print(f"\nSnapshot verified and written to {destination}")
+        if directory is not None and keep is not None:
+            for path in stuffr_backup.prune_snapshots(directory, keep):
+                print(f"Deleted old snapshot {path}")
+    except stuffr_backup.BackupError as e:
+        print(e.args[0], file=sys.stderr)
+
+
+@app.cli.command()
+@click.argument('snapshot', type=click.Path(dir_okay=False, exists=True))
+@click.confirmation_option(prompt='This will replace all data in the database. Continue?')
+def restore(snapshot):
+    """Replace the database with a snapshot taken by the backup command."""
+    if models.UserShard.get_shards():
+        print("Restoring the main database would leave the shards out of step with "
+              "the shard map, disable STUFFR_SHARDS first", file=sys.stderr)
+        return
+    try:
+        dest = stuffr_backup.sqlite_database_path(db.engine)
+        # Don't leave pooled connections pointing at the old data
+        db.engine.dispose()
+        stuffr_backup.restore_database(snapshot, dest)
+    except stuffr_backup.BackupError as e:
+        print(e.args[0], file=sys.stderr)
+    else:
+        print(f"Database restored from {snapshot}")
+
+
+@app.cli.command()
+@click.option('--once', is_flag=True, help='Send messages that are due and exit.')
+def sendmail(once):
+    """Send queued email.
+
+    Runs the outbox sender in the foreground, for use when
+    STUFFR_MAIL_SENDER_THREAD is disabled.
+    """
+    sender = app.extensions['stuffr_outbox']
+    if once:
+        print(f"Sent {sender.deliver_pending()} messages")
+        return
+    print("Sending queued email, press Ctrl-C to exit")
+    try:
+        while True:
+            sender.deliver_pending()
+            db.session.remove()
+            time.sleep(sender.poll_interval)
+    except KeyboardInterrupt:
+        pass
+
+
+@app.cli.command()
+def outboxstats():
+    """Show the number of queued, sent and failed emails."""
+    stats = models.OutboxEmail.get_queue_stats()
+    print(f"Pending: {stats['pending']}")
+    if stats['oldest_pending'] is not None:
+        print(f"Oldest pending: {stats['oldest_pending'].isoformat()}")
+    print(f"Sent: {stats['sent']}")
+    print(f"Failed: {stats['failed']}")
+
+
+@app.cli.command()
+@click.option('--threads', type=int, default=1, show_default=True,
+              help='Number of jobs this worker runs at once.')
+@click.option('--once', is_flag=True, help='Run jobs that are due and exit.')
+def worker(threads, once):
+    """Run background jobs.
+
+    Several workers can run at once. The total number of jobs running is
+    limited by STUFFR_JOB_CONCURRENCY.
+    """
+    job_worker = jobs.Worker(app)
+    if once:
+        print(f"Ran {job_worker.run_pending()} jobs")
+        return
+    print(f"Running jobs with {threads} threads, press Ctrl-C to exit")
+    try:
+        job_worker.run(threads)
+    except KeyboardInterrupt:
+        job_worker.stop()
+
+
+@app.cli.command()
+def jobstats():
+    """Show the number of pending, running, finished and failed jobs."""
+    for state, count in models.Job.get_queue_stats().items():
+        print(f"{state.capitalize()}: {count}")
+
+
+@app.cli.command()
+@click.option('--days', default=30, show_default=True,
+              help='Compact entries older than this many days.')
+@click.option('--through', 'through_id', type=int,
+              help='Compact entries up to this ID instead.')
+def compactjournal(days, through_id):
+    """Merge old journal entries for the same item.
+
+    Clients reading the journal from before the compacted entries only get
+    the latest value of each changed field.
+    """
+    cutoff = models.utc_now() - datetime.timedelta(days=days)
+    for shard in shards.database_keys():
+        db.session().use_shard(shard)
+        shard_name = 'main database' if shard is None else f'shard {shard}'
+        first_id = models.UserShard.first_id(shard)
+        if through_id is None:
+            shard_through_id = models.JournalEntry.get_last_id(cutoff)
+        elif first_id <= through_id < first_id + models.UserShard.ID_RANGE:
+            shard_through_id = through_id
+        else:
+            # Each shard has its own range of IDs
+            continue
+        if shard_through_id is None:
+            print(f"No journal entries older than {days} days in {shard_name}")
+            continue
+        num_removed = models.JournalEntry.compact(shard_through_id)
+        print(f"Removed {num_removed} journal entries up to #{shard_through_id} in {shard_name}")
+
+
+@app.cli.command()
+@click.option('--user', 'email', help='Move only this user.')
+@click.option('--shard', help='With --user, the shard to move the user to.')
+@click.option('--dry-run', is_flag=True, help='Only show the moves that would be made.')
+def rebalance(email, shard, dry_run):
+    """Move users between shards to even out their size.
+
+    Users whose data is in the main database are moved to the shards first.
+    Moved inventories and things get new IDs, so clients have to reload
+    them. Requests changing data in a database wait while a user is moved out of
+    it, so run this when the server is not busy.
+    """
+    try:
+        if email is not None:
+            user = models.User.query.filter_by(email=email).one_or_none()
+            if user is None or shard is None:
+                print("--user needs an existing user's email and --shard", file=sys.stderr)
+                return
+            moves = [(user.id, models.UserShard.get_shard(user.id), shard)]
+        else:
+            moves = shards.plan_rebalance()
+        if not moves:
+            print("Shards are balanced")
+        for user_id, source, target in moves:
+            print(f"User #{user_id}: {source or 'main database'} -> {target}", end='')
+            if dry_run:
+                print()
+                continue
+            moved = shards.move_user(user_id, target)
+            print(f", moved {sum(moved.values())} rows")
+    except shards.ShardError as e:
+        print(e.args[0], file=sys.stderr)
+
+
+@app.cli.command()
+def emailsrv():
+    """Barebones development SMTP server.
+
+    Normally this is not needed, as a default development config will suppress
+    sending of emails and print them to stdout instead. However, if you wish
+    to develop or test with an actual SMTP server, this will work as a very
+    bare-bones server. Anything more complicated than simply printing emails
+    to the screen will need a proper server.
+    """
+    if 'MAIL_SERVER' not in app.config:
+        print("MAIL_SERVER must be configured to use email")
+        return
+    host = app.config['MAIL_SERVER']
+    port = app.config.get('MAIL_PORT', 25)
+    DummySMTP((host, port), None)
+    print(f"Starting email test server on port {port}...")
+    print("Press Ctrl-C to exit")
+    try:
+        asyncore.loop()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,38 @@
+"""Add append-only journal of changes to things and inventories.
+
+Revision ID: 2b7e5d1c9f34
+Revises: 9a2f6c4d8e15
+Create Date: 2026-10-19 17:41:09.204316
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '2b7e5d1c9f34'
+down_revision = '9a2f6c4d8e15'
+
+
+def upgrade():
+    """Add journal_entry table."""
+    op.create_table(
+        'journal_entry',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('entity', sa.Unicode(length=32), nullable=False),
+        sa.Column('entity_id', sa.Integer(), nullable=False),
+        sa.Column('operation', sa.Unicode(length=16), nullable=False),
+        sa.Column('changes', sa.UnicodeText(), nullable=False),
+        sa.Column('date_created', sa.DateTime(), nullable=False),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+        sa.PrimaryKeyConstraint('id'),
+        sqlite_autoincrement=True
+    )
+    op.create_index('ix_journal_entry_user_id_id', 'journal_entry', ['user_id', 'id'])
+
+
+def downgrade():
+    """Remove journal_entry table."""
+    op.drop_index('ix_journal_entry_user_id_id', table_name='journal_entry')
+    op.drop_table('journal_entry')
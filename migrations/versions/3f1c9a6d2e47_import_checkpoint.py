@@ -0,0 +1,39 @@
+"""Add table tracking bulk import progress.
+
+Revision ID: 3f1c9a6d2e47
+Revises: b242e125adb8
+Create Date: 2026-10-19 04:02:11.318204
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '3f1c9a6d2e47'
+down_revision = 'b242e125adb8'
+
+
+def upgrade():
+    """Add import_checkpoint table."""
+    op.create_table(
+        'import_checkpoint',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('import_key', sa.Unicode(length=64), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('inventory_id', sa.Integer(), nullable=False),
+        sa.Column('rows_processed', sa.Integer(), nullable=False),
+        sa.Column('rows_imported', sa.Integer(), nullable=False),
+        sa.Column('num_errors', sa.Integer(), nullable=False),
+        sa.Column('date_created', sa.DateTime(), nullable=False),
+        sa.Column('date_completed', sa.DateTime()),
+        sa.ForeignKeyConstraint(['inventory_id'], ['inventory.id'], ),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('user_id', 'import_key')
+    )
+
+
+def downgrade():
+    """Remove import_checkpoint table."""
+    op.drop_table('import_checkpoint')
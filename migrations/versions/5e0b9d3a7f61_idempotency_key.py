@@ -0,0 +1,38 @@
+"""Add table storing responses for idempotency keys.
+
+Revision ID: 5e0b9d3a7f61
+Revises: c7a3f05e9b12
+Create Date: 2026-10-19 13:20:56.861305
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '5e0b9d3a7f61'
+down_revision = 'c7a3f05e9b12'
+
+
+def upgrade():
+    """Add idempotency_key table."""
+    op.create_table(
+        'idempotency_key',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('key', sa.Unicode(length=255), nullable=False),
+        sa.Column('fingerprint', sa.Unicode(length=40), nullable=False),
+        sa.Column('status_code', sa.Integer()),
+        sa.Column('response_body', sa.UnicodeText()),
+        sa.Column('response_mimetype', sa.Unicode(length=128)),
+        sa.Column('date_created', sa.DateTime(), nullable=False),
+        sa.Column('date_expires', sa.DateTime(), nullable=False),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('user_id', 'key')
+    )
+
+
+def downgrade():
+    """Remove idempotency_key table."""
+    op.drop_table('idempotency_key')
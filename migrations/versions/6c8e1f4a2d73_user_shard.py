@@ -0,0 +1,32 @@
+"""Add shard map.
+
+Revision ID: 6c8e1f4a2d73
+Revises: 2b7e5d1c9f34
+Create Date: 2026-10-19 19:02:36.518240
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '6c8e1f4a2d73'
+down_revision = '2b7e5d1c9f34'
+
+
+def upgrade():
+    """Add user_shard table."""
+    op.create_table(
+        'user_shard',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('shard', sa.Unicode(length=64), nullable=False),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('user_id')
+    )
+
+
+def downgrade():
+    """Remove user_shard table."""
+    op.drop_table('user_shard')
@@ -0,0 +1,41 @@
+"""Add outbox table for queued email.
+
+Revision ID: 8d4e2b7c1a90
+Revises: 3f1c9a6d2e47
+Create Date: 2026-10-19 09:12:40.551873
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '8d4e2b7c1a90'
+down_revision = '3f1c9a6d2e47'
+
+
+def upgrade():
+    """Add outbox_email table."""
+    op.create_table(
+        'outbox_email',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('sender', sa.Unicode(length=256), nullable=False),
+        sa.Column('recipients', sa.UnicodeText(), nullable=False),
+        sa.Column('message', sa.LargeBinary(), nullable=False),
+        sa.Column('attempts', sa.Integer(), nullable=False),
+        sa.Column('last_error', sa.UnicodeText()),
+        sa.Column('claim_token', sa.Unicode(length=32)),
+        sa.Column('date_created', sa.DateTime(), nullable=False),
+        sa.Column('date_next_attempt', sa.DateTime(), nullable=False),
+        sa.Column('date_sent', sa.DateTime()),
+        sa.Column('date_failed', sa.DateTime()),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_outbox_email_date_next_attempt'), 'outbox_email',
+                    ['date_next_attempt'], unique=False)
+
+
+def downgrade():
+    """Remove outbox_email table."""
+    op.drop_index(op.f('ix_outbox_email_date_next_attempt'), table_name='outbox_email')
+    op.drop_table('outbox_email')
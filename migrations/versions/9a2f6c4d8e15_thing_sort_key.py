@@ -0,0 +1,53 @@
+"""Add case-insensitive name sort key and indexes for sorting things.
+
+Revision ID: 9a2f6c4d8e15
+Revises: 5e0b9d3a7f61
+Create Date: 2026-10-19 15:02:37.514820
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '9a2f6c4d8e15'
+down_revision = '5e0b9d3a7f61'
+
+# Rows updated per statement when filling in sort keys
+BATCH_SIZE = 1000
+
+
+def upgrade():
+    """Add thing.name_key and indexes on inventory_id and sort columns."""
+    op.add_column('thing', sa.Column('name_key', sa.Unicode(length=128)))
+
+    # Sort keys are computed in Python, as SQL lower() only handles ASCII
+    connection = op.get_bind()
+    thing = sa.table('thing', sa.column('id', sa.Integer), sa.column('name', sa.Unicode),
+                     sa.column('name_key', sa.Unicode))
+    rows = connection.execute(sa.select([thing.c.id, thing.c.name])).fetchall()
+    update = thing.update().where(thing.c.id == sa.bindparam('thing_id')). \
+        values(name_key=sa.bindparam('key'))
+    for start in range(0, len(rows), BATCH_SIZE):
+        connection.execute(update, [{'thing_id': row.id, 'key': row.name.casefold()}
+                                    for row in rows[start:start + BATCH_SIZE]])
+
+    with op.batch_alter_table('thing') as batch_op:
+        batch_op.alter_column('name_key', existing_type=sa.Unicode(length=128),
+                              nullable=False)
+        batch_op.create_index('ix_thing_inventory_id_name_key', ['inventory_id', 'name_key'])
+        batch_op.create_index('ix_thing_inventory_id_location', ['inventory_id', 'location'])
+        batch_op.create_index('ix_thing_inventory_id_date_created',
+                              ['inventory_id', 'date_created'])
+        batch_op.create_index('ix_thing_inventory_id_date_modified',
+                              ['inventory_id', 'date_modified'])
+
+
+def downgrade():
+    """Remove thing.name_key and the sorting indexes."""
+    with op.batch_alter_table('thing') as batch_op:
+        batch_op.drop_index('ix_thing_inventory_id_date_modified')
+        batch_op.drop_index('ix_thing_inventory_id_date_created')
+        batch_op.drop_index('ix_thing_inventory_id_location')
+        batch_op.drop_index('ix_thing_inventory_id_name_key')
+        batch_op.drop_column('name_key')
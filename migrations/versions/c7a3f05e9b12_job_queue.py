@@ -0,0 +1,42 @@
+"""Add table for background jobs.
+
+Revision ID: c7a3f05e9b12
+Revises: 8d4e2b7c1a90
+Create Date: 2026-10-19 11:47:03.204116
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'c7a3f05e9b12'
+down_revision = '8d4e2b7c1a90'
+
+
+def upgrade():
+    """Add job table."""
+    op.create_table(
+        'job',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('name', sa.Unicode(length=64), nullable=False),
+        sa.Column('arguments', sa.UnicodeText(), nullable=False),
+        sa.Column('priority', sa.Integer(), nullable=False),
+        sa.Column('attempts', sa.Integer(), nullable=False),
+        sa.Column('max_attempts', sa.Integer(), nullable=False),
+        sa.Column('timeout', sa.Integer(), nullable=False),
+        sa.Column('last_error', sa.UnicodeText()),
+        sa.Column('claim_token', sa.Unicode(length=32)),
+        sa.Column('date_created', sa.DateTime(), nullable=False),
+        sa.Column('date_visible', sa.DateTime(), nullable=False),
+        sa.Column('date_finished', sa.DateTime()),
+        sa.Column('date_failed', sa.DateTime()),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_job_date_visible'), 'job', ['date_visible'], unique=False)
+
+
+def downgrade():
+    """Remove job table."""
+    op.drop_index(op.f('ix_job_date_visible'), table_name='job')
+    op.drop_table('job')
@@ -17,12 +17,33 @@ from flask_security.forms import ConfirmRegisterForm, StringField, validators
 
 from database import db
 from . import logger
-from .api import models
+from .api import counts, events, models, ratelimit, spec, transactions
 from .api.views import bp as blueprint_api
 from .api.views_common import api_unauthenticated_handler, error_response
 from .simple import bp as blueprint_simple
+# The API registers job handlers, so the jobs module is imported through it
+from . import jobs, outbox
 
-user_store = SQLAlchemyUserDatastore(db, models.User, models.Role)
+
+class StuffrUserDatastore(SQLAlchemyUserDatastore):
+    """User datastore that schedules setup of new users."""
+
+    def create_user(self, **kwargs) -> models.User:
+        """Create a user, enqueueing a job to set it up.
+
+        The job and the user's shard map entry are committed along with the
+        new user. The user's default inventory is only added once a job
+        worker ("flask worker") runs the job.
+        """
+        user = super().create_user(**kwargs)
+        # Flush to get the new user's ID
+        self.db.session.flush()
+        models.UserShard.assign(user.id)
+        jobs.enqueue('setup_new_user', priority=10, user_id=user.id)
+        return user
+
+
+user_store = StuffrUserDatastore(db, models.User, models.Role)
 
 
 class StuffrRegisterForm(ConfirmRegisterForm):
@@ -67,7 +88,9 @@ def create_app(config_override: Mapping = None) -> Flask:
     db.init_app(app)
     security = Security(app, user_store, confirm_register_form=StuffrRegisterForm)
     security.unauthorized_handler(api_unauthenticated_handler)
+    security.send_mail_task(outbox.send_mail_task)
     Mail(app)
+    outbox.init_app(app)
 
     # In debug mode Swagger documentation is served at root
     if not app.config['DEBUG']:
@@ -79,6 +102,11 @@ def create_app(config_override: Mapping = None) -> Flask:
 
     app.register_blueprint(blueprint_simple, url_prefix='/simple')
     app.register_blueprint(blueprint_api, url_prefix='/api')
+    spec.init_app(app)
+    ratelimit.init_app(app)
+    counts.init_app(app)
+    events.init_app(app)
+    transactions.init_app(app)
 
     def default404(e):
         """Default handler for 404."""
@@ -1,23 +1,27 @@
 """Common startup code for API blueprints."""
 
-from flask_security import user_registered
-
-from database import db
+from ..jobs import handler
 from ..logger import logger
 from . import models
+from . import transactions
 
 
-@user_registered.connect
-def setup_new_user(*_, user: models.User, **__):
+@handler('setup_new_user')
+def setup_new_user(user_id: int):
     """Initial setup for a new user.
 
-    Called via signal handler on user creation. The only parameter we need is
-    the user instance.
+    Run as a job, enqueued when the user is created. Does nothing if the user
+    has already been set up, so the job can safely be retried.
     """
-    logger.info('Initializing new user %s', user.email)
-    default_inventory = models.Inventory(
-        # TODO: Adapt for missing first name, possesive when ends with S
-        name='{}\'s stuff'.format(user.name_first),
-        user=user)
-    db.session.add(default_inventory)
-    db.session.commit()
+    def add_default_inventory() -> None:
+        """Add the user's first inventory, unless they have one."""
+        user = models.User.query.get(user_id)
+        models.UserShard.route(user_id)
+        if user is None or user.inventories.count():
+            return
+        logger.info('Initializing new user %s', user.email)
+        # Journaled like inventories created by the user
+        models.Inventory.create_new_inventory(
+            # TODO: Adapt for missing first name, possesive when ends with S
+            {'name': '{}\'s stuff'.format(user.name_first)}, user_id)
+    transactions.write(add_default_inventory, models.Inventory)
@@ -0,0 +1,183 @@
+"""Batch requests, running several API operations in one HTTP request.
+
+Each operation names a method and path of one of the views in views_core,
+and optionally a JSON body and an If-Match header. Operations are run in
+order by calling the views directly, in a request context of their own, so
+they don't go through HTTP, rate limiting or authentication again: the
+user is authenticated once for the whole batch, which is charged the rate
+limit costs of all of its operations up front (see ratelimit).
+
+By default each operation is committed separately, like separate requests.
+In a transaction batch each operation runs in a savepoint of one database
+transaction, which is only committed if every operation succeeds. After a
+failure the remaining operations are not run and everything is rolled
+back.
+"""
+
+import json
+from http import HTTPStatus
+from typing import Dict, List, Mapping, Sequence, Tuple
+from flask import current_app, request
+from flask_security import current_user
+import sqlalchemy
+from werkzeug.exceptions import HTTPException
+
+from database import db
+from . import errors
+from . import formats
+from . import models
+from . import transactions
+from .views_common import serialize_object
+
+# Maximum number of operations in a batch
+MAX_OPERATIONS = 100
+# Only views from this module can be used in batches
+VIEWS_MODULE = __package__ + '.views_core'
+# Views that can't be used in batches: batches themselves, and views with
+# streamed request or response bodies
+EXCLUDED_ENDPOINTS = {
+    'stuffrapi.post_batch',
+    'stuffrapi.get_events',
+    'stuffrapi.export_inventories',
+    'stuffrapi.export_inventory',
+    'stuffrapi.post_import'
+}
+# Headers operations can give
+ALLOWED_HEADERS = {'If-Match'}
+METHODS = {'GET', 'POST', 'PUT', 'DELETE'}
+
+
+def parse_operations(data: Mapping) -> Tuple[List[Mapping], bool]:
+    """Validate a batch request body.
+
+    Returns the list of operations and whether to run them in one
+    transaction.
+    """
+    if not isinstance(data, Mapping):
+        raise errors.InvalidDataError('Batch must be an object')
+    operations = data.get('operations')
+    if not isinstance(operations, list) or not operations:
+        raise errors.InvalidDataError('operations must be a non-empty list')
+    if len(operations) > MAX_OPERATIONS:
+        raise errors.InvalidDataError(f'A batch can have at most {MAX_OPERATIONS} operations')
+    for index, operation in enumerate(operations):
+        if not isinstance(operation, Mapping):
+            raise errors.InvalidDataError(f'Operation {index} must be an object')
+        if operation.get('method') not in METHODS:
+            error = 'Operation {} method must be one of: {}'.format(
+                index, ', '.join(sorted(METHODS)))
+            raise errors.InvalidDataError(error)
+        if not isinstance(operation.get('path'), str):
+            raise errors.InvalidDataError(f'Operation {index} path must be a string')
+        headers = operation.get('headers', {})
+        if not isinstance(headers, Mapping) or not set(headers) <= ALLOWED_HEADERS:
+            error = 'Operation {} can only have headers: {}'.format(
+                index, ', '.join(sorted(ALLOWED_HEADERS)))
+            raise errors.InvalidDataError(error)
+    transaction = data.get('transaction', False)
+    if not isinstance(transaction, bool):
+        raise errors.InvalidDataError('transaction must be true or false')
+    return operations, transaction
+
+
+def _error_result(status: int, message: str) -> Dict:
+    """Return the result of an operation that failed before reaching a view."""
+    return {'status': status, 'body': {'message': message}}
+
+
+def run_operation(operation: Mapping, user) -> Dict:
+    """Run one operation as the given user, returning its status and body."""
+    path, _, query_string = operation['path'].partition('?')
+    adapter = current_app.create_url_adapter(request)
+    try:
+        endpoint, view_args = adapter.match(path, method=operation['method'])
+    except HTTPException as e:
+        return _error_result(e.code, e.description)
+    if endpoint == 'static':
+        # Static files are served from the root, so any GET path matches
+        return _error_result(HTTPStatus.NOT_FOUND, f'{path} is not an API view')
+    view = current_app.view_functions[endpoint]
+    if endpoint in EXCLUDED_ENDPOINTS or view.__module__ != VIEWS_MODULE:
+        return _error_result(HTTPStatus.BAD_REQUEST, f'{path} cannot be used in a batch')
+
+    body = operation.get('body')
+    try:
+        data = None if body is None else json.dumps(body, default=serialize_object)
+    except TypeError as e:
+        return _error_result(HTTPStatus.BAD_REQUEST, e.args[0])
+    # Operations respond in the format of the batch, so nothing is lost when
+    # their bodies are included in its response
+    headers = dict(operation.get('headers', {}))
+    headers['Accept'] = formats.response_mimetype()
+    context = current_app.test_request_context(
+        path, method=operation['method'], query_string=query_string, data=data,
+        content_type=None if data is None else formats.JSON_MIMETYPE, headers=headers,
+        environ_base={'REMOTE_ADDR': request.remote_addr})
+    with context:
+        # The batch is already authenticated, so the view is called without
+        # its auth_token_required decorator, as the user
+        context.user = user
+        try:
+            response = current_app.make_response(view.__wrapped__(**view_args))
+        except HTTPException as e:
+            return _error_result(e.code, e.description)
+    response_data = response.get_data()
+    if not response_data:
+        body = None
+    elif response.mimetype == formats.JSON_MIMETYPE:
+        body = json.loads(response_data.decode('utf-8'))
+    elif formats.is_binary(response.mimetype):
+        body = formats.unpack(response_data)
+    else:
+        body = response_data.decode('utf-8')
+    return {'status': response.status_code, 'body': body}
+
+
+def _begin_transaction(user_id: int) -> None:
+    """Make sure a write transaction is in progress before the savepoints.
+
+    The user's data may be in a shard, which has a connection of its own.
+    """
+    models.UserShard.route(user_id)
+    for model in (models.User, models.Thing):
+        transactions.begin(db.session.connection(mapper=sqlalchemy.inspect(model)))
+
+
+def run_batch(operations: Sequence[Mapping], transaction: bool) -> Tuple[List[Dict], bool]:
+    """Run a batch of operations as the current user.
+
+    Returns the results of the operations and whether all of their changes
+    were committed.
+    """
+    user = current_user._get_current_object()
+    results = []
+    failed = False
+    if transaction:
+        _begin_transaction(user.id)
+    for operation in operations:
+        if failed and transaction:
+            results.append(_error_result(HTTPStatus.FAILED_DEPENDENCY,
+                                         'Not run, an earlier operation failed'))
+            continue
+        if transaction:
+            db.session.begin_nested()
+        result = run_operation(operation, user)
+        succeeded = result['status'] < HTTPStatus.BAD_REQUEST
+        failed = failed or not succeeded
+        if not transaction:
+            if not succeeded:
+                db.session.rollback()
+        elif db.session().transaction.nested:
+            # Views that don't write leave their savepoint open
+            if succeeded:
+                db.session.commit()
+            else:
+                db.session.rollback()
+        results.append(result)
+
+    if transaction:
+        if failed:
+            db.session.rollback()
+        else:
+            db.session.commit()
+    return results, not (failed and transaction)
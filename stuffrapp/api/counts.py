@@ -0,0 +1,116 @@
+"""Cached counts of things per inventory and per location.
+
+Counting a user's things takes two GROUP BY queries over all of them, so
+the counts are kept in process memory until a thing of the user is written,
+or for at most STUFFR_COUNT_CACHE_TTL seconds. The time limit bounds how
+stale counts can get when things are changed by another process, which
+can't invalidate this process's cache, or with Core statements that bypass
+the session, like those of seed_database().
+
+Every write of things and inventories through the models adds a journal
+entry (see models.JournalEntry). The users of the entries flushed in a
+transaction are collected, and their counts are invalidated when the
+transaction ends. Counts are also invalidated when it is rolled back, since
+they may have been counted from its changes.
+"""
+
+from collections import OrderedDict
+import threading
+import time
+from typing import Mapping
+from flask import Flask, current_app
+import sqlalchemy
+
+from database import db
+from . import models
+
+# Key of the IDs of users with written things in a session's info dict
+SESSION_KEY = 'stuffr_count_users'
+
+
+class ThingCountCache:
+    """Least-recently-used cache of thing counts per user."""
+
+    def __init__(self, max_size: int, ttl: float) -> None:
+        """Create an empty cache for up to max_size users."""
+        self.max_size = max_size
+        self.ttl = ttl
+        # User ID -> (expiry time, counts)
+        self._counts = OrderedDict()
+        # Incremented for a user whenever their counts are invalidated
+        self._generations = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id: int) -> Mapping:
+        """Return a user's counts, see Thing.get_thing_counts()."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._counts.get(user_id)
+            if entry is not None and entry[0] > now:
+                self._counts.move_to_end(user_id)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            generation = self._generations.get(user_id, 0)
+        counts = models.Thing.get_thing_counts(user_id)
+        with self._lock:
+            # Don't store counts that were invalidated while being counted
+            if self._generations.get(user_id, 0) == generation:
+                self._counts[user_id] = (now + self.ttl, counts)
+                self._counts.move_to_end(user_id)
+                if len(self._counts) > self.max_size:
+                    self._counts.popitem(last=False)
+        return counts
+
+    def invalidate(self, user_id: int) -> None:
+        """Forget a user's counts after their things changed."""
+        with self._lock:
+            self._counts.pop(user_id, None)
+            self._generations[user_id] = self._generations.get(user_id, 0) + 1
+
+    def clear(self) -> None:
+        """Forget all counts."""
+        with self._lock:
+            self._counts.clear()
+            self._generations.clear()
+
+
+def get_counts(user_id: int) -> Mapping:
+    """Return a user's thing counts from the current app's cache."""
+    return current_app.extensions['stuffr_count_cache'].get(user_id)
+
+
+def invalidate(user_id: int) -> None:
+    """Forget a user's cached thing counts."""
+    current_app.extensions['stuffr_count_cache'].invalidate(user_id)
+
+
+@sqlalchemy.event.listens_for(db.session, 'after_flush')
+def _collect_written(session: sqlalchemy.orm.Session, _flush_context) -> None:
+    """Collect the users of the journal entries written in a flush."""
+    user_ids = {o.user_id for o in session.new if isinstance(o, models.JournalEntry)}
+    if user_ids:
+        session.info.setdefault(SESSION_KEY, set()).update(user_ids)
+
+
+@sqlalchemy.event.listens_for(db.session, 'after_transaction_end')
+def _invalidate_written(session: sqlalchemy.orm.Session,
+                        transaction: sqlalchemy.orm.session.SessionTransaction) -> None:
+    """Invalidate the counts of the users written in a transaction once it ends."""
+    if transaction.parent is not None:
+        # A savepoint or subtransaction, the transaction is still open
+        return
+    user_ids = session.info.pop(SESSION_KEY, None)
+    if user_ids:
+        cache = current_app.extensions.get('stuffr_count_cache')
+        if cache is not None:
+            for user_id in user_ids:
+                cache.invalidate(user_id)
+
+
+def init_app(app: Flask) -> None:
+    """Create the app's thing count cache."""
+    app.extensions['stuffr_count_cache'] = ThingCountCache(
+        app.config['STUFFR_COUNT_CACHE_SIZE'], app.config['STUFFR_COUNT_CACHE_TTL'])
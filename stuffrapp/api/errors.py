@@ -26,3 +26,12 @@ class InvalidDataError(Exception):
     """
 
     pass
+
+
+class PreconditionFailedError(Exception):
+    """Raised when a conditional write does not match the current data.
+
+    Example: A thing is updated with If-Match, but was modified since.
+    """
+
+    pass
@@ -0,0 +1,286 @@
+"""Server-sent events announcing changes to a user's things and inventories.
+
+The Thing and Inventory write methods record an event for each change with
+record(), along with its journal entry (see models.JournalEntry). Events
+are only published once the database transaction they were recorded in is
+committed, and are dropped if it is rolled back, so batches run in one
+transaction only announce changes that were kept.
+
+Each process has an EventBroker which passes published events to the
+event streams of its clients (see stream()). A stream yields events of one
+user as they arrive, and a comment line every STUFFR_EVENTS_HEARTBEAT
+seconds without events, which keeps proxies from closing the connection.
+Each stream buffers at most STUFFR_EVENTS_BUFFER_SIZE events for a client
+that reads them too slowly; if the buffer fills up the stream is ended.
+
+Clients resume a stream by sending the ID of the last event they received
+(EventSource does this automatically with the Last-Event-ID header). The
+last STUFFR_EVENTS_HISTORY_SIZE events are kept for this. If the event is
+no longer known, a "reset" event is sent first, telling the client to
+reload its data.
+
+Set STUFFR_EVENTS_SOCKET_DIR to share events between the processes of a
+server running on one machine. Each process binds a Unix datagram socket in
+that directory, and sends every event it publishes to the sockets of the
+other processes.
+
+Streams hold a connection open for as long as the client listens, so the
+server should use worker threads or an asynchronous worker type.
+"""
+
+from collections import deque
+import itertools
+import json
+import os
+import socket
+import threading
+import uuid
+from typing import Iterator, List, Mapping, Optional, Tuple
+from flask import Flask, current_app
+import sqlalchemy
+
+from database import db
+from ..logger import logger
+from .views_common import serialize_object
+
+# Key of the events recorded in a session's info dict
+SESSION_KEY = 'stuffr_events'
+# Event sent first to clients whose last event is no longer known
+RESET_EVENT = 'reset'
+# Largest event shared between processes
+MAX_DATAGRAM_SIZE = 200000
+
+# (event ID, user ID, encoded event)
+EventType = Tuple[str, int, str]
+
+
+def record(user_id: int, event_type: str, data: Mapping) -> None:
+    """Record a change to a user's data, announced once it is committed."""
+    json_data = json.dumps(data, default=serialize_object)
+    db.session.info.setdefault(SESSION_KEY, []).append((user_id, event_type, json_data))
+
+
+@sqlalchemy.event.listens_for(db.session, 'after_commit')
+def _publish_recorded(session: sqlalchemy.orm.Session) -> None:
+    """Publish the events recorded in a transaction once it is committed."""
+    if session.transaction.nested:
+        # Only a savepoint was released, the transaction can still be rolled back
+        return
+    recorded = session.info.pop(SESSION_KEY, None)
+    if recorded:
+        broker = current_app.extensions.get('stuffr_events')
+        if broker is not None:
+            broker.publish(recorded)
+
+
+@sqlalchemy.event.listens_for(db.session, 'after_soft_rollback')
+def _drop_recorded(session: sqlalchemy.orm.Session, _previous_transaction) -> None:
+    """Drop the events recorded in a transaction that was rolled back."""
+    session.info.pop(SESSION_KEY, None)
+
+
+def encode_event(event_id: str, event_type: str, json_data: str) -> str:
+    """Encode an event with JSON data in the text/event-stream format."""
+    return f'id: {event_id}\nevent: {event_type}\ndata: {json_data}\n\n'
+
+
+class Subscription:
+    """Events waiting to be sent to one client."""
+
+    def __init__(self, user_id: int, max_size: int) -> None:
+        """Create an empty subscription to a user's events."""
+        self.user_id = user_id
+        self.max_size = max_size
+        self.overflowed = False
+        self._events = deque()
+        self._condition = threading.Condition()
+
+    def put(self, event: str) -> None:
+        """Add an event, or mark the subscription overflowed if it is full."""
+        with self._condition:
+            if len(self._events) >= self.max_size:
+                self.overflowed = True
+            else:
+                self._events.append(event)
+            self._condition.notify()
+
+    def get(self, timeout: float) -> List[str]:
+        """Return the events waiting, waiting for some up to timeout seconds."""
+        with self._condition:
+            if not self._events and not self.overflowed:
+                self._condition.wait(timeout)
+            events = list(self._events)
+            self._events.clear()
+        return events
+
+
+class EventBroker:
+    """Passes events to subscribers in this process and other processes."""
+
+    def __init__(self, history_size: int, buffer_size: int,
+                 socket_dir: Optional[str] = None) -> None:
+        """Create a broker, sharing events through socket_dir if given."""
+        self.buffer_size = buffer_size
+        self.socket_dir = socket_dir
+        # Recent events of all users, oldest first
+        self._history = deque(maxlen=history_size)
+        self._subscriptions = set()
+        self._lock = threading.Lock()
+        self._socket = None
+        self._socket_path = None
+        self._socket_pid = None
+
+    def publish(self, recorded: List[Tuple[int, str, str]]) -> None:
+        """Publish recorded events, see record()."""
+        self.start()
+        for user_id, event_type, json_data in recorded:
+            event_id = uuid.uuid4().hex
+            event = (event_id, user_id, encode_event(event_id, event_type, json_data))
+            self._deliver(event)
+            if self.socket_dir is not None:
+                self._send(event)
+
+    def _deliver(self, event: EventType) -> None:
+        """Pass an event to the subscriptions of its user in this process."""
+        with self._lock:
+            self._history.append(event)
+            subscriptions = [s for s in self._subscriptions if s.user_id == event[1]]
+        for subscription in subscriptions:
+            subscription.put(event[2])
+
+    def subscribe(self, user_id: int, last_event_id: Optional[str] = None) -> Subscription:
+        """Subscribe to a user's events.
+
+        If last_event_id is given, the user's events since that event are
+        added to the subscription.
+        """
+        self.start()
+        subscription = Subscription(user_id, self.buffer_size)
+        with self._lock:
+            if last_event_id is not None:
+                ids = [event[0] for event in self._history]
+                if last_event_id in ids:
+                    missed = itertools.islice(self._history, ids.index(last_event_id) + 1, None)
+                    for event in missed:
+                        if event[1] == user_id:
+                            subscription.put(event[2])
+                else:
+                    # Resuming after the reset event skips the events the
+                    # client reloads
+                    latest_id = self._history[-1][0] if self._history else ''
+                    subscription.put(encode_event(latest_id, RESET_EVENT, 'null'))
+            self._subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        """Stop passing events to a subscription."""
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    def start(self) -> None:
+        """Start receiving events from other processes, if sharing them.
+
+        Threads and sockets do not survive a fork, so each worker process of
+        a pre-forking server binds its own socket.
+        """
+        if self.socket_dir is None:
+            return
+        with self._lock:
+            if self._socket_pid == os.getpid():
+                return
+            self._socket_path = os.path.join(self.socket_dir,
+                                             '{}.sock'.format(uuid.uuid4().hex[:16]))
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self._socket.bind(self._socket_path)
+            self._socket_pid = os.getpid()
+            threading.Thread(target=self._receive, args=(self._socket,),
+                             name='stuffr-events', daemon=True).start()
+
+    def stop(self) -> None:
+        """Stop receiving events from other processes."""
+        with self._lock:
+            if self._socket_pid != os.getpid():
+                return
+            self._socket_pid = None
+            # An empty datagram stops the receiving thread
+            with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sending_socket:
+                sending_socket.sendto(b'', self._socket_path)
+            os.unlink(self._socket_path)
+
+    def _receive(self, receiving_socket: socket.socket) -> None:
+        """Receiving thread main loop."""
+        with receiving_socket:
+            while True:
+                try:
+                    datagram = receiving_socket.recv(MAX_DATAGRAM_SIZE)
+                except OSError:
+                    break
+                if not datagram:
+                    break
+                try:
+                    event_id, user_id, event = json.loads(datagram.decode('utf-8'))
+                except ValueError:
+                    logger.warning('Received an invalid event')
+                    continue
+                self._deliver((event_id, user_id, event))
+
+    def _send(self, event: EventType) -> None:
+        """Send an event to the other processes."""
+        datagram = json.dumps(event).encode('utf-8')
+        if len(datagram) > MAX_DATAGRAM_SIZE:
+            logger.warning('Event %s is too large to share with other processes', event[0])
+            return
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sending_socket:
+            # Don't wait for processes that aren't receiving
+            sending_socket.setblocking(False)
+            for entry in os.scandir(self.socket_dir):
+                if not entry.name.endswith('.sock') or entry.path == self._socket_path:
+                    continue
+                try:
+                    sending_socket.sendto(datagram, entry.path)
+                except (ConnectionRefusedError, FileNotFoundError):
+                    # Left behind by a process that exited
+                    try:
+                        os.unlink(entry.path)
+                    except FileNotFoundError:
+                        pass
+                except OSError as e:
+                    logger.warning('Could not send event %s to %s: %s', event[0], entry.path, e)
+
+
+def stream(broker: EventBroker, user_id: int, last_event_id: Optional[str],
+           heartbeat: float) -> Iterator[str]:
+    """Generate a text/event-stream body with a user's events.
+
+    Ends if the client reads events too slowly. The subscription is made
+    when the stream is started, and ended when it is closed.
+    """
+    subscription = broker.subscribe(user_id, last_event_id)
+    try:
+        # Sent at once so the client knows it is connected
+        yield ': heartbeat\n\n'
+        while True:
+            events = subscription.get(heartbeat)
+            if events:
+                yield ''.join(events)
+            elif subscription.overflowed:
+                return
+            else:
+                yield ': heartbeat\n\n'
+    finally:
+        broker.unsubscribe(subscription)
+
+
+def open_stream(user_id: int, last_event_id: Optional[str] = None) -> Iterator[str]:
+    """Return a stream of a user's events from the current app's broker."""
+    return stream(current_app.extensions['stuffr_events'], user_id, last_event_id,
+                  current_app.config['STUFFR_EVENTS_HEARTBEAT'])
+
+
+def init_app(app: Flask) -> EventBroker:
+    """Create the app's event broker."""
+    broker = EventBroker(app.config['STUFFR_EVENTS_HISTORY_SIZE'],
+                         app.config['STUFFR_EVENTS_BUFFER_SIZE'],
+                         app.config['STUFFR_EVENTS_SOCKET_DIR'])
+    app.extensions['stuffr_events'] = broker
+    return broker
@@ -0,0 +1,164 @@
+"""Streaming export of inventories and their things.
+
+Exports are generated row by row from a single SELECT, so memory use stays
+constant no matter how large an inventory is. Because the whole export is one
+statement it reads from one consistent snapshot of the database, and under
+SQLite's WAL mode a long-running export does not block writers.
+
+Two formats are available:
+
+* ndjson: One JSON object per line. Each inventory is written as an object
+  with "type": "inventory", followed by its things with "type": "thing".
+* csv: One row per thing, with the inventory's ID and name in the first
+  columns. Inventories without things are written as a row with empty thing
+  columns.
+"""
+
+import csv
+import io
+import json
+import zlib
+from typing import Dict, Iterator, Optional, Sequence, Tuple
+import sqlalchemy
+
+from database import db
+from . import errors
+from . import models
+from .views_common import serialize_object
+
+EXPORT_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv'
+}
+INVENTORY_EXPORT_FIELDS = ['id', 'name', 'date_created']
+THING_EXPORT_FIELDS = ['id', 'name', 'date_created', 'date_modified', 'location', 'details']
+CSV_HEADER = ['inventory_id', 'inventory_name'] + THING_EXPORT_FIELDS
+# Rows fetched from the database cursor at a time
+FETCH_SIZE = 1000
+# Approximate size of chunks of output sent to the client
+CHUNK_SIZE = 64 * 1024
+
+ExportRow = Tuple[Dict, Optional[Dict]]
+
+
+def _stream_query(engine: sqlalchemy.engine.Engine,
+                  query: sqlalchemy.sql.Select) -> Iterator[sqlalchemy.engine.RowProxy]:
+    """Yield the rows of a query, fetching them from the cursor in batches."""
+    connection = engine.connect()
+    try:
+        result = connection.execution_options(stream_results=True).execute(query)
+        while True:
+            rows = result.fetchmany(FETCH_SIZE)
+            if not rows:
+                break
+            yield from rows
+    finally:
+        connection.close()
+
+
+def _split_row(row: Sequence) -> ExportRow:
+    """Split a row of joined inventory and thing columns into two dicts."""
+    num_inventory_fields = len(INVENTORY_EXPORT_FIELDS)
+    inventory = dict(zip(INVENTORY_EXPORT_FIELDS, row[:num_inventory_fields]))
+    thing = dict(zip(THING_EXPORT_FIELDS, row[num_inventory_fields:]))
+    return inventory, (thing if thing['id'] is not None else None)
+
+
+def iter_export_rows(user_id: int, inventory_id: int = None) -> Iterator[ExportRow]:
+    """Return an iterator of (inventory, thing) dicts for a user's inventories.
+
+    Things are yielded grouped by inventory, in ID order. An inventory with
+    no things is yielded once with thing set to None. If inventory_id is
+    given only that inventory is exported, otherwise all of the user's
+    inventories are.
+
+    The engine is looked up immediately, so the returned iterator can be
+    consumed after the app context has ended (e.g. by a streaming response).
+    The caller is responsible for checking that the user has access to the
+    inventory.
+    """
+    inventory_table = models.Inventory.__table__
+    thing_table = models.Thing.__table__
+    inventory_columns = [inventory_table.c[f] for f in INVENTORY_EXPORT_FIELDS]
+    thing_columns = [thing_table.c[f] for f in THING_EXPORT_FIELDS]
+    joined = inventory_table.outerjoin(
+        thing_table, sqlalchemy.and_(thing_table.c.inventory_id == inventory_table.c.id,
+                                     thing_table.c.date_deleted.is_(None)))
+    query = sqlalchemy.select(inventory_columns + thing_columns). \
+        select_from(joined). \
+        where(inventory_table.c.user_id == user_id). \
+        order_by(inventory_table.c.id, thing_table.c.id)
+    if inventory_id is not None:
+        query = query.where(inventory_table.c.id == inventory_id)
+
+    models.UserShard.route(user_id)
+    engine = db.session.get_bind(clause=query)
+    return (_split_row(row) for row in _stream_query(engine, query))
+
+
+def format_ndjson(rows: Iterator[ExportRow]) -> Iterator[str]:
+    """Convert export rows to lines of newline-delimited JSON."""
+    current_inventory_id = None
+    for inventory, thing in rows:
+        if inventory['id'] != current_inventory_id:
+            current_inventory_id = inventory['id']
+            inventory_record = dict(inventory, type='inventory')
+            yield json.dumps(inventory_record, default=serialize_object) + '\n'
+        if thing is not None:
+            thing_record = dict(thing, type='thing', inventory_id=current_inventory_id)
+            yield json.dumps(thing_record, default=serialize_object) + '\n'
+
+
+def format_csv(rows: Iterator[ExportRow]) -> Iterator[str]:
+    """Convert export rows to lines of CSV, starting with a header."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(CSV_HEADER)
+    for inventory, thing in rows:
+        thing = thing or {}
+        values = [inventory['id'], inventory['name']] + \
+                 [thing.get(f) for f in THING_EXPORT_FIELDS]
+        writer.writerow([v.isoformat() if hasattr(v, 'isoformat') else v
+                         for v in values])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+def buffer_chunks(lines: Iterator[str], chunk_size: int = CHUNK_SIZE) -> Iterator[str]:
+    """Combine small strings into chunks of roughly chunk_size characters."""
+    parts = []
+    size = 0
+    for line in lines:
+        parts.append(line)
+        size += len(line)
+        if size >= chunk_size:
+            yield ''.join(parts)
+            parts = []
+            size = 0
+    if parts:
+        yield ''.join(parts)
+
+
+def gzip_chunks(chunks: Iterator[str]) -> Iterator[bytes]:
+    """Compress a stream of strings into a stream of gzip data."""
+    # wbits=31 selects the gzip container format
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def generate_export(export_format: str, user_id: int,
+                    inventory_id: int = None) -> Iterator[str]:
+    """Return an iterator of chunks of exported data in the given format."""
+    formatters = {'ndjson': format_ndjson, 'csv': format_csv}
+    if export_format not in formatters:
+        error = 'Unknown export format {}, must be one of: {}'.format(
+            export_format, ', '.join(sorted(formatters)))
+        raise errors.InvalidDataError(error)
+    rows = iter_export_rows(user_id, inventory_id)
+    return buffer_chunks(formatters[export_format](rows))
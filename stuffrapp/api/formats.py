@@ -0,0 +1,304 @@
+"""Request and response body formats.
+
+Responses are JSON unless the client asks for MessagePack with an Accept
+header, which is more compact and faster to decode for large thing lists.
+Request bodies can also be sent as MessagePack, by setting Content-Type.
+Dates are encoded as MessagePack timestamps (extension type -1) instead of
+ISO 8601 strings, and are decoded back into datetimes.
+
+The msgpack package is used if it is installed. Otherwise a pure-Python
+implementation is used, which is slower than the json module's C encoder;
+run "flask formatbench" to compare them on the current machine.
+"""
+
+import datetime
+import struct
+from typing import Any, Tuple
+from flask import has_request_context, request
+from werkzeug.exceptions import BadRequest
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+else:
+    # Older versions can't encode and decode datetimes
+    if msgpack.version < (1, 0, 0):
+        msgpack = None
+
+JSON_MIMETYPE = 'application/json'
+MSGPACK_MIMETYPE = 'application/msgpack'
+# Also accepted in Accept and Content-Type headers, but not sent
+MSGPACK_MIMETYPES = {MSGPACK_MIMETYPE, 'application/x-msgpack'}
+# Response formats in order of preference when the client accepts several
+RESPONSE_MIMETYPES = [JSON_MIMETYPE, MSGPACK_MIMETYPE, 'application/x-msgpack']
+
+# MessagePack extension type of timestamps
+TIMESTAMP_TYPE = -1
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+# Pure-Python MessagePack
+##########################
+
+# Struct formats by MessagePack type code
+_UINT8 = struct.Struct('>B')
+_UINT16 = struct.Struct('>H')
+_UINT32 = struct.Struct('>I')
+_LENGTHS = {1: _UINT8, 2: _UINT16, 4: _UINT32}
+_NUMBERS = {
+    0xca: struct.Struct('>f'), 0xcb: struct.Struct('>d'),
+    0xcc: _UINT8, 0xcd: _UINT16, 0xce: _UINT32, 0xcf: struct.Struct('>Q'),
+    0xd0: struct.Struct('>b'), 0xd1: struct.Struct('>h'), 0xd2: struct.Struct('>i'),
+    0xd3: struct.Struct('>q')
+}
+# Type codes of strings, binary data, arrays, maps and extensions with a
+# length field, mapped to the size of the field
+_SIZED = {
+    0xc4: 1, 0xc5: 2, 0xc6: 4, 0xc7: 1, 0xc8: 2, 0xc9: 4,
+    0xd9: 1, 0xda: 2, 0xdb: 4, 0xdc: 2, 0xdd: 4, 0xde: 2, 0xdf: 4
+}
+# Type codes of extensions with a fixed length
+_FIXEXT = {0xd4: 1, 0xd5: 2, 0xd6: 4, 0xd7: 8, 0xd8: 16}
+
+
+def _pack_length(buffer: bytearray, length: int, codes: Tuple[int, int, int]) -> None:
+    """Write the type code and length of a string, binary data or extension."""
+    if length <= 0xff:
+        buffer += struct.pack('>BB', codes[0], length)
+    elif length <= 0xffff:
+        buffer += struct.pack('>BH', codes[1], length)
+    else:
+        buffer += struct.pack('>BI', codes[2], length)
+
+
+def _pack_int(buffer: bytearray, value: int) -> None:
+    """Write an integer in its shortest encoding."""
+    if 0 <= value < 0x80 or -0x20 <= value < 0:
+        buffer.append(value & 0xff)
+    elif value >= 0:
+        if value <= 0xff:
+            buffer += struct.pack('>BB', 0xcc, value)
+        elif value <= 0xffff:
+            buffer += struct.pack('>BH', 0xcd, value)
+        elif value <= 0xffffffff:
+            buffer += struct.pack('>BI', 0xce, value)
+        elif value < 2 ** 64:
+            buffer += struct.pack('>BQ', 0xcf, value)
+        else:
+            raise TypeError(f'MessagePack: Integer too large: {value}')
+    elif value >= -0x80:
+        buffer += struct.pack('>Bb', 0xd0, value)
+    elif value >= -0x8000:
+        buffer += struct.pack('>Bh', 0xd1, value)
+    elif value >= -0x80000000:
+        buffer += struct.pack('>Bi', 0xd2, value)
+    elif value >= -2 ** 63:
+        buffer += struct.pack('>Bq', 0xd3, value)
+    else:
+        raise TypeError(f'MessagePack: Integer too large: {value}')
+
+
+def _pack_timestamp(buffer: bytearray, value: datetime.datetime) -> None:
+    """Write a datetime as a timestamp extension, naive datetimes are UTC."""
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=datetime.timezone.utc)
+    delta = value - EPOCH
+    seconds = delta.days * 86400 + delta.seconds
+    nanoseconds = delta.microseconds * 1000
+    if nanoseconds == 0 and 0 <= seconds <= 0xffffffff:
+        buffer += struct.pack('>BbI', 0xd6, TIMESTAMP_TYPE, seconds)
+    elif 0 <= seconds < 2 ** 34:
+        buffer += struct.pack('>BbQ', 0xd7, TIMESTAMP_TYPE, nanoseconds << 34 | seconds)
+    else:
+        buffer += struct.pack('>BBbIq', 0xc7, 12, TIMESTAMP_TYPE, nanoseconds, seconds)
+
+
+def _pack_into(buffer: bytearray, value: Any) -> None:
+    """Append the encoding of a value to a buffer."""
+    # Most common types first
+    if isinstance(value, str):
+        data = value.encode('utf-8')
+        if len(data) < 32:
+            buffer.append(0xa0 | len(data))
+        else:
+            _pack_length(buffer, len(data), (0xd9, 0xda, 0xdb))
+        buffer += data
+    elif value is None:
+        buffer.append(0xc0)
+    elif value is True:
+        buffer.append(0xc3)
+    elif value is False:
+        buffer.append(0xc2)
+    elif isinstance(value, int):
+        _pack_int(buffer, value)
+    elif isinstance(value, dict):
+        if len(value) < 16:
+            buffer.append(0x80 | len(value))
+        elif len(value) <= 0xffff:
+            buffer += struct.pack('>BH', 0xde, len(value))
+        else:
+            buffer += struct.pack('>BI', 0xdf, len(value))
+        for key, item in value.items():
+            _pack_into(buffer, key)
+            _pack_into(buffer, item)
+    elif isinstance(value, (list, tuple)):
+        if len(value) < 16:
+            buffer.append(0x90 | len(value))
+        elif len(value) <= 0xffff:
+            buffer += struct.pack('>BH', 0xdc, len(value))
+        else:
+            buffer += struct.pack('>BI', 0xdd, len(value))
+        for item in value:
+            _pack_into(buffer, item)
+    elif isinstance(value, datetime.datetime):
+        _pack_timestamp(buffer, value)
+    elif isinstance(value, float):
+        buffer += struct.pack('>Bd', 0xcb, value)
+    elif isinstance(value, (bytes, bytearray)):
+        _pack_length(buffer, len(value), (0xc4, 0xc5, 0xc6))
+        buffer += value
+    else:
+        raise TypeError("MessagePack: Cannot serialize {}".format(type(value)))
+
+
+def _unpack_timestamp(data: bytes) -> datetime.datetime:
+    """Decode the data of a timestamp extension."""
+    if len(data) == 4:
+        seconds, nanoseconds = _UINT32.unpack(data)[0], 0
+    elif len(data) == 8:
+        value = struct.unpack('>Q', data)[0]
+        seconds, nanoseconds = value & (2 ** 34 - 1), value >> 34
+    elif len(data) == 12:
+        nanoseconds, seconds = struct.unpack('>Iq', data)
+    else:
+        raise ValueError(f'Invalid timestamp length {len(data)}')
+    return EPOCH + datetime.timedelta(seconds=seconds, microseconds=nanoseconds // 1000)
+
+
+def _unpack_from(data: bytes, position: int) -> Tuple[Any, int]:
+    """Decode the value at a position, returning it and the next position."""
+    code = data[position]
+    position += 1
+    if code <= 0x7f:
+        return code, position
+    if code >= 0xe0:
+        return code - 0x100, position
+    if code in _NUMBERS:
+        number = _NUMBERS[code]
+        return number.unpack_from(data, position)[0], position + number.size
+    if code == 0xc0:
+        return None, position
+    if code in (0xc2, 0xc3):
+        return code == 0xc3, position
+
+    if code <= 0x8f:
+        kind, length = 'map', code & 0x0f
+    elif code <= 0x9f:
+        kind, length = 'array', code & 0x0f
+    elif code <= 0xbf:
+        kind, length = 'str', code & 0x1f
+    elif code in _FIXEXT:
+        kind, length = 'ext', _FIXEXT[code]
+    elif code in _SIZED:
+        size = _SIZED[code]
+        length = _LENGTHS[size].unpack_from(data, position)[0]
+        position += size
+        kind = ('bin' if code <= 0xc6 else 'ext' if code <= 0xc9 else
+                'str' if code <= 0xdb else 'array' if code <= 0xdd else 'map')
+    else:
+        raise ValueError(f'Invalid MessagePack type code {code:#x}')
+
+    if kind == 'array':
+        items = []
+        for _ in range(length):
+            item, position = _unpack_from(data, position)
+            items.append(item)
+        return items, position
+    if kind == 'map':
+        items = {}
+        for _ in range(length):
+            key, position = _unpack_from(data, position)
+            items[key], position = _unpack_from(data, position)
+        return items, position
+    if kind == 'ext':
+        ext_type = struct.unpack_from('>b', data, position)[0]
+        position += 1
+        if ext_type != TIMESTAMP_TYPE:
+            raise ValueError(f'Unsupported MessagePack extension type {ext_type}')
+    end = position + length
+    if end > len(data):
+        raise ValueError('MessagePack data is truncated')
+    if kind == 'str':
+        return data[position:end].decode('utf-8'), end
+    if kind == 'bin':
+        return data[position:end], end
+    return _unpack_timestamp(data[position:end]), end
+
+
+def py_pack(value: Any) -> bytes:
+    """Encode a value as MessagePack in pure Python."""
+    buffer = bytearray()
+    _pack_into(buffer, value)
+    return bytes(buffer)
+
+
+def py_unpack(data: bytes) -> Any:
+    """Decode MessagePack data in pure Python.
+
+    Raises ValueError if the data is not a single valid MessagePack value.
+    """
+    try:
+        value, position = _unpack_from(data, 0)
+    except (IndexError, struct.error, OverflowError, RecursionError, TypeError) as e:
+        raise ValueError(f'Invalid MessagePack data: {e}')
+    if position != len(data):
+        raise ValueError('Extra data after MessagePack value')
+    return value
+
+
+# Encoding and decoding
+########################
+
+def pack(value: Any) -> bytes:
+    """Encode a value as MessagePack."""
+    if msgpack is None:
+        return py_pack(value)
+    return msgpack.packb(value, use_bin_type=True, datetime=True)
+
+
+def unpack(data: bytes) -> Any:
+    """Decode MessagePack data, raising ValueError if it is invalid."""
+    if msgpack is None:
+        return py_unpack(data)
+    try:
+        return msgpack.unpackb(data, raw=False, timestamp=3, strict_map_key=False)
+    except (ValueError, TypeError) as e:
+        raise ValueError(f'Invalid MessagePack data: {e}')
+
+
+def response_mimetype() -> str:
+    """Return the response format the client asked for, JSON by default."""
+    if not has_request_context():
+        return JSON_MIMETYPE
+    mimetype = request.accept_mimetypes.best_match(RESPONSE_MIMETYPES, default=JSON_MIMETYPE)
+    return MSGPACK_MIMETYPE if mimetype in MSGPACK_MIMETYPES else JSON_MIMETYPE
+
+
+def is_binary(mimetype: str) -> bool:
+    """Return whether bodies in a format are binary rather than text."""
+    return mimetype in MSGPACK_MIMETYPES
+
+
+def request_data() -> Any:
+    """Return the decoded body of a JSON or MessagePack request.
+
+    Like request.get_json(), returns None if the body is in neither format,
+    and fails with 400 Bad Request if it can't be decoded.
+    """
+    if request.mimetype in MSGPACK_MIMETYPES:
+        try:
+            return unpack(request.get_data())
+        except ValueError as e:
+            raise BadRequest(f'Failed to decode MessagePack object: {e}')
+    return request.get_json()
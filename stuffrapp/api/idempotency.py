@@ -0,0 +1,129 @@
+"""Support for the Idempotency-Key header on POST endpoints.
+
+Clients on unreliable networks can't tell whether a POST that timed out was
+handled. By sending a unique Idempotency-Key header, they can safely retry:
+the first response for a key is stored, and repeats of the request get the
+stored response again, with an Idempotent-Replayed header, without creating
+anything new.
+
+If a repeat arrives while the first request is still being handled, it
+waits for the stored response, up to STUFFR_IDEMPOTENCY_WAIT seconds, and
+gets 409 if the first request is still not done. If the first request has
+not stored a response after STUFFR_IDEMPOTENCY_LEASE seconds, e.g. because
+its worker was killed, a repeat takes the key over and is handled. Keys are
+stored per user and expire after STUFFR_IDEMPOTENCY_KEY_TTL seconds. Responses with server
+errors are not stored, so the request can be retried with the same key.
+"""
+
+import base64
+import datetime
+import functools
+import hashlib
+import time
+from http import HTTPStatus
+from typing import Callable
+from flask import Response, current_app, make_response, request
+from flask_security import current_user
+
+from database import db
+from . import formats
+from . import models
+from .views_common import error_response
+
+HEADER = 'Idempotency-Key'
+REPLAYED_HEADER = 'Idempotent-Replayed'
+MAX_KEY_LENGTH = 255
+# Seconds between checks for the response of a request in progress
+POLL_INTERVAL = 0.05
+
+
+def request_fingerprint() -> str:
+    """Return a hash identifying the current request."""
+    fingerprint = hashlib.sha1()
+    fingerprint.update(f'{request.method} {request.path}\n'.encode('utf-8'))
+    fingerprint.update(request.get_data())
+    return fingerprint.hexdigest()
+
+
+def replay_response(record: models.IdempotencyKey) -> Response:
+    """Return the stored response for a key."""
+    body = record.response_body
+    if formats.is_binary(record.response_mimetype):
+        body = base64.b64decode(body)
+    response = Response(body, status=record.status_code,
+                        mimetype=record.response_mimetype)
+    response.headers[REPLAYED_HEADER] = 'true'
+    return response
+
+
+def wait_for_response(user_id: int, key: str) -> models.IdempotencyKey:
+    """Wait for another request with the same key to store its response.
+
+    Returns the key's record, which is None if the other request released
+    the key, or has no response if it is still in progress.
+    """
+    deadline = time.monotonic() + current_app.config['STUFFR_IDEMPOTENCY_WAIT']
+    while True:
+        record = models.IdempotencyKey.get_key(user_id, key)
+        if record is None or record.status_code is not None or time.monotonic() >= deadline:
+            return record
+        # End the read transaction so the next check sees new data
+        db.session.rollback()
+        time.sleep(POLL_INTERVAL)
+
+
+def idempotent(view: Callable) -> Callable:
+    """Decorator adding Idempotency-Key support to a view.
+
+    Must be applied after authentication, as keys are stored per user.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        """Handle the request unless its key has already been used."""
+        key = request.headers.get(HEADER)
+        if key is None:
+            return view(*args, **kwargs)
+        if not key or len(key) > MAX_KEY_LENGTH:
+            return error_response(f'{HEADER} must be 1 to {MAX_KEY_LENGTH} characters')
+
+        user_id = current_user.id
+        fingerprint = request_fingerprint()
+        ttl = datetime.timedelta(seconds=current_app.config['STUFFR_IDEMPOTENCY_KEY_TTL'])
+        lease = datetime.timedelta(seconds=current_app.config['STUFFR_IDEMPOTENCY_LEASE'])
+        while True:
+            record_id, record = models.IdempotencyKey.claim(user_id, key, fingerprint, ttl,
+                                                            lease)
+            if record_id is not None:
+                break
+            if record is not None and record.fingerprint != fingerprint:
+                return error_response(f'{HEADER} was already used for a different request',
+                                      HTTPStatus.UNPROCESSABLE_ENTITY)
+            if record is not None and record.status_code is None:
+                record = wait_for_response(user_id, key)
+            if record is None:
+                # Released by a request that failed, try to claim it again
+                continue
+            if record.status_code is None:
+                data, status, headers = error_response(
+                    'A request with this key is still in progress', HTTPStatus.CONFLICT)
+                headers['Retry-After'] = '1'
+                return data, status, headers
+            return replay_response(record)
+
+        try:
+            response = make_response(view(*args, **kwargs))
+        except BaseException:
+            models.IdempotencyKey.release(record_id)
+            raise
+        if response.status_code >= HTTPStatus.INTERNAL_SERVER_ERROR:
+            models.IdempotencyKey.release(record_id)
+        else:
+            if formats.is_binary(response.mimetype):
+                # Stored as text, like other responses
+                body = base64.b64encode(response.get_data()).decode('ascii')
+            else:
+                body = response.get_data(as_text=True)
+            models.IdempotencyKey.store_response(record_id, response.status_code, body,
+                                                 response.mimetype)
+        return response
+    return wrapper
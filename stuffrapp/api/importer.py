@@ -0,0 +1,250 @@
+"""Chunked, resumable bulk import of things from NDJSON or CSV.
+
+Input is parsed as a stream, one row at a time, so files of any size can be
+imported without being loaded into memory. Valid rows are inserted in chunks,
+each chunk committed in its own transaction together with a journal entry
+for each new thing and an update to the import's ImportCheckpoint. If an
+import fails partway through, sending the same file again with the same
+import key skips the rows that were already handled and continues from
+there.
+
+Rows are validated the same way as things posted through the API: unknown
+fields are dropped and required fields must be present. Rows that fail
+validation are skipped and reported, they do not stop the import. Input that
+is not UTF-8 or not readable as CSV stops the import with InvalidDataError,
+after the chunks before it were committed.
+
+Both formats accepted by the importer match the output of the exporter:
+
+* ndjson: One JSON object per line. Objects with a "type" other than
+  "thing" (e.g. inventory records in an export) are skipped.
+* csv: A header row followed by one row per thing. Empty cells are treated
+  as missing values.
+"""
+
+import csv
+import io
+import json
+from collections import abc
+from typing import Any, BinaryIO, Callable, Dict, Iterator, List, Optional, TextIO, Tuple
+import uuid
+from flask import current_app
+import sqlalchemy
+
+from database import db
+from . import errors
+from . import models
+from . import transactions
+
+IMPORT_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv'
+}
+# Columns of new things recorded in their journal entries
+JOURNAL_COLUMNS = [getattr(models.Thing, c)
+                   for c in sorted(models.Thing.CLIENT_FIELDS | {'inventory_id'})]
+# Limit on errors included in the result, to keep it a reasonable size
+MAX_REPORTED_ERRORS = 100
+
+ImportRecord = Tuple[int, Any]
+ProgressCallback = Callable[[models.ImportCheckpoint], None]
+
+
+# Parsing
+##########
+
+def _decode(stream: BinaryIO) -> TextIO:
+    """Return a reader of UTF-8 text from a binary stream.
+
+    Lines only end at \\n, \\r or \\r\\n, not at other Unicode line breaks
+    such as U+2028, which may appear in values. Line endings are left as
+    they are, as the csv module expects.
+    """
+    return io.TextIOWrapper(stream, encoding='utf-8', newline='')
+
+
+def iter_ndjson_records(stream: BinaryIO) -> Iterator[ImportRecord]:
+    """Yield (line number, record) for each non-blank line of NDJSON data.
+
+    Lines that are not valid JSON are yielded as an InvalidDataError instead
+    of a record, so they can be reported along with other invalid rows.
+    Raises InvalidDataError if the data is not UTF-8.
+    """
+    reader = _decode(stream)
+    line_number = 0
+    try:
+        for line_number, line in enumerate(reader, start=1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                record = errors.InvalidDataError(f'Invalid JSON: {e}')
+            yield line_number, record
+    except UnicodeDecodeError as e:
+        raise errors.InvalidDataError(f'Invalid UTF-8 after line {line_number}: {e.reason}')
+    finally:
+        # Leave the stream open for its owner
+        reader.detach()
+
+
+def iter_csv_records(stream: BinaryIO) -> Iterator[ImportRecord]:
+    """Yield (line number, record) for each row of CSV data.
+
+    Raises InvalidDataError if the data is not UTF-8 or not valid CSV.
+    """
+    text = _decode(stream)
+    reader = csv.DictReader(text)
+    try:
+        for record in reader:
+            yield reader.line_num, record
+    except UnicodeDecodeError as e:
+        raise errors.InvalidDataError(f'Invalid UTF-8 after line {reader.line_num}: {e.reason}')
+    except csv.Error as e:
+        raise errors.InvalidDataError(f'Invalid CSV on line {reader.line_num}: {e}')
+    finally:
+        text.detach()
+
+
+PARSERS = {
+    'ndjson': iter_ndjson_records,
+    'csv': iter_csv_records
+}
+
+
+def validate_thing_record(record: Any) -> Optional[Dict]:
+    """Return column data for a thing from an input record.
+
+    Returns None if the record is not a thing and should be skipped. Raises
+    InvalidDataError if it is not valid.
+    """
+    if isinstance(record, Exception):
+        raise record
+    if isinstance(record, abc.Mapping) and record.get('type', 'thing') != 'thing':
+        return None
+    clean_data = models.Thing.filter_user_input_dict(record)
+    # CSV can't tell the difference between empty and missing values
+    clean_data = {k: (None if v == '' else v) for k, v in clean_data.items()}
+    missing_fields = [f for f in sorted(models.Thing.REQUIRED_FIELDS)
+                      if clean_data.get(f) is None]
+    if missing_fields:
+        error = "Required field(s) missing: {}".format(', '.join(missing_fields))
+        raise errors.InvalidDataError(error)
+    for field, value in clean_data.items():
+        if value is not None and not isinstance(value, str):
+            error = f'Field {field} must be a string, got {type(value).__name__}'
+            raise errors.InvalidDataError(error)
+    return clean_data
+
+
+# Importing
+############
+
+def _commit_chunk(checkpoint: models.ImportCheckpoint, rows: List[Dict],
+                  rows_processed: int, num_errors: int, completed: bool = False) -> None:
+    """Insert a chunk of things and update the checkpoint in one transaction."""
+    def insert() -> None:
+        """Insert the rows, counting them in the checkpoint as loaded in the transaction."""
+        models.UserShard.route(checkpoint.user_id)
+        if rows:
+            # New rows get increasing IDs, and no one else can insert while
+            # the write holds the lock, so the chunk's rows are read back as
+            # the ones after the last ID
+            last_id = db.session.query(sqlalchemy.func.max(models.Thing.id)).scalar() or 0
+            db.session.execute(models.Thing.__table__.insert(), rows)
+            inserted = db.session.query(*JOURNAL_COLUMNS). \
+                filter(models.Thing.id > last_id). \
+                order_by(models.Thing.id)
+            for row in inserted:
+                changes = row._asdict()
+                models.JournalEntry.record(checkpoint.user_id, 'thing', changes.pop('id'),
+                                           'created', changes)
+        checkpoint.rows_processed += rows_processed
+        checkpoint.rows_imported += len(rows)
+        checkpoint.num_errors += num_errors
+        if completed:
+            checkpoint.date_completed = models.utc_now()
+    transactions.write(insert, models.Thing, models.ImportCheckpoint)
+
+
+def import_things(stream: BinaryIO, import_format: str, inventory_id: int, user_id: int,
+                  import_key: str = None, chunk_size: int = None,
+                  progress: ProgressCallback = None) -> Dict:
+    """Import things from a stream of NDJSON or CSV data into an inventory.
+
+    Parameters:
+        stream:
+            Binary file-like object containing the data to import.
+        import_format:
+            Either 'ndjson' or 'csv'.
+        inventory_id:
+            ID of the inventory things are imported to.
+        user_id:
+            ID of the user performing the import, must own the inventory.
+        import_key:
+            Identifies the import for resuming. If the user already started
+            an import with this key, rows it handled are skipped. A new key
+            is generated if not given.
+        chunk_size:
+            Number of input rows handled per transaction. Defaults to the
+            STUFFR_IMPORT_CHUNK_SIZE setting.
+        progress:
+            Called with the checkpoint after each committed chunk.
+
+    Returns a dict summarizing the import, including a list of errors for
+    rows that were not imported.
+    """
+    if import_format not in PARSERS:
+        error = 'Unknown import format {}, must be one of: {}'.format(
+            import_format, ', '.join(sorted(PARSERS)))
+        raise errors.InvalidDataError(error)
+    if chunk_size is None:
+        chunk_size = current_app.config['STUFFR_IMPORT_CHUNK_SIZE']
+    if chunk_size < 1:
+        raise errors.InvalidDataError('Chunk size must be at least 1')
+    models.Inventory.check_user_access(inventory_id, user_id)
+    if import_key is None:
+        import_key = uuid.uuid4().hex
+    checkpoint = models.ImportCheckpoint.get_or_create(import_key, inventory_id, user_id)
+    resumed_from = checkpoint.rows_processed
+    row_errors = []
+
+    if checkpoint.date_completed is None:
+        rows = []
+        chunk_processed = 0
+        chunk_errors = 0
+        for record_number, (line_number, record) in enumerate(PARSERS[import_format](stream)):
+            if record_number < resumed_from:
+                continue
+            chunk_processed += 1
+            try:
+                thing_data = validate_thing_record(record)
+            except errors.InvalidDataError as e:
+                chunk_errors += 1
+                if len(row_errors) < MAX_REPORTED_ERRORS:
+                    row_errors.append({'row': line_number, 'message': e.args[0]})
+            else:
+                if thing_data is not None:
+                    now = models.utc_now()
+                    thing_data.update(inventory_id=inventory_id,
+                                      date_created=now, date_modified=now)
+                    rows.append(thing_data)
+            if chunk_processed >= chunk_size:
+                _commit_chunk(checkpoint, rows, chunk_processed, chunk_errors)
+                if progress is not None:
+                    progress(checkpoint)
+                rows = []
+                chunk_processed = 0
+                chunk_errors = 0
+        _commit_chunk(checkpoint, rows, chunk_processed, chunk_errors, completed=True)
+        if progress is not None:
+            progress(checkpoint)
+
+    return {
+        'import_id': checkpoint.import_key,
+        'resumed_from': resumed_from,
+        'rows_processed': checkpoint.rows_processed,
+        'rows_imported': checkpoint.rows_imported,
+        'num_errors': checkpoint.num_errors,
+        'errors': row_errors
+    }
@@ -18,13 +18,18 @@ practice.
 
 from collections import abc
 import datetime
-from typing import List, Mapping, Sequence, Set
+import json
+from typing import Any, Callable, Dict, Iterable, List, Mapping, Optional, Sequence, Set, Tuple
+from flask import current_app
 import flask_security
+import flask_sqlalchemy
 import sqlalchemy
 from sqlalchemy_utc import UtcDateTime
 
 from database import db
 from . import errors
+from . import events
+from . import transactions
 
 # TODO: Increment this once the database layout settles down
 DATABASE_VERSION = 0
@@ -35,6 +40,36 @@ def get_entity_names(entities: Sequence) -> Set:
     return {c.key for c in entities}
 
 
+def _json_default(value: Any) -> str:
+    """Convert datetimes for JSON encoding of stored data."""
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    raise TypeError("JSON: Cannot serialize {}".format(type(value)))
+
+
+def utc_now() -> datetime.datetime:
+    """Return the current time in UTC, used for column defaults."""
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def sort_key(value: Optional[str]) -> Optional[str]:
+    """Return the key used to sort text case-insensitively."""
+    return None if value is None else str(value).casefold()
+
+
+def _name_sort_key(context) -> str:
+    """Column default with the sort key for the name being inserted."""
+    return sort_key(context.current_parameters['name'])
+
+
+def _prefix_filter(column: sqlalchemy.Column, prefix: str) -> sqlalchemy.sql.ClauseElement:
+    """Return a filter for values of column starting with prefix.
+
+    Unlike LIKE, the range comparison can use an index on the column.
+    """
+    return sqlalchemy.and_(column >= prefix, column < prefix + '\U0010ffff')
+
+
 # Models
 #########
 
@@ -63,9 +98,44 @@ class BaseModel(db.Model):
         return {c.key: getattr(self, c.key)
                 for c in sqlalchemy.inspect(self).mapper.column_attrs}
 
-    def as_client_dict(self) -> Mapping:
-        """Return fields as a dict, filtered for clients."""
-        return {k: v for k, v in self._asdict().items() if k in self.CLIENT_FIELDS}
+    def as_client_dict(self, fields: Iterable[str] = None) -> Mapping:
+        """Return fields as a dict, filtered for clients.
+
+        If fields is given, only those fields are included and read, so
+        columns that were not loaded are not loaded now.
+        """
+        if fields is None:
+            return self.filter_client_dict(self._asdict())
+        return {f: getattr(self, f) for f in fields}
+
+    def insert_new(self, after_insert: Callable[[Mapping], None] = None) -> Mapping:
+        """Add a new object to the session and INSERT it, in a write transaction.
+
+        Returns the column values the object has after the INSERT, including
+        its generated ID. Pass them to keep_values() once the transaction is
+        committed, so reading them does not reload the row. Columns left out
+        of the INSERT are NULL unless they have a server default, which would
+        still be read back, so managed columns should be given their values
+        in Python.
+
+        Parameters:
+            after_insert:
+                Called with the dict of column values, to make other changes
+                in the same transaction.
+        """
+        db.session.add(self)
+        db.session.flush()
+        state = sqlalchemy.inspect(self)
+        values = {c.key: state.dict.get(c.key) for c in state.mapper.column_attrs
+                  if c.key in state.dict or c.columns[0].server_default is None}
+        if after_insert is not None:
+            after_insert(values)
+        return values
+
+    def keep_values(self, values: Mapping) -> None:
+        """Set the column values of a committed object, see insert_new()."""
+        for key, value in values.items():
+            sqlalchemy.orm.attributes.set_committed_value(self, key, value)
 
     @classmethod
     def id_exists(cls, item_id: int) -> bool:
@@ -77,6 +147,39 @@ class BaseModel(db.Model):
         """Return SQLAlchemy entities used by clients."""
         return {getattr(cls, f) for f in cls.CLIENT_FIELDS}
 
+    @classmethod
+    def parse_client_fields(cls, fields: Optional[str]) -> Optional[List[str]]:
+        """Parse a comma separated list of client fields from a query string.
+
+        Returns None if no list is given, meaning all client fields.
+        """
+        if fields is None:
+            return None
+        names = [f.strip() for f in fields.split(',') if f.strip()]
+        if not names:
+            raise errors.InvalidDataError('No fields requested')
+        unknown_fields = [f for f in names if f not in cls.CLIENT_FIELDS]
+        if unknown_fields:
+            error = 'Unknown field(s) requested: {}'.format(', '.join(unknown_fields))
+            raise errors.InvalidDataError(error)
+        # Remove duplicates, keeping the order
+        return list(dict.fromkeys(names))
+
+    @classmethod
+    def load_fields(cls, fields: Optional[Sequence[str]]) -> sqlalchemy.orm.Load:
+        """Return a query option loading only the given fields, or all if None.
+
+        Other columns (except the ID) are deferred until accessed.
+        """
+        if fields is None:
+            return sqlalchemy.orm.Load(cls).undefer('*')
+        return sqlalchemy.orm.Load(cls).load_only(*fields)
+
+    @classmethod
+    def filter_client_dict(cls, data: Mapping) -> dict:
+        """Filter a dict of column values to contain only client fields."""
+        return {k: v for k, v in data.items() if k in cls.CLIENT_FIELDS}
+
     @classmethod
     def filter_user_input_dict(cls, data: Mapping) -> dict:
         """Take a dict with model object data and remove non-user fields."""
@@ -96,8 +199,7 @@ class DatabaseInfo(BaseModel):
 
     creator_name = db.Column(db.Unicode(length=32), nullable=False)
     creator_version = db.Column(db.Unicode(length=32), nullable=False)
-    date_created = db.Column(UtcDateTime, nullable=False,
-                             default=datetime.datetime.now(datetime.timezone.utc))
+    date_created = db.Column(UtcDateTime, nullable=False, default=utc_now)
     # Database schema version - value incremented when a breaking change is made
     database_version = db.Column(db.Integer, nullable=False,
                                  default=DATABASE_VERSION)
@@ -127,8 +229,7 @@ class User(BaseModel, flask_security.UserMixin):
     password = db.Column(db.Unicode(length=128), nullable=False)
     name_first = db.Column(db.Unicode(length=128), nullable=False)
     name_last = db.Column(db.Unicode(length=128), nullable=False)
-    date_created = db.Column(UtcDateTime, nullable=False,
-                             default=datetime.datetime.now(datetime.timezone.utc))
+    date_created = db.Column(UtcDateTime, nullable=False, default=utc_now)
     active = db.Column(db.Boolean)
     confirmed_at = db.Column(UtcDateTime)
     last_login_at = db.Column(UtcDateTime)
@@ -164,15 +265,106 @@ class Role(BaseModel, flask_security.RoleMixin):
         return "<Role name='{}'>".format(self.email)
 
 
+class UserShard(BaseModel):
+    """Entry of the shard map, giving the shard holding a user's data.
+
+    When STUFFR_SHARDS lists the bind keys of shard databases, sharded
+    tables (inventories, things and the tables belonging to them) are split
+    between the shards by user, and everything else stays in the main
+    database. Users without an entry, e.g. those created before sharding was
+    enabled, keep their data in the main database. See shards.py for moving
+    users between shards.
+
+    Each shard allocates IDs from its own range of ID_RANGE IDs, so IDs are
+    unique across all databases, and rows moved to a shard are given new
+    IDs in its range. The range of a
+    shard depends on its position in STUFFR_SHARDS, so new shards must be
+    added at the end.
+    """
+
+    ID_RANGE = 2 ** 40
+    # Key of the cached shard map entries in a session's info dict
+    SESSION_KEY = 'stuffr_user_shards'
+
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, unique=True)
+    # Bind key of the shard
+    shard = db.Column(db.Unicode(length=64), nullable=False)
+
+    def __repr__(self) -> str:
+        """Basic UserShard data as a string."""
+        return "<UserShard user_id={} shard='{}'>".format(self.user_id, self.shard)
+
+    @staticmethod
+    def get_shards() -> List[str]:
+        """Return the bind keys of the shards, empty if sharding is disabled."""
+        return list(current_app.config['STUFFR_SHARDS'] or [])
+
+    @classmethod
+    def first_id(cls, shard: Optional[str]) -> int:
+        """Return the start of a shard's ID range, None is the main database."""
+        if shard is None:
+            return 0
+        return (cls.get_shards().index(shard) + 1) * cls.ID_RANGE
+
+    @classmethod
+    def get_shard(cls, user_id: int) -> Optional[str]:
+        """Return the shard holding a user's data, None for the main database."""
+        return db.session.query(cls.shard).filter(cls.user_id == user_id).scalar()
+
+    @classmethod
+    def route(cls, user_id: int) -> Optional[str]:
+        """Send queries on sharded tables to the shard holding a user's data.
+
+        The selected shard is kept until the session is closed. The shard map
+        is read once per session for each user. Returns the shard.
+
+        In a write transaction (see transactions.write()), the shard's write
+        lock is taken and the map is read again, so a write that waited for
+        a move of the user's data goes to the shard the data was moved to.
+        """
+        if not current_app.config['STUFFR_SHARDS']:
+            return None
+        session = db.session()
+        cached = session.info.setdefault(cls.SESSION_KEY, {})
+        if user_id not in cached:
+            cached[user_id] = cls.get_shard(user_id)
+        session.use_shard(cached[user_id])
+        while session.info.get(transactions.WRITE_KEY) is not None:
+            session.connection(mapper=sqlalchemy.inspect(Inventory))
+            shard = cls.get_shard(user_id)
+            if shard == cached[user_id]:
+                break
+            cached[user_id] = shard
+            session.use_shard(shard)
+        return cached[user_id]
+
+    @classmethod
+    def assign(cls, user_id: int) -> Optional[str]:
+        """Add a new user to the shard with the fewest users.
+
+        The entry is added to the session without committing it. Returns
+        the shard, or None if sharding is disabled.
+        """
+        shards = cls.get_shards()
+        if not shards:
+            return None
+        num_users = dict(db.session.query(cls.shard, sqlalchemy.func.count(cls.id)).
+                         group_by(cls.shard))
+        shard = min(shards, key=lambda s: num_users.get(s, 0))
+        db.session.add(cls(user_id=user_id, shard=shard))
+        return shard
+
+
 # Stuffr data models
 
 class Inventory(BaseModel):
     """Model for a collection of things."""
 
+    __table_args__ = {'info': {'sharded': True}}
+
     # Columns
     name = db.Column(db.Unicode(length=128), nullable=False)
-    date_created = db.Column(UtcDateTime, nullable=False,
-                             default=datetime.datetime.now(datetime.timezone.utc))
+    date_created = db.Column(UtcDateTime, nullable=False, default=utc_now)
     # Relationships
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     things = db.relationship('Thing', backref='inventory', lazy='dynamic')
@@ -188,31 +380,91 @@ class Inventory(BaseModel):
     @classmethod
     def get_user_inventories(cls, user_id: int) -> List['Inventory']:
         """Return all inventories belonging to specified user."""
+        UserShard.route(user_id)
         if not db.session.query(sqlalchemy.sql.exists().where(User.id == user_id)).scalar():
             error = f'User #{user_id} does not exist'
             raise errors.ItemNotFoundError(error)
         inventories = cls.query.filter_by(user_id=user_id).all()
         return inventories
 
+    @classmethod
+    def get_user_inventories_page(cls, user_id: int, page: int,
+                                  per_page: int) -> flask_sqlalchemy.Pagination:
+        """Return one page of a user's inventories, ordered by ID.
+
+        Only the ID and name of each inventory are loaded.
+        """
+        UserShard.route(user_id)
+        query = db.session.query(cls.id, cls.name). \
+            filter(cls.user_id == user_id). \
+            order_by(cls.id)
+        return query.paginate(page, per_page, error_out=False)
+
+    @classmethod
+    def check_user_access(cls, inventory_id: int, user_id: int) -> None:
+        """Check that an inventory exists and belongs to the specified user.
+
+        Raises ItemNotFoundError or UserPermissionError if it does not.
+        """
+        UserShard.route(user_id)
+        owner_id = db.session.query(cls.user_id).filter(cls.id == inventory_id).scalar()
+        if owner_id is None:
+            error = f'Inventory #{inventory_id} does not exist'
+            raise errors.ItemNotFoundError(error)
+        elif owner_id != user_id:
+            error = f'User #{user_id} does not have permission to access Inventory #{inventory_id}'
+            raise errors.UserPermissionError(error)
+
+    @classmethod
+    def check_user_access_many(cls, inventory_ids: Sequence[int],
+                               user_id: int) -> Dict[int, Exception]:
+        """Check that several inventories exist and belong to a user, with one query.
+
+        Returns a dict mapping the IDs of the inventories the user can't
+        access to the error check_user_access() would raise for them.
+        """
+        UserShard.route(user_id)
+        owner_ids = dict(db.session.query(cls.id, cls.user_id).filter(cls.id.in_(inventory_ids)))
+        access_errors = {}
+        for inventory_id in inventory_ids:
+            owner_id = owner_ids.get(inventory_id)
+            if owner_id is None:
+                error = f'Inventory #{inventory_id} does not exist'
+                access_errors[inventory_id] = errors.ItemNotFoundError(error)
+            elif owner_id != user_id:
+                error = (f'User #{user_id} does not have permission to access '
+                         f'Inventory #{inventory_id}')
+                access_errors[inventory_id] = errors.UserPermissionError(error)
+        return access_errors
+
     @classmethod
     def create_new_inventory(cls, inventory_data: Mapping, user_id: int) -> 'Inventory':
         """Create a new inventory based on inventory_data."""
-        if not db.session.query(sqlalchemy.sql.exists().where(User.id == user_id)).scalar():
-            error = f'User #{user_id} does not exist'
-            raise errors.ItemNotFoundError(error)
-        clean_data = cls.filter_user_input_dict(inventory_data)
-        if not cls.REQUIRED_FIELDS.issubset(clean_data):
-            missing_fields = [f for f in cls.REQUIRED_FIELDS
-                              if f not in inventory_data]
-            error = "Required field(s) missing: {}".format(', '.join(missing_fields))
-            raise errors.InvalidDataError(error)
-        inventory = cls(user_id=user_id, **clean_data)
-        db.session.add(inventory)
+        def record_created(values: Mapping) -> None:
+            """Add the journal entry for the new inventory."""
+            changes = cls.filter_client_dict(values)
+            JournalEntry.record(user_id, 'inventory', changes.pop('id'), 'created', changes)
+
+        def create() -> Tuple['Inventory', Mapping]:
+            """Check the input and insert the inventory."""
+            UserShard.route(user_id)
+            if not db.session.query(sqlalchemy.sql.exists().where(User.id == user_id)).scalar():
+                error = f'User #{user_id} does not exist'
+                raise errors.ItemNotFoundError(error)
+            clean_data = cls.filter_user_input_dict(inventory_data)
+            if not cls.REQUIRED_FIELDS.issubset(clean_data):
+                missing_fields = [f for f in cls.REQUIRED_FIELDS
+                                  if f not in inventory_data]
+                error = "Required field(s) missing: {}".format(', '.join(missing_fields))
+                raise errors.InvalidDataError(error)
+            inventory = cls(user_id=user_id, date_created=utc_now(), **clean_data)
+            return inventory, inventory.insert_new(record_created)
         try:
-            db.session.commit()
+            inventory, values = transactions.write(create, cls, group=True)
         except sqlalchemy.exc.IntegrityError as e:
             error = 'Database error: {}'.format(e.orig)
             raise errors.InvalidDataError(error)
+        inventory.keep_values(values)
         return inventory
 
 
@@ -221,17 +473,26 @@ class Thing(BaseModel):
 
     # Columns
     name = db.Column(db.Unicode(length=128), nullable=False)
-    date_created = db.Column(UtcDateTime, nullable=False,
-                             default=datetime.datetime.now(datetime.timezone.utc))
+    date_created = db.Column(UtcDateTime, nullable=False, default=utc_now)
     date_modified = db.Column(UtcDateTime, nullable=False,
-                              default=datetime.datetime.now(datetime.timezone.utc),
-                              onupdate=datetime.datetime.now(datetime.timezone.utc))
+                              default=utc_now, onupdate=utc_now)
     date_deleted = db.Column(UtcDateTime)
     location = db.Column(db.Unicode(length=128))
-    details = db.Column(db.UnicodeText)
+    # Can be large, so only loaded when used
+    details = db.deferred(db.Column(db.UnicodeText))
+    # Case-insensitive version of name for sorting, set from name
+    name_key = db.Column(db.Unicode(length=128), nullable=False, default=_name_sort_key)
     # Relationships
     inventory_id = db.Column(db.Integer, db.ForeignKey('inventory.id'),
                              nullable=False)
+    # Indexes for sorting and filtering things in an inventory
+    __table_args__ = (
+        db.Index('ix_thing_inventory_id_name_key', 'inventory_id', 'name_key'),
+        db.Index('ix_thing_inventory_id_location', 'inventory_id', 'location'),
+        db.Index('ix_thing_inventory_id_date_created', 'inventory_id', 'date_created'),
+        db.Index('ix_thing_inventory_id_date_modified', 'inventory_id', 'date_modified'),
+        {'info': {'sharded': True}}
+    )
     # Other data
     CLIENT_FIELDS = {
         'id', 'name',
@@ -239,14 +500,44 @@ class Thing(BaseModel):
         'location', 'details'}
     USER_FIELDS = {'name', 'location', 'details'}
     REQUIRED_FIELDS = {'name'}
+    # Fields things can be sorted by, and the columns they are sorted on
+    SORT_FIELDS = {
+        'name': 'name_key',
+        'date_created': 'date_created',
+        'date_modified': 'date_modified',
+        'location': 'location'}
+    # Filters for things and the types of their values
+    FILTERS = {
+        'location': str,
+        'location_prefix': str,
+        'name_prefix': str,
+        'created_after': datetime.datetime,
+        'created_before': datetime.datetime,
+        'modified_after': datetime.datetime,
+        'modified_before': datetime.datetime}
 
     def __repr__(self) -> str:
         """Basic Thing data as a string."""
         return "<Thing name='{}'>".format(self.name)
 
     @classmethod
-    def get_things_for_inventory(cls, inventory_id: int, user_id: int) -> List['Thing']:
-        """Return all things belonging to specified inventory."""
+    def get_things_for_inventory(cls, inventory_id: int, user_id: int,
+                                 fields: Sequence[str] = None, sort: str = None,
+                                 filters: Mapping = None) -> List['Thing']:
+        """Return all things belonging to specified inventory.
+
+        Parameters:
+            fields:
+                If given, only those columns are loaded.
+            sort:
+                Field in SORT_FIELDS to sort by, prefixed with "-" for
+                descending order. Things are in ID order by default, and
+                things with the same value in ID order.
+            filters:
+                Values of FILTERS things have to match. Ranges of dates
+                include the start and exclude the end.
+        """
+        UserShard.route(user_id)
         if not Inventory.id_exists(inventory_id):
             error = 'Inventory #{} does not exist'.format(inventory_id)
             raise errors.ItemNotFoundError(error)
@@ -258,20 +549,160 @@ class Thing(BaseModel):
             error = 'User #{} does not have permission to get things from Inventory #{}'.format(
                 user_id, inventory_id)
             raise errors.UserPermissionError(error)
-        things = cls.query.filter_by(date_deleted=None, inventory_id=inventory_id).all()
+        query = cls.query.filter_by(date_deleted=None, inventory_id=inventory_id). \
+            options(cls.load_fields(fields))
+        query = cls._filter_query(query, filters or {})
+        things = query.order_by(*cls._sort_order(sort)).all()
+        return things
+
+    @classmethod
+    def get_things_for_inventories(cls, inventory_ids: Sequence[int],
+                                   fields: Sequence[str] = None,
+                                   limit: int = None) -> Dict[int, List['Thing']]:
+        """Return the things in several inventories, grouped by inventory ID.
+
+        All things are fetched with one query, in ID order. Access to the
+        inventories is not checked, so they are read from the shard of the
+        user whose access was checked last. If fields is given, only those columns
+        are loaded. If limit is given, only the oldest things of each
+        inventory are returned, at most that many.
+        """
+        things = {i: [] for i in inventory_ids}
+        if not things:
+            return things
+        if fields is not None:
+            # Needed to group the things
+            fields = list(fields) + ['inventory_id']
+        if limit is None:
+            query = cls.query.filter(cls.inventory_id.in_(things), cls.date_deleted.is_(None))
+        else:
+            # The first things of each inventory are read from the
+            # (inventory_id, date_created) index, once per inventory
+            first_things = sqlalchemy.orm.aliased(cls)
+            first_ids = db.session.query(first_things.id). \
+                filter(first_things.inventory_id == Inventory.id,
+                       first_things.date_deleted.is_(None)). \
+                order_by(first_things.date_created, first_things.id). \
+                limit(limit)
+            query = cls.query.join(Inventory, cls.id.in_(first_ids)). \
+                filter(Inventory.id.in_(things))
+        query = query.options(cls.load_fields(fields)).order_by(cls.id)
+        for thing in query:
+            things[thing.inventory_id].append(thing)
         return things
 
     @classmethod
-    def get_thing(cls, thing_id: int, user_id: int) -> 'Thing':
-        """Return all information for specified thing."""
-        thing = cls.query.get(thing_id)
-        if thing is None:
+    def _sort_order(cls, sort: Optional[str]) -> List[sqlalchemy.sql.ClauseElement]:
+        """Return the ORDER BY clauses for a sort parameter."""
+        if sort is None:
+            return [cls.id]
+        field = sort[1:] if sort.startswith('-') else sort
+        if field not in cls.SORT_FIELDS:
+            error = 'Cannot sort by {}, must be one of: {}'.format(
+                field, ', '.join(sorted(cls.SORT_FIELDS)))
+            raise errors.InvalidDataError(error)
+        column = getattr(cls, cls.SORT_FIELDS[field])
+        if sort.startswith('-'):
+            return [column.desc(), cls.id.desc()]
+        return [column, cls.id]
+
+    @classmethod
+    def _filter_query(cls, query: flask_sqlalchemy.BaseQuery,
+                      filters: Mapping) -> flask_sqlalchemy.BaseQuery:
+        """Add the filters to a query of things."""
+        unknown_filters = [f for f in filters if f not in cls.FILTERS]
+        if unknown_filters:
+            error = 'Unknown filter(s): {}'.format(', '.join(unknown_filters))
+            raise errors.InvalidDataError(error)
+        for name, value in filters.items():
+            if not isinstance(value, cls.FILTERS[name]):
+                error = f'Filter {name} must be a {cls.FILTERS[name].__name__}'
+                raise errors.InvalidDataError(error)
+        if 'location' in filters:
+            query = query.filter(cls.location == filters['location'])
+        if 'location_prefix' in filters:
+            query = query.filter(_prefix_filter(cls.location, filters['location_prefix']))
+        if 'name_prefix' in filters:
+            query = query.filter(_prefix_filter(cls.name_key, sort_key(filters['name_prefix'])))
+        if 'created_after' in filters:
+            query = query.filter(cls.date_created >= filters['created_after'])
+        if 'created_before' in filters:
+            query = query.filter(cls.date_created < filters['created_before'])
+        if 'modified_after' in filters:
+            query = query.filter(cls.date_modified >= filters['modified_after'])
+        if 'modified_before' in filters:
+            query = query.filter(cls.date_modified < filters['modified_before'])
+        return query
+
+    @classmethod
+    def get_thing_summaries_page(cls, inventory_id: int, user_id: int, page: int,
+                                 per_page: int) -> flask_sqlalchemy.Pagination:
+        """Return one page of things in an inventory, ordered by ID.
+
+        Only the ID, name and modification date of each thing are loaded,
+        which is enough to list things and check whether they changed.
+        """
+        Inventory.check_user_access(inventory_id, user_id)
+        query = db.session.query(cls.id, cls.name, cls.date_modified). \
+            filter(cls.inventory_id == inventory_id, cls.date_deleted.is_(None)). \
+            order_by(cls.id)
+        return query.paginate(page, per_page, error_out=False)
+
+    @classmethod
+    def get_thing_counts(cls, user_id: int) -> Mapping:
+        """Return the number of things per inventory and per location for a user.
+
+        Deleted things are not counted. Returns a dict with "inventories",
+        mapping the IDs of all of the user's inventories (including empty
+        ones) to counts, and "locations", mapping each location (None for
+        things without one) to counts across all inventories.
+        """
+        UserShard.route(user_id)
+        by_inventory = db.session.query(Inventory.id, sqlalchemy.func.count(cls.id)). \
+            outerjoin(cls, sqlalchemy.and_(cls.inventory_id == Inventory.id,
+                                           cls.date_deleted.is_(None))). \
+            filter(Inventory.user_id == user_id). \
+            group_by(Inventory.id)
+        by_location = db.session.query(cls.location, sqlalchemy.func.count(cls.id)). \
+            join(Inventory, cls.inventory_id == Inventory.id). \
+            filter(Inventory.user_id == user_id, cls.date_deleted.is_(None)). \
+            group_by(cls.location)
+        return {'inventories': dict(by_inventory.all()),
+                'locations': dict(by_location.all())}
+
+    @classmethod
+    def get_inventory_version(cls, inventory_id: int) -> Tuple[int, datetime.datetime]:
+        """Return values that change whenever things in an inventory change.
+
+        Returns a tuple with the number of things (including deleted things)
+        and the latest modification date. Deleting a thing also updates its
+        modification date. The date is None for an empty inventory. Like
+        get_things_for_inventories(), it is read from the current shard.
+        """
+        return db.session.query(sqlalchemy.func.count(cls.id),
+                                sqlalchemy.func.max(cls.date_modified)). \
+            filter(cls.inventory_id == inventory_id).one()
+
+    @classmethod
+    def get_thing(cls, thing_id: int, user_id: int, fields: Sequence[str] = None) -> 'Thing':
+        """Return all information for specified thing.
+
+        The thing and its owner are fetched with a single query. Whether the
+        user exists is only checked if they don't own the thing. If fields is
+        given, only those columns are loaded.
+        """
+        UserShard.route(user_id)
+        result = db.session.query(cls, Inventory.user_id). \
+            join(Inventory, cls.inventory_id == Inventory.id). \
+            filter(cls.id == thing_id).options(cls.load_fields(fields)).first()
+        if result is None:
             error = f'Thing #{thing_id} does not exist'
             raise errors.ItemNotFoundError(error)
-        if not db.session.query(sqlalchemy.sql.exists().where(User.id == user_id)).scalar():
-            error = f'User #{user_id} does not exist'
-            raise errors.ItemNotFoundError(error)
-        elif thing.inventory.user_id != user_id:
+        thing, owner_id = result
+        if owner_id != user_id:
+            if not db.session.query(sqlalchemy.sql.exists().where(User.id == user_id)).scalar():
+                error = f'User #{user_id} does not exist'
+                raise errors.ItemNotFoundError(error)
             error = f'User #{user_id} does not have permission to read Thing #{thing_id}'
             raise errors.UserPermissionError(error)
         return thing
@@ -279,76 +710,599 @@ class Thing(BaseModel):
     @classmethod
     def create_new_thing(cls, thing_data: Mapping, inventory_id: int, user_id: int) -> 'Thing':
         """Create a new thing."""
-        # Sanity check of input
-        if not Inventory.id_exists(inventory_id):
-            raise errors.ItemNotFoundError('No Inventory with id {}'.format(inventory_id))
-        if not db.session.query(sqlalchemy.sql.exists().where(User.id == user_id)).scalar():
-            error = f'User #{user_id} does not exist'
-            raise errors.ItemNotFoundError(error)
-        if Inventory.query.get(inventory_id).user_id != user_id:
-            raise errors.UserPermissionError('Inventory #{} does not belong to user #{}'.format(
-                inventory_id, user_id))
-        clean_data = cls.filter_user_input_dict(thing_data)
-        if not cls.REQUIRED_FIELDS.issubset(clean_data):
-            missing_fields = [f for f in cls.REQUIRED_FIELDS
-                              if f not in thing_data]
-            error = "Required field(s) missing: {}".format(', '.join(missing_fields))
-            raise errors.InvalidDataError(error)
+        def record_created(values: Mapping) -> None:
+            """Add the journal entry for the new thing."""
+            changes = dict(cls.filter_client_dict(values), inventory_id=inventory_id)
+            JournalEntry.record(user_id, 'thing', changes.pop('id'), 'created', changes)
 
-        # Create the thing
-        thing = cls(inventory_id=inventory_id, **clean_data)
-        db.session.add(thing)
+        def create() -> Tuple['Thing', Mapping]:
+            """Check the input and insert the thing."""
+            UserShard.route(user_id)
+            # Sanity check of input
+            owner_id = db.session.query(Inventory.user_id). \
+                filter(Inventory.id == inventory_id).scalar()
+            if owner_id is None:
+                raise errors.ItemNotFoundError('No Inventory with id {}'.format(inventory_id))
+            if owner_id != user_id:
+                if not db.session.query(
+                        sqlalchemy.sql.exists().where(User.id == user_id)).scalar():
+                    error = f'User #{user_id} does not exist'
+                    raise errors.ItemNotFoundError(error)
+                raise errors.UserPermissionError(
+                    'Inventory #{} does not belong to user #{}'.format(inventory_id, user_id))
+            clean_data = cls.filter_user_input_dict(thing_data)
+            if not cls.REQUIRED_FIELDS.issubset(clean_data):
+                missing_fields = [f for f in cls.REQUIRED_FIELDS
+                                  if f not in thing_data]
+                error = "Required field(s) missing: {}".format(', '.join(missing_fields))
+                raise errors.InvalidDataError(error)
+
+            # Create the thing
+            now = utc_now()
+            thing = cls(inventory_id=inventory_id, date_created=now, date_modified=now,
+                        **clean_data)
+            return thing, thing.insert_new(record_created)
         try:
-            db.session.commit()
+            thing, values = transactions.write(create, cls, group=True)
         except sqlalchemy.exc.IntegrityError as e:
             error = 'Database error: {}'.format(e.orig)
             raise errors.InvalidDataError(error)
+        thing.keep_values(values)
         return thing
 
     @classmethod
-    def update_thing(cls, thing_id: int, update_data: Mapping, user_id: int) -> dict:
+    def update_thing(cls, thing_id: int, update_data: Mapping, user_id: int,
+                     expected_date_modified: datetime.datetime = None) -> dict:
         """Update thing with new data.
 
         Afer updating, returns data that changed (including server-managed
-        fields such as date_updated).
-        """
-        thing = cls.query.get(thing_id)
-        if thing is None:
-            error = 'Thing #{} does not exist'.format(thing_id)
-            raise errors.ItemNotFoundError(error)
-        if not db.session.query(sqlalchemy.sql.exists().where(User.id == user_id)).scalar():
-            error = f'User #{user_id} does not exist'
-            raise errors.ItemNotFoundError(error)
-        elif thing.inventory.user_id != user_id:
-            error = 'User #{} does not have permission to modify Thing #{}'.format(
-                user_id, thing_id)
-            raise errors.UserPermissionError(error)
+        fields such as date_modified).
+
+        The update is a single UPDATE statement, with the ownership check in
+        its WHERE clause. The modification date is set explicitly, so it is
+        known without reading the thing back. Only if nothing was updated is
+        the database queried to find out why.
 
+        Parameters:
+            expected_date_modified:
+                If given, the thing is only updated if its modification date
+                still matches, otherwise PreconditionFailedError is raised.
+        """
+        UserShard.route(user_id)
         # Filter only desired fields
         clean_data = cls.filter_user_input_dict(update_data)
+        if not clean_data:
+            # Nothing to change, don't touch the modification date
+            thing = cls.get_thing(thing_id, user_id, fields=['date_modified'])
+            cls._check_date_modified(thing, expected_date_modified)
+            return {'date_modified': thing.date_modified}
+
+        date_modified = utc_now()
+        values = dict(clean_data, date_modified=date_modified)
+        if 'name' in clean_data:
+            values['name_key'] = sort_key(clean_data['name'])
 
-        for field, value in clean_data.items():
-            setattr(thing, field, value)
+        def update() -> int:
+            """Update the thing if the user owns it, returning the number updated."""
+            UserShard.route(user_id)
+            owned_inventories = db.session.query(Inventory.id). \
+                filter(Inventory.user_id == user_id)
+            query = cls.query.filter(cls.id == thing_id, cls.inventory_id.in_(owned_inventories))
+            if expected_date_modified is not None:
+                query = query.filter(cls.date_modified == expected_date_modified)
+            num_updated = query.update(values, synchronize_session=False)
+            if num_updated:
+                JournalEntry.record(user_id, 'thing', thing_id, 'updated',
+                                    dict(clean_data, date_modified=date_modified))
+            return num_updated
         try:
-            db.session.commit()
+            num_updated = transactions.write(update, cls, group=True)
         except sqlalchemy.exc.IntegrityError as e:
             error = 'Database error: {}'.format(e.orig)
             raise errors.InvalidDataError(error)
 
-        # Get the modified data
-        clean_data.update({'date_modified': thing.date_modified})
+        if not num_updated:
+            # Raises the appropriate error if the thing is missing or not owned
+            thing = cls.get_thing(thing_id, user_id, fields=['date_modified'])
+            cls._check_date_modified(thing, expected_date_modified)
+            # The thing changed between the UPDATE and the checks above
+            error = f'Thing #{thing_id} was modified while it was being updated'
+            raise errors.PreconditionFailedError(error)
+
+        clean_data.update({'date_modified': date_modified})
         return clean_data
 
+    @staticmethod
+    def _check_date_modified(thing: 'Thing', expected_date_modified: datetime.datetime) -> None:
+        """Raise PreconditionFailedError if a thing's modification date is not as expected."""
+        if expected_date_modified is not None and thing.date_modified != expected_date_modified:
+            error = 'Thing #{} has been modified since {}'.format(
+                thing.id, expected_date_modified.isoformat())
+            raise errors.PreconditionFailedError(error)
+
     @classmethod
     def delete_thing(cls, thing_id: int, user_id: int) -> None:
         """Delete an existing thing."""
-        thing = cls.query.get(thing_id)
-        if thing is None:
-            error = 'Thing #{} does not exist'.format(thing_id)
-            raise errors.ItemNotFoundError(error)
-        elif thing.inventory.user_id != user_id:
-            error = 'User #{} does not have permission to delete Thing #{}'.format(
-                user_id, thing_id)
-            raise errors.UserPermissionError(error)
-        thing.date_deleted = datetime.datetime.now(datetime.timezone.utc)
-        db.session.commit()
+        def delete() -> None:
+            """Mark the thing deleted if the user owns it."""
+            UserShard.route(user_id)
+            thing = cls.query.get(thing_id)
+            if thing is None:
+                error = 'Thing #{} does not exist'.format(thing_id)
+                raise errors.ItemNotFoundError(error)
+            elif thing.inventory.user_id != user_id:
+                error = 'User #{} does not have permission to delete Thing #{}'.format(
+                    user_id, thing_id)
+                raise errors.UserPermissionError(error)
+            now = utc_now()
+            thing.date_deleted = now
+            thing.date_modified = now
+            JournalEntry.record(user_id, 'thing', thing_id, 'deleted',
+                                {'date_deleted': now, 'date_modified': now})
+        transactions.write(delete, cls, group=True)
+
+
+# Models for tracking changes
+
+class JournalEntry(BaseModel):
+    """Append-only record of changes to things and inventories.
+
+    The Thing and Inventory write methods add an entry for each change in
+    the same transaction as the change, with only the fields that changed.
+    Entry IDs are sequence numbers, which are never reused, so clients can
+    find out what changed by reading the entries after the last one they
+    have seen. When a user is moved to another shard their entries and items
+    are given new IDs in that shard's range, and reading after an ID outside
+    of it returns all of their entries again.
+    """
+
+    __table_args__ = (
+        db.Index('ix_journal_entry_user_id_id', 'user_id', 'id'),
+        # Don't reuse the IDs of removed entries
+        {'sqlite_autoincrement': True, 'info': {'sharded': True}})
+
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    # Name of the changed item's model, e.g. "thing"
+    entity = db.Column(db.Unicode(length=32), nullable=False)
+    entity_id = db.Column(db.Integer, nullable=False)
+    # "created", "updated" or "deleted"
+    operation = db.Column(db.Unicode(length=16), nullable=False)
+    # JSON object with the changed fields
+    changes = db.Column(db.UnicodeText, nullable=False)
+    date_created = db.Column(UtcDateTime, nullable=False, default=utc_now)
+    CLIENT_FIELDS = {'id', 'entity', 'entity_id', 'operation', 'changes', 'date_created'}
+
+    def __repr__(self) -> str:
+        """Basic JournalEntry data as a string."""
+        return "<JournalEntry {} {} #{}>".format(self.operation, self.entity, self.entity_id)
+
+    @classmethod
+    def record(cls, user_id: int, entity: str, entity_id: int, operation: str,
+               changes: Mapping) -> None:
+        """Add an entry for a change to the session, and record its event.
+
+        The entry is written when the session is committed, together with
+        the change.
+        """
+        db.session.add(cls(user_id=user_id, entity=entity, entity_id=entity_id,
+                           operation=operation, date_created=utc_now(),
+                           changes=json.dumps(changes, default=_json_default)))
+        events.record(user_id, f'{entity}.{operation}', dict(changes, id=entity_id))
+
+    @classmethod
+    def get_entries(cls, user_id: int, after_id: int, limit: int) -> List[Mapping]:
+        """Return up to limit of a user's entries after the given ID, oldest first."""
+        first_id = UserShard.first_id(UserShard.route(user_id))
+        if not first_id <= after_id < first_id + UserShard.ID_RANGE:
+            # Read before the user was moved to this shard
+            after_id = 0
+        entries = cls.query. \
+            filter(cls.user_id == user_id, cls.id > after_id). \
+            order_by(cls.id). \
+            limit(limit)
+        return [dict(e.as_client_dict(), changes=json.loads(e.changes)) for e in entries]
+
+    @classmethod
+    def get_last_id(cls, before: datetime.datetime) -> Optional[int]:
+        """Return the ID of the last entry made before a date, if any."""
+        return db.session.query(sqlalchemy.func.max(cls.id)). \
+            filter(cls.date_created < before). \
+            scalar()
+
+    @classmethod
+    def compact(cls, through_id: int, batch_size: int = 500) -> int:
+        """Merge each item's entries up to through_id into its last one.
+
+        Clients reading from before through_id still see the latest value
+        of every field that changed, but not the values in between. The
+        merged entry is a creation if the first entry was, unless the item
+        was deleted by the last one. Returns the number of entries removed.
+        """
+        items = db.session.query(cls.entity, cls.entity_id). \
+            filter(cls.id <= through_id). \
+            group_by(cls.entity, cls.entity_id). \
+            having(sqlalchemy.func.count() > 1). \
+            all()
+
+        def compact_batch(batch: Sequence[Tuple[str, int]]) -> int:
+            """Merge the entries of a batch of items, returning the number removed."""
+            batch_removed = 0
+            for entity, entity_id in batch:
+                entries = cls.query. \
+                    filter(cls.entity == entity, cls.entity_id == entity_id,
+                           cls.id <= through_id). \
+                    order_by(cls.id). \
+                    all()
+                changes = {}
+                for entry in entries:
+                    changes.update(json.loads(entry.changes))
+                last = entries[-1]
+                last.changes = json.dumps(changes)
+                # Don't have clients that missed the creation create a deleted item
+                if entries[0].operation == 'created' and last.operation != 'deleted':
+                    last.operation = 'created'
+                cls.query.filter(cls.id.in_([e.id for e in entries[:-1]])). \
+                    delete(synchronize_session=False)
+                batch_removed += len(entries) - 1
+            return batch_removed
+        num_removed = 0
+        for start in range(0, len(items), batch_size):
+            batch = items[start:start + batch_size]
+            num_removed += transactions.write(lambda: compact_batch(batch), cls)
+        return num_removed
+
+
+# Models for tracking work
+
+class ImportCheckpoint(BaseModel):
+    """Progress of a bulk import of things into an inventory.
+
+    Updated in the same transaction as each chunk of imported rows, so after
+    a failure rows_processed is exactly the number of input rows that do not
+    need to be imported again.
+    """
+
+    # Import keys are chosen by clients, so each user has their own
+    __table_args__ = (db.UniqueConstraint('user_id', 'import_key'), {'info': {'sharded': True}})
+
+    import_key = db.Column(db.Unicode(length=64), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    inventory_id = db.Column(db.Integer, db.ForeignKey('inventory.id'), nullable=False)
+    # Number of input rows handled, whether they were imported or not
+    rows_processed = db.Column(db.Integer, nullable=False, default=0)
+    rows_imported = db.Column(db.Integer, nullable=False, default=0)
+    num_errors = db.Column(db.Integer, nullable=False, default=0)
+    date_created = db.Column(UtcDateTime, nullable=False, default=utc_now)
+    date_completed = db.Column(UtcDateTime)
+
+    def __repr__(self) -> str:
+        """Basic ImportCheckpoint data as a string."""
+        return "<ImportCheckpoint import_key='{}'>".format(self.import_key)
+
+    @classmethod
+    def get_or_create(cls, import_key: str, inventory_id: int,
+                      user_id: int) -> 'ImportCheckpoint':
+        """Return the checkpoint for a user's import, creating it if needed.
+
+        Raises InvalidDataError if the key was used for a different inventory.
+        """
+        def get_or_add() -> 'ImportCheckpoint':
+            """Return the checkpoint, adding a new one if there is none."""
+            UserShard.route(user_id)
+            existing = cls.query.filter_by(user_id=user_id, import_key=import_key).one_or_none()
+            if existing is None:
+                existing = cls(import_key=import_key, inventory_id=inventory_id,
+                               user_id=user_id, rows_processed=0, rows_imported=0,
+                               num_errors=0)
+                db.session.add(existing)
+            return existing
+        checkpoint = transactions.write(get_or_add, cls)
+        if checkpoint.inventory_id != inventory_id:
+            error = f'Import {import_key} was started for Inventory #{checkpoint.inventory_id}'
+            raise errors.InvalidDataError(error)
+        return checkpoint
+
+
+class OutboxEmail(BaseModel):
+    """Outgoing email waiting to be sent by the background sender.
+
+    Messages are stored fully rendered, so the sender only needs the envelope
+    and the raw message. A message is claimed by setting claim_token and
+    pushing date_next_attempt past the sender's lease time, so if a sender
+    dies while sending, the message is picked up again once the lease ends.
+    """
+
+    sender = db.Column(db.Unicode(length=256), nullable=False)
+    # Newline-separated envelope recipients
+    recipients = db.Column(db.UnicodeText, nullable=False)
+    message = db.Column(db.LargeBinary, nullable=False)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    last_error = db.Column(db.UnicodeText)
+    claim_token = db.Column(db.Unicode(length=32))
+    date_created = db.Column(UtcDateTime, nullable=False, default=utc_now)
+    date_next_attempt = db.Column(UtcDateTime, nullable=False, default=utc_now, index=True)
+    date_sent = db.Column(UtcDateTime)
+    date_failed = db.Column(UtcDateTime)
+
+    def __repr__(self) -> str:
+        """Basic OutboxEmail data as a string."""
+        return "<OutboxEmail id={} attempts={}>".format(self.id, self.attempts)
+
+    @classmethod
+    def _pending(cls) -> sqlalchemy.sql.ClauseElement:
+        """Condition for messages that still need to be sent."""
+        return sqlalchemy.and_(cls.date_sent.is_(None), cls.date_failed.is_(None))
+
+    @classmethod
+    def enqueue(cls, sender: str, recipients: Sequence[str], message: bytes) -> None:
+        """Add a message to the outbox."""
+        transactions.write(lambda: db.session.add(cls(
+            sender=sender, recipients='\n'.join(recipients), message=message,
+            attempts=0)), cls)
+
+    @classmethod
+    def claim_batch(cls, claim_token: str, limit: int,
+                    lease_time: datetime.timedelta) -> List['OutboxEmail']:
+        """Claim messages that are due to be sent.
+
+        The claim is a single UPDATE, so concurrent senders never claim the
+        same message.
+        """
+        now = utc_now()
+        due_ids = db.session.query(cls.id). \
+            filter(cls._pending(), cls.date_next_attempt <= now). \
+            order_by(cls.date_next_attempt, cls.id). \
+            limit(limit).subquery()
+        claimed = transactions.write(lambda: cls.query.
+                                     filter(cls.id.in_(due_ids), cls.date_next_attempt <= now).
+                                     update({'claim_token': claim_token,
+                                             'date_next_attempt': now + lease_time},
+                                            synchronize_session=False), cls)
+        if not claimed:
+            return []
+        return cls.query.filter_by(claim_token=claim_token).order_by(cls.id).all()
+
+    @classmethod
+    def mark_sent(cls, email_ids: Sequence[int]) -> None:
+        """Record that messages were sent."""
+        if email_ids:
+            transactions.write(lambda: cls.query.filter(cls.id.in_(email_ids)).
+                               update({'date_sent': utc_now(), 'claim_token': None},
+                                      synchronize_session=False), cls)
+        else:
+            db.session.commit()
+
+    @classmethod
+    def mark_attempt_failed(cls, email: 'OutboxEmail', error: str,
+                            retry_delay: datetime.timedelta = None) -> None:
+        """Record a failed attempt to send a message.
+
+        The message is retried after retry_delay, or given up on if
+        retry_delay is None.
+        """
+        now = utc_now()
+
+        def record_failure() -> None:
+            """Update the message, as loaded in the write transaction."""
+            email.attempts += 1
+            email.last_error = error
+            email.claim_token = None
+            if retry_delay is None:
+                email.date_failed = now
+            else:
+                email.date_next_attempt = now + retry_delay
+        transactions.write(record_failure, cls)
+
+    @classmethod
+    def get_queue_stats(cls) -> Mapping:
+        """Return the number of messages in each state of the outbox.
+
+        Includes the creation date of the oldest pending message, to show
+        how far behind the sender is.
+        """
+        pending_count, oldest_pending = db.session.query(
+            db.func.count(cls.id), db.func.min(cls.date_created)). \
+            filter(cls._pending()).one()
+        return {
+            'pending': pending_count,
+            'oldest_pending': oldest_pending,
+            'sent': cls.query.filter(cls.date_sent.isnot(None)).count(),
+            'failed': cls.query.filter(cls.date_failed.isnot(None)).count()
+        }
+
+
+class Job(BaseModel):
+    """Deferred work to be run by a background worker.
+
+    Jobs are added to the session by the code doing the triggering write, so
+    they are committed (or rolled back) along with it. A worker claims a job
+    by setting claim_token and hiding it until its timeout ends; if the
+    worker dies, the job becomes visible again and is retried.
+    """
+
+    name = db.Column(db.Unicode(length=64), nullable=False)
+    # JSON-encoded keyword arguments for the job's handler
+    arguments = db.Column(db.UnicodeText, nullable=False, default='{}')
+    # Jobs with higher priority run first
+    priority = db.Column(db.Integer, nullable=False, default=0)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False)
+    # Seconds a claimed job is hidden from other workers
+    timeout = db.Column(db.Integer, nullable=False)
+    last_error = db.Column(db.UnicodeText)
+    claim_token = db.Column(db.Unicode(length=32))
+    date_created = db.Column(UtcDateTime, nullable=False, default=utc_now)
+    date_visible = db.Column(UtcDateTime, nullable=False, default=utc_now, index=True)
+    date_finished = db.Column(UtcDateTime)
+    date_failed = db.Column(UtcDateTime)
+
+    def __repr__(self) -> str:
+        """Basic Job data as a string."""
+        return "<Job id={} name='{}'>".format(self.id, self.name)
+
+    @classmethod
+    def _pending(cls, table=None) -> sqlalchemy.sql.ClauseElement:
+        """Condition for jobs that have not finished or failed."""
+        table = cls if table is None else table
+        return sqlalchemy.and_(table.date_finished.is_(None), table.date_failed.is_(None))
+
+    @classmethod
+    def claim_next(cls, claim_token: str, concurrency: int) -> 'Job':
+        """Claim the highest priority job that is due to run.
+
+        Returns None if no job is due, or if concurrency jobs are already
+        running. The claim is a single UPDATE, so the limit holds across all
+        workers and no job is claimed twice. Claiming counts as an attempt:
+        a job that becomes visible again after using up its attempts, because
+        it kept crashing its worker, is marked failed instead of claimed.
+        """
+        now = utc_now()
+        due = sqlalchemy.orm.aliased(cls)
+        running = sqlalchemy.orm.aliased(cls)
+        next_id = db.session.query(due.id). \
+            filter(cls._pending(due), due.date_visible <= now,
+                   due.attempts < due.max_attempts). \
+            order_by(due.priority.desc(), due.date_visible, due.id). \
+            limit(1).as_scalar()
+        num_running = db.session.query(db.func.count(running.id)). \
+            filter(cls._pending(running), running.claim_token.isnot(None),
+                   running.date_visible > now).as_scalar()
+
+        def claim() -> Optional['Job']:
+            """Claim the job and hide it, returning it if there was one."""
+            cls.query. \
+                filter(cls._pending(), cls.date_visible <= now,
+                       cls.attempts >= cls.max_attempts). \
+                update({'date_failed': now, 'claim_token': None,
+                        'last_error': 'Timed out on the last attempt'},
+                       synchronize_session=False)
+            claimed = cls.query. \
+                filter(cls.id == next_id, cls.date_visible <= now,
+                       num_running < concurrency). \
+                update({'claim_token': claim_token, 'attempts': cls.attempts + 1},
+                       synchronize_session=False)
+            if not claimed:
+                return None
+            # Hide the job in the same transaction, using its own timeout
+            job = cls.query.filter_by(claim_token=claim_token).one()
+            job.date_visible = now + datetime.timedelta(seconds=job.timeout)
+            return job
+        return transactions.write(claim, cls)
+
+    def finish(self) -> None:
+        """Record that the job ran successfully."""
+        def record_finished() -> None:
+            """Update the job, as loaded in the write transaction."""
+            self.date_finished = utc_now()
+            self.claim_token = None
+        transactions.write(record_finished, type(self))
+
+    def fail(self, error: str, retry_delay: datetime.timedelta = None) -> None:
+        """Record that the job failed.
+
+        The job is retried after retry_delay, or given up on if retry_delay
+        is None.
+        """
+        def record_failure() -> None:
+            """Update the job, as loaded in the write transaction."""
+            self.last_error = error
+            self.claim_token = None
+            if retry_delay is None:
+                self.date_failed = utc_now()
+            else:
+                self.date_visible = utc_now() + retry_delay
+        transactions.write(record_failure, type(self))
+
+    @classmethod
+    def get_queue_stats(cls) -> Mapping:
+        """Return the number of jobs in each state."""
+        now = utc_now()
+        running_filter = sqlalchemy.and_(cls._pending(), cls.claim_token.isnot(None),
+                                         cls.date_visible > now)
+        return {
+            'pending': cls.query.filter(cls._pending()).count(),
+            'running': cls.query.filter(running_filter).count(),
+            'finished': cls.query.filter(cls.date_finished.isnot(None)).count(),
+            'failed': cls.query.filter(cls.date_failed.isnot(None)).count()
+        }
+
+
+class IdempotencyKey(BaseModel):
+    """Stored response for a request made with an Idempotency-Key header.
+
+    A key is claimed before the request is handled, with status_code left
+    empty until the response is stored. The unique constraint means only one
+    request with a given key can be in progress at a time. A claim without a
+    response can be taken over once its lease is over, in case the request
+    handling it was killed without releasing it.
+    """
+
+    __table_args__ = (db.UniqueConstraint('user_id', 'key'),)
+
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    key = db.Column(db.Unicode(length=255), nullable=False)
+    # Hash of the request, to detect keys reused for different requests
+    fingerprint = db.Column(db.Unicode(length=40), nullable=False)
+    status_code = db.Column(db.Integer)
+    response_body = db.Column(db.UnicodeText)
+    response_mimetype = db.Column(db.Unicode(length=128))
+    # When the key was claimed
+    date_created = db.Column(UtcDateTime, nullable=False, default=utc_now)
+    date_expires = db.Column(UtcDateTime, nullable=False)
+
+    def __repr__(self) -> str:
+        """Basic IdempotencyKey data as a string."""
+        return "<IdempotencyKey user_id={} key='{}'>".format(self.user_id, self.key)
+
+    @classmethod
+    def get_key(cls, user_id: int, key: str) -> 'IdempotencyKey':
+        """Return the current record for a key, or None."""
+        return cls.query. \
+            filter(cls.user_id == user_id, cls.key == key, cls.date_expires > utc_now()). \
+            one_or_none()
+
+    @classmethod
+    def claim(cls, user_id: int, key: str, fingerprint: str, ttl: datetime.timedelta,
+              lease: datetime.timedelta) -> Tuple[int, 'IdempotencyKey']:
+        """Claim a key for a new request.
+
+        Returns the ID of the new record and None if the key was claimed.
+        If the key is already in use, returns None and the existing record,
+        which may also be None if the other request released the key in the
+        meantime. The user's expired keys are removed, as is a claim of the
+        key made more than lease ago that has no response.
+        """
+        now = utc_now()
+
+        def add_record() -> int:
+            """Remove the expired keys and add the new one, returning its ID."""
+            cls.query.filter(cls.user_id == user_id, cls.date_expires <= now). \
+                delete(synchronize_session=False)
+            cls.query.filter(cls.user_id == user_id, cls.key == key,
+                             cls.status_code.is_(None), cls.date_created <= now - lease). \
+                delete(synchronize_session=False)
+            record = cls(user_id=user_id, key=key, fingerprint=fingerprint,
+                         date_created=now, date_expires=now + ttl)
+            db.session.add(record)
+            db.session.flush()
+            return record.id
+        try:
+            return transactions.write(add_record, cls), None
+        except sqlalchemy.exc.IntegrityError:
+            return None, cls.get_key(user_id, key)
+
+    @classmethod
+    def store_response(cls, record_id: int, status_code: int, body: str,
+                       mimetype: str) -> None:
+        """Store the response for a claimed key."""
+        transactions.write(lambda: cls.query.filter_by(id=record_id).
+                           update({'status_code': status_code, 'response_body': body,
+                                   'response_mimetype': mimetype},
+                                  synchronize_session=False), cls)
+
+    @classmethod
+    def release(cls, record_id: int) -> None:
+        """Release a claimed key without storing a response."""
+        db.session.rollback()
+        transactions.write(lambda: cls.query.filter_by(id=record_id).
+                           delete(synchronize_session=False), cls)
@@ -0,0 +1,261 @@
+"""Rate limiting and admission control for the API.
+
+Each client gets a token bucket, keyed by user ID if authenticated (with a
+token or a session) or by IP address otherwise. Buckets hold up to
+STUFFR_RATE_LIMIT_BURST tokens and refill at STUFFR_RATE_LIMIT tokens per
+second. Each request takes tokens from the bucket according to its
+endpoint's cost (STUFFR_RATE_LIMIT_COSTS, 1 by default); if there are not
+enough, the request is rejected with 429 and Retry-After set to when enough
+tokens will be available. A batch request costs the sum of the costs of its
+operations' endpoints. A batch costing more than a full bucket could never
+be let through, so it is rejected with 413 and must be split up.
+
+Independently of rate limits, at most STUFFR_MAX_CONCURRENT_REQUESTS API
+requests are handled at once by each process. Requests over the cap are
+rejected immediately with 503 instead of queueing up behind a busy
+database. A request keeps its slot until its response is closed, so
+streamed responses (e.g. events and exports) count for as long as they are
+being sent.
+
+Buckets are kept in process memory by default, so each worker process has
+its own limits. Set STUFFR_RATE_LIMIT_DB to the path of a SQLite database
+to share buckets between processes.
+"""
+
+import math
+import os
+import sqlite3
+import threading
+import time
+from http import HTTPStatus
+from typing import Optional
+from flask import Flask, Response, current_app, g, request
+from flask_security import current_user
+from werkzeug.exceptions import HTTPException
+
+from . import batch
+from . import errors
+from . import formats
+from .views_common import error_response
+from ..typing import ViewReturnType
+
+# Check for idle buckets to remove after this many requests
+PRUNE_INTERVAL = 1000
+BATCH_ENDPOINT = 'stuffrapi.post_batch'
+
+
+class MemoryBackend:
+    """Token buckets stored in process memory."""
+
+    def __init__(self) -> None:
+        """Create an empty set of buckets."""
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._num_requests = 0
+
+    def consume(self, key: str, cost: float, rate: float, burst: float) -> float:
+        """Take tokens from a bucket.
+
+        Returns 0 if the tokens were taken, otherwise the number of seconds
+        until enough tokens are available.
+        """
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            wait = 0.0 if tokens >= cost else (cost - tokens) / rate
+            if not wait:
+                tokens -= cost
+            self._buckets[key] = (tokens, now)
+
+            self._num_requests += 1
+            if self._num_requests % PRUNE_INTERVAL == 0:
+                # Buckets that would be full again are the same as no bucket
+                idle_time = burst / rate
+                self._buckets = {k: v for k, v in self._buckets.items()
+                                 if now - v[1] < idle_time}
+        return wait
+
+
+class SQLiteBackend:
+    """Token buckets stored in a SQLite database shared by processes.
+
+    Each bucket update is done in an immediate transaction, so concurrent
+    requests from different processes are applied one at a time.
+    """
+
+    def __init__(self, path: str) -> None:
+        """Use buckets stored in the database at path."""
+        self.path = path
+        self._local = threading.local()
+        self._num_requests = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        """Return this thread's connection to the database."""
+        # Connections must not be shared with forked processes
+        if getattr(self._local, 'pid', None) != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute('CREATE TABLE IF NOT EXISTS rate_limit_bucket ('
+                               'key TEXT PRIMARY KEY, tokens REAL, updated REAL)')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return self._local.connection
+
+    def consume(self, key: str, cost: float, rate: float, burst: float) -> float:
+        """Take tokens from a bucket, see MemoryBackend.consume()."""
+        connection = self._connect()
+        # Wall clock time, as it is compared between processes
+        now = time.time()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute('SELECT tokens, updated FROM rate_limit_bucket '
+                                     'WHERE key = ?', (key,)).fetchone()
+            tokens, updated = row if row else (burst, now)
+            tokens = min(burst, tokens + max(0, now - updated) * rate)
+            wait = 0.0 if tokens >= cost else (cost - tokens) / rate
+            if not wait:
+                tokens -= cost
+            connection.execute('INSERT OR REPLACE INTO rate_limit_bucket (key, tokens, updated) '
+                               'VALUES (?, ?, ?)', (key, tokens, now))
+            self._num_requests += 1
+            if self._num_requests % PRUNE_INTERVAL == 0:
+                connection.execute('DELETE FROM rate_limit_bucket WHERE updated < ?',
+                                   (now - burst / rate,))
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        return wait
+
+
+class RateLimiter:
+    """Applies rate limits and the concurrency cap to API requests."""
+
+    def __init__(self, app: Flask) -> None:
+        """Create a limiter using the app's rate limiting settings."""
+        config = app.config
+        self.rate = config['STUFFR_RATE_LIMIT']
+        self.burst = config['STUFFR_RATE_LIMIT_BURST']
+        self.costs = config['STUFFR_RATE_LIMIT_COSTS']
+        self.overload_retry_after = config['STUFFR_OVERLOAD_RETRY_AFTER']
+        if config['STUFFR_RATE_LIMIT_DB']:
+            self.backend = SQLiteBackend(config['STUFFR_RATE_LIMIT_DB'])
+        else:
+            self.backend = MemoryBackend()
+        max_concurrent = config['STUFFR_MAX_CONCURRENT_REQUESTS']
+        self.slots = threading.BoundedSemaphore(max_concurrent) if max_concurrent else None
+
+    def get_cost(self, endpoint: str) -> float:
+        """Return the number of tokens a request to an endpoint takes."""
+        # Requests are never rejected for costing more than a full bucket
+        return min(self.costs.get(endpoint, 1), self.burst)
+
+    def get_batch_cost(self) -> float:
+        """Return the total cost of the operations of the current batch request.
+
+        Operations are priced like requests to their endpoints. A body that
+        is not a valid batch, which the view rejects, costs as much as a
+        request to the batch endpoint.
+        """
+        try:
+            operations, _ = batch.parse_operations(formats.request_data())
+        except (errors.InvalidDataError, HTTPException):
+            return self.get_cost(BATCH_ENDPOINT)
+        adapter = current_app.create_url_adapter(request)
+        cost = 0
+        for operation in operations:
+            try:
+                endpoint, _ = adapter.match(operation['path'].partition('?')[0],
+                                            method=operation['method'])
+            except HTTPException:
+                # Fails without reaching a view
+                endpoint = None
+            cost += self.costs.get(endpoint, 1)
+        return cost
+
+    @staticmethod
+    def get_client_key() -> str:
+        """Return the key identifying the client making the current request."""
+        # Any of a user's tokens count against the same limit, while invalid
+        # tokens are treated as anonymous so they can't be used to dodge it
+        if current_user.is_authenticated:
+            return f'user:{current_user.id}'
+        return f'ip:{request.remote_addr}'
+
+    def check_rate(self) -> Optional[ViewReturnType]:
+        """Take tokens for the current request, returning an error response if limited.
+
+        The response is a 429, or a 413 for a batch that costs more than a
+        full bucket.
+        """
+        if not self.rate:
+            return None
+        if request.endpoint == BATCH_ENDPOINT:
+            cost = self.get_batch_cost()
+            if cost > self.burst:
+                return error_response(f'Batch costs {cost}, more than the limit of '
+                                      f'{self.burst}, split it into smaller batches',
+                                      HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+        else:
+            cost = self.get_cost(request.endpoint)
+        wait = self.backend.consume(self.get_client_key(), cost, self.rate, self.burst)
+        if not wait:
+            return None
+        data, status, headers = error_response('Too many requests, slow down',
+                                               HTTPStatus.TOO_MANY_REQUESTS)
+        headers['Retry-After'] = str(math.ceil(wait))
+        return data, status, headers
+
+    def acquire_slot(self) -> Optional[ViewReturnType]:
+        """Start handling a request, returning a 503 response if overloaded."""
+        if self.slots is None:
+            return None
+        if not self.slots.acquire(blocking=False):
+            data, status, headers = error_response('Server is busy, try again later',
+                                                   HTTPStatus.SERVICE_UNAVAILABLE)
+            headers['Retry-After'] = str(self.overload_retry_after)
+            return data, status, headers
+        g.stuffr_request_slot = (self.slots, request.environ)
+        return None
+
+
+def get_limiter() -> RateLimiter:
+    """Return the current app's rate limiter."""
+    return current_app.extensions['stuffr_rate_limiter']
+
+
+def before_request() -> Optional[ViewReturnType]:
+    """Reject requests over the client's rate limit or the concurrency cap."""
+    limiter = get_limiter()
+    return limiter.check_rate() or limiter.acquire_slot()
+
+
+def _pop_slot() -> Optional[threading.BoundedSemaphore]:
+    """Return the semaphore the current request holds a slot of, if any."""
+    slot = g.get('stuffr_request_slot')
+    # Operations in batch requests share g with the batch, but have no slot
+    if slot is not None and slot[1] is request.environ:
+        del g.stuffr_request_slot
+        return slot[0]
+    return None
+
+
+def after_request(response: Response) -> Response:
+    """Release the request's concurrency slot once its response is closed."""
+    slots = _pop_slot()
+    if slots is not None:
+        # Teardown runs before streamed responses are sent
+        response.call_on_close(slots.release)
+    return response
+
+
+def teardown_request(_=None) -> None:
+    """Release the concurrency slot of a request that ended without a response."""
+    slots = _pop_slot()
+    if slots is not None:
+        slots.release()
+
+
+def init_app(app: Flask) -> None:
+    """Create the app's rate limiter."""
+    app.extensions['stuffr_rate_limiter'] = RateLimiter(app)
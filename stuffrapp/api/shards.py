@@ -0,0 +1,265 @@
+"""Splitting users' inventories and things between several databases.
+
+SQLite lets one process write to a database at a time, so a single database
+file limits how many users can make changes at once. With STUFFR_SHARDS set
+to the bind keys of several SQLite databases (configured in
+SQLALCHEMY_BINDS), inventories, things, journal entries and import
+checkpoints are split between these shards by user. Users, jobs and other
+data not belonging to one user stay in the main database, along with the data
+of users created before sharding was enabled.
+
+The shard map (models.UserShard) gives each user's shard. New users are
+added to the shard with the fewest users, and the model classmethods send
+their queries to the shard of the user they are given (see
+UserShard.route()), so views don't need to know about shards.
+
+Shard tables are created by create_tables() ("flask init"), not by
+migrations, so schema changes to sharded tables must also be made in each
+shard. move_user() and plan_rebalance() ("flask rebalance") move users
+between shards, e.g. after adding a shard, or out of the main database after
+enabling sharding.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, TypeVar
+from flask import current_app
+import sqlalchemy
+from sqlalchemy.engine import Connection, Engine
+
+from database import db
+from . import models
+from . import transactions
+
+# Models stored in shards, in the order their rows are copied
+SHARDED_MODELS = [models.Inventory, models.Thing, models.ImportCheckpoint, models.JournalEntry]
+
+T = TypeVar('T')
+# (user ID, source shard, target shard), None is the main database
+MoveType = Tuple[int, Optional[str], str]
+
+
+class ShardError(Exception):
+    """Raised when data cannot be moved between shards."""
+
+    pass
+
+
+def database_keys() -> List[Optional[str]]:
+    """Return the bind keys of the main database (None) and all shards."""
+    return [None] + models.UserShard.get_shards()
+
+
+def get_engine(shard: Optional[str]) -> Engine:
+    """Return the engine of a shard, None for the main database."""
+    return db.get_engine(current_app, bind=shard)
+
+
+def map_databases(func: Callable[[Engine], T]) -> Dict[Optional[str], T]:
+    """Call func with the engine of the main database and of each shard.
+
+    The calls are made in parallel threads, so func should only use the
+    engine it is given. Returns the results by bind key.
+    """
+    engines = {key: get_engine(key) for key in database_keys()}
+    if len(engines) == 1:
+        return {None: func(engines[None])}
+    with ThreadPoolExecutor(max_workers=len(engines)) as executor:
+        futures = {key: executor.submit(func, engine) for key, engine in engines.items()}
+        return {key: future.result() for key, future in futures.items()}
+
+
+def count_rows(tables: Sequence[sqlalchemy.Table]) -> List[int]:
+    """Return the number of rows in sharded tables, summed over all databases."""
+    query = sqlalchemy.select([sqlalchemy.select([sqlalchemy.func.count()]).
+                               select_from(table).as_scalar() for table in tables])
+    results = map_databases(lambda engine: engine.execute(query).first())
+    return [sum(row[i] for row in results.values()) for i in range(len(tables))]
+
+
+def create_tables(shard: str) -> List[str]:
+    """Create the sharded tables that are missing from a shard.
+
+    The tables' IDs start at the shard's ID range, and are never reused, so
+    IDs are unique across all databases.
+    Returns the names of the tables created.
+    """
+    engine = get_engine(shard)
+    if engine.dialect.name != 'sqlite':
+        raise ShardError(f'Shard {shard} is not a SQLite database')
+    metadata = sqlalchemy.MetaData()
+    # Referenced by foreign keys, but not created in shards
+    models.User.__table__.tometadata(metadata)
+    created = []
+    with engine.begin() as connection:
+        for model in SHARDED_MODELS:
+            if engine.dialect.has_table(connection, model.__tablename__):
+                continue
+            table = model.__table__.tometadata(metadata)
+            table.dialect_options['sqlite']['autoincrement'] = True
+            table.create(connection)
+            connection.execute(
+                'INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)',
+                table.name, models.UserShard.first_id(shard) - 1)
+            created.append(table.name)
+    return created
+
+
+def _user_rows(table: sqlalchemy.Table, user_id: int) -> sqlalchemy.sql.ClauseElement:
+    """Return the condition for a user's rows in a sharded table."""
+    if 'user_id' in table.c:
+        return table.c.user_id == user_id
+    inventory_table = models.Inventory.__table__
+    inventory_ids = sqlalchemy.select([inventory_table.c.id]). \
+        where(inventory_table.c.user_id == user_id)
+    return table.c.inventory_id.in_(inventory_ids)
+
+
+def _allocate_ids(connection: Connection, table: sqlalchemy.Table, count: int) -> int:
+    """Reserve count IDs from the sequence of a shard table, returning the first."""
+    connection.execute('UPDATE sqlite_sequence SET seq = seq + ? WHERE name = ?',
+                       count, table.name)
+    last_id = connection.execute('SELECT seq FROM sqlite_sequence WHERE name = ?',
+                                 table.name).scalar()
+    return last_id - count + 1
+
+
+def _copy_rows(connection: Connection, rows: Dict[str, List[Dict]], user_id: int) -> None:
+    """Insert a user's rows into a shard, replacing those of an interrupted move.
+
+    The rows are given new IDs from the shard's range, in the same order,
+    and the references between them are changed to match.
+    """
+    for model in reversed(SHARDED_MODELS):
+        connection.execute(model.__table__.delete().where(_user_rows(model.__table__, user_id)))
+    # Old ID: new ID by table name
+    new_ids = {}
+    for model in SHARDED_MODELS:
+        table = model.__table__
+        table_rows = [dict(row) for row in rows[table.name]]
+        ids = new_ids[table.name] = {}
+        if not table_rows:
+            continue
+        first_id = _allocate_ids(connection, table, len(table_rows))
+        for new_id, row in enumerate(table_rows, first_id):
+            ids[row['id']] = row['id'] = new_id
+            if 'inventory_id' in row:
+                row['inventory_id'] = new_ids['inventory'][row['inventory_id']]
+            if model is models.JournalEntry:
+                # Entries of removed items keep the old ID
+                entity_ids = new_ids.get(row['entity'], {})
+                row['entity_id'] = entity_ids.get(row['entity_id'], row['entity_id'])
+        connection.execute(table.insert(), table_rows)
+
+
+def _set_shard(connection: Connection, user_id: int, shard: str) -> None:
+    """Change a user's entry in the shard map."""
+    table = models.UserShard.__table__
+    updated = connection.execute(
+        table.update().where(table.c.user_id == user_id).values(shard=shard))
+    if not updated.rowcount:
+        connection.execute(table.insert().values(user_id=user_id, shard=shard))
+
+
+def move_user(user_id: int, target: str) -> Dict[str, int]:
+    """Move a user's rows to another shard, and update the shard map.
+
+    The rows are copied to the target shard before the map is updated, and
+    removed from the source afterwards. They are given new IDs in the
+    target's range, so clients have to load the user's data again. The
+    source database is locked for writing meanwhile, so requests changing
+    data in it wait until the move is done. They then read the shard map
+    again with the lock held (see UserShard.route()), and make their changes
+    in the new shard. If a move is interrupted it can be run again.
+    Returns the number of rows moved from each table.
+    """
+    if target not in models.UserShard.get_shards():
+        raise ShardError(f'Unknown shard {target}')
+    # Don't hold locks the move waits for
+    db.session.commit()
+    source = models.UserShard.get_shard(user_id)
+    if source == target:
+        return {model.__tablename__: 0 for model in SHARDED_MODELS}
+    with get_engine(source).connect() as source_connection:
+        with source_connection.begin():
+            transactions.begin(source_connection)
+            rows = {}
+            for model in SHARDED_MODELS:
+                query = model.__table__.select(). \
+                    where(_user_rows(model.__table__, user_id)). \
+                    order_by(model.__table__.c.id)
+                rows[model.__tablename__] = [dict(r) for r in source_connection.execute(query)]
+            try:
+                with get_engine(target).begin() as target_connection:
+                    _copy_rows(target_connection, rows, user_id)
+            except sqlalchemy.exc.IntegrityError as e:
+                raise ShardError(f'Could not copy the rows of user #{user_id} to {target}: '
+                                 f'{e.orig}')
+            if source is None:
+                # Removed in the same transaction as the map is changed
+                _set_shard(source_connection, user_id, target)
+            else:
+                with get_engine(None).begin() as main_connection:
+                    _set_shard(main_connection, user_id, target)
+            for model in reversed(SHARDED_MODELS):
+                source_connection.execute(
+                    model.__table__.delete().where(_user_rows(model.__table__, user_id)))
+    db.session.info.get(models.UserShard.SESSION_KEY, {}).pop(user_id, None)
+    return {name: len(table_rows) for name, table_rows in rows.items()}
+
+
+def _user_weights(engine: Engine) -> Dict[int, int]:
+    """Return the number of inventories and things of each user in a database."""
+    inventory_table = models.Inventory.__table__
+    thing_table = models.Thing.__table__
+    weights = dict(engine.execute(
+        sqlalchemy.select([inventory_table.c.user_id, sqlalchemy.func.count()]).
+        group_by(inventory_table.c.user_id)).fetchall())
+    things = engine.execute(
+        sqlalchemy.select([inventory_table.c.user_id, sqlalchemy.func.count()]).
+        select_from(inventory_table.join(thing_table)).
+        group_by(inventory_table.c.user_id))
+    for user_id, count in things:
+        weights[user_id] += count
+    return weights
+
+
+def plan_rebalance() -> List[MoveType]:
+    """Return the moves that even out the amount of data in each shard.
+
+    Users in the main database are moved to the shards first, largest
+    first. Then users are moved from the shard with the most rows to the
+    one with the fewest, as long as that narrows the gap between them. Each
+    user is moved at most once.
+    """
+    shards = models.UserShard.get_shards()
+    if not shards:
+        raise ShardError('Sharding is not enabled, set STUFFR_SHARDS')
+    weights = map_databases(_user_weights)
+    user_shards = dict(db.session.query(models.UserShard.user_id, models.UserShard.shard))
+    user_ids = [user_id for user_id, in db.session.query(models.User.id)]
+    loads = {shard: sum(weight for user_id, weight in weights[shard].items()
+                        if user_shards.get(user_id) == shard)
+             for shard in shards}
+    moves = []
+    unassigned = [u for u in user_ids if u not in user_shards]
+    for user_id in sorted(unassigned, key=lambda u: -weights[None].get(u, 0)):
+        target = min(shards, key=loads.get)
+        moves.append((user_id, None, target))
+        loads[target] += weights[None].get(user_id, 0)
+
+    moved = set()
+    while True:
+        heaviest = max(shards, key=loads.get)
+        lightest = min(shards, key=loads.get)
+        gap = loads[heaviest] - loads[lightest]
+        candidates = [(weight, user_id) for user_id, weight in weights[heaviest].items()
+                      if user_shards.get(user_id) == heaviest and user_id not in moved
+                      if 0 < weight < gap]
+        if not candidates:
+            return moves
+        # Leave the two as close as possible
+        weight, user_id = min(candidates, key=lambda c: (abs(gap - 2 * c[0]), c[1]))
+        moves.append((user_id, heaviest, lightest))
+        moved.add(user_id)
+        loads[heaviest] -= weight
+        loads[lightest] += weight
@@ -0,0 +1,85 @@
+"""Precomputed Swagger specification for the API.
+
+flask_restplus builds swagger.json from the registered namespaces and
+encodes it again for every request. Instead, the spec is encoded once when
+the app is created (or loaded from a file generated at build time, see the
+STUFFR_API_SPEC_FILE setting) and served as a static document, with an ETag
+and a pre-compressed gzip version.
+"""
+
+import gzip
+import hashlib
+import json
+from typing import Mapping
+from flask import Flask, Response, current_app, request
+from werkzeug.http import is_resource_modified
+
+from .views import api
+
+SPEC_ENDPOINT = 'stuffrapi.specs'
+
+
+class ApiSpec:
+    """Encoded Swagger spec, ready to be sent to clients."""
+
+    def __init__(self, data: bytes) -> None:
+        """Prepare the encoded spec for serving."""
+        self.data = data
+        self.gzip_data = gzip.compress(data)
+        self.etag = hashlib.sha1(data).hexdigest()
+        # Each encoding is a different representation, with its own strong ETag
+        self.gzip_etag = self.etag + '-gzip'
+
+
+def generate_spec(app: Flask) -> Mapping:
+    """Generate the Swagger spec for the API as a dict."""
+    # Generating URLs in the spec needs a request context
+    with app.test_request_context():
+        return api.__schema__
+
+
+def encode_spec(spec: Mapping) -> bytes:
+    """Encode the spec as JSON.
+
+    Keys are sorted so the same spec always produces the same ETag.
+    """
+    return json.dumps(spec, sort_keys=True, separators=(',', ':')).encode('utf-8')
+
+
+def get_spec() -> ApiSpec:
+    """Return the current app's precomputed spec."""
+    return current_app.extensions['stuffr_api_spec']
+
+
+def spec_view() -> Response:
+    """Serve the precomputed spec."""
+    spec = get_spec()
+    if request.accept_encodings['gzip'] > 0:
+        data, etag, headers = spec.gzip_data, spec.gzip_etag, {'Content-Encoding': 'gzip'}
+    else:
+        data, etag, headers = spec.data, spec.etag, {}
+    if is_resource_modified(request.environ, etag=etag):
+        response = Response(data, mimetype='application/json', headers=headers)
+    else:
+        response = Response(status=304)
+    response.set_etag(etag)
+    response.vary.add('Accept-Encoding')
+    # Spec only changes on deployment, but clients should revalidate in case it did
+    response.cache_control.public = True
+    response.cache_control.no_cache = True
+    return response
+
+
+def init_app(app: Flask) -> None:
+    """Precompute the spec and serve it in place of flask_restplus's view.
+
+    Must be called after the API blueprint is registered.
+    """
+    spec_file = app.config.get('STUFFR_API_SPEC_FILE')
+    if spec_file:
+        with app.open_instance_resource(spec_file, 'rb') as f:
+            data = f.read()
+    else:
+        data = encode_spec(generate_spec(app))
+    app.extensions['stuffr_api_spec'] = ApiSpec(data)
+    app.view_functions[SPEC_ENDPOINT] = spec_view
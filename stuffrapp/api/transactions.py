@@ -0,0 +1,325 @@
+"""Write transactions that cope with concurrent writers.
+
+SQLite lets one connection write to a database at a time. pysqlite only
+starts a transaction right before the first INSERT, UPDATE or DELETE, so
+what a write method reads first (e.g. its permission checks) is not
+isolated from other writers, and a writer that can't get the lock within
+the connection's timeout fails with "database is locked".
+
+The model write methods make their changes with write(), which runs them in
+a transaction started with BEGIN IMMEDIATE on the databases of the models
+they change, taking the write lock before anything is read. Other databases
+(e.g. the main database, for a write to a shard that checks the user) are
+only read, and are not locked. If a database is locked by another writer, the
+transaction is rolled back and run again after a random delay, which grows
+with each attempt (STUFFR_WRITE_RETRIES, STUFFR_WRITE_RETRY_DELAY). The
+work passed to write() can therefore run more than once: it must make all
+of its changes itself, without committing, and create new objects each
+time.
+
+Each commit waits for the database file to be synced to disk. With
+STUFFR_GROUP_COMMIT set, small writes are passed to a thread of the process
+(see GroupCommitter), which runs the writes arriving within
+STUFFR_GROUP_COMMIT_WINDOW seconds of each other in one transaction, each
+in a savepoint of its own, and commits them together.
+"""
+
+from collections import deque
+import os
+import random
+import sqlite3
+import threading
+import time
+from typing import Callable, List, Sequence, Type, TypeVar
+from flask import Flask, current_app
+import sqlalchemy
+from sqlalchemy.engine import Connection
+
+from database import db
+from ..logger import logger
+from . import events
+
+# Key of the models changed by the write transaction a session is running,
+# in its info dict
+WRITE_KEY = 'stuffr_write'
+# Key set in a session's info dict once the transaction has flushed changes
+CHANGED_KEY = 'stuffr_changed'
+
+T = TypeVar('T')
+
+
+def begin(connection: Connection, immediate: bool = True) -> None:
+    """Start a transaction on a SQLite connection, if none is in progress.
+
+    pysqlite only starts transactions before changing data, so a SAVEPOINT
+    issued first would start a transaction of its own, which releasing the
+    savepoint would commit. If immediate is set, the database's write lock
+    is taken at once.
+    """
+    if connection.dialect.name == 'sqlite' and not connection.connection.in_transaction:
+        connection.connection.execute('BEGIN IMMEDIATE' if immediate else 'BEGIN')
+
+
+@sqlalchemy.event.listens_for(db.session, 'after_begin')
+def _begin_write(session: sqlalchemy.orm.Session, _transaction,
+                 connection: Connection) -> None:
+    """Start the transaction on each database a write uses, as it is used."""
+    written = session.info.get(WRITE_KEY)
+    if written is None:
+        return
+    if any(session.get_bind(mapper=sqlalchemy.inspect(model)) is connection.engine
+           for model in written):
+        begin(connection)
+    elif session.transaction.nested:
+        begin(connection, immediate=False)
+
+
+@sqlalchemy.event.listens_for(db.session, 'after_flush')
+def _flushed(session: sqlalchemy.orm.Session, _flush_context) -> None:
+    """Note that the session's transaction has changes."""
+    session.info[CHANGED_KEY] = True
+
+
+@sqlalchemy.event.listens_for(db.session, 'after_bulk_update')
+@sqlalchemy.event.listens_for(db.session, 'after_bulk_delete')
+def _bulk_changed(context) -> None:
+    """Note that the session's transaction has changes made by a query."""
+    context.session.info[CHANGED_KEY] = True
+
+
+@sqlalchemy.event.listens_for(db.session, 'after_transaction_end')
+def _ended(session: sqlalchemy.orm.Session,
+           transaction: sqlalchemy.orm.session.SessionTransaction) -> None:
+    """Forget the changes of a transaction once it is committed or rolled back."""
+    if transaction.parent is None:
+        session.info.pop(CHANGED_KEY, None)
+
+
+def is_busy(error: Exception) -> bool:
+    """Return whether an error was caused by another connection's lock."""
+    if isinstance(error, sqlalchemy.exc.DBAPIError):
+        error = error.orig
+    return isinstance(error, sqlite3.OperationalError) and 'is locked' in str(error)
+
+
+def _retry_delays() -> List[float]:
+    """Return the delays before each retry of a busy write."""
+    config = current_app.config
+    # Random delays up to an exponentially growing limit keep the writers
+    # that were waiting from retrying all at once
+    return [random.uniform(0, config['STUFFR_WRITE_RETRY_DELAY'] * 2 ** attempt)
+            for attempt in range(config['STUFFR_WRITE_RETRIES'])]
+
+
+def write(work: Callable[[], T], *models: Type, group: bool = False) -> T:
+    """Run work in a write transaction and commit it, returning its result.
+
+    The write lock of each database holding models is taken when work first
+    uses it, so work can route sharded models to a user's shard before (see
+    UserShard.route()). The transaction is retried if a database is busy.
+    If work raises an exception, its changes are rolled back and the
+    exception is raised.
+
+    Earlier reads made with the session are ended first, so objects read
+    before are reloaded when they are next used. Changes must not be
+    waiting to be committed: add them in work, so they are written in the
+    same transaction. RuntimeError is raised otherwise. Inside a
+    transaction batch, the work is run in the batch's savepoint and not
+    retried.
+
+    Parameters:
+        group:
+            Allow committing the work along with other writes, see
+            GroupCommitter. The work is then run by another thread, and
+            returned objects are detached from any session.
+    """
+    session = db.session()
+    if session.info.get(WRITE_KEY) is not None:
+        # Already part of a write transaction
+        return work()
+    if session.transaction is not None and session.transaction.nested:
+        return _write_nested(session, work, models)
+    if session.new or session.dirty or session.deleted or session.info.get(CHANGED_KEY):
+        # Committing them first would leave them written if work failed, and
+        # rolling back on a busy database would lose them
+        raise RuntimeError('Changes that are not committed would not be part of the write')
+    # Connections already in use would not be locked, and their read locks
+    # would keep other writers from committing
+    session.rollback()
+    if group and current_app.config['STUFFR_GROUP_COMMIT']:
+        return current_app.extensions['stuffr_group_commit'].submit(work, models)
+
+    delays = _retry_delays()
+    while True:
+        session.info[WRITE_KEY] = models
+        try:
+            result = work()
+            session.commit()
+            return result
+        except Exception as e:
+            session.rollback()
+            if not (is_busy(e) and delays):
+                raise
+        finally:
+            session.info.pop(WRITE_KEY, None)
+        time.sleep(delays.pop(0))
+
+
+def _write_nested(session: sqlalchemy.orm.Session, work: Callable[[], T],
+                  models: Sequence[Type]) -> T:
+    """Run work in the current savepoint, and release it."""
+    session.info[WRITE_KEY] = models
+    try:
+        result = work()
+        session.commit()
+        return result
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.info.pop(WRITE_KEY, None)
+
+
+class _Write:
+    """Work passed to a GroupCommitter, and its outcome."""
+
+    def __init__(self, work: Callable, models: Sequence[Type]) -> None:
+        """Wrap work waiting to be run."""
+        self.work = work
+        self.models = models
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class GroupCommitter:
+    """Thread running the writes of concurrent requests in one transaction.
+
+    Each write runs in a savepoint, so one failing only rolls back its own
+    changes. If the database is busy, the whole group is retried. Objects
+    used by the writes are detached from the thread's session once they are
+    committed, so the requests can read the values they were given, but not
+    load anything else.
+    """
+
+    def __init__(self, app: Flask) -> None:
+        """Create a committer for app's writes, using its settings."""
+        self.app = app
+        self.window = app.config['STUFFR_GROUP_COMMIT_WINDOW']
+        self.max_size = app.config['STUFFR_GROUP_COMMIT_SIZE']
+        self._waiting = deque()
+        self._condition = threading.Condition()
+        self._thread = None
+        self._thread_pid = None
+        self.groups = 0
+        self.writes = 0
+
+    def submit(self, work: Callable[[], T], models: Sequence[Type]) -> T:
+        """Run work with the next group, waiting until it is committed."""
+        self.start()
+        pending = _Write(work, models)
+        with self._condition:
+            self._waiting.append(pending)
+            self._condition.notify()
+        pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def start(self) -> None:
+        """Start the thread if it is not running in this process.
+
+        Threads do not survive a fork, so a new one is started in each
+        worker process of a pre-forking server.
+        """
+        with self._condition:
+            if self._thread_pid == os.getpid() and self._thread.is_alive():
+                return
+            if self._thread_pid != os.getpid():
+                # Writes waiting in the parent process are its own
+                self._waiting.clear()
+            self._thread = threading.Thread(target=self._run, name='stuffr-group-commit',
+                                            daemon=True)
+            self._thread_pid = os.getpid()
+            self._thread.start()
+
+    def _next_group(self) -> List[_Write]:
+        """Wait for writes, and return those arriving within the window."""
+        with self._condition:
+            while not self._waiting:
+                self._condition.wait()
+            deadline = time.monotonic() + self.window
+            while len(self._waiting) < self.max_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            return [self._waiting.popleft()
+                    for _ in range(min(self.max_size, len(self._waiting)))]
+
+    def _run(self) -> None:
+        """Thread main loop."""
+        while True:
+            group = self._next_group()
+            with self.app.app_context():
+                try:
+                    self._commit_group(group)
+                except Exception as e:  # pylint: disable=broad-except
+                    logger.exception('Error committing a group of writes')
+                    for pending in group:
+                        if pending.error is None:
+                            pending.error = e
+                finally:
+                    db.session.remove()
+                    for pending in group:
+                        pending.done.set()
+
+    def _commit_group(self, group: List[_Write]) -> None:
+        """Run a group of writes in one transaction, retrying if it is busy."""
+        session = db.session()
+        delays = _retry_delays()
+        while True:
+            session.info[WRITE_KEY] = ()
+            try:
+                self._run_group(session, group)
+                session.commit()
+                break
+            except Exception as e:
+                session.rollback()
+                if not (is_busy(e) and delays):
+                    raise
+            finally:
+                session.info.pop(WRITE_KEY, None)
+            time.sleep(delays.pop(0))
+        session.expunge_all()
+        self.groups += 1
+        self.writes += len(group)
+
+    @staticmethod
+    def _run_group(session: sqlalchemy.orm.Session, group: List[_Write]) -> None:
+        """Run each write of a group in a savepoint."""
+        for pending in group:
+            pending.result = pending.error = None
+            # Rolling back a savepoint drops all events recorded in the
+            # session, so each write's events are kept aside until it is done
+            recorded = session.info.pop(events.SESSION_KEY, [])
+            session.info[WRITE_KEY] = pending.models
+            session.begin_nested()
+            try:
+                pending.result = pending.work()
+                session.commit()
+                recorded.extend(session.info.pop(events.SESSION_KEY, []))
+            except Exception as e:  # pylint: disable=broad-except
+                session.rollback()
+                if is_busy(e):
+                    raise
+                pending.error = e
+            finally:
+                session.info[events.SESSION_KEY] = recorded
+
+
+def init_app(app: Flask) -> GroupCommitter:
+    """Create the app's group committer."""
+    committer = GroupCommitter(app)
+    app.extensions['stuffr_group_commit'] = committer
+    return committer
@@ -1,8 +1,11 @@
 """Main module managing views."""
 
 # from flask import Blueprint
+from flask import make_response
 from flask_restplus import Api
 
+from . import formats
+from . import ratelimit
 from .views_admin import ns as ns_admin
 # from .views_core import ns as ns_core
 from .views_core import bp
@@ -19,3 +22,16 @@ authorizations = {
 api = Api(bp, authorizations=authorizations, security='ApiKey')
 # api.add_namespace(ns_core)
 api.add_namespace(ns_admin)
+
+
+@api.representation(formats.MSGPACK_MIMETYPE)
+def output_msgpack(data, code, headers=None):
+    """Encode responses of namespaced views as MessagePack."""
+    response = make_response(formats.pack(data), code)
+    response.headers.extend(headers or {})
+    return response
+
+
+bp.before_request(ratelimit.before_request)
+bp.after_request(ratelimit.after_request)
+bp.teardown_request(ratelimit.teardown_request)
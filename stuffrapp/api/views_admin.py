@@ -7,6 +7,7 @@ from flask_restplus import Namespace, Resource, fields
 from flask_security.decorators import auth_token_required
 
 from . import models
+from . import shards
 from ..typing import ViewReturnType
 
 
@@ -25,7 +26,13 @@ stats = ns.model('Stats', {
         description='Total inventories across all users'),
     'numThings': fields.Integer(
         required=True, example=4295,
-        description='Total inventories across all users')
+        description='Total inventories across all users'),
+    'numPendingEmails': fields.Integer(
+        required=True, example=3,
+        description='Emails waiting to be sent'),
+    'numFailedEmails': fields.Integer(
+        required=True, example=0,
+        description='Emails that could not be sent')
 })
 
 user_model = ns.model('User', {
@@ -53,14 +60,20 @@ class Stats(Resource):
     @auth_token_required
     @ns.marshal_with(stats, code=HTTPStatus.OK, description="Success")
     def get(self) -> ViewReturnType:
-        """Returns database stats."""
+        """Returns database stats.
+
+        Inventories and things are counted in all shards in parallel.
+        """
         users_count = models.User.total_count()
-        inventories_count = models.Inventory.total_count()
-        thing_count = models.Thing.total_count()
+        inventories_count, thing_count = shards.count_rows(
+            [models.Inventory.__table__, models.Thing.__table__])
+        email_stats = models.OutboxEmail.get_queue_stats()
         return {
             'numUsers': users_count,
             'numInventories': inventories_count,
-            'numThings': thing_count
+            'numThings': thing_count,
+            'numPendingEmails': email_stats['pending'],
+            'numFailedEmails': email_stats['failed']
         }
 
 
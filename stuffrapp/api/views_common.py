@@ -5,6 +5,7 @@ from http import HTTPStatus
 import json
 from typing import Any
 
+from . import formats
 from ..logger import logger
 from ..typing import ViewReturnType
 
@@ -26,14 +27,23 @@ def serialize_object(obj: Any) -> str:
 
 
 def json_response(data: Any, status_code: int = HTTPStatus.OK) -> ViewReturnType:
-    """Create a response object suitable for JSON data."""
-    json_data = json.dumps(data, default=serialize_object)
+    """Create a response object suitable for JSON data.
+
+    The data is encoded as MessagePack instead if the client asked for it,
+    see formats.
+    """
+    mimetype = formats.response_mimetype()
+    if mimetype == formats.JSON_MIMETYPE:
+        response_data = json.dumps(data, default=serialize_object)
+    else:
+        response_data = formats.pack(data)
     if status_code == HTTPStatus.UNAUTHORIZED:
-        headers = {'Content-Type': 'application/json',
+        headers = {'Content-Type': mimetype,
                    'WWW-Authenticate': 'FormBased'}
     else:
-        headers = {'Content-Type': 'application/json'}
-    return json_data, status_code, headers
+        headers = {'Content-Type': mimetype}
+    headers['Vary'] = 'Accept'
+    return response_data, status_code, headers
 
 
 def error_response(message: str, status_code: int = HTTPStatus.BAD_REQUEST) -> ViewReturnType:
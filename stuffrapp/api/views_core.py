@@ -1,13 +1,21 @@
 """REST views for stuffr."""
 
+import datetime
 from http import HTTPStatus
-from typing import Dict, Mapping, Sequence
-from flask import request, Blueprint
+from typing import Dict, Mapping, Optional, Sequence
+from flask import request, Blueprint, Response
 from flask_security import current_user
 from flask_security.decorators import auth_token_required
 
 from . import models
+from . import batch
+from . import counts
 from . import errors
+from . import events
+from . import export
+from . import formats
+from .idempotency import idempotent
+from . import importer
 from .views_common import json_response, error_response, NO_CONTENT
 from ..typing import ViewReturnType
 
@@ -23,9 +31,94 @@ def filter_dict(the_dict: Mapping, allowed_keys: Sequence) -> Dict:
     return {k: the_dict[k] for k in the_dict if k in allowed_keys}
 
 
+def export_response(user_id: int, inventory_id: int = None) -> Response:
+    """Create a streaming response with exported inventory data.
+
+    Format is taken from the "format" query parameter. Data is gzipped if the
+    client accepts it.
+    """
+    export_format = request.args.get('format', 'ndjson')
+    chunks = export.generate_export(export_format, user_id, inventory_id)
+    filename = 'stuffr-export.{}'.format(export_format)
+    headers = {'Content-Disposition': f'attachment; filename="{filename}"',
+               'Vary': 'Accept-Encoding'}
+    if request.accept_encodings['gzip'] > 0:
+        chunks = export.gzip_chunks(chunks)
+        headers['Content-Encoding'] = 'gzip'
+    return Response(chunks,
+                    mimetype=export.EXPORT_FORMATS[export_format],
+                    headers=headers)
+
+
+def parse_date(date_string: str) -> Optional[datetime.datetime]:
+    """Parse an ISO 8601 date and time with a UTC offset.
+
+    Returns None if the string is not in that format.
+    """
+    if date_string.endswith('Z'):
+        date_string = date_string[:-1] + '+0000'
+    # strptime in Python 3.6 doesn't accept colons in UTC offsets
+    if len(date_string) > 6 and date_string[-6] in '+-' and date_string[-3] == ':':
+        date_string = date_string[:-3] + date_string[-2:]
+    for date_format in ('%Y-%m-%dT%H:%M:%S.%f%z', '%Y-%m-%dT%H:%M:%S%z'):
+        try:
+            return datetime.datetime.strptime(date_string, date_format)
+        except ValueError:
+            pass
+    return None
+
+
+def get_if_match_date() -> Optional[datetime.datetime]:
+    """Return the modification date given in the If-Match header, if any.
+
+    Clients send the ETag returned when they last read or updated the item,
+    which is its quoted ISO modification date. "*" matches any version of
+    an item that exists, so no date is returned for it.
+    """
+    value = request.headers.get('If-Match')
+    if value is None or value.strip() == '*':
+        return None
+    date_string = value.strip()
+    if date_string.startswith('W/'):
+        date_string = date_string[2:]
+    date = parse_date(date_string.strip('"'))
+    if date is None:
+        error = f'If-Match must be an ETag returned by the server, not {value}'
+        raise errors.InvalidDataError(error)
+    return date
+
+
+def get_thing_filters() -> Dict:
+    """Return the filters for things given in the query string."""
+    filters = {}
+    for name, value_type in models.Thing.FILTERS.items():
+        value = request.args.get(name)
+        if value is None:
+            continue
+        if value_type is datetime.datetime:
+            # Unescaped "+" in UTC offsets is decoded as a space
+            date = parse_date(value.replace(' ', '+'))
+            if date is None:
+                error = f'{name} must be a date and time with a UTC offset, not {value}'
+                raise errors.InvalidDataError(error)
+            value = date
+        filters[name] = value
+    return filters
+
+
+def date_etag(date: datetime.datetime) -> str:
+    """Return the ETag for an item with the given modification date."""
+    return '"{}"'.format(date.isoformat())
+
+
 # Constants
 ###########
 
+# Maximum number of inventories things can be requested from at once
+MAX_INVENTORY_IDS = 100
+# Maximum number of journal entries returned at once
+MAX_JOURNAL_ENTRIES = 1000
+
 # These fields are handled by the server and not passed in from the client.
 THING_MANAGED_FIELDS = models.Thing.CLIENT_FIELDS - models.Thing.USER_FIELDS
 INVENTORY_MANAGED_FIELDS = models.Inventory.CLIENT_FIELDS - models.Inventory.USER_FIELDS
@@ -51,20 +144,118 @@ def get_userinfo() -> ViewReturnType:
     return json_response(filter_dict(current_user._asdict(), models.User.CLIENT_FIELDS))
 
 
+@bp.route('/bootstrap')
+@auth_token_required
+def get_bootstrap() -> ViewReturnType:
+    """Provide the user info, inventories and things in one response.
+
+    Things are included in each inventory as "things". The "fields" query
+    parameter selects the things' fields, as for get_things. If
+    "things_limit" is given, only the oldest things of each inventory are
+    included, and "more_things" is true for inventories with more. The
+    response takes the same number of queries however many inventories
+    there are.
+    """
+    try:
+        fields = models.Thing.parse_client_fields(request.args.get('fields'))
+        limit = request.args.get('things_limit', type=int)
+        if limit is not None and limit < 0:
+            raise errors.InvalidDataError('things_limit must not be negative')
+    except errors.InvalidDataError as e:
+        return error_response(e.args, status_code=HTTPStatus.BAD_REQUEST)
+
+    inventories = models.Inventory.get_user_inventories(current_user.id)
+    # Get one more thing than the limit to find out if there are more
+    things = models.Thing.get_things_for_inventories(
+        [i.id for i in inventories], fields, None if limit is None else limit + 1)
+    inventory_list = []
+    for inventory in inventories:
+        inventory_data = filter_dict(inventory._asdict(), models.Inventory.CLIENT_FIELDS)
+        inventory_things = things[inventory.id]
+        inventory_data['more_things'] = limit is not None and len(inventory_things) > limit
+        inventory_data['things'] = [t.as_client_dict(fields) for t in inventory_things[:limit]]
+        inventory_list.append(inventory_data)
+    return json_response({
+        'user': filter_dict(current_user._asdict(), models.User.CLIENT_FIELDS),
+        'inventories': inventory_list})
+
+
 @bp.route('/inventories')
 @auth_token_required
 def get_inventories() -> ViewReturnType:
-    """Provide a list of inventories from the database."""
+    """Provide a list of inventories from the database.
+
+    If the "counts" query parameter is true, each inventory includes its
+    number of things as num_things.
+    """
     inventories = models.Inventory.get_user_inventories(current_user.id)
-    return json_response([filter_dict(i._asdict(), models.Inventory.CLIENT_FIELDS)
-                          for i in inventories])
+    inventory_list = [filter_dict(i._asdict(), models.Inventory.CLIENT_FIELDS)
+                      for i in inventories]
+    if request.args.get('counts', '').lower() in ('1', 'true'):
+        inventory_counts = counts.get_counts(current_user.id)['inventories']
+        for inventory in inventory_list:
+            inventory['num_things'] = inventory_counts.get(inventory['id'], 0)
+    return json_response(inventory_list)
+
+
+@bp.route('/counts')
+@auth_token_required
+def get_thing_counts() -> ViewReturnType:
+    """Provide the number of things per inventory and per location.
+
+    Deleted things are not counted.
+    """
+    thing_counts = counts.get_counts(current_user.id)
+    return json_response({
+        'inventories': [{'id': i, 'num_things': n}
+                        for i, n in sorted(thing_counts['inventories'].items())],
+        # Things without a location are listed first
+        'locations': [{'location': location, 'num_things': n}
+                      for location, n in sorted(thing_counts['locations'].items(),
+                                                key=lambda item: (item[0] is not None, item[0]))]})
+
+
+@bp.route('/events')
+@auth_token_required
+def get_events() -> ViewReturnType:
+    """Stream changes to the user's things and inventories as server-sent events.
+
+    Resumes after the event given in the Last-Event-ID header, or in the
+    last_event_id parameter for clients that can't set headers.
+    """
+    last_event_id = request.headers.get('Last-Event-ID', request.args.get('last_event_id'))
+    return Response(events.open_stream(current_user.id, last_event_id),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@bp.route('/journal')
+@auth_token_required
+def get_journal() -> ViewReturnType:
+    """Provide the changes to the user's things and inventories since an entry.
+
+    Returns the journal entries after the ID given in "after", oldest
+    first, up to "limit" of them. "more" is true if there are more.
+    """
+    try:
+        after = request.args.get('after', 0, type=int)
+        limit = request.args.get('limit', MAX_JOURNAL_ENTRIES, type=int)
+        if not 0 < limit <= MAX_JOURNAL_ENTRIES:
+            raise errors.InvalidDataError(f'limit must be from 1 to {MAX_JOURNAL_ENTRIES}')
+    except errors.InvalidDataError as e:
+        return error_response(e.args, status_code=HTTPStatus.BAD_REQUEST)
+
+    # Get one more entry than the limit to find out if there are more
+    entries = models.JournalEntry.get_entries(current_user.id, after, limit + 1)
+    return json_response({'entries': entries[:limit], 'more': len(entries) > limit})
 
 
 @bp.route('/inventories', methods=['POST'])
 @auth_token_required
+@idempotent
 def post_inventory() -> ViewReturnType:
     """POST an inventory to the database."""
-    request_data = request.get_json()
+    request_data = formats.request_data()
     # TODO: Error handling - what if database is down?
     try:
         inventory = models.Inventory.create_new_inventory(request_data, current_user.id)
@@ -80,23 +271,108 @@ def post_inventory() -> ViewReturnType:
 @bp.route('/inventories/<int:inventory_id>/things')
 @auth_token_required
 def get_things(inventory_id: int = None) -> ViewReturnType:
-    """Provide a list of things from the database."""
+    """Provide a list of things from the database.
+
+    The "fields" query parameter can list the fields to return, separated by
+    commas. Only those columns are read from the database.
+
+    Things can be sorted with the "sort" query parameter and filtered with
+    the parameters in Thing.FILTERS, see Thing.get_things_for_inventory().
+    Dates are given in ISO 8601 format with a UTC offset.
+    """
     try:
-        things = models.Thing.get_things_for_inventory(inventory_id, current_user.id)
+        fields = models.Thing.parse_client_fields(request.args.get('fields'))
+        things = models.Thing.get_things_for_inventory(
+            inventory_id, current_user.id, fields,
+            sort=request.args.get('sort'), filters=get_thing_filters())
     except errors.ItemNotFoundError as e:
         response = error_response(e.args, status_code=HTTPStatus.NOT_FOUND)
     except errors.UserPermissionError as e:
         response = error_response(e.args, status_code=HTTPStatus.FORBIDDEN)
+    except errors.InvalidDataError as e:
+        response = error_response(e.args, status_code=HTTPStatus.BAD_REQUEST)
     else:
-        response = json_response([t.as_client_dict() for t in things])
+        response = json_response([t.as_client_dict(fields) for t in things])
+    return response
+
+
+@bp.route('/things')
+@auth_token_required
+def get_things_for_inventories() -> ViewReturnType:
+    """Provide the things from several inventories.
+
+    The inventories are given as a comma separated list of IDs in the
+    "inventory_ids" query parameter, and "fields" can select fields as for
+    get_things. Things are returned grouped by inventory, in the order the
+    inventories were given. Inventories that don't exist or belong to
+    someone else have an error with a message and status code instead.
+    """
+    try:
+        fields = models.Thing.parse_client_fields(request.args.get('fields'))
+        inventory_ids = list(dict.fromkeys(
+            int(i) for i in request.args.get('inventory_ids', '').split(',') if i.strip()))
+        if not inventory_ids:
+            raise errors.InvalidDataError('No inventory_ids given')
+        if len(inventory_ids) > MAX_INVENTORY_IDS:
+            raise errors.InvalidDataError(
+                f'Things can be requested from at most {MAX_INVENTORY_IDS} inventories')
+    except ValueError:
+        return error_response('inventory_ids must be a comma separated list of IDs',
+                              status_code=HTTPStatus.BAD_REQUEST)
+    except errors.InvalidDataError as e:
+        return error_response(e.args, status_code=HTTPStatus.BAD_REQUEST)
+
+    access_errors = models.Inventory.check_user_access_many(inventory_ids, current_user.id)
+    things = models.Thing.get_things_for_inventories(
+        [i for i in inventory_ids if i not in access_errors], fields)
+    inventory_list = []
+    for inventory_id in inventory_ids:
+        error = access_errors.get(inventory_id)
+        if error is None:
+            inventory_list.append({'id': inventory_id,
+                                   'things': [t.as_client_dict(fields)
+                                              for t in things[inventory_id]]})
+        else:
+            status = HTTPStatus.NOT_FOUND if isinstance(error, errors.ItemNotFoundError) \
+                else HTTPStatus.FORBIDDEN
+            inventory_list.append({'id': inventory_id,
+                                   'error': {'message': error.args, 'status': status}})
+    return json_response({'inventories': inventory_list})
+
+
+@bp.route('/export')
+@auth_token_required
+def export_inventories() -> ViewReturnType:
+    """Export all of the user's inventories as NDJSON or CSV."""
+    try:
+        response = export_response(current_user.id)
+    except errors.InvalidDataError as e:
+        response = error_response(e.args, status_code=HTTPStatus.BAD_REQUEST)
+    return response
+
+
+@bp.route('/inventories/<int:inventory_id>/export')
+@auth_token_required
+def export_inventory(inventory_id: int) -> ViewReturnType:
+    """Export a single inventory as NDJSON or CSV."""
+    try:
+        models.Inventory.check_user_access(inventory_id, current_user.id)
+        response = export_response(current_user.id, inventory_id)
+    except errors.ItemNotFoundError as e:
+        response = error_response(e.args, status_code=HTTPStatus.NOT_FOUND)
+    except errors.UserPermissionError as e:
+        response = error_response(e.args, status_code=HTTPStatus.FORBIDDEN)
+    except errors.InvalidDataError as e:
+        response = error_response(e.args, status_code=HTTPStatus.BAD_REQUEST)
     return response
 
 
 @bp.route('/inventories/<int:inventory_id>/things', methods=['POST'])
 @auth_token_required
+@idempotent
 def post_thing(inventory_id: int) -> ViewReturnType:
     """POST a thing to the database."""
-    request_data = request.get_json()
+    request_data = formats.request_data()
 
     # TODO: Error handling - what if database is down?
     try:
@@ -114,6 +390,61 @@ def post_thing(inventory_id: int) -> ViewReturnType:
     return response
 
 
+@bp.route('/inventories/<int:inventory_id>/import', methods=['POST'])
+@auth_token_required
+def post_import(inventory_id: int) -> ViewReturnType:
+    """Import things into an inventory from an NDJSON or CSV request body.
+
+    To resume a failed import, send the same data again with the import_id
+    returned by (or given to) the original request.
+    """
+    default_format = 'csv' if request.mimetype == 'text/csv' else 'ndjson'
+    try:
+        result = importer.import_things(
+            request.stream,
+            request.args.get('format', default_format),
+            inventory_id, current_user.id,
+            import_key=request.args.get('import_id'),
+            chunk_size=request.args.get('chunk_size', type=int))
+    except errors.ItemNotFoundError as e:
+        response = error_response(e.args, status_code=HTTPStatus.NOT_FOUND)
+    except errors.UserPermissionError as e:
+        response = error_response(e.args, status_code=HTTPStatus.FORBIDDEN)
+    except errors.InvalidDataError as e:
+        response = error_response(e.args, status_code=HTTPStatus.BAD_REQUEST)
+    else:
+        response = json_response(result)
+    return response
+
+
+@bp.route('/things/<int:thing_id>')
+@bp.route('/inventories/<int:_>/things/<int:thing_id>')
+@auth_token_required
+def get_thing(thing_id: int, _: int = None) -> ViewReturnType:
+    """Provide a single thing from the database.
+
+    inventory_id (_) is ignored, only thing_id is needed. Fields can be
+    selected with the "fields" query parameter, as for get_things. The
+    response's ETag can be used in If-Match to update the thing.
+    """
+    try:
+        fields = models.Thing.parse_client_fields(request.args.get('fields'))
+        # The modification date is needed for the ETag
+        loaded_fields = None if fields is None else list(dict.fromkeys(fields + ['date_modified']))
+        thing = models.Thing.get_thing(thing_id, current_user.id, loaded_fields)
+    except errors.ItemNotFoundError as e:
+        response = error_response(e.args, status_code=HTTPStatus.NOT_FOUND)
+    except errors.UserPermissionError as e:
+        response = error_response(e.args, status_code=HTTPStatus.FORBIDDEN)
+    except errors.InvalidDataError as e:
+        response = error_response(e.args, status_code=HTTPStatus.BAD_REQUEST)
+    else:
+        data, status, headers = json_response(thing.as_client_dict(fields))
+        headers['ETag'] = date_etag(thing.date_modified)
+        response = data, status, headers
+    return response
+
+
 @bp.route('/things/<int:thing_id>', methods=['PUT'])
 @bp.route('/inventories/<int:_>/things/<int:thing_id>', methods=['PUT'])
 @auth_token_required
@@ -121,18 +452,27 @@ def update_thing(thing_id: int, _: int = None) -> ViewReturnType:
     """PUT (update) a thing in the database.
 
     inventory_id (_) is ignored, only thing_id is needed.
+
+    If an If-Match header is given, the thing is only updated if it has not
+    been modified since the ETag was returned. The response's ETag can be
+    used for the next update.
     """
-    request_data = request.get_json()
+    request_data = formats.request_data()
     try:
-        modified_data = models.Thing.update_thing(thing_id, request_data, current_user.id)
+        modified_data = models.Thing.update_thing(thing_id, request_data, current_user.id,
+                                                  expected_date_modified=get_if_match_date())
     except errors.ItemNotFoundError as e:
         response = error_response(e.args, status_code=HTTPStatus.NOT_FOUND)
     except errors.UserPermissionError as e:
         response = error_response(e.args, status_code=HTTPStatus.FORBIDDEN)
     except errors.InvalidDataError as e:
         response = error_response(e.args, status_code=HTTPStatus.BAD_REQUEST)
+    except errors.PreconditionFailedError as e:
+        response = error_response(e.args, status_code=HTTPStatus.PRECONDITION_FAILED)
     else:
-        response = json_response(modified_data)
+        data, status, headers = json_response(modified_data)
+        headers['ETag'] = date_etag(modified_data['date_modified'])
+        response = data, status, headers
     return response
 
 
@@ -152,3 +492,23 @@ def delete_thing(thing_id: int, _: int = None) -> ViewReturnType:
     except errors.UserPermissionError as e:
         response = error_response(e.args, status_code=HTTPStatus.FORBIDDEN)
     return response
+
+
+@bp.route('/batch', methods=['POST'])
+@auth_token_required
+def post_batch() -> ViewReturnType:
+    """Run several operations in one request, see the batch module.
+
+    The request body has a list of "operations", each with a "method",
+    a "path" (e.g. /api/inventories), and optionally a JSON "body" and
+    "headers". If "transaction" is true, the operations' changes are only
+    committed if all of them succeed. The response has the "status" and
+    "body" of each operation in "results", and whether the changes were
+    "committed".
+    """
+    try:
+        operations, transaction = batch.parse_operations(formats.request_data())
+    except errors.InvalidDataError as e:
+        return error_response(e.args, status_code=HTTPStatus.BAD_REQUEST)
+    results, committed = batch.run_batch(operations, transaction)
+    return json_response({'results': results, 'committed': committed})
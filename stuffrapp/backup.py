@@ -0,0 +1,181 @@
+"""Online backup and restore of SQLite databases.
+
+Backups use SQLite's online backup API, so they can be taken while the
+server is running. The database is copied a limited number of pages at a
+time, sleeping between steps so that writers are not starved. If a write
+happens during the backup, SQLite restarts it so the snapshot is always
+consistent.
+
+Every snapshot is checked with PRAGMA integrity_check before it is kept, and
+again before it is restored. Snapshots can optionally be gzip compressed.
+
+For scheduled backups, snapshots written to a directory are given
+timestamped names, and prune_snapshots() can be used to keep only the most
+recent ones.
+"""
+
+import datetime
+import gzip
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+from typing import Callable, List
+from sqlalchemy.engine import Engine
+
+SNAPSHOT_PREFIX = 'stuffr-'
+SNAPSHOT_TIME_FORMAT = '%Y%m%d-%H%M%S'
+SNAPSHOT_SUFFIXES = ('.db', '.db.gz')
+DEFAULT_PAGES_PER_STEP = 256
+DEFAULT_STEP_SLEEP = 0.05
+
+ProgressCallback = Callable[[int, int], None]
+
+
+class BackupError(Exception):
+    """Raised when a backup or restore cannot be performed."""
+
+    pass
+
+
+def sqlite_database_path(engine: Engine) -> str:
+    """Return the path of the SQLite database file used by an engine."""
+    url = engine.url
+    if url.get_backend_name() != 'sqlite':
+        raise BackupError(f'Backups are only supported for SQLite, not {url.drivername}')
+    if not url.database or url.database == ':memory:':
+        raise BackupError('Cannot back up an in-memory database')
+    return url.database
+
+
+def check_integrity(path: str) -> None:
+    """Run an integrity check on an uncompressed database file.
+
+    Raises BackupError if the check fails.
+    """
+    connection = sqlite3.connect(path)
+    try:
+        results = [r[0] for r in connection.execute('PRAGMA integrity_check')]
+    except sqlite3.DatabaseError as e:
+        raise BackupError(f'{path} is not a valid database: {e}')
+    finally:
+        connection.close()
+    if results != ['ok']:
+        raise BackupError('Integrity check failed for {}: {}'.format(path, '; '.join(results)))
+
+
+def _copy_online(source_path: str, dest_path: str, pages_per_step: int,
+                 step_sleep: float, progress: ProgressCallback = None) -> None:
+    """Copy a database with the online backup API."""
+    if not hasattr(sqlite3.Connection, 'backup'):
+        raise BackupError('Online backups require Python 3.7 or newer')
+
+    def step_done(_status, remaining, total):
+        """Report progress and give writers a chance between steps."""
+        if progress is not None:
+            progress(total - remaining, total)
+        if remaining and step_sleep:
+            time.sleep(step_sleep)
+
+    source = sqlite3.connect(source_path)
+    dest = sqlite3.connect(dest_path)
+    try:
+        source.backup(dest, pages=pages_per_step, progress=step_done)
+    finally:
+        dest.close()
+        source.close()
+
+
+def backup_database(source_path: str, dest_path: str, compress: bool = False,
+                    pages_per_step: int = DEFAULT_PAGES_PER_STEP,
+                    step_sleep: float = DEFAULT_STEP_SLEEP,
+                    progress: ProgressCallback = None) -> None:
+    """Take a verified snapshot of a live SQLite database.
+
+    Parameters:
+        source_path:
+            Path of the database to back up.
+        dest_path:
+            Path the snapshot is written to. It is only created once the
+            snapshot has passed its integrity check.
+        compress:
+            If True, the snapshot is gzip compressed.
+        pages_per_step:
+            Number of database pages copied per step.
+        step_sleep:
+            Seconds to sleep between steps.
+        progress:
+            Called after each step with the number of pages copied and the
+            total number of pages.
+    """
+    dest_dir = os.path.dirname(os.path.abspath(dest_path))
+    handle, temp_path = tempfile.mkstemp(suffix='.db', dir=dest_dir)
+    os.close(handle)
+    try:
+        _copy_online(source_path, temp_path, pages_per_step, step_sleep, progress)
+        check_integrity(temp_path)
+        if compress:
+            compressed_path = temp_path + '.gz'
+            with open(temp_path, 'rb') as in_file, gzip.open(compressed_path, 'wb') as out_file:
+                shutil.copyfileobj(in_file, out_file)
+            os.remove(temp_path)
+            temp_path = compressed_path
+        os.replace(temp_path, dest_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def restore_database(snapshot_path: str, dest_path: str) -> None:
+    """Replace the contents of a database with a snapshot.
+
+    The snapshot is verified before anything is changed. It is copied into
+    the destination with the backup API in a single step, so other
+    connections see either the old or the new database, never a mix.
+    """
+    if not os.path.exists(snapshot_path):
+        raise BackupError(f'Snapshot {snapshot_path} does not exist')
+    handle, temp_path = tempfile.mkstemp(suffix='.db')
+    os.close(handle)
+    try:
+        if snapshot_path.endswith('.gz'):
+            with gzip.open(snapshot_path, 'rb') as in_file, open(temp_path, 'wb') as out_file:
+                shutil.copyfileobj(in_file, out_file)
+            source_path = temp_path
+        else:
+            source_path = snapshot_path
+        check_integrity(source_path)
+        _copy_online(source_path, dest_path, -1, 0)
+    finally:
+        os.remove(temp_path)
+
+
+def snapshot_filename(when: datetime.datetime = None, compress: bool = False) -> str:
+    """Return a timestamped filename for a scheduled snapshot."""
+    if when is None:
+        when = datetime.datetime.now(datetime.timezone.utc)
+    suffix = SNAPSHOT_SUFFIXES[1] if compress else SNAPSHOT_SUFFIXES[0]
+    return SNAPSHOT_PREFIX + when.strftime(SNAPSHOT_TIME_FORMAT) + suffix
+
+
+def list_snapshots(directory: str) -> List[str]:
+    """Return paths of the snapshots in a directory, oldest first."""
+    names = [n for n in os.listdir(directory)
+             if n.startswith(SNAPSHOT_PREFIX) and n.endswith(SNAPSHOT_SUFFIXES)]
+    # Timestamps in names sort chronologically
+    return [os.path.join(directory, n) for n in sorted(names)]
+
+
+def prune_snapshots(directory: str, keep: int) -> List[str]:
+    """Delete all but the newest snapshots in a directory.
+
+    Returns the paths of the deleted snapshots.
+    """
+    if keep < 1:
+        raise BackupError('At least one snapshot must be kept')
+    snapshots = list_snapshots(directory)
+    deleted = snapshots[:-keep]
+    for path in deleted:
+        os.remove(path)
+    return deleted
@@ -0,0 +1,32 @@
+"""Bare-bones SMTP server for development and testing.
+
+Only imported by development tools and tests, never when serving the app.
+"""
+
+from smtpd import SMTPServer
+
+
+class DummySMTP(SMTPServer):
+    """Simple SMTP Server that prints messages to screen.
+
+    No bells or whistles, just prints email straight to the terminal. Use a
+    proper email dev server if you need anything fancier. Received messages
+    are also kept in the received list as (mailfrom, rcpttos, data) tuples.
+
+    smtpd is considered deprecated by the Python docs. Nevertheless, it's far
+    more than enough for what we're doing here, and doesn't require additional
+    dependencies.
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        """Start listening, see SMTPServer."""
+        super().__init__(*args, **kwargs)
+        self.received = []
+
+    def process_message(self, peer, mailfrom, rcpttos, data, **_):
+        """Take an incoming message and print it to the screen."""
+        self.received.append((mailfrom, rcpttos, data))
+        print(f"===== Message from {peer[0]} =====")
+        print(f"From: {mailfrom}")
+        print(f"To: {','.join(rcpttos)}")
+        print(f"Body:\n{data.decode()}")
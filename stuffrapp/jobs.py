@@ -0,0 +1,163 @@
+"""Background jobs stored in the database.
+
+Work that does not need to happen inside a request is enqueued as a job and
+run later by a worker, started with "flask worker". Jobs are added to the
+current database session without committing, so a job is only queued if
+the write that triggered it is committed.
+
+Handlers are registered with the handler decorator and are called with the
+keyword arguments given to enqueue(), which must be JSON serializable.
+Handlers should be safe to run more than once, as a job is retried if it
+raises an exception or its worker dies before finishing it.
+
+A job is hidden from other workers while it runs, until its timeout ends.
+Failed jobs are retried with exponential backoff up to their maximum number
+of attempts. The number of jobs running at once is limited across all
+workers by STUFFR_JOB_CONCURRENCY.
+"""
+
+import datetime
+import json
+import threading
+import uuid
+from typing import Callable, Dict, List
+from flask import Flask, current_app
+
+from database import db
+from .api import models
+from .logger import logger
+
+HANDLERS: Dict[str, Callable] = {}
+
+
+def handler(name: str) -> Callable:
+    """Decorator registering a function as the handler for a job name."""
+    def register(func: Callable) -> Callable:
+        """Register the handler."""
+        HANDLERS[name] = func
+        return func
+    return register
+
+
+def enqueue(name: str, priority: int = 0, delay: float = 0, max_attempts: int = None,
+            timeout: int = None, **arguments) -> models.Job:
+    """Add a job to the current session.
+
+    The job is not committed, it is queued when the caller commits. To
+    queue it along with a model write, enqueue it in the write's work (see
+    transactions.write()).
+
+    Parameters:
+        name:
+            Name of the registered handler.
+        priority:
+            Jobs with higher priority are run first.
+        delay:
+            Seconds to wait before running the job.
+        max_attempts:
+            Attempts before giving up, defaults to STUFFR_JOB_MAX_ATTEMPTS.
+        timeout:
+            Seconds the job is hidden from other workers while it runs,
+            defaults to STUFFR_JOB_TIMEOUT.
+        arguments:
+            Keyword arguments for the handler.
+    """
+    if name not in HANDLERS:
+        raise ValueError(f'No handler for job {name}')
+    config = current_app.config
+    job = models.Job(
+        name=name, arguments=json.dumps(arguments), priority=priority, attempts=0,
+        max_attempts=config['STUFFR_JOB_MAX_ATTEMPTS'] if max_attempts is None else max_attempts,
+        timeout=config['STUFFR_JOB_TIMEOUT'] if timeout is None else timeout,
+        date_visible=models.utc_now() + datetime.timedelta(seconds=delay))
+    db.session.add(job)
+    return job
+
+
+class Worker:
+    """Runs queued jobs.
+
+    run_pending() runs jobs until none are due and can be called directly.
+    run() keeps polling for jobs with several threads until stop() is
+    called.
+    """
+
+    def __init__(self, app: Flask) -> None:
+        """Create a worker using the app's job settings."""
+        self.app = app
+        self.concurrency = app.config['STUFFR_JOB_CONCURRENCY']
+        self.retry_delay = app.config['STUFFR_JOB_RETRY_DELAY']
+        self.retry_max_delay = app.config['STUFFR_JOB_RETRY_MAX_DELAY']
+        self.poll_interval = app.config['STUFFR_JOB_POLL_INTERVAL']
+        self._stop = threading.Event()
+
+    def get_retry_delay(self, attempts: int) -> datetime.timedelta:
+        """Return how long to wait before retrying a job."""
+        delay = min(self.retry_delay * 2 ** (attempts - 1), self.retry_max_delay)
+        return datetime.timedelta(seconds=delay)
+
+    def run_one(self) -> bool:
+        """Run the next job that is due.
+
+        Must be called within an app context. Returns False if there was
+        no job to run.
+        """
+        job = models.Job.claim_next(uuid.uuid4().hex, self.concurrency)
+        if job is None:
+            return False
+        func = HANDLERS.get(job.name)
+        if func is None:
+            logger.error('No handler for job #%s (%s)', job.id, job.name)
+            job.fail(f'No handler for job {job.name}')
+            return True
+        try:
+            func(**json.loads(job.arguments))
+        except Exception as e:  # pylint: disable=broad-except
+            db.session.rollback()
+            if job.attempts >= job.max_attempts:
+                logger.exception('Job #%s (%s) failed, giving up', job.id, job.name)
+                job.fail(repr(e))
+            else:
+                logger.warning('Job #%s (%s) failed, will retry: %r', job.id, job.name, e)
+                job.fail(repr(e), self.get_retry_delay(job.attempts))
+        else:
+            job.finish()
+        return True
+
+    def run_pending(self) -> int:
+        """Run jobs until none are due, returning the number run."""
+        num_run = 0
+        while self.run_one():
+            num_run += 1
+        return num_run
+
+    def _run_thread(self) -> None:
+        """Worker thread main loop."""
+        while not self._stop.is_set():
+            with self.app.app_context():
+                try:
+                    ran_job = self.run_one()
+                except Exception:  # pylint: disable=broad-except
+                    logger.exception('Error running job')
+                    ran_job = False
+                finally:
+                    db.session.remove()
+            if not ran_job:
+                self._stop.wait(self.poll_interval)
+
+    def run(self, num_threads: int = 1) -> None:
+        """Run jobs in num_threads threads until stopped."""
+        self._stop.clear()
+        threads: List[threading.Thread] = [
+            threading.Thread(target=self._run_thread, name=f'stuffr-worker-{i}', daemon=True)
+            for i in range(num_threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            # Wake up regularly so KeyboardInterrupt is handled
+            while thread.is_alive():
+                thread.join(1)
+
+    def stop(self) -> None:
+        """Stop running jobs once the current jobs finish."""
+        self._stop.set()
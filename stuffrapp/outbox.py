@@ -0,0 +1,251 @@
+"""Asynchronous delivery of outgoing email.
+
+Emails sent by Flask-Security (registration, password recovery, etc.) are
+stored in an outbox table instead of being sent on the request thread, so a
+slow SMTP server does not slow down the request. A background sender
+delivers them in batches, reusing one SMTP connection for as long as there
+are messages to send.
+
+Failed messages are retried with exponential backoff. Permanent SMTP errors
+(5xx responses) and messages that run out of attempts are marked as failed
+and kept in the outbox for inspection.
+
+By default each server process runs a sender thread, started the first time
+it queues a message. Alternatively, set STUFFR_MAIL_SENDER_THREAD to False
+and run "flask sendmail" as a separate process.
+"""
+
+import datetime
+import os
+import smtplib
+import threading
+import time
+import uuid
+from typing import List, Optional, Tuple
+from flask import Flask, current_app
+from flask_mail import Connection, Message, sanitize_address, sanitize_addresses
+
+from database import db
+from .api import models
+from .logger import logger
+
+# How long a sender may hold claimed messages before others can retry them
+LEASE_TIME = datetime.timedelta(minutes=5)
+
+
+def queue_message(message: Message) -> None:
+    """Store a Flask-Mail message in the outbox."""
+    if not message.send_to:
+        raise ValueError('The message has no recipients')
+    if not message.sender:
+        raise ValueError('The message does not specify a sender')
+    if message.has_bad_headers():
+        raise ValueError('The message has invalid headers')
+    if message.date is None:
+        message.date = time.time()
+    models.OutboxEmail.enqueue(sanitize_address(message.sender),
+                               list(sanitize_addresses(message.send_to)),
+                               message.as_bytes())
+
+
+def send_mail_task(message: Message) -> None:
+    """Flask-Security mail task, queues messages instead of sending them.
+
+    If sending is suppressed (testing or development) the message is passed
+    straight to Flask-Mail, which only dispatches its signal.
+    """
+    mail = current_app.extensions['mail']
+    if mail.suppress or not current_app.config['STUFFR_MAIL_OUTBOX']:
+        mail.send(message)
+        return
+    queue_message(message)
+    sender = current_app.extensions['stuffr_outbox']
+    if current_app.config['STUFFR_MAIL_SENDER_THREAD']:
+        sender.notify()
+
+
+def _is_connection_error(error: Exception) -> bool:
+    """Return True if an error means the SMTP connection cannot be used."""
+    return not isinstance(error, smtplib.SMTPResponseException) and \
+        not isinstance(error, smtplib.SMTPRecipientsRefused)
+
+
+def _is_permanent_error(error: Exception) -> bool:
+    """Return True if the server rejected a message for good."""
+    if isinstance(error, smtplib.SMTPResponseException):
+        return error.smtp_code >= 500
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, _ in error.recipients.values())
+    return False
+
+
+class OutboxSender:
+    """Delivers messages queued in the outbox.
+
+    deliver_pending() sends everything that is due and can be called
+    directly, e.g. from the sendmail command. start() runs it in a
+    background thread, woken by notify() when a message is queued and
+    otherwise every poll interval to pick up retries.
+
+    Counters in stats track what this sender has done since it was created.
+    """
+
+    def __init__(self, app: Flask) -> None:
+        """Create a sender using the app's mail and outbox settings."""
+        self.app = app
+        self.batch_size = app.config['STUFFR_MAIL_BATCH_SIZE']
+        self.max_attempts = app.config['STUFFR_MAIL_MAX_ATTEMPTS']
+        self.retry_delay = app.config['STUFFR_MAIL_RETRY_DELAY']
+        self.retry_max_delay = app.config['STUFFR_MAIL_RETRY_MAX_DELAY']
+        self.poll_interval = app.config['STUFFR_MAIL_POLL_INTERVAL']
+        self.stats = {'sent': 0, 'retried': 0, 'failed': 0, 'batches': 0, 'connections': 0}
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._thread_pid = None
+
+    def get_retry_delay(self, attempts: int) -> datetime.timedelta:
+        """Return how long to wait before the next attempt."""
+        delay = min(self.retry_delay * 2 ** (attempts - 1), self.retry_max_delay)
+        return datetime.timedelta(seconds=delay)
+
+    def _connect(self) -> Connection:
+        """Open a connection to the SMTP server."""
+        connection = self.app.extensions['mail'].connect()
+        connection.__enter__()
+        self.stats['connections'] += 1
+        return connection
+
+    @staticmethod
+    def _close(connection: Connection) -> None:
+        """Close a connection, ignoring errors from a dead connection."""
+        try:
+            connection.__exit__(None, None, None)
+        except (smtplib.SMTPException, OSError):
+            pass
+
+    def _record_failure(self, email: models.OutboxEmail, error: Exception) -> None:
+        """Schedule a retry for a message, or give up on it."""
+        attempts = email.attempts + 1
+        if _is_permanent_error(error) or attempts >= self.max_attempts:
+            logger.error('Giving up sending email #%s after %s attempts: %s',
+                         email.id, attempts, error)
+            models.OutboxEmail.mark_attempt_failed(email, str(error))
+            self.stats['failed'] += 1
+        else:
+            logger.warning('Failed to send email #%s, will retry: %s', email.id, error)
+            models.OutboxEmail.mark_attempt_failed(email, str(error),
+                                                   self.get_retry_delay(attempts))
+            self.stats['retried'] += 1
+
+    def _send_batch(self, batch: List[models.OutboxEmail],
+                    connection: Optional[Connection]) -> Tuple[Optional[Connection], bool]:
+        """Send a batch of claimed messages and record the results.
+
+        Returns the connection to reuse for the next batch (None if it was
+        closed), and whether the whole batch was sent without connection
+        errors.
+        """
+        sent_ids = []
+        failed = []
+        connection_ok = True
+        for index, email in enumerate(batch):
+            try:
+                if connection is None:
+                    connection = self._connect()
+                if connection.host is not None:
+                    connection.host.sendmail(email.sender, email.recipients.split('\n'),
+                                             email.message)
+            except (smtplib.SMTPException, OSError) as e:
+                failed.append((email, e))
+                if _is_connection_error(e):
+                    if connection is not None:
+                        self._close(connection)
+                        connection = None
+                    # Retry the rest of the batch later as well
+                    failed.extend((rest, e) for rest in batch[index + 1:])
+                    connection_ok = False
+                    break
+            else:
+                sent_ids.append(email.id)
+        models.OutboxEmail.mark_sent(sent_ids)
+        self.stats['sent'] += len(sent_ids)
+        for email, error in failed:
+            self._record_failure(email, error)
+        return connection, connection_ok
+
+    def deliver_pending(self) -> int:
+        """Send all messages that are due, returning the number sent.
+
+        Must be called within an app context. If the SMTP server cannot be
+        reached, the rest of the batch is retried later and delivery stops.
+        """
+        claim_token = uuid.uuid4().hex
+        sent_before = self.stats['sent']
+        connection = None
+        try:
+            while True:
+                batch = models.OutboxEmail.claim_batch(claim_token, self.batch_size, LEASE_TIME)
+                if not batch:
+                    break
+                self.stats['batches'] += 1
+                connection, connection_ok = self._send_batch(batch, connection)
+                if not connection_ok:
+                    break
+        finally:
+            if connection is not None:
+                self._close(connection)
+        return self.stats['sent'] - sent_before
+
+    def _run(self) -> None:
+        """Sender thread main loop."""
+        while not self._stop.is_set():
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+            if self._stop.is_set():
+                break
+            with self.app.app_context():
+                try:
+                    self.deliver_pending()
+                except Exception:  # pylint: disable=broad-except
+                    # Keep the thread alive, messages will be retried
+                    logger.exception('Error delivering queued email')
+                finally:
+                    db.session.remove()
+
+    def start(self) -> None:
+        """Start the sender thread if it is not running in this process.
+
+        Threads do not survive a fork, so a new one is started in each
+        worker process of a pre-forking server.
+        """
+        with self._lock:
+            if self._thread is not None and self._thread_pid == os.getpid() and \
+                    self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='stuffr-outbox',
+                                            daemon=True)
+            self._thread_pid = os.getpid()
+            self._thread.start()
+
+    def notify(self) -> None:
+        """Wake up the sender thread, starting it if needed."""
+        self.start()
+        self._wake.set()
+
+    def stop(self, timeout: float = None) -> None:
+        """Stop the sender thread."""
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+
+def init_app(app: Flask) -> OutboxSender:
+    """Create the app's outbox sender."""
+    sender = OutboxSender(app)
+    app.extensions['stuffr_outbox'] = sender
+    return sender
@@ -0,0 +1,265 @@
+"""Bulk generation of fake data for test and staging databases.
+
+Creating rows through the models commits every row separately, which makes
+building a large database impractically slow. The functions here use batched
+Core inserts inside chunked transactions instead.
+
+Seeding is declarative: seed_database() makes sure that the requested number
+of seed users exist, each with the requested number of inventories, each with
+the requested number of things. Anything that already exists is counted and
+skipped, so an interrupted run can simply be started again to resume it.
+
+Generated content is deterministic. Text is picked from pools built with a
+fixed random seed, indexed by the position of the row, so the same parameters
+always produce the same data no matter how many times a run was resumed.
+"""
+
+import datetime
+import random
+import string
+import time
+from typing import Callable, Dict, Iterator, List, Mapping, Tuple
+import sqlalchemy
+from flask_security.utils import hash_password
+
+from database import db
+from .api import models
+
+# Seed users are recognized by their email address
+SEED_EMAIL_TEMPLATE = 'seed{}@example.com'
+SEED_EMAIL_PATTERN = 'seed%@example.com'
+SEED_INVENTORY_TEMPLATE = 'Seed inventory {}'
+SEED_PASSWORD = 'seedpassword'
+DEFAULT_BATCH_SIZE = 10000
+# Number of unique values generated for each text column
+POOL_SIZE = 4096
+
+ProgressCallback = Callable[[str, int, int], None]
+
+
+# Content generation
+#####################
+
+def _random_words(rng: random.Random, min_length: int, max_length: int) -> str:
+    """Generate a string of random words with a length in the given range."""
+    target_length = rng.randint(min_length, max_length)
+    words = []
+    length = 0
+    while length < target_length:
+        word = ''.join(rng.choice(string.ascii_lowercase)
+                       for _ in range(rng.randint(2, 10)))
+        words.append(word)
+        length += len(word) + 1
+    return ' '.join(words)[:target_length].strip().capitalize()
+
+
+def build_text_pools(seed: int) -> Dict[str, List[str]]:
+    """Create pools of text used for generated thing columns.
+
+    Lengths roughly follow what real users enter: short names and locations,
+    with details ranging from nothing to a few paragraphs.
+    """
+    rng = random.Random(seed)
+    pools = {
+        'name': [_random_words(rng, 3, 60) for _ in range(POOL_SIZE)],
+        'location': [_random_words(rng, 3, 40) for _ in range(POOL_SIZE)],
+        'details': [_random_words(rng, 0, 600) if rng.random() < 0.7 else None
+                    for _ in range(POOL_SIZE)]
+    }
+    return pools
+
+
+def generate_thing_row(pools: Mapping, inventory_id: int, index: int,
+                       timestamp: datetime.datetime) -> Dict:
+    """Return column values for a seed thing.
+
+    Values only depend on the inventory and the thing's position in it.
+    Different prime strides are used so columns don't repeat in lockstep.
+    """
+    key = inventory_id * 7919 + index
+    return {
+        'name': pools['name'][(key * 31) % POOL_SIZE],
+        'location': pools['location'][(key * 131) % POOL_SIZE],
+        'details': pools['details'][(key * 521) % POOL_SIZE],
+        'date_created': timestamp,
+        'date_modified': timestamp,
+        'inventory_id': inventory_id
+    }
+
+
+# Database helpers
+###################
+
+def _batches(rows: Iterator[Dict], batch_size: int) -> Iterator[List[Dict]]:
+    """Split an iterator of rows into lists of at most batch_size rows."""
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _insert_batches(table: sqlalchemy.Table, rows: Iterator[Dict], batch_size: int,
+                    total: int, label: str, progress: ProgressCallback) -> int:
+    """Insert rows into a table, committing once per batch.
+
+    Returns the number of rows inserted.
+    """
+    inserted = 0
+    progress(label, inserted, total)
+    for batch in _batches(rows, batch_size):
+        with db.engine.begin() as connection:
+            connection.execute(table.insert(), batch)
+        inserted += len(batch)
+        progress(label, inserted, total)
+    return inserted
+
+
+def _existing_users() -> Dict[str, int]:
+    """Return a dict mapping seed user emails to their IDs."""
+    user_table = models.User.__table__
+    query = sqlalchemy.select([user_table.c.email, user_table.c.id]). \
+        where(user_table.c.email.like(SEED_EMAIL_PATTERN))
+    return dict(db.engine.execute(query).fetchall())
+
+
+def _existing_inventories() -> Dict[Tuple[int, str], Tuple[int, int]]:
+    """Return information on seed inventories and their things.
+
+    Returns a dict mapping (user_id, inventory_name) to a tuple of
+    (inventory_id, thing_count).
+    """
+    user_table = models.User.__table__
+    inventory_table = models.Inventory.__table__
+    thing_table = models.Thing.__table__
+    joined = inventory_table. \
+        join(user_table, inventory_table.c.user_id == user_table.c.id). \
+        outerjoin(thing_table, thing_table.c.inventory_id == inventory_table.c.id)
+    query = sqlalchemy.select([inventory_table.c.user_id, inventory_table.c.name,
+                               inventory_table.c.id,
+                               sqlalchemy.func.count(thing_table.c.id)]). \
+        select_from(joined). \
+        where(user_table.c.email.like(SEED_EMAIL_PATTERN)). \
+        group_by(inventory_table.c.id)
+    return {(user_id, name): (inventory_id, count)
+            for user_id, name, inventory_id, count in db.engine.execute(query)}
+
+
+def _no_progress(label: str, done: int, total: int) -> None:
+    """Default progress callback, does nothing."""
+    pass
+
+
+# Main seeding function
+########################
+
+def seed_database(num_users: int, inventories_per_user: int, things_per_inventory: int,
+                  batch_size: int = DEFAULT_BATCH_SIZE, seed: int = 0,
+                  progress: ProgressCallback = _no_progress) -> Dict[str, int]:
+    """Fill the database with generated users, inventories and things.
+
+    Parameters:
+        num_users:
+            Total number of seed users that should exist.
+        inventories_per_user:
+            Number of inventories each seed user should have.
+        things_per_inventory:
+            Number of things each seed inventory should have.
+        batch_size:
+            Number of rows inserted per transaction.
+        seed:
+            Seed used to generate text content.
+        progress:
+            Called before inserting into a table and after every committed
+            batch with a label, the number of rows inserted so far, and the
+            number of rows to insert.
+
+    Returns a dict with the number of new rows created for each table.
+    """
+    timestamp = datetime.datetime.now(datetime.timezone.utc)
+    created = {'users': 0, 'inventories': 0, 'things': 0}
+
+    # Users
+    existing_users = _existing_users()
+    emails = [SEED_EMAIL_TEMPLATE.format(i) for i in range(num_users)]
+    missing_emails = [e for e in emails if e not in existing_users]
+    if missing_emails:
+        # Hashing is slow, all seed users share the same password hash
+        password = hash_password(SEED_PASSWORD)
+        user_rows = ({'email': email,
+                      'password': password,
+                      'name_first': 'Seed',
+                      'name_last': email.split('@')[0],
+                      'date_created': timestamp,
+                      'active': True}
+                     for email in missing_emails)
+        created['users'] = _insert_batches(
+            models.User.__table__, user_rows, batch_size,
+            len(missing_emails), 'users', progress)
+        existing_users = _existing_users()
+    user_ids = [existing_users[e] for e in emails]
+
+    # Inventories
+    existing_inventories = _existing_inventories()
+    inventory_keys = [(user_id, SEED_INVENTORY_TEMPLATE.format(i))
+                      for user_id in user_ids
+                      for i in range(inventories_per_user)]
+    missing_inventories = [k for k in inventory_keys if k not in existing_inventories]
+    if missing_inventories:
+        inventory_rows = ({'name': name, 'user_id': user_id, 'date_created': timestamp}
+                          for user_id, name in missing_inventories)
+        created['inventories'] = _insert_batches(
+            models.Inventory.__table__, inventory_rows, batch_size,
+            len(missing_inventories), 'inventories', progress)
+        existing_inventories = _existing_inventories()
+
+    # Things
+    # Inventories are filled in order, so a partially filled inventory gets
+    # topped off with the rows it's missing.
+    pending = [existing_inventories[k] for k in inventory_keys]
+    things_total = sum(max(things_per_inventory - count, 0) for _, count in pending)
+    if things_total:
+        pools = build_text_pools(seed)
+        thing_rows = (generate_thing_row(pools, inventory_id, index, timestamp)
+                      for inventory_id, count in pending
+                      for index in range(count, things_per_inventory))
+        created['things'] = _insert_batches(
+            models.Thing.__table__, thing_rows, batch_size,
+            things_total, 'things', progress)
+
+    return created
+
+
+def make_progress_printer(print_func: Callable = print,
+                          interval: float = 1.0) -> ProgressCallback:
+    """Return a progress callback that prints at most once per interval.
+
+    The final update for each label is always printed.
+    """
+    state = {'label': None, 'start': time.monotonic(), 'last': 0.0}
+
+    def progress(label: str, done: int, total: int) -> None:
+        """Print progress and the current insertion rate."""
+        now = time.monotonic()
+        if label != state['label']:
+            state.update(label=label, start=now, last=0.0)
+        if done == 0 or (now - state['last'] < interval and done < total):
+            return
+        state['last'] = now
+        elapsed = max(now - state['start'], 1e-6)
+        print_func(f"{label}: {done}/{total} ({done / elapsed:.0f} rows/s)")
+
+    return progress
+
+
+def seed_row_counts() -> Dict[str, int]:
+    """Return the number of seed users, inventories and things present."""
+    existing_inventories = _existing_inventories()
+    return {
+        'users': len(_existing_users()),
+        'inventories': len(existing_inventories),
+        'things': sum(count for _, count in existing_inventories.values())
+    }
@@ -0,0 +1,128 @@
+"""Preparing the app for a pre-forking production server.
+
+A pre-forking server (see gunicorn.conf.py) creates the app once in its
+master process and forks worker processes from it, so the workers share the
+memory of the loaded code and warmed caches. Database connections must not
+be shared between processes though: the master closes its connections
+before forking (dispose_pools()), and each worker starts with empty pools
+and opens its own connections (after_fork()). Connections to in-memory
+SQLite databases are kept, since the database only exists in them.
+
+Rate limits and event streams keep state in each process unless they are
+set up to share it (see process_warnings()).
+"""
+
+import gc
+import os
+from typing import List, Tuple
+from flask import Flask
+import sqlalchemy
+from sqlalchemy.engine import Engine
+
+from database import db
+
+# Threads per worker process. Requests mostly wait for the database, and
+# each event stream holds a thread for as long as its client listens.
+THREADS_PER_WORKER = 4
+
+
+def available_cores() -> int:
+    """Return the number of CPU cores this process may run on."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        # Not available on all platforms
+        return os.cpu_count() or 1
+
+
+def recommended_workers(cores: int = None) -> Tuple[int, int]:
+    """Return the recommended number of worker processes and threads each.
+
+    Uses two processes per core, plus one to take over while another waits,
+    as recommended by gunicorn.
+    """
+    if cores is None:
+        cores = available_cores()
+    return 2 * cores + 1, THREADS_PER_WORKER
+
+
+def process_warnings(app: Flask, workers: int) -> List[str]:
+    """Return warnings about settings that don't work with several workers."""
+    if workers < 2:
+        return []
+    warnings = []
+    if app.config['STUFFR_RATE_LIMIT'] and not app.config['STUFFR_RATE_LIMIT_DB']:
+        warnings.append(f'STUFFR_RATE_LIMIT_DB is not set, so each of the {workers} '
+                        'workers applies its own rate limits, multiplying them')
+    if not app.config['STUFFR_EVENTS_SOCKET_DIR']:
+        warnings.append('STUFFR_EVENTS_SOCKET_DIR is not set, so event streams only get '
+                        'the changes made through their own worker')
+    return warnings
+
+
+def _engines(app: Flask) -> List[Engine]:
+    """Return the engines of the main database and of all binds."""
+    bind_keys = [None] + list(app.config['SQLALCHEMY_BINDS'] or {})
+    return [db.get_engine(app, bind=key) for key in bind_keys]
+
+
+def _in_memory(engine: Engine) -> bool:
+    """Return whether an engine uses an in-memory SQLite database."""
+    return engine.url.drivername.startswith('sqlite') and \
+        engine.url.database in (None, '', ':memory:')
+
+
+def warm_caches(app: Flask) -> None:
+    """Do the work otherwise done by the first requests of each worker.
+
+    Configures the SQLAlchemy mappers and compiles the templates.
+    """
+    sqlalchemy.orm.configure_mappers()
+    for name in app.jinja_env.list_templates(extensions=['html']):
+        app.jinja_env.get_template(name)
+
+
+def warm_pools(app: Flask, size: int = THREADS_PER_WORKER) -> None:
+    """Open up to size connections to each database, left in their pools.
+
+    Also makes sure the databases can be reached.
+    """
+    for engine in _engines(app):
+        connections = []
+        try:
+            for _ in range(size):
+                connection = engine.connect()
+                connections.append(connection)
+                connection.execute('SELECT 1')
+        finally:
+            for connection in connections:
+                connection.close()
+
+
+def dispose_pools(app: Flask) -> None:
+    """Close the pooled connections to all databases, except in-memory ones."""
+    for engine in _engines(app):
+        if not _in_memory(engine):
+            engine.dispose()
+
+
+def before_fork(app: Flask) -> None:
+    """Prepare the app in the master process for forking workers.
+
+    Warms the caches and checks the databases, then closes the connections
+    so workers don't inherit them.
+    """
+    warm_caches(app)
+    warm_pools(app, size=1)
+    dispose_pools(app)
+    if hasattr(gc, 'freeze'):
+        # Keep the garbage collector from copying shared pages (Python 3.7+)
+        gc.freeze()
+
+
+def after_fork(app: Flask, threads: int = THREADS_PER_WORKER) -> None:
+    """Prepare a worker process before it accepts requests."""
+    # Pools must not be used by more than one process
+    dispose_pools(app)
+    warm_pools(app, size=threads)
+    app.logger.info('Worker %d ready', os.getpid())
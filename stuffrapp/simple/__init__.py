@@ -7,19 +7,83 @@ accessibility reasons) this provides an alternative.
 Views should be static HTML & CSS generated server-side, with little or no
 JavaScript used. If JavaScript does get used for anything, it shall not be
 required for any functionality.
+
+To keep things fast, lists are paginated, rendered list rows are cached, and
+views send ETag and Last-Modified headers. Conditional requests are checked
+before anything is rendered, so revisiting an unchanged page costs only a
+couple of small queries.
 """
 
+import datetime
+import hashlib
 from http import HTTPStatus
-from flask import Blueprint, render_template, abort
+from typing import Callable, Optional, Sequence
+from flask import Blueprint, Response, abort, current_app, render_template, request
 from flask_security import current_user
 from flask_security.decorators import login_required
+from werkzeug.http import is_resource_modified
 
 from ..api import models
 from ..api.errors import ItemNotFoundError, UserPermissionError
+from .cache import FragmentCache
 
 bp = Blueprint('simple_interface', __name__, template_folder='templates')
 
 
+@bp.record_once
+def setup_fragment_cache(state) -> None:
+    """Create the app's cache for rendered list rows."""
+    max_size = state.app.config['STUFFR_FRAGMENT_CACHE_SIZE']
+    state.app.extensions['stuffr_fragment_cache'] = FragmentCache(max_size)
+
+
+# Helper functions
+##################
+
+def get_page() -> int:
+    """Return the page number requested in the query string."""
+    return max(request.args.get('page', 1, type=int), 1)
+
+
+def make_etag(*validators) -> str:
+    """Create an ETag from values that change when the page does."""
+    return hashlib.sha1(repr(validators).encode()).hexdigest()
+
+
+def conditional_response(etag: str, last_modified: Optional[datetime.datetime],
+                         render: Callable[[], str]) -> Response:
+    """Respond with 304 Not Modified if the client is up to date.
+
+    render() is only called if a full response is needed.
+    """
+    if last_modified is not None:
+        # Werkzeug compares against naive UTC datetimes
+        last_modified = last_modified.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    if is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        response = Response(render(), mimetype='text/html')
+    else:
+        response = Response(status=HTTPStatus.NOT_MODIFIED)
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    # Pages are per-user, and must be revalidated in case they changed
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+def render_thing_rows(things: Sequence) -> list:
+    """Render list rows for things, using cached rows when possible."""
+    cache = current_app.extensions['stuffr_fragment_cache']
+    template = current_app.jinja_env.get_template('simple/thing_row.html')
+    return [cache.get_or_render(('thing', t.id, t.date_modified),
+                                lambda t=t: template.render(thing=t))
+            for t in things]
+
+
+# Views
+#######
+
 @bp.route('/')
 @login_required
 def main_view() -> str:
@@ -29,32 +93,49 @@ def main_view() -> str:
 
 @bp.route('/inventories/')
 @login_required
-def list_inventories() -> str:
-    """Display all available inventories."""
-    inventories = models.Inventory.get_user_inventories(current_user.id)
-    return render_template('simple/inventories.html', inventories=inventories)
+def list_inventories() -> Response:
+    """Display available inventories, one page at a time."""
+    page = models.Inventory.get_user_inventories_page(
+        current_user.id, get_page(), current_app.config['STUFFR_SIMPLE_PAGE_SIZE'])
+    etag = make_etag('inventories', page.page, page.per_page, page.total, page.items)
+    return conditional_response(etag, None, lambda: render_template(
+        'simple/inventories.html', inventories=page.items, pagination=page))
 
 
 @bp.route('/inventories/<int:inventory_id>/')
 @login_required
-def list_things(inventory_id: int) -> str:
-    """Display things part of given inventory."""
+def list_things(inventory_id: int) -> Response:
+    """Display things part of given inventory, one page at a time."""
     try:
-        things = models.Thing.get_things_for_inventory(inventory_id, current_user.id)
-    except (ItemNotFoundError, UserPermissionError) as e:
+        models.Inventory.check_user_access(inventory_id, current_user.id)
+    except (ItemNotFoundError, UserPermissionError):
         abort(HTTPStatus.FORBIDDEN)
-    return render_template('simple/things.html', things=things)
+    page_number = get_page()
+    per_page = current_app.config['STUFFR_SIMPLE_PAGE_SIZE']
+    num_things, last_modified = models.Thing.get_inventory_version(inventory_id)
+    etag = make_etag('things', inventory_id, page_number, per_page, num_things, last_modified)
+
+    def render():
+        """Render the page of things."""
+        page = models.Thing.get_thing_summaries_page(
+            inventory_id, current_user.id, page_number, per_page)
+        return render_template('simple/things.html',
+                               rows=render_thing_rows(page.items), pagination=page)
+
+    return conditional_response(etag, last_modified, render)
 
 
 @bp.route('/inventories/<int:inventory_id>/<int:thing_id>/')
 @login_required
-def thing_details(inventory_id: int, thing_id: int) -> str:
+def thing_details(inventory_id: int, thing_id: int) -> Response:
     """Display details for specified thing."""
     try:
         thing = models.Thing.get_thing(thing_id, current_user.id)
-    except (ItemNotFoundError, UserPermissionError) as e:
+    except (ItemNotFoundError, UserPermissionError):
         abort(HTTPStatus.FORBIDDEN)
     # If the thing ID is correct but the inventory ID is not, something is screwy
     if inventory_id != thing.inventory_id:
         abort(HTTPStatus.BAD_REQUEST)
-    return render_template('simple/thing_details.html', thing=thing.as_client_dict())
+    etag = make_etag('thing', thing.id, thing.date_modified)
+    return conditional_response(etag, thing.date_modified, lambda: render_template(
+        'simple/thing_details.html', thing=thing.as_client_dict()))
@@ -0,0 +1,49 @@
+"""In-process cache for rendered HTML fragments."""
+
+from collections import OrderedDict
+import threading
+from typing import Callable, Hashable
+from flask import Markup
+
+
+class FragmentCache:
+    """Least-recently-used cache of rendered HTML fragments.
+
+    Keys should include everything the fragment depends on, e.g. a thing's ID
+    and modification date, so that stale entries are never looked up again
+    and simply fall off the end of the cache.
+    """
+
+    def __init__(self, max_size: int) -> None:
+        """Create an empty cache holding up to max_size fragments."""
+        self.max_size = max_size
+        self._fragments = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        """Number of fragments currently cached."""
+        return len(self._fragments)
+
+    def get_or_render(self, key: Hashable, render: Callable[[], str]) -> Markup:
+        """Return the cached fragment for key, rendering it if needed."""
+        with self._lock:
+            fragment = self._fragments.get(key)
+            if fragment is not None:
+                self._fragments.move_to_end(key)
+                self.hits += 1
+                return fragment
+            self.misses += 1
+        # Render outside the lock, rendering the same fragment twice is harmless
+        fragment = Markup(render())
+        with self._lock:
+            self._fragments[key] = fragment
+            if len(self._fragments) > self.max_size:
+                self._fragments.popitem(last=False)
+        return fragment
+
+    def clear(self) -> None:
+        """Remove all cached fragments."""
+        with self._lock:
+            self._fragments.clear()
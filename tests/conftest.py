@@ -6,7 +6,9 @@ import json
 from http import HTTPStatus
 import pytest
 from flask import url_for, session
+from flask.testing import FlaskClient
 from flask_security.utils import login_user
+from sqlalchemy import event
 from sqlalchemy.engine.url import URL
 
 from stuffrapp import create_app, user_store
@@ -67,6 +69,18 @@ def _login_session(test_app, client):
     client.set_cookie('localhost', 'session', session_cookie)
 
 
+class ClosingClient(FlaskClient):
+    """Test client that closes responses after reading them, like a WSGI server.
+
+    Pass buffered=False to read a streamed response, and close it when done.
+    """
+
+    def open(self, *args, **kwargs):  # pylint: disable=arguments-differ
+        """Make a request, reading and closing the response unless buffered is False."""
+        kwargs.setdefault('buffered', True)
+        return super().open(*args, **kwargs)
+
+
 # Test data
 ############
 TEST_TIME = datetime.datetime(2011, 11, 11, 11, 11, 11,
@@ -105,9 +119,12 @@ def app():
         'SECURITY_PASSWORD_HASH': 'plaintext',
         'SQLALCHEMY_DATABASE_URI': URL(drivername='sqlite'),
         'SQLALCHEMY_TRACK_MODIFICATIONS': False,
-        'MAIL_SUPPRESS_SEND': True
+        'MAIL_SUPPRESS_SEND': True,
+        # Rate limits are tested separately, see test_ratelimit.py
+        'STUFFR_RATE_LIMIT': None
     }
     new_app = create_app(config_override=test_config)
+    new_app.test_client_class = ClosingClient
     return new_app
 
 
@@ -150,6 +167,24 @@ def setupdb(app):  # pylint: disable=redefined-outer-name,unused-argument
     yield test_values
     db.session.remove()
     db.drop_all()
+    # Cached data is for a database that no longer exists
+    app.extensions['stuffr_count_cache'].clear()
+
+
+@pytest.fixture
+def statements(app):  # pylint: disable=redefined-outer-name,unused-argument
+    """List of SQL statements executed during the test.
+
+    Clear it before the code being measured.
+    """
+    executed = []
+
+    def record_statement(_conn, _cursor, statement, *_):
+        """Record each statement sent to the database."""
+        executed.append(statement)
+    event.listen(db.engine, 'before_cursor_execute', record_statement)
+    yield executed
+    event.remove(db.engine, 'before_cursor_execute', record_statement)
 
 
 @pytest.fixture
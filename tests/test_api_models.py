@@ -1,11 +1,14 @@
 """Test cases for Stuffr models."""
 
 from collections import abc
+import datetime
 import pytest
+import sqlalchemy
 
+from database import db
 from stuffrapp.api import models
 from stuffrapp.api.errors import InvalidDataError, ItemNotFoundError, \
-    UserPermissionError
+    PreconditionFailedError, UserPermissionError
 from tests import conftest
 
 
@@ -112,6 +115,39 @@ class TestInventoryModel(ModelTestBase):
         with pytest.raises(ItemNotFoundError):
             self.model.create_new_inventory(new_data, setupdb.test_user_bad_id)
 
+    def test_create_new_inventory_statements(self, setupdb, statements):
+        """Test that creating an inventory does not read it back afterwards."""
+        statements.clear()
+        new_inventory = self.model.create_new_inventory({'name': 'NEW_INVENTORY'},
+                                                        setupdb.test_user_id)
+        new_inventory_dict = new_inventory._asdict()
+        # The second INSERT is the journal entry
+        assert [s.split()[0] for s in statements] == ['SELECT', 'INSERT', 'INSERT']
+        assert new_inventory_dict == self.model.query.get(new_inventory.id)._asdict()
+
+    def test_check_user_access(self, setupdb):
+        """Check verifying ownership of an inventory."""
+        self.model.check_user_access(setupdb.test_inventory_id, setupdb.test_user_id)
+
+        with pytest.raises(ItemNotFoundError):
+            self.model.check_user_access(setupdb.test_inventory_bad_id, setupdb.test_user_id)
+
+        with pytest.raises(UserPermissionError):
+            self.model.check_user_access(setupdb.test_inventory_id, setupdb.test_alt_user_id)
+
+    def test_check_user_access_many(self, setupdb, statements):
+        """Check verifying ownership of several inventories at once."""
+        alt_inventory_id = self.model.query.filter_by(user_id=setupdb.test_alt_user_id). \
+            first().id
+        statements.clear()
+        access_errors = self.model.check_user_access_many(
+            [setupdb.test_inventory_id, setupdb.test_inventory_bad_id, alt_inventory_id],
+            setupdb.test_user_id)
+        assert len(statements) == 1
+        assert set(access_errors) == {setupdb.test_inventory_bad_id, alt_inventory_id}
+        assert isinstance(access_errors[setupdb.test_inventory_bad_id], ItemNotFoundError)
+        assert isinstance(access_errors[alt_inventory_id], UserPermissionError)
+
 
 class TestThingModel(ModelTestBase):
     """Test cases for Things."""
@@ -136,6 +172,174 @@ class TestThingModel(ModelTestBase):
         assert len(things) == num_test_things
         assert all(isinstance(t, self.model) for t in things)
 
+    def test_get_things_for_inventory_fields(self, setupdb, statements):
+        """Test that only the requested columns are loaded."""
+        statements.clear()
+        things = self.model.get_things_for_inventory(
+            setupdb.test_inventory_id, setupdb.test_user_id, ['name', 'location'])
+        assert things
+        assert 'details' not in statements[-1]
+        assert 'date_created' not in statements[-1]
+        num_statements = len(statements)
+        assert [set(t.as_client_dict(['name', 'location'])) for t in things] == \
+            [{'name', 'location'}] * len(things)
+        assert len(statements) == num_statements
+
+    def test_get_things_for_inventory_sorted(self, setupdb):
+        """Test sorting things, with names sorted case-insensitively."""
+        for name, location in [('banana', 'B'), ('Apple', None), ('cherry', 'A')]:
+            self.model.create_new_thing({'name': name, 'location': location},
+                                        setupdb.test_inventory_id, setupdb.test_user_id)
+        things = self.model.get_things_for_inventory(
+            setupdb.test_inventory_id, setupdb.test_user_id,
+            filters={'name_prefix': ''}, sort='name')
+        names = [t.name for t in things]
+        assert names == sorted(names, key=str.casefold)
+        assert names.index('Apple') < names.index('banana') < names.index('cherry')
+
+        things = self.model.get_things_for_inventory(
+            setupdb.test_inventory_id, setupdb.test_user_id, sort='-date_created')
+        assert [t.id for t in things] == sorted((t.id for t in things), reverse=True)
+        things = self.model.get_things_for_inventory(
+            setupdb.test_inventory_id, setupdb.test_user_id, sort='location')
+        assert [t.location for t in things][:3] == [None, 'A', 'B']
+
+        for sort in ('inventory_id', '-', 'name_key'):
+            with pytest.raises(InvalidDataError):
+                self.model.get_things_for_inventory(
+                    setupdb.test_inventory_id, setupdb.test_user_id, sort=sort)
+
+    def test_get_things_for_inventory_filtered(self, setupdb):
+        """Test filtering things."""
+        self.model.create_new_thing({'name': 'NEW thing', 'location': 'Shelf 1'},
+                                    setupdb.test_inventory_id, setupdb.test_user_id)
+
+        def get_names(**filters):
+            things = self.model.get_things_for_inventory(
+                setupdb.test_inventory_id, setupdb.test_user_id, filters=filters)
+            return sorted(t.name for t in things)
+
+        assert get_names(name_prefix='new') == ['NEW thing']
+        assert get_names(name_prefix='New T') == ['NEW thing']
+        assert get_names(location='Shelf 1') == ['NEW thing']
+        assert get_names(location='Shelf') == []
+        assert get_names(location_prefix='Shelf') == ['NEW thing']
+        assert len(get_names(location_prefix='T')) == 2
+        assert get_names(created_after=conftest.TEST_TIME_COMPARE) == ['NEW thing']
+        assert 'NEW thing' not in get_names(modified_before=conftest.TEST_TIME_COMPARE)
+        assert len(get_names(created_after=conftest.TEST_TIME,
+                             created_before=conftest.TEST_TIME_COMPARE)) == 2
+        assert get_names(created_before=conftest.TEST_TIME) == []
+
+        with pytest.raises(InvalidDataError):
+            get_names(not_a_filter='value')
+        with pytest.raises(InvalidDataError):
+            get_names(created_after='2011-11-11')
+
+    def test_sort_uses_index(self, setupdb):
+        """Test that sorting by name is done with an index."""
+        query = self.model.query.filter_by(inventory_id=setupdb.test_inventory_id). \
+            order_by(*self.model._sort_order('name'))
+        plan = db.session.execute('EXPLAIN QUERY PLAN ' + str(query.statement.compile(
+            compile_kwargs={'literal_binds': True}))).fetchall()
+        plan_text = ' '.join(str(row) for row in plan)
+        assert 'ix_thing_inventory_id_name_key' in plan_text
+        assert 'TEMP B-TREE' not in plan_text
+
+    def test_name_key(self, setupdb):
+        """Test that the name sort key follows the name."""
+        thing = self.model.create_new_thing({'name': 'MiXeD'}, setupdb.test_inventory_id,
+                                            setupdb.test_user_id)
+        assert thing.name_key == 'mixed'
+        self.model.update_thing(thing.id, {'name': 'Straße'}, setupdb.test_user_id)
+        assert self.model.query.get(thing.id).name_key == 'strasse'
+
+    def test_get_things_for_inventories(self, setupdb, statements):
+        """Test getting the things of several inventories with one query."""
+        inventory_ids = [i.id for i in models.Inventory.query]
+        self.model.create_new_thing({'name': 'Third'}, setupdb.test_inventory_id,
+                                    setupdb.test_user_id)
+        self.model.delete_thing(setupdb.test_thing_id, setupdb.test_user_id)
+        statements.clear()
+        things = self.model.get_things_for_inventories(
+            inventory_ids + [setupdb.test_inventory_bad_id])
+        assert len(statements) == 1
+        assert set(things) == set(inventory_ids) | {setupdb.test_inventory_bad_id}
+        assert things[setupdb.test_inventory_bad_id] == []
+        for inventory_id in inventory_ids:
+            expected = self.model.query.filter_by(inventory_id=inventory_id, date_deleted=None). \
+                order_by(self.model.id).all()
+            assert things[inventory_id] == expected
+
+        statements.clear()
+        executed = []
+
+        def record_parameters(_conn, _cursor, statement, parameters, *_):
+            """Record each statement with its parameters."""
+            executed.append((statement, parameters))
+        sqlalchemy.event.listen(db.engine, 'before_cursor_execute', record_parameters)
+        things = self.model.get_things_for_inventories(inventory_ids, fields=['name'], limit=1)
+        sqlalchemy.event.remove(db.engine, 'before_cursor_execute', record_parameters)
+        assert all(len(t) == 1 for t in things.values())
+        assert things[setupdb.test_inventory_id][0].name == 'Test Thing U1I1T0'
+        assert 'details' not in statements[0]
+        assert len(statements) == 1
+        # Only the first things of each inventory are read from the index, in
+        # order, then looked up by ID
+        plan = [row[-1] for row in db.session.connection().connection.execute(
+            'EXPLAIN QUERY PLAN ' + executed[0][0], executed[0][1])]
+        assert 'SEARCH thing USING INTEGER PRIMARY KEY (rowid=?)' in plan
+        assert 'SEARCH thing_1 USING INDEX ix_thing_inventory_id_date_created (inventory_id=?)' \
+            in plan
+        # Only the result is sorted
+        assert plan.count('USE TEMP B-TREE FOR ORDER BY') == 1
+        assert self.model.get_things_for_inventories([]) == {}
+
+    def test_get_thing_counts(self, setupdb):
+        """Test counting things per inventory and per location."""
+        empty_inventory = models.Inventory.create_new_inventory({'name': 'Empty'},
+                                                                setupdb.test_user_id)
+        self.model.create_new_thing({'name': 'No location'}, setupdb.test_inventory_id,
+                                    setupdb.test_user_id)
+        self.model.delete_thing(setupdb.test_thing_id, setupdb.test_user_id)
+        thing_counts = self.model.get_thing_counts(setupdb.test_user_id)
+
+        user_things = self.model.query.join(models.Inventory). \
+            filter(models.Inventory.user_id == setupdb.test_user_id,
+                   self.model.date_deleted.is_(None)).all()
+        expected_inventories = {i.id: 0 for i in
+                                models.Inventory.get_user_inventories(setupdb.test_user_id)}
+        expected_locations = {}
+        for thing in user_things:
+            expected_inventories[thing.inventory_id] += 1
+            expected_locations[thing.location] = expected_locations.get(thing.location, 0) + 1
+        assert thing_counts == {'inventories': expected_inventories,
+                                'locations': expected_locations}
+        assert thing_counts['inventories'][empty_inventory.id] == 0
+        assert thing_counts['locations'][None] == 1
+
+    def test_details_deferred(self, setupdb, statements):
+        """Test that details are only loaded when used or requested."""
+        db.session.expunge_all()
+        statements.clear()
+        thing = self.model.query.get(setupdb.test_thing_id)
+        assert 'details' not in statements[-1]
+        assert thing.details is not None
+        assert 'details' in statements[-1]
+        db.session.expunge_all()
+        thing = self.model.get_thing(setupdb.test_thing_id, setupdb.test_user_id)
+        assert 'details' in sqlalchemy.inspect(thing).dict
+
+    def test_parse_client_fields(self):
+        """Test parsing a list of fields from a query string."""
+        assert self.model.parse_client_fields(None) is None
+        assert self.model.parse_client_fields('id, name,id,details') == \
+            ['id', 'name', 'details']
+        with pytest.raises(InvalidDataError):
+            self.model.parse_client_fields('id,inventory_id')
+        with pytest.raises(InvalidDataError):
+            self.model.parse_client_fields(',')
+
     def test_get_thing(self, setupdb):
         """Test that thing details are retreived."""
         thing = self.model.get_thing(setupdb.test_thing_id, setupdb.test_user_id)
@@ -205,6 +409,18 @@ class TestThingModel(ModelTestBase):
                                         setupdb.test_inventory_id,
                                         setupdb.test_user_bad_id)
 
+    def test_create_new_thing_statements(self, setupdb, statements):
+        """Test that creating a thing does not read it back afterwards."""
+        statements.clear()
+        new_thing = self.model.create_new_thing({'name': 'NEW_THING'},
+                                                setupdb.test_inventory_id,
+                                                setupdb.test_user_id)
+        new_thing_dict = new_thing._asdict()
+        # The second INSERT is the journal entry
+        assert [s.split()[0] for s in statements] == ['SELECT', 'INSERT', 'INSERT']
+        assert new_thing_dict['date_modified'] == new_thing_dict['date_created']
+        assert new_thing_dict == self.model.query.get(new_thing.id)._asdict()
+
     def test_update_thing(self, setupdb):
         """Test that thing data is updated."""
         # Everything correct
@@ -246,6 +462,45 @@ class TestThingModel(ModelTestBase):
                                     conftest.TEST_UPDATE_THING,
                                     setupdb.test_alt_user_id)
 
+    def test_update_thing_single_statement(self, setupdb, statements):
+        """Test that a successful update is a single UPDATE, and its journal entry."""
+        statements.clear()
+        updated = self.model.update_thing(setupdb.test_thing_id, conftest.TEST_UPDATE_THING,
+                                          setupdb.test_user_id)
+        assert len(statements) == 2
+        assert statements[0].startswith('UPDATE')
+        assert statements[1].startswith('INSERT INTO journal_entry')
+        thing = self.model.query.get(setupdb.test_thing_id)
+        assert thing.date_modified == updated['date_modified']
+        assert thing.name == conftest.TEST_UPDATE_THING['name']
+
+    def test_update_thing_if_match(self, setupdb):
+        """Test conditional updates based on the modification date."""
+        # Test data is all created at TEST_TIME
+        updated = self.model.update_thing(setupdb.test_thing_id, {'name': 'First'},
+                                          setupdb.test_user_id,
+                                          expected_date_modified=conftest.TEST_TIME)
+        assert updated['date_modified'] > conftest.TEST_TIME
+        # Stale date
+        with pytest.raises(PreconditionFailedError):
+            self.model.update_thing(setupdb.test_thing_id, {'name': 'Second'},
+                                    setupdb.test_user_id,
+                                    expected_date_modified=conftest.TEST_TIME)
+        with pytest.raises(PreconditionFailedError):
+            self.model.update_thing(setupdb.test_thing_id, {}, setupdb.test_user_id,
+                                    expected_date_modified=conftest.TEST_TIME)
+        assert self.model.query.get(setupdb.test_thing_id).name == 'First'
+        # Same instant in another time zone
+        other_zone = updated['date_modified'].astimezone(
+            datetime.timezone(datetime.timedelta(hours=-5)))
+        self.model.update_thing(setupdb.test_thing_id, {'name': 'Second'},
+                                setupdb.test_user_id, expected_date_modified=other_zone)
+        # Ownership is checked before the date
+        with pytest.raises(UserPermissionError):
+            self.model.update_thing(setupdb.test_thing_id, {'name': 'Third'},
+                                    setupdb.test_alt_user_id,
+                                    expected_date_modified=conftest.TEST_TIME)
+
         # Invalid user
         with pytest.raises(ItemNotFoundError):
             self.model.update_thing(setupdb.test_thing_id,
@@ -0,0 +1,70 @@
+"""Test cases for the precomputed API spec."""
+
+import gzip
+import json
+from http import HTTPStatus
+import pytest
+from flask import url_for
+
+from stuffrapp.api import spec
+from stuffrapp.api.views import api
+
+
+pytestmark = pytest.mark.spec
+
+
+def test_spec_matches_restplus(app, client):
+    """Test that the served spec is the one generated by flask_restplus."""
+    response = client.get(url_for('stuffrapi.specs'))
+    assert response.status_code == HTTPStatus.OK
+    assert response.mimetype == 'application/json'
+    assert response.headers['ETag'] == '"{}"'.format(spec.get_spec().etag)
+    with app.test_request_context():
+        expected = json.loads(json.dumps(api.__schema__))
+    assert json.loads(response.get_data(as_text=True)) == expected
+
+
+def test_spec_conditional(client):
+    """Test that the spec is not sent again if the client has it."""
+    etag = client.get(url_for('stuffrapi.specs')).headers['ETag']
+    response = client.get(url_for('stuffrapi.specs'), headers={'If-None-Match': etag})
+    assert response.status_code == HTTPStatus.NOT_MODIFIED
+    assert response.get_data() == b''
+    response = client.get(url_for('stuffrapi.specs'), headers={'If-None-Match': '"stale"'})
+    assert response.status_code == HTTPStatus.OK
+
+
+def test_spec_gzip(client):
+    """Test that the precompressed spec is sent to clients accepting gzip."""
+    response = client.get(url_for('stuffrapi.specs'), headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in response.headers['Vary']
+    assert gzip.decompress(response.get_data()) == spec.get_spec().data
+    assert response.headers['ETag'] == '"{}-gzip"'.format(spec.get_spec().etag)
+    # The uncompressed spec's ETag doesn't match the compressed one
+    response = client.get(url_for('stuffrapi.specs'),
+                          headers={'Accept-Encoding': 'gzip',
+                                   'If-None-Match': '"{}"'.format(spec.get_spec().etag)})
+    assert response.status_code == HTTPStatus.OK
+
+
+def test_spec_gzip_refused(client):
+    """Test that the uncompressed spec is sent to clients refusing gzip."""
+    response = client.get(url_for('stuffrapi.specs'), headers={'Accept-Encoding': 'gzip;q=0'})
+    assert 'Content-Encoding' not in response.headers
+    assert response.get_data() == spec.get_spec().data
+
+
+def test_spec_file(app, client, tmpdir):
+    """Test serving a spec generated ahead of time."""
+    spec_file = tmpdir.join('swagger.json')
+    spec_file.write_binary(b'{"swagger": "file"}')
+    generated = spec.get_spec()
+    app.config['STUFFR_API_SPEC_FILE'] = str(spec_file)
+    try:
+        spec.init_app(app)
+        response = client.get(url_for('stuffrapi.specs'))
+        assert response.get_data() == b'{"swagger": "file"}'
+    finally:
+        app.config['STUFFR_API_SPEC_FILE'] = None
+        app.extensions['stuffr_api_spec'] = generated
@@ -1,11 +1,16 @@
 """Test cases for Stuffr views."""
 
+import csv
 import datetime
+import gzip
 from http import HTTPStatus
+import io
+import json
 import pytest
 from flask import url_for
 
 from stuffrapp.api import models
+from database import db
 from tests import conftest
 from tests.conftest import post_as_json, CommonViewTests
 
@@ -146,6 +151,114 @@ class TestGetInventories(CommonViewTests):
             expected_response.remove(response_inventory)
         assert expected_response == [], "Unknown inventories in database"
 
+    def test_get_inventories_counts(self, authenticated_client, setupdb):
+        """Test GETing Inventories with their numbers of things."""
+        url = url_for(self.view_name, counts='true')
+        response = authenticated_client.get(url)
+        assert response.status_code == HTTPStatus.OK
+        expected_counts = models.Thing.get_thing_counts(setupdb.test_user_id)['inventories']
+        assert {i['id']: i['num_things'] for i in response.json} == expected_counts
+
+
+class TestGetBootstrap(CommonViewTests):
+    """Tests for getting all data needed at startup."""
+
+    view_name = 'stuffrapi.get_bootstrap'
+    method = 'get'
+
+    def test_get_bootstrap(self, authenticated_client, setupdb):
+        """Test GETing user info, inventories and things together."""
+        url = url_for(self.view_name)
+        response = authenticated_client.get(url)
+        assert response.status_code == HTTPStatus.OK
+        data = response.json
+
+        userinfo = authenticated_client.get(url_for('stuffrapi.get_userinfo')).json
+        assert data['user'] == userinfo
+        inventories = authenticated_client.get(url_for('stuffrapi.get_inventories')).json
+        assert [{k: v for k, v in i.items() if k not in ('things', 'more_things')}
+                for i in data['inventories']] == inventories
+        for inventory in data['inventories']:
+            things_url = url_for('stuffrapi.get_things', inventory_id=inventory['id'])
+            assert inventory['things'] == authenticated_client.get(things_url).json
+            assert inventory['more_things'] is False
+
+    def test_get_bootstrap_limit_fields(self, authenticated_client, setupdb):
+        """Test limiting the number and fields of things."""
+        url = url_for(self.view_name, things_limit=1, fields='id,name')
+        response = authenticated_client.get(url)
+        assert response.status_code == HTTPStatus.OK
+        for inventory in response.json['inventories']:
+            assert len(inventory['things']) == 1
+            assert set(inventory['things'][0]) == {'id', 'name'}
+            assert inventory['more_things'] is True
+
+        for params in ({'things_limit': -1}, {'fields': 'inventory_id'}):
+            response = authenticated_client.get(url_for(self.view_name, **params))
+            assert response.status_code == HTTPStatus.BAD_REQUEST
+
+    def test_get_bootstrap_queries(self, authenticated_client, setupdb, statements):
+        """Test that the number of queries doesn't depend on the number of inventories."""
+        url = url_for(self.view_name)
+        authenticated_client.get(url)
+        statements.clear()
+        authenticated_client.get(url)
+        num_statements = len(statements)
+
+        for i in range(3):
+            inventory = models.Inventory.create_new_inventory({'name': f'Extra {i}'},
+                                                              setupdb.test_user_id)
+            models.Thing.create_new_thing({'name': 'Extra'}, inventory.id,
+                                          setupdb.test_user_id)
+        authenticated_client.get(url)
+        statements.clear()
+        response = authenticated_client.get(url)
+        assert len(response.json['inventories']) == 5
+        assert len(statements) == num_statements
+
+
+class TestGetThingCounts(CommonViewTests):
+    """Tests for getting numbers of things."""
+
+    view_name = 'stuffrapi.get_thing_counts'
+    method = 'get'
+
+    def test_get_thing_counts(self, authenticated_client, setupdb):
+        """Test GETing the numbers of things per inventory and location."""
+        url = url_for(self.view_name)
+        response = authenticated_client.get(url)
+        assert response.status_code == HTTPStatus.OK
+        expected_counts = models.Thing.get_thing_counts(setupdb.test_user_id)
+        assert response.json['inventories'] == [
+            {'id': i, 'num_things': n} for i, n in sorted(expected_counts['inventories'].items())]
+        assert response.json['locations'] == [
+            {'location': location, 'num_things': n}
+            for location, n in sorted(expected_counts['locations'].items())]
+
+    def test_counts_updated_after_writes(self, authenticated_client, setupdb):
+        """Test that cached counts are invalidated when things are written."""
+        url = url_for(self.view_name)
+
+        def get_location_counts():
+            """Return the number of things at each location."""
+            response = authenticated_client.get(url)
+            return {c['location']: c['num_things'] for c in response.json['locations']}
+
+        assert 'Attic' not in get_location_counts()
+        thing_url = url_for('stuffrapi.post_thing', inventory_id=setupdb.test_inventory_id)
+        response = post_as_json(authenticated_client.post, thing_url,
+                                {'name': 'New', 'location': 'Attic'})
+        assert get_location_counts()['Attic'] == 1
+
+        thing_url = url_for('stuffrapi.update_thing', thing_id=response.json['id'])
+        post_as_json(authenticated_client.put, thing_url, {'location': 'Cellar'})
+        location_counts = get_location_counts()
+        assert 'Attic' not in location_counts
+        assert location_counts['Cellar'] == 1
+
+        authenticated_client.delete(thing_url)
+        assert 'Cellar' not in get_location_counts()
+
 
 class TestPostInventory(CommonViewTests, SubmitRequestMixin):
     """Tests for adding inventories."""
@@ -260,7 +373,7 @@ class TestGetThings(CommonViewTests):
                 expected_thing['date_created'].isoformat()
             expected_thing['date_modified'] = \
                 expected_thing['date_modified'].isoformat()
-            del expected_thing['inventory_id']
+            del expected_thing['inventory_id'], expected_thing['name_key']
             expected_response.append(expected_thing)
 
         response = authenticated_client.get(url)
@@ -291,6 +404,166 @@ class TestGetThings(CommonViewTests):
         response = authenticated_client.get(url)
         assert response.status_code == HTTPStatus.FORBIDDEN
 
+    def test_get_things_fields(self, authenticated_client, setupdb):
+        """Test GETing only some fields of Things."""
+        url = url_for(self.view_name, fields='id,name', **self.view_params)
+        response = authenticated_client.get(url)
+        assert response.status_code == HTTPStatus.OK
+        expected_response = [
+            {'id': t.id, 'name': t.name} for t in models.Thing.query.filter_by(
+                inventory_id=setupdb.test_inventory_id, date_deleted=None)]
+        assert sorted(response.json, key=lambda t: t['id']) == \
+            sorted(expected_response, key=lambda t: t['id'])
+
+    def test_get_things_bad_fields(self, authenticated_client):
+        """Test requesting fields that don't exist or aren't for clients."""
+        for fields in ('id,not_a_field', 'inventory_id', ''):
+            url = url_for(self.view_name, fields=fields, **self.view_params)
+            response = authenticated_client.get(url)
+            assert response.status_code == HTTPStatus.BAD_REQUEST
+
+    def test_get_things_sorted_filtered(self, authenticated_client, setupdb):
+        """Test sorting and filtering things."""
+        for name in ('b thing', 'A thing', 'Other'):
+            models.Thing.create_new_thing({'name': name}, setupdb.test_inventory_id,
+                                          setupdb.test_user_id)
+        url = url_for(self.view_name, sort='-name', name_prefix='a', fields='name',
+                      **self.view_params)
+        response = authenticated_client.get(url)
+        assert response.status_code == HTTPStatus.OK
+        assert response.json == [{'name': 'A thing'}]
+
+        url = url_for(self.view_name, sort='name', created_after='2012-01-01T00:00:00Z',
+                      fields='name', **self.view_params)
+        response = authenticated_client.get(url)
+        assert response.json == [{'name': 'A thing'}, {'name': 'b thing'}, {'name': 'Other'}]
+
+        url = url_for(self.view_name, modified_before='2012-01-01T00:00:00+00:00',
+                      **self.view_params)
+        response = authenticated_client.get(url)
+        assert response.status_code == HTTPStatus.OK
+        assert len(response.json) == 2
+
+    def test_get_things_bad_sort_filters(self, authenticated_client):
+        """Test invalid sort and filter parameters."""
+        for params in ({'sort': 'details'}, {'created_after': 'yesterday'},
+                       {'modified_before': '2012-01-01T00:00:00'}):
+            url = url_for(self.view_name, **params, **self.view_params)
+            response = authenticated_client.get(url)
+            assert response.status_code == HTTPStatus.BAD_REQUEST
+
+
+class TestGetThingsForInventories(CommonViewTests):
+    """Tests for getting things from several inventories."""
+
+    view_name = 'stuffrapi.get_things_for_inventories'
+    method = 'get'
+
+    def test_get_things_for_inventories(self, authenticated_client, setupdb):
+        """Test GETing things from several inventories, including inaccessible ones."""
+        user_inventory_ids = [i.id for i in
+                              models.Inventory.get_user_inventories(setupdb.test_user_id)]
+        alt_inventory_id = models.Inventory.query. \
+            filter_by(user_id=setupdb.test_alt_user_id).first().id
+        inventory_ids = user_inventory_ids + [setupdb.test_inventory_bad_id, alt_inventory_id]
+        url = url_for(self.view_name, inventory_ids=','.join(str(i) for i in inventory_ids))
+        response = authenticated_client.get(url)
+        assert response.status_code == HTTPStatus.OK
+        inventories = response.json['inventories']
+        assert [i['id'] for i in inventories] == inventory_ids
+
+        for inventory in inventories[:len(user_inventory_ids)]:
+            things_url = url_for('stuffrapi.get_things', inventory_id=inventory['id'])
+            assert inventory['things'] == authenticated_client.get(things_url).json
+            assert 'error' not in inventory
+        assert inventories[-2]['error']['status'] == HTTPStatus.NOT_FOUND
+        assert inventories[-1]['error']['status'] == HTTPStatus.FORBIDDEN
+        assert 'things' not in inventories[-1]
+
+    def test_queries(self, authenticated_client, setupdb, statements):
+        """Test that ownership and things are each checked with one query."""
+        url = url_for(self.view_name, inventory_ids=setupdb.test_inventory_id)
+        authenticated_client.get(url)
+        statements.clear()
+        authenticated_client.get(url)
+        num_statements = len(statements)
+
+        inventory_ids = [i.id for i in models.Inventory.query]
+        url = url_for(self.view_name, inventory_ids=','.join(str(i) for i in inventory_ids),
+                      fields='name')
+        authenticated_client.get(url)
+        statements.clear()
+        response = authenticated_client.get(url)
+        assert len(statements) == num_statements
+        assert all(set(t) == {'name'} for i in response.json['inventories']
+                   for t in i.get('things', []))
+
+    def test_bad_inventory_ids(self, authenticated_client):
+        """Test requests with invalid or missing inventory IDs."""
+        for params in ({}, {'inventory_ids': ''}, {'inventory_ids': '1,two'},
+                       {'inventory_ids': ','.join(str(i) for i in range(1000))},
+                       {'inventory_ids': '1', 'fields': 'bad'}):
+            response = authenticated_client.get(url_for(self.view_name, **params))
+            assert response.status_code == HTTPStatus.BAD_REQUEST
+
+
+class TestGetThing(CommonViewTests):
+    """Tests for getting a single thing."""
+
+    view_name = 'stuffrapi.get_thing'
+    method = 'get'
+    model = models.Thing
+
+    @pytest.fixture(autouse=True)
+    def set_view_params(self, setupdb):
+        """Set up test params for getting a thing."""
+        self.view_params = {'thing_id': setupdb.test_thing_id}
+
+    def test_get_thing(self, authenticated_client, setupdb):
+        """Test GETing a Thing."""
+        url = url_for(self.view_name, **self.view_params)
+        response = authenticated_client.get(url)
+        assert response.status_code == HTTPStatus.OK
+        thing = models.Thing.query.get(setupdb.test_thing_id)
+        assert response.json['details'] == thing.details
+        assert set(response.json) == models.Thing.CLIENT_FIELDS
+
+    def test_get_thing_fields(self, authenticated_client):
+        """Test GETing some fields of a Thing."""
+        url = url_for(self.view_name, fields='name,location', **self.view_params)
+        response = authenticated_client.get(url)
+        assert response.status_code == HTTPStatus.OK
+        assert set(response.json) == {'name', 'location'}
+
+        url = url_for(self.view_name, fields='name,not_a_field', **self.view_params)
+        response = authenticated_client.get(url)
+        assert response.status_code == HTTPStatus.BAD_REQUEST
+
+    def test_get_thing_etag(self, authenticated_client):
+        """Test that the ETag of a Thing can be used to update it."""
+        url = url_for(self.view_name, fields='name', **self.view_params)
+        response = authenticated_client.get(url)
+        assert set(response.json) == {'name'}
+        headers = {'Content-Type': 'application/json', 'If-Match': response.headers['ETag']}
+        put_url = url_for('stuffrapi.update_thing', **self.view_params)
+        response = authenticated_client.put(put_url, data=json.dumps({'name': 'New'}),
+                                            headers=headers)
+        assert response.status_code == HTTPStatus.OK
+
+    def test_get_nonexistant_thing(self, authenticated_client, setupdb):
+        """Test getting a thing that doesn't exist."""
+        url = url_for(self.view_name, thing_id=setupdb.test_thing_bad_id)
+        response = authenticated_client.get(url)
+        assert response.status_code == HTTPStatus.NOT_FOUND
+
+    @pytest.mark.use_alt_user
+    @pytest.mark.usefixtures('setupdb')
+    def test_wrong_user(self, authenticated_client):
+        """Test that getting a thing as the wrong user fails."""
+        url = url_for(self.view_name, **self.view_params)
+        response = authenticated_client.get(url)
+        assert response.status_code == HTTPStatus.FORBIDDEN
+
 
 class TestPostThing(CommonViewTests, SubmitRequestMixin):
     """Tests for adding things."""
@@ -313,7 +586,7 @@ class TestPostThing(CommonViewTests, SubmitRequestMixin):
         """Test POSTing Things."""
         url = url_for(self.view_name, **self.view_params)
         # Fields part of the full thing data but not returned
-        server_fields = {'date_deleted', 'inventory_id'}
+        server_fields = {'date_deleted', 'inventory_id', 'name_key'}
 
         response = post_as_json(authenticated_client.post, url, self.new_thing_data)
         assert response.status_code == HTTPStatus.CREATED
@@ -335,7 +608,7 @@ class TestPostThing(CommonViewTests, SubmitRequestMixin):
         """Test POSTing Things with nonexistant or non-user-editable fields."""
         url = url_for(self.view_name, **self.view_params)
         # Fields part of the full thing data but not returned
-        server_fields = {'date_deleted', 'inventory_id'}
+        server_fields = {'date_deleted', 'inventory_id', 'name_key'}
 
         extra_thing_data = self.new_thing_data.copy()
         extra_thing_data['not_a_real_field'] = 'Will be removed from input'
@@ -413,7 +686,7 @@ class TestPutThing(CommonViewTests, SubmitRequestMixin):
         update_data = {'name': 'CHANGED NAME',
                        'location': 'CHANGED LOCATION',
                        'details': 'CHANGED DETAILS'}
-        expected_data.update(update_data)
+        expected_data.update(update_data, name_key='changed name')
 
         response = post_as_json(authenticated_client.put, url, update_data)
         assert response.status_code == HTTPStatus.OK
@@ -424,6 +697,39 @@ class TestPutThing(CommonViewTests, SubmitRequestMixin):
         del modified_data['date_modified'], expected_data['date_modified']
         assert modified_data == expected_data
 
+    def test_update_thing_if_match(self, authenticated_client):
+        """Test conditional updates with If-Match."""
+        url = url_for(self.view_name, **self.view_params)
+        data = json.dumps({'name': 'CHANGED NAME'})
+        etag = '"{}"'.format(conftest.TEST_TIME.isoformat())
+        headers = {'Content-Type': 'application/json', 'If-Match': etag}
+        response = authenticated_client.put(url, data=data, headers=headers)
+        assert response.status_code == HTTPStatus.OK
+        new_etag = response.headers['ETag']
+        assert new_etag == '"{}"'.format(response.json['date_modified'])
+
+        # Another update with the old ETag fails
+        response = authenticated_client.put(url, data=data, headers=headers)
+        assert response.status_code == HTTPStatus.PRECONDITION_FAILED
+        headers['If-Match'] = new_etag
+        response = authenticated_client.put(url, data=data, headers=headers)
+        assert response.status_code == HTTPStatus.OK
+
+        headers['If-Match'] = '"yesterday"'
+        response = authenticated_client.put(url, data=data, headers=headers)
+        assert response.status_code == HTTPStatus.BAD_REQUEST
+
+    def test_update_thing_if_match_any(self, authenticated_client, setupdb):
+        """Test that If-Match: * updates any existing thing."""
+        headers = {'Content-Type': 'application/json', 'If-Match': '*'}
+        data = json.dumps({'name': 'CHANGED NAME'})
+        url = url_for(self.view_name, **self.view_params)
+        response = authenticated_client.put(url, data=data, headers=headers)
+        assert response.status_code == HTTPStatus.OK
+        url = url_for(self.view_name, thing_id=setupdb.test_thing_bad_id)
+        response = authenticated_client.put(url, data=data, headers=headers)
+        assert response.status_code == HTTPStatus.NOT_FOUND
+
     def test_update_nonexistant_thing(self, authenticated_client, setupdb):
         """Test updating a nonexistant thing."""
         invalid_url = url_for('stuffrapi.update_thing', thing_id=setupdb.test_thing_bad_id)
@@ -505,6 +811,249 @@ class TestDeleteThing(CommonViewTests):
         assert response.status_code == HTTPStatus.FORBIDDEN
 
 
+class TestExportInventory(CommonViewTests):
+    """Tests for exporting a single inventory."""
+
+    view_name = 'stuffrapi.export_inventory'
+    method = 'get'
+
+    @pytest.fixture(autouse=True)
+    def set_view_params(self, setupdb):
+        """Set up test params for exporting an inventory."""
+        self.view_params = {'inventory_id': setupdb.test_inventory_id}
+
+    def test_export_ndjson(self, authenticated_client, setupdb):
+        """Test exporting an inventory as NDJSON."""
+        url = url_for(self.view_name, format='ndjson', **self.view_params)
+        response = authenticated_client.get(url)
+        assert response.status_code == HTTPStatus.OK
+        assert response.headers['Content-Type'] == 'application/x-ndjson'
+
+        records = [json.loads(line) for line in response.data.decode().splitlines()]
+        assert records[0]['type'] == 'inventory'
+        assert records[0]['id'] == setupdb.test_inventory_id
+        things = models.Thing.query. \
+            filter_by(inventory_id=setupdb.test_inventory_id, date_deleted=None).all()
+        assert sorted(r['name'] for r in records[1:]) == sorted(t.name for t in things)
+        assert all(r['type'] == 'thing' for r in records[1:])
+
+    def test_export_csv_gzip(self, authenticated_client, setupdb):
+        """Test exporting an inventory as gzipped CSV."""
+        url = url_for(self.view_name, format='csv', **self.view_params)
+        response = authenticated_client.get(url, headers={'Accept-Encoding': 'gzip'})
+        assert response.status_code == HTTPStatus.OK
+        assert response.headers['Content-Encoding'] == 'gzip'
+
+        data = gzip.decompress(response.data).decode()
+        rows = list(csv.DictReader(io.StringIO(data)))
+        num_things = models.Thing.query. \
+            filter_by(inventory_id=setupdb.test_inventory_id, date_deleted=None).count()
+        assert len(rows) == num_things
+        assert all(int(r['inventory_id']) == setupdb.test_inventory_id for r in rows)
+
+    def test_export_gzip_refused(self, authenticated_client):
+        """Test that exports aren't gzipped for clients refusing gzip."""
+        url = url_for(self.view_name, format='csv', **self.view_params)
+        response = authenticated_client.get(url, headers={'Accept-Encoding': 'gzip;q=0'})
+        assert response.status_code == HTTPStatus.OK
+        assert 'Content-Encoding' not in response.headers
+
+    def test_export_bad_format(self, authenticated_client):
+        """Test exporting with an unknown format."""
+        url = url_for(self.view_name, format='xml', **self.view_params)
+        response = authenticated_client.get(url)
+        assert response.status_code == HTTPStatus.BAD_REQUEST
+
+    def test_export_nonexistant_inventory(self, authenticated_client, setupdb):
+        """Test exporting an inventory that doesn't exist."""
+        url = url_for(self.view_name, inventory_id=setupdb.test_inventory_bad_id)
+        response = authenticated_client.get(url)
+        assert response.status_code == HTTPStatus.NOT_FOUND
+
+    @pytest.mark.use_alt_user
+    @pytest.mark.usefixtures('setupdb')
+    def test_wrong_user(self, authenticated_client):
+        """Test exporting an inventory owned by another user."""
+        url = url_for(self.view_name, **self.view_params)
+        response = authenticated_client.get(url)
+        assert response.status_code == HTTPStatus.FORBIDDEN
+
+
+class TestExportInventories(CommonViewTests):
+    """Tests for exporting all of a user's inventories."""
+
+    view_name = 'stuffrapi.export_inventories'
+    method = 'get'
+
+    def test_export_all(self, authenticated_client, setupdb):
+        """Test that all inventories and only the user's are exported."""
+        url = url_for(self.view_name)
+        response = authenticated_client.get(url)
+        assert response.status_code == HTTPStatus.OK
+
+        records = [json.loads(line) for line in response.data.decode().splitlines()]
+        inventory_ids = {r['id'] for r in records if r['type'] == 'inventory'}
+        expected_ids = {i.id for i in models.Inventory.query.filter_by(
+            user_id=setupdb.test_user_id)}
+        assert inventory_ids == expected_ids
+        thing_records = [r for r in records if r['type'] == 'thing']
+        assert all(r['inventory_id'] in expected_ids for r in thing_records)
+
+
+class TestImportThings(CommonViewTests):
+    """Tests for bulk importing things."""
+
+    view_name = 'stuffrapi.post_import'
+    method = 'post'
+
+    @pytest.fixture(autouse=True)
+    def set_view_params(self, setupdb):
+        """Set up test params for importing things."""
+        self.view_params = {'inventory_id': setupdb.test_inventory_id}
+
+    def count_things(self, inventory_id):
+        """Return number of things in an inventory."""
+        return models.Thing.query.filter_by(inventory_id=inventory_id).count()
+
+    def test_import_ndjson(self, authenticated_client, setupdb):
+        """Test importing NDJSON, including invalid rows."""
+        lines = [json.dumps({'type': 'inventory', 'name': 'Skipped'}),
+                 json.dumps({'name': 'Imported 1', 'location': 'Here'}),
+                 '',
+                 '{Bad JSON',
+                 json.dumps({'location': 'Missing name'}),
+                 json.dumps(['not', 'an', 'object']),
+                 json.dumps({'type': 'thing', 'name': 'Imported 2', 'id': 12345})]
+        things_before = self.count_things(setupdb.test_inventory_id)
+        url = url_for(self.view_name, chunk_size=2, **self.view_params)
+        response = authenticated_client.post(
+            url, headers={'Content-Type': 'application/x-ndjson'}, data='\n'.join(lines))
+        assert response.status_code == HTTPStatus.OK
+
+        result = response.json
+        assert result['rows_processed'] == 6
+        assert result['rows_imported'] == 2
+        assert result['num_errors'] == 3
+        assert [e['row'] for e in result['errors']] == [4, 5, 6]
+        assert self.count_things(setupdb.test_inventory_id) == things_before + 2
+        # IDs from the input are ignored
+        assert models.Thing.query.get(12345) is None
+        assert models.Thing.query.filter_by(name='Imported 1').one().name_key == 'imported 1'
+        # Journaled like things created one at a time
+        entries = models.JournalEntry.get_entries(setupdb.test_user_id, 0, 10)
+        assert [(e['entity'], e['operation'], e['changes']['name']) for e in entries] == [
+            ('thing', 'created', 'Imported 1'), ('thing', 'created', 'Imported 2')]
+        assert entries[0]['changes']['inventory_id'] == setupdb.test_inventory_id
+        assert entries[0]['entity_id'] == models.Thing.query.filter_by(name='Imported 1').one().id
+
+    def test_import_one_insert(self, authenticated_client, setupdb, statements):
+        """Test that each chunk's things are inserted with one statement."""
+        lines = [json.dumps({'name': f'Chunked {i}'}) for i in range(5)]
+        url = url_for(self.view_name, chunk_size=5, **self.view_params)
+        statements.clear()
+        response = authenticated_client.post(url, data='\n'.join(lines))
+        assert response.json['rows_imported'] == 5
+        assert len([s for s in statements if s.startswith('INSERT INTO thing ')]) == 1
+        things = models.Thing.query.filter(models.Thing.name.like('Chunked %')). \
+            order_by(models.Thing.id)
+        entries = models.JournalEntry.get_entries(setupdb.test_user_id, 0, 10)
+        assert [(e['entity_id'], e['changes']['name']) for e in entries] == \
+            [(t.id, t.name) for t in things]
+
+    def test_import_csv(self, authenticated_client, setupdb):
+        """Test importing CSV."""
+        data = 'id,name,location,details\n1,CSV thing,,Some details\n2,,Nowhere,\n'
+        things_before = self.count_things(setupdb.test_inventory_id)
+        url = url_for(self.view_name, **self.view_params)
+        response = authenticated_client.post(
+            url, headers={'Content-Type': 'text/csv'}, data=data)
+        assert response.status_code == HTTPStatus.OK
+        assert response.json['rows_imported'] == 1
+        assert response.json['errors'] == [
+            {'row': 3, 'message': 'Required field(s) missing: name'}]
+        assert self.count_things(setupdb.test_inventory_id) == things_before + 1
+        thing = models.Thing.query.filter_by(name='CSV thing').one()
+        assert thing.location is None
+        assert thing.details == 'Some details'
+
+    def test_import_line_separators(self, authenticated_client, setupdb):
+        """Test that Unicode line separators in values don't split NDJSON lines."""
+        lines = [json.dumps({'name': 'Split\u2028name\x85'}, ensure_ascii=False), '{Bad JSON']
+        url = url_for(self.view_name, **self.view_params)
+        response = authenticated_client.post(url, data='\n'.join(lines).encode('utf-8'))
+        assert response.json['rows_imported'] == 1
+        assert [e['row'] for e in response.json['errors']] == [2]
+        assert models.Thing.query.filter_by(name='Split\u2028name\x85').count() == 1
+
+    @pytest.mark.parametrize('import_format, data', [
+        ('ndjson', b'{"name": "Bad \xff"}\n'),
+        ('csv', b'name\nBad \xff\n'),
+        ('csv', b'name\nNul \x00\n')], ids=['ndjson-encoding', 'csv-encoding', 'csv-nul'])
+    def test_import_unreadable(self, authenticated_client, setupdb, import_format, data):
+        """Test that data that is not UTF-8 or not valid CSV is rejected."""
+        things_before = self.count_things(setupdb.test_inventory_id)
+        url = url_for(self.view_name, format=import_format, **self.view_params)
+        response = authenticated_client.post(url, data=data)
+        assert response.status_code == HTTPStatus.BAD_REQUEST
+        assert self.count_things(setupdb.test_inventory_id) == things_before
+
+    def test_import_resume(self, authenticated_client, setupdb):
+        """Test that resuming an import skips rows already processed."""
+        # Simulate an import that stopped after processing two rows
+        checkpoint = models.ImportCheckpoint.get_or_create(
+            'resume-test', setupdb.test_inventory_id, setupdb.test_user_id)
+        checkpoint.rows_processed = 2
+        db.session.commit()
+
+        lines = [json.dumps({'name': f'Resume {i}'}) for i in range(5)]
+        url = url_for(self.view_name, import_id='resume-test', **self.view_params)
+        response = authenticated_client.post(url, data='\n'.join(lines))
+        assert response.status_code == HTTPStatus.OK
+        assert response.json['resumed_from'] == 2
+        assert response.json['rows_imported'] == 3
+        imported = {t.name for t in models.Thing.query.filter(
+            models.Thing.name.like('Resume %'))}
+        assert imported == {'Resume 2', 'Resume 3', 'Resume 4'}
+
+        # Completed imports are not run again
+        response = authenticated_client.post(url, data='\n'.join(lines))
+        assert response.json['rows_imported'] == 3
+        assert models.Thing.query.filter(models.Thing.name.like('Resume %')).count() == 3
+
+    def test_import_key_per_user(self, authenticated_client, setupdb):
+        """Test that another user's import with the same key is not resumed."""
+        alt_inventory = models.Inventory.query.filter_by(user_id=setupdb.test_alt_user_id).first()
+        checkpoint = models.ImportCheckpoint.get_or_create(
+            'shared-key', alt_inventory.id, setupdb.test_alt_user_id)
+        checkpoint.rows_processed = 1
+        db.session.commit()
+
+        url = url_for(self.view_name, import_id='shared-key', **self.view_params)
+        response = authenticated_client.post(url, data=json.dumps({'name': 'Own import'}))
+        assert response.status_code == HTTPStatus.OK
+        assert (response.json['resumed_from'], response.json['rows_imported']) == (0, 1)
+
+    def test_import_bad_format(self, authenticated_client):
+        """Test importing with an unknown format."""
+        url = url_for(self.view_name, format='xml', **self.view_params)
+        response = authenticated_client.post(url, data='<thing/>')
+        assert response.status_code == HTTPStatus.BAD_REQUEST
+
+    def test_import_nonexistant_inventory(self, authenticated_client, setupdb):
+        """Test importing into an inventory that doesn't exist."""
+        url = url_for(self.view_name, inventory_id=setupdb.test_inventory_bad_id)
+        response = authenticated_client.post(url, data='{"name": "Nope"}')
+        assert response.status_code == HTTPStatus.NOT_FOUND
+
+    @pytest.mark.use_alt_user
+    @pytest.mark.usefixtures('setupdb')
+    def test_wrong_user(self, authenticated_client):
+        """Test importing into an inventory owned by another user."""
+        url = url_for(self.view_name, **self.view_params)
+        response = authenticated_client.post(url, data='{"name": "Nope"}')
+        assert response.status_code == HTTPStatus.FORBIDDEN
+
+
 def test_root_error(client):
     """Sanity check that root behaves as expected."""
     url = url_for('stuffrapi.apiindex')
@@ -40,6 +40,8 @@ class TestGetAdminStats(conftest.CommonViewTests):
         response_data = response.json
         assert isinstance(response_data, Mapping)
         assert response_data['numUsers'] == num_users
+        assert response_data['numPendingEmails'] == 0
+        assert response_data['numFailedEmails'] == 0
 
 
 class TestGetAdminUsers(conftest.CommonViewTests):
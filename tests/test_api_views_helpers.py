@@ -23,7 +23,7 @@ def test_json_response():
     data, status, headers = views_common.json_response(1)
     assert data == '1'
     assert status == HTTPStatus.OK
-    assert headers == {'Content-Type': 'application/json'}
+    assert headers == {'Content-Type': 'application/json', 'Vary': 'Accept'}
     # Special object serialization
     the_time = datetime.datetime.now()
     data, status, headers = views_common.json_response(the_time)
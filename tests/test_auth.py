@@ -1,9 +1,10 @@
 """Test cases for Stuffr's simple HTML views."""
 
 import pytest
-from flask_security import user_registered
 from flask_security.registerable import register_user
 
+from stuffrapp import jobs
+from stuffrapp.api import models
 from tests.conftest import TEST_NEW_USER
 
 
@@ -15,13 +16,18 @@ pytestmark = pytest.mark.auth
 
 @pytest.mark.options(SECURITY_SEND_REGISTER_EMAIL=False)
 @pytest.mark.usefixtures('setupdb')
-def test_new_user_setup():
+def test_new_user_setup(app):
     """Test new user creation initial setup.
 
-    New user setup is handled with a signal handler, running when
-    Flask-Security flashes a user_registered signal.
+    New user setup is handled by a background job, committed along with the
+    new user.
     """
-    assert user_registered.receivers
     user = register_user(**TEST_NEW_USER)
+    job = models.Job.query.filter_by(name='setup_new_user').order_by(models.Job.id.desc()).first()
+    assert job.arguments == '{{"user_id": {}}}'.format(user.id)
+    assert user.inventories.count() == 0
+    jobs.Worker(app).run_pending()
     # New users get a default inventory
     assert user.inventories.count() == 1
+    entries = models.JournalEntry.get_entries(user.id, 0, 10)
+    assert [(e['entity'], e['operation']) for e in entries] == [('inventory', 'created')]
@@ -0,0 +1,100 @@
+"""Test cases for database backup and restore."""
+
+import datetime
+import os
+import sqlite3
+import pytest
+from sqlalchemy import create_engine
+
+from stuffrapp import backup
+
+
+pytestmark = [
+    pytest.mark.backup,
+    pytest.mark.skipif(not hasattr(sqlite3.Connection, 'backup'),
+                       reason='Online backups require Python 3.7')
+]
+
+
+# Utility functions
+####################
+
+def _create_database(path, values):
+    """Create a small SQLite database containing the given values."""
+    connection = sqlite3.connect(path)
+    connection.execute('CREATE TABLE test_data (value TEXT)')
+    connection.executemany('INSERT INTO test_data VALUES (?)', [(v,) for v in values])
+    connection.commit()
+    connection.close()
+
+
+def _read_values(path):
+    """Return values stored in a database created by _create_database."""
+    connection = sqlite3.connect(path)
+    values = [r[0] for r in connection.execute('SELECT value FROM test_data ORDER BY rowid')]
+    connection.close()
+    return values
+
+
+# The tests
+#############
+
+def test_sqlite_database_path(tmpdir):
+    """Test getting the database path from an engine."""
+    path = str(tmpdir.join('test.db'))
+    assert backup.sqlite_database_path(create_engine(f'sqlite:///{path}')) == path
+    with pytest.raises(backup.BackupError):
+        backup.sqlite_database_path(create_engine('sqlite://'))
+
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_backup_and_restore(tmpdir, compress):
+    """Test that a snapshot can be taken and restored."""
+    live_path = str(tmpdir.join('live.db'))
+    snapshot_path = str(tmpdir.join('snapshot.db.gz' if compress else 'snapshot.db'))
+    values = ['value {}'.format(i) * 20 for i in range(2000)]
+    _create_database(live_path, values)
+
+    steps = []
+    backup.backup_database(live_path, snapshot_path, compress=compress,
+                           pages_per_step=10, step_sleep=0,
+                           progress=lambda done, total: steps.append((done, total)))
+    # Copied in multiple steps, ending with everything copied
+    assert len(steps) > 1
+    assert steps[-1][0] == steps[-1][1]
+    # Only the snapshot is left in the directory
+    assert sorted(os.listdir(str(tmpdir))) == sorted(['live.db', os.path.basename(snapshot_path)])
+
+    connection = sqlite3.connect(live_path)
+    connection.execute('DELETE FROM test_data')
+    connection.commit()
+    connection.close()
+    backup.restore_database(snapshot_path, live_path)
+    assert _read_values(live_path) == values
+
+
+def test_restore_invalid_snapshot(tmpdir):
+    """Test that an invalid snapshot is not restored."""
+    live_path = str(tmpdir.join('live.db'))
+    bad_snapshot = tmpdir.join('bad.db')
+    bad_snapshot.write('This is not a database' * 100)
+    _create_database(live_path, ['original'])
+    with pytest.raises(backup.BackupError):
+        backup.restore_database(str(bad_snapshot), live_path)
+    assert _read_values(live_path) == ['original']
+
+
+def test_prune_snapshots(tmpdir):
+    """Test that only the newest snapshots are kept."""
+    start = datetime.datetime(2017, 1, 1)
+    names = [backup.snapshot_filename(start + datetime.timedelta(days=d), compress=d % 2)
+             for d in range(5)]
+    for name in names:
+        tmpdir.join(name).write('')
+    tmpdir.join('unrelated.db').write('')
+
+    deleted = backup.prune_snapshots(str(tmpdir), 2)
+    assert [os.path.basename(p) for p in deleted] == names[:3]
+    assert sorted(os.listdir(str(tmpdir))) == sorted(names[3:] + ['unrelated.db'])
+    with pytest.raises(backup.BackupError):
+        backup.prune_snapshots(str(tmpdir), 0)
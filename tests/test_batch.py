@@ -0,0 +1,159 @@
+"""Test cases for batch requests."""
+
+from http import HTTPStatus
+import flask_security.decorators
+import pytest
+from flask import url_for
+
+from stuffrapp.api import models
+from tests.conftest import CommonViewTests, post_as_json
+
+
+pytestmark = pytest.mark.batch
+
+
+# Utility functions
+####################
+
+def _post_batch(client, operations, transaction=False):
+    """POST a batch of operations, returning the response."""
+    return post_as_json(client.post, url_for('stuffrapi.post_batch'),
+                        {'operations': operations, 'transaction': transaction})
+
+
+# The tests
+#############
+
+class TestPostBatch(CommonViewTests):
+    """Tests for running batches of operations."""
+
+    view_name = 'stuffrapi.post_batch'
+    method = 'post'
+
+    def test_mixed_operations(self, authenticated_client, setupdb):
+        """Test a batch of reads and writes."""
+        things_path = url_for('stuffrapi.get_things', inventory_id=setupdb.test_inventory_id)
+        thing_path = url_for('stuffrapi.update_thing', thing_id=setupdb.test_thing_id)
+        response = _post_batch(authenticated_client, [
+            {'method': 'POST', 'path': url_for('stuffrapi.post_inventory'),
+             'body': {'name': 'Batch inventory'}},
+            {'method': 'POST', 'path': things_path, 'body': {'name': 'Batch thing'}},
+            {'method': 'PUT', 'path': thing_path, 'body': {'location': 'Batch location'}},
+            {'method': 'GET', 'path': things_path + '?fields=name,location&sort=name'},
+            {'method': 'DELETE', 'path': thing_path}])
+        assert response.status_code == HTTPStatus.OK
+        assert response.json['committed'] is True
+        results = response.json['results']
+        assert [r['status'] for r in results] == [
+            HTTPStatus.CREATED, HTTPStatus.CREATED, HTTPStatus.OK, HTTPStatus.OK,
+            HTTPStatus.NO_CONTENT]
+
+        inventory = models.Inventory.query.get(results[0]['body']['id'])
+        assert inventory.name == 'Batch inventory'
+        assert models.Thing.query.get(results[1]['body']['id']).name == 'Batch thing'
+        assert {'name': models.Thing.query.get(setupdb.test_thing_id).name,
+                'location': 'Batch location'} in results[3]['body']
+        assert {'name': 'Batch thing', 'location': None} in results[3]['body']
+        assert models.Thing.query.get(setupdb.test_thing_id).date_deleted is not None
+        assert results[4]['body'] is None
+
+    def test_separate_commits(self, authenticated_client, setupdb):
+        """Test that operations are committed separately by default."""
+        response = _post_batch(authenticated_client, [
+            {'method': 'POST', 'path': url_for('stuffrapi.post_inventory'),
+             'body': {'name': 'Kept'}},
+            {'method': 'POST', 'path': url_for('stuffrapi.post_inventory'), 'body': {}},
+            {'method': 'DELETE',
+             'path': url_for('stuffrapi.delete_thing', thing_id=setupdb.test_thing_bad_id)},
+            {'method': 'GET', 'path': url_for('stuffrapi.get_userinfo')}])
+        assert response.json['committed'] is True
+        assert [r['status'] for r in response.json['results']] == [
+            HTTPStatus.CREATED, HTTPStatus.BAD_REQUEST, HTTPStatus.NOT_FOUND, HTTPStatus.OK]
+        assert models.Inventory.query.filter_by(name='Kept').count() == 1
+
+    def test_transaction_rolled_back(self, authenticated_client, setupdb):
+        """Test that nothing is committed if an operation in a transaction fails."""
+        thing_count = models.Thing.query.count()
+        things_path = url_for('stuffrapi.get_things', inventory_id=setupdb.test_inventory_id)
+        response = _post_batch(authenticated_client, [
+            {'method': 'POST', 'path': url_for('stuffrapi.post_inventory'),
+             'body': {'name': 'Rolled back'}},
+            {'method': 'POST', 'path': things_path, 'body': {'name': 'Rolled back'}},
+            {'method': 'GET', 'path': things_path},
+            {'method': 'PUT',
+             'path': url_for('stuffrapi.update_thing', thing_id=setupdb.test_thing_id),
+             'body': {'name': None}},
+            {'method': 'DELETE',
+             'path': url_for('stuffrapi.delete_thing', thing_id=setupdb.test_thing_id)}],
+            transaction=True)
+        assert response.status_code == HTTPStatus.OK
+        assert response.json['committed'] is False
+        assert [r['status'] for r in response.json['results']] == [
+            HTTPStatus.CREATED, HTTPStatus.CREATED, HTTPStatus.OK, HTTPStatus.BAD_REQUEST,
+            HTTPStatus.FAILED_DEPENDENCY]
+        # The read saw the thing created earlier in the transaction
+        assert 'Rolled back' in [t['name'] for t in response.json['results'][2]['body']]
+
+        assert models.Inventory.query.filter_by(name='Rolled back').count() == 0
+        assert models.Thing.query.count() == thing_count
+        assert models.Thing.query.get(setupdb.test_thing_id).date_deleted is None
+
+    def test_transaction_committed(self, authenticated_client, setupdb):
+        """Test that a transaction is committed if all operations succeed."""
+        things_path = url_for('stuffrapi.get_things', inventory_id=setupdb.test_inventory_id)
+        response = _post_batch(authenticated_client, [
+            {'method': 'GET', 'path': things_path},
+            {'method': 'POST', 'path': things_path, 'body': {'name': 'First'}},
+            {'method': 'POST', 'path': things_path, 'body': {'name': 'Second'}}],
+            transaction=True)
+        assert response.json['committed'] is True
+        assert models.Thing.query.filter(models.Thing.name.in_(['First', 'Second'])).count() == 2
+
+    def test_if_match(self, authenticated_client, setupdb):
+        """Test passing If-Match headers to operations."""
+        thing_path = url_for('stuffrapi.update_thing', thing_id=setupdb.test_thing_id)
+        response = _post_batch(authenticated_client, [
+            {'method': 'PUT', 'path': thing_path, 'body': {'name': 'Changed'},
+             'headers': {'If-Match': '"2000-01-01T00:00:00+00:00"'}}])
+        assert response.json['results'][0]['status'] == HTTPStatus.PRECONDITION_FAILED
+
+    def test_authenticated_once(self, authenticated_client, setupdb, monkeypatch):
+        """Test that the token is only checked for the batch, not each operation."""
+        check_token = flask_security.decorators._check_token
+        calls = []
+
+        def counting_check_token():
+            """Count token checks."""
+            calls.append(None)
+            return check_token()
+        monkeypatch.setattr(flask_security.decorators, '_check_token', counting_check_token)
+        things_path = url_for('stuffrapi.get_things', inventory_id=setupdb.test_inventory_id)
+        response = _post_batch(authenticated_client, [{'method': 'GET', 'path': things_path}] * 3)
+        assert [r['status'] for r in response.json['results']] == [HTTPStatus.OK] * 3
+        assert len(calls) == 1
+
+    def test_operations_checked(self, authenticated_client, setupdb):
+        """Test operations on views that don't exist or can't be batched."""
+        export_path = url_for('stuffrapi.export_inventory', inventory_id=setupdb.test_inventory_id)
+        response = _post_batch(authenticated_client, [
+            {'method': 'GET', 'path': '/api/not_a_view'},
+            {'method': 'DELETE', 'path': url_for('stuffrapi.get_userinfo')},
+            {'method': 'GET', 'path': export_path},
+            {'method': 'POST', 'path': url_for('stuffrapi.post_batch'), 'body': {}},
+            {'method': 'GET', 'path': '/api/admin/stats'}])
+        assert [r['status'] for r in response.json['results']] == [
+            HTTPStatus.NOT_FOUND, HTTPStatus.METHOD_NOT_ALLOWED, HTTPStatus.BAD_REQUEST,
+            HTTPStatus.BAD_REQUEST, HTTPStatus.BAD_REQUEST]
+
+    @pytest.mark.parametrize('data', [
+        None, [], {}, {'operations': []},
+        {'operations': [{'method': 'PATCH', 'path': '/api/inventories'}]},
+        {'operations': [{'method': 'GET'}]},
+        {'operations': [{'method': 'GET', 'path': '/api/inventories',
+                         'headers': {'Authentication-Token': 'x'}}]},
+        {'operations': [{'method': 'GET', 'path': '/api/inventories'}], 'transaction': 'yes'},
+        {'operations': [{'method': 'GET', 'path': '/api/inventories'}] * 101}])
+    def test_invalid_batch(self, authenticated_client, data):
+        """Test batches that are rejected as a whole."""
+        response = post_as_json(authenticated_client.post, url_for(self.view_name), data)
+        assert response.status_code == HTTPStatus.BAD_REQUEST
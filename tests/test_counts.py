@@ -0,0 +1,103 @@
+"""Test cases for cached thing counts."""
+
+import pytest
+
+from database import db
+from stuffrapp.api import counts, models
+
+
+pytestmark = pytest.mark.counts
+
+
+# Test fixtures
+################
+
+@pytest.fixture
+def cache(setupdb):  # pylint: disable=unused-argument
+    """Empty thing count cache."""
+    return counts.ThingCountCache(max_size=2, ttl=60)
+
+
+# The tests
+#############
+
+def test_cached_until_invalidated(cache, setupdb, statements):
+    """Test that counts are only counted again after being invalidated."""
+    statements.clear()
+    first_counts = cache.get(setupdb.test_user_id)
+    num_statements = len(statements)
+    assert num_statements == 2
+    assert cache.get(setupdb.test_user_id) is first_counts
+    assert len(statements) == num_statements
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    models.Thing.delete_thing(setupdb.test_thing_id, setupdb.test_user_id)
+    cache.invalidate(setupdb.test_user_id)
+    new_counts = cache.get(setupdb.test_user_id)
+    assert len(statements) > num_statements
+    inventory_id = setupdb.test_inventory_id
+    assert new_counts['inventories'][inventory_id] == \
+        first_counts['inventories'][inventory_id] - 1
+
+
+def test_expiry(cache, setupdb):
+    """Test that counts are counted again after they expire."""
+    cache.ttl = 0
+    cache.get(setupdb.test_user_id)
+    cache.get(setupdb.test_user_id)
+    assert cache.misses == 2
+
+
+def test_size_limit(cache, setupdb):
+    """Test that the least recently used counts are removed when the cache is full."""
+    user_ids = [setupdb.test_user_id, setupdb.test_alt_user_id, setupdb.test_user_bad_id]
+    for user_id in user_ids:
+        cache.get(user_id)
+    cache.get(user_ids[2])
+    cache.get(user_ids[0])
+    assert (cache.hits, cache.misses) == (1, 4)
+
+
+def test_invalidated_while_counting(cache, setupdb, monkeypatch):
+    """Test that counts invalidated while being counted are not cached."""
+    get_thing_counts = models.Thing.get_thing_counts
+
+    def invalidate_during_count(user_id):
+        """Count, with another request invalidating the counts meanwhile."""
+        result = get_thing_counts(user_id)
+        cache.invalidate(user_id)
+        return result
+    monkeypatch.setattr(models.Thing, 'get_thing_counts', invalidate_during_count)
+    cache.get(setupdb.test_user_id)
+    monkeypatch.undo()
+    cache.get(setupdb.test_user_id)
+    assert cache.misses == 2
+
+
+def test_invalidated_by_writes(app, setupdb):
+    """Test that writing things through the models invalidates their user's counts."""
+    cache = app.extensions['stuffr_count_cache']
+    cache.clear()
+    user_ids = [setupdb.test_user_id, setupdb.test_alt_user_id]
+    first_counts = [counts.get_counts(user_id) for user_id in user_ids]
+    models.Thing.create_new_thing({'name': 'Counted'}, setupdb.test_inventory_id,
+                                  setupdb.test_user_id)
+    assert counts.get_counts(user_ids[1]) is first_counts[1]
+    new_counts = counts.get_counts(user_ids[0])
+    inventory_id = setupdb.test_inventory_id
+    assert new_counts['inventories'][inventory_id] == \
+        first_counts[0]['inventories'][inventory_id] + 1
+
+
+def test_invalidated_by_rollback(app, setupdb):
+    """Test that counts counted from changes that are rolled back are invalidated."""
+    cache = app.extensions['stuffr_count_cache']
+    cache.clear()
+    inventory_id = setupdb.test_inventory_id
+    db.session.add(models.Thing(name='Rolled back', inventory_id=inventory_id))
+    models.JournalEntry.record(setupdb.test_user_id, 'thing', 0, 'created', {})
+    db.session.flush()
+    uncommitted_counts = counts.get_counts(setupdb.test_user_id)
+    db.session.rollback()
+    assert counts.get_counts(setupdb.test_user_id)['inventories'][inventory_id] == \
+        uncommitted_counts['inventories'][inventory_id] - 1
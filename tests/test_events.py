@@ -0,0 +1,217 @@
+"""Test cases for the server-sent events change feed."""
+
+import json
+from http import HTTPStatus
+import pytest
+from flask import url_for
+
+from stuffrapp.api import events, models
+from tests.conftest import post_as_json
+
+
+pytestmark = pytest.mark.events
+
+
+# Utility functions
+####################
+
+def _parse_events(text):
+    """Return the (ID, type, data) of the events in a text/event-stream body."""
+    parsed = []
+    for message in text.split('\n\n'):
+        fields = dict(line.split(': ', 1) for line in message.splitlines()
+                      if not line.startswith(':'))
+        if fields:
+            parsed.append((fields['id'], fields['event'], json.loads(fields['data'])))
+    return parsed
+
+
+def _received(subscription):
+    """Return the events waiting in a subscription."""
+    return _parse_events(''.join(subscription.get(0)))
+
+
+def _publish(broker, user_id, event_type, data=None):
+    """Publish an event, as if it was recorded in a committed transaction."""
+    broker.publish([(user_id, event_type, json.dumps(data))])
+
+
+@pytest.fixture
+def broker(app):  # pylint: disable=redefined-outer-name,unused-argument
+    """The app's event broker."""
+    return app.extensions['stuffr_events']
+
+
+# The tests
+#############
+
+class TestEventBroker:
+    """Tests for passing events to subscribers."""
+
+    def test_subscribe(self):
+        """Test that subscribers only get events of their user."""
+        broker = events.EventBroker(10, 10)
+        subscription = broker.subscribe(1)
+        other_subscription = broker.subscribe(2)
+        _publish(broker, 1, 'thing.created', {'id': 3})
+        _publish(broker, 1, 'thing.deleted', {'id': 3})
+        received = _received(subscription)
+        assert [(e[1], e[2]) for e in received] == [
+            ('thing.created', {'id': 3}), ('thing.deleted', {'id': 3})]
+        assert received[0][0] != received[1][0]
+        assert _received(other_subscription) == []
+
+        broker.unsubscribe(subscription)
+        _publish(broker, 1, 'thing.created', {'id': 4})
+        assert _received(subscription) == []
+
+    def test_resume(self):
+        """Test resuming after an event."""
+        broker = events.EventBroker(3, 10)
+        for thing_id in range(4):
+            _publish(broker, thing_id % 2, 'thing.created', {'id': thing_id})
+        subscription = broker.subscribe(1)
+        _publish(broker, 1, 'thing.created', {'id': 4})
+        event_ids = [e[0] for e in _received(subscription)]
+
+        resumed = broker.subscribe(1, last_event_id=event_ids[0])
+        assert _received(resumed) == []
+        broker.unsubscribe(resumed)
+        # Event 1 is the oldest kept
+        history = [e[0] for e in broker._history]  # pylint: disable=protected-access
+        resumed = broker.subscribe(1, last_event_id=history[0])
+        assert [e[2] for e in _received(resumed)] == [{'id': 3}, {'id': 4}]
+
+    def test_resume_unknown(self):
+        """Test that clients resuming after a forgotten event are told to reset."""
+        broker = events.EventBroker(10, 10)
+        _publish(broker, 1, 'thing.created', {'id': 1})
+        subscription = broker.subscribe(1, last_event_id='forgotten')
+        reset = _received(subscription)
+        assert [(e[1], e[2]) for e in reset] == [(events.RESET_EVENT, None)]
+        # Resuming from the reset event works
+        resumed = broker.subscribe(1, last_event_id=reset[0][0])
+        assert _received(resumed) == []
+
+    def test_stream(self):
+        """Test the heartbeat and events of a stream."""
+        broker = events.EventBroker(10, 10)
+        stream = events.stream(broker, 1, None, heartbeat=0.01)
+        assert next(stream) == ': heartbeat\n\n'
+        assert next(stream) == ': heartbeat\n\n'
+        _publish(broker, 1, 'thing.created', {'id': 1})
+        _publish(broker, 1, 'thing.created', {'id': 2})
+        assert [e[2] for e in _parse_events(next(stream))] == [{'id': 1}, {'id': 2}]
+        stream.close()
+        assert not broker._subscriptions  # pylint: disable=protected-access
+
+    def test_stream_overflow(self):
+        """Test that a stream ends when a client falls too far behind."""
+        broker = events.EventBroker(10, 2)
+        stream = events.stream(broker, 1, None, heartbeat=0.01)
+        next(stream)
+        for thing_id in range(3):
+            _publish(broker, 1, 'thing.created', {'id': thing_id})
+        assert len(_parse_events(next(stream))) == 2
+        with pytest.raises(StopIteration):
+            next(stream)
+        assert not broker._subscriptions  # pylint: disable=protected-access
+
+    def test_shared_between_processes(self, tmpdir):
+        """Test that events are passed to the brokers of other processes."""
+        brokers = [events.EventBroker(10, 10, str(tmpdir)) for _ in range(2)]
+        try:
+            # Not listening processes are skipped
+            tmpdir.join('exited.sock').write('')
+            subscriptions = [broker.subscribe(1) for broker in brokers]
+            _publish(brokers[0], 1, 'thing.created', {'id': 1})
+            received = [_parse_events(''.join(s.get(5))) for s in subscriptions]
+            assert received[0] == received[1]
+            assert [e[2] for e in received[0]] == [{'id': 1}]
+            assert not tmpdir.join('exited.sock').exists()
+        finally:
+            for broker in brokers:
+                broker.stop()
+        assert tmpdir.listdir() == []
+
+
+class TestRecordedEvents:
+    """Tests for the events recorded by model write methods."""
+
+    def test_write_methods(self, setupdb, broker):
+        """Test the events recorded when things and inventories are written."""
+        user_id = setupdb.test_user_id
+        subscription = broker.subscribe(user_id)
+        inventory = models.Inventory.create_new_inventory({'name': 'New'}, user_id)
+        thing = models.Thing.create_new_thing({'name': 'New'}, inventory.id, user_id)
+        changes = models.Thing.update_thing(thing.id, {'location': 'Here'}, user_id)
+        models.Thing.delete_thing(thing.id, user_id)
+        received = [(e[1], e[2]) for e in _received(subscription)]
+        assert received == [
+            ('inventory.created', {'id': inventory.id, 'name': 'New',
+                                   'date_created': inventory.date_created.isoformat()}),
+            ('thing.created', {
+                'id': thing.id, 'inventory_id': inventory.id, 'name': 'New', 'location': None,
+                'details': None, 'date_created': thing.date_created.isoformat(),
+                'date_modified': thing.date_created.isoformat(), 'date_deleted': None}),
+            ('thing.updated', {'id': thing.id, 'location': 'Here',
+                               'date_modified': changes['date_modified'].isoformat()}),
+            ('thing.deleted', {'id': thing.id, 'date_deleted': thing.date_deleted.isoformat(),
+                               'date_modified': thing.date_deleted.isoformat()})]
+
+    def test_failed_writes(self, setupdb, broker):
+        """Test that failed writes have no events."""
+        subscription = broker.subscribe(setupdb.test_user_id)
+        with pytest.raises(models.errors.UserPermissionError):
+            models.Thing.update_thing(setupdb.test_thing_id, {'name': 'No'},
+                                      setupdb.test_alt_user_id)
+        assert _received(subscription) == []
+
+    def test_batch_transaction(self, authenticated_client, setupdb, broker):
+        """Test that events of a batch transaction are only published if it is committed."""
+        subscription = broker.subscribe(setupdb.test_user_id)
+        things_path = url_for('stuffrapi.get_things', inventory_id=setupdb.test_inventory_id)
+        operations = [{'method': 'POST', 'path': things_path, 'body': {'name': 'Batch'}},
+                      {'method': 'POST', 'path': things_path, 'body': {}}]
+        post_as_json(authenticated_client.post, url_for('stuffrapi.post_batch'),
+                     {'operations': operations, 'transaction': True})
+        assert _received(subscription) == []
+
+        post_as_json(authenticated_client.post, url_for('stuffrapi.post_batch'),
+                     {'operations': operations[:1] * 2, 'transaction': True})
+        assert [e[1] for e in _received(subscription)] == ['thing.created'] * 2
+
+
+class TestGetEvents:
+    """Tests for the event stream view."""
+
+    def test_unauthenticated(self, client):
+        """Test that the stream requires authentication."""
+        response = client.get(url_for('stuffrapi.get_events'))
+        assert response.status_code == HTTPStatus.UNAUTHORIZED
+
+    def test_stream(self, app, authenticated_client, setupdb, monkeypatch):
+        """Test streaming events, and resuming the stream."""
+        monkeypatch.setitem(app.config, 'STUFFR_EVENTS_HEARTBEAT', 0.01)
+        response = authenticated_client.get(url_for('stuffrapi.get_events'), buffered=False)
+        assert response.status_code == HTTPStatus.OK
+        assert response.mimetype == 'text/event-stream'
+        assert response.headers['Cache-Control'] == 'no-cache'
+        chunks = iter(response.response)
+        assert next(chunks) == b': heartbeat\n\n'
+
+        url = url_for('stuffrapi.post_thing', inventory_id=setupdb.test_inventory_id)
+        post_as_json(authenticated_client.post, url, {'name': 'Streamed'})
+        received = _parse_events(next(chunks).decode('utf-8'))
+        assert [(e[1], e[2]['name']) for e in received] == [('thing.created', 'Streamed')]
+        response.close()
+
+        post_as_json(authenticated_client.post, url, {'name': 'Missed'})
+        response = authenticated_client.get(url_for('stuffrapi.get_events'),
+                                            headers={'Last-Event-ID': received[0][0]},
+                                            buffered=False)
+        chunks = iter(response.response)
+        next(chunks)
+        received = _parse_events(next(chunks).decode('utf-8'))
+        assert [(e[1], e[2]['name']) for e in received] == [('thing.created', 'Missed')]
+        response.close()
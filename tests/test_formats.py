@@ -0,0 +1,151 @@
+"""Test cases for MessagePack request and response bodies."""
+
+import datetime
+import json
+from http import HTTPStatus
+import pytest
+from flask import url_for
+
+from stuffrapp.api import formats, models
+
+
+pytestmark = pytest.mark.formats
+
+MSGPACK_HEADERS = {'Accept': formats.MSGPACK_MIMETYPE}
+TEST_DATE = datetime.datetime(2017, 3, 4, 5, 6, 7, 890123, tzinfo=datetime.timezone.utc)
+
+
+# Utility functions
+####################
+
+def _post_msgpack(client, url, data, headers=None):
+    """POST data encoded as MessagePack."""
+    headers = dict(headers or {}, **{'Content-Type': formats.MSGPACK_MIMETYPE})
+    return client.post(url, headers=headers, data=formats.py_pack(data))
+
+
+# The tests
+#############
+
+@pytest.mark.parametrize('value, encoded', [
+    (None, b'\xc0'), (True, b'\xc3'), (False, b'\xc2'),
+    (0, b'\x00'), (127, b'\x7f'), (-32, b'\xe0'), (-33, b'\xd0\xdf'),
+    (255, b'\xcc\xff'), (65536, b'\xce\x00\x01\x00\x00'),
+    (-2 ** 63, b'\xd3\x80' + b'\x00' * 7), (1.5, b'\xcb?\xf8' + b'\x00' * 6),
+    ('', b'\xa0'), ('é', b'\xa2\xc3\xa9'), ('x' * 32, b'\xd9\x20' + b'x' * 32),
+    (b'\x01', b'\xc4\x01\x01'), ([1, [2]], b'\x92\x01\x91\x02'), ({'a': 1}, b'\x81\xa1a\x01'),
+    (datetime.datetime(2017, 1, 1, tzinfo=datetime.timezone.utc),
+     b'\xd6\xff\x58\x68\x46\x80'),
+    (datetime.datetime(1969, 12, 31, 23, 59, 59, tzinfo=datetime.timezone.utc),
+     b'\xc7\x0c\xff' + b'\x00' * 4 + b'\xff' * 8)], ids=repr)
+def test_py_pack(value, encoded):
+    """Test encoding values in their shortest MessagePack form."""
+    assert formats.py_pack(value) == encoded
+    assert formats.py_unpack(encoded) == value
+
+
+def test_py_round_trip():
+    """Test decoding encoded values of all sizes."""
+    value = {
+        'ints': [-2 ** 31, -40000, -200, 200, 70000, 2 ** 40, 2 ** 64 - 1],
+        'strings': ['y' * 300, 'z' * 70000],
+        'long list': list(range(70000)),
+        'long map': {str(i): i for i in range(20)},
+        'dates': [TEST_DATE, datetime.datetime(2500, 1, 1, tzinfo=datetime.timezone.utc)],
+        1: b'\x00' * 300
+    }
+    assert formats.py_unpack(formats.py_pack(value)) == value
+
+
+@pytest.mark.skipif(formats.msgpack is None, reason='msgpack is not installed')
+def test_msgpack_compatible():
+    """Test that the pure-Python encoding matches the msgpack package's."""
+    value = [{'id': 1, 'name': 'é' * 40, 'date_created': TEST_DATE, 'details': None}]
+    assert formats.py_pack(value) == formats.pack(value)
+    assert formats.unpack(formats.py_pack(value)) == value
+
+
+@pytest.mark.parametrize('data', [
+    b'', b'\xc1', b'\x92\x01', b'\xa2a', b'\xc0\xc0', b'\xd4\x01\x00', b'\x81\x91\x01\x01'
+], ids=repr)
+def test_py_unpack_invalid(data):
+    """Test decoding invalid MessagePack data."""
+    with pytest.raises(ValueError):
+        formats.py_unpack(data)
+
+
+def test_default_json(authenticated_client, setupdb):
+    """Test that responses are JSON unless MessagePack is asked for."""
+    url = url_for('stuffrapi.get_things', inventory_id=setupdb.test_inventory_id)
+    for accept in (None, '*/*', 'application/json, application/msgpack;q=0.5'):
+        response = authenticated_client.get(url, headers={'Accept': accept} if accept else {})
+        assert response.headers['Content-Type'] == 'application/json'
+        assert response.headers['Vary'] == 'Accept'
+
+
+def test_get_msgpack(authenticated_client, setupdb):
+    """Test getting things as MessagePack, with native dates."""
+    url = url_for('stuffrapi.get_things', inventory_id=setupdb.test_inventory_id)
+    response = authenticated_client.get(url, headers=MSGPACK_HEADERS)
+    assert response.status_code == HTTPStatus.OK
+    assert response.headers['Content-Type'] == formats.MSGPACK_MIMETYPE
+    things = formats.py_unpack(response.data)
+    json_things = json.loads(authenticated_client.get(url).data)
+    assert len(things) == len(json_things) > 0
+    for thing, json_thing in zip(things, json_things):
+        assert isinstance(thing['date_created'], datetime.datetime)
+        assert thing['date_created'].isoformat() == json_thing['date_created']
+        assert thing == dict(json_thing, date_created=thing['date_created'],
+                             date_modified=thing['date_modified'])
+
+
+def test_errors_msgpack(authenticated_client, setupdb):
+    """Test that errors are encoded in the format asked for."""
+    url = url_for('stuffrapi.get_things', inventory_id=setupdb.test_inventory_bad_id)
+    response = authenticated_client.get(url, headers=MSGPACK_HEADERS)
+    assert response.status_code == HTTPStatus.NOT_FOUND
+    assert 'message' in formats.py_unpack(response.data)
+
+
+def test_post_msgpack(authenticated_client, setupdb):
+    """Test creating and updating a thing with MessagePack request bodies."""
+    url = url_for('stuffrapi.post_thing', inventory_id=setupdb.test_inventory_id)
+    response = _post_msgpack(authenticated_client, url, {'name': 'Packed', 'details': 'é'})
+    assert response.status_code == HTTPStatus.CREATED
+    assert response.headers['Content-Type'] == 'application/json'
+    thing = models.Thing.query.get(response.json['id'])
+    assert (thing.name, thing.details) == ('Packed', 'é')
+
+    response = authenticated_client.put(
+        url_for('stuffrapi.update_thing', thing_id=thing.id),
+        headers=dict(MSGPACK_HEADERS, **{'Content-Type': 'application/x-msgpack'}),
+        data=formats.py_pack({'location': 'Packed location'}))
+    assert response.status_code == HTTPStatus.OK
+    assert formats.py_unpack(response.data)['date_modified'] == thing.date_modified
+    assert thing.location == 'Packed location'
+
+    response = authenticated_client.post(
+        url, headers={'Content-Type': formats.MSGPACK_MIMETYPE}, data=b'\x92\x01')
+    assert response.status_code == HTTPStatus.BAD_REQUEST
+
+
+def test_idempotent_replay_msgpack(authenticated_client, setupdb):
+    """Test that MessagePack responses are replayed unchanged."""
+    url = url_for('stuffrapi.post_inventory')
+    headers = dict(MSGPACK_HEADERS, **{'Idempotency-Key': 'packed'})
+    first = _post_msgpack(authenticated_client, url, {'name': 'Packed'}, headers)
+    repeat = _post_msgpack(authenticated_client, url, {'name': 'Packed'}, headers)
+    assert repeat.headers['Idempotent-Replayed'] == 'true'
+    assert repeat.headers['Content-Type'] == formats.MSGPACK_MIMETYPE
+    assert repeat.data == first.data
+
+
+def test_batch_msgpack(authenticated_client, setupdb):
+    """Test that batch operations respond in the format of the batch."""
+    things_path = url_for('stuffrapi.get_things', inventory_id=setupdb.test_inventory_id)
+    response = _post_msgpack(authenticated_client, url_for('stuffrapi.post_batch'), {
+        'operations': [{'method': 'POST', 'path': things_path, 'body': {'name': 'Packed'}},
+                       {'method': 'GET', 'path': things_path}]}, MSGPACK_HEADERS)
+    results = formats.py_unpack(response.data)['results']
+    assert [r['status'] for r in results] == [HTTPStatus.CREATED, HTTPStatus.OK]
+    assert all(isinstance(t['date_created'], datetime.datetime) for t in results[1]['body'])
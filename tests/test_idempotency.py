@@ -0,0 +1,155 @@
+"""Test cases for Idempotency-Key support."""
+
+import datetime
+import json
+import threading
+from http import HTTPStatus
+import pytest
+from flask import url_for
+
+from database import db
+from stuffrapp.api import idempotency, models
+
+
+pytestmark = pytest.mark.idempotency
+
+TEST_KEY = 'a3f2b1c4-test-key'
+
+
+# Utility functions
+####################
+
+def _post(client, url, data, key=TEST_KEY):
+    """POST JSON data with an idempotency key."""
+    headers = {'Content-Type': 'application/json'}
+    if key is not None:
+        headers['Idempotency-Key'] = key
+    return client.post(url, headers=headers, data=json.dumps(data))
+
+
+# The tests
+#############
+
+@pytest.mark.parametrize('view_name, model', [('stuffrapi.post_inventory', models.Inventory),
+                                              ('stuffrapi.post_thing', models.Thing)])
+def test_replay(authenticated_client, setupdb, view_name, model):
+    """Test that repeated requests get the first response without creating anything."""
+    url = url_for(view_name, inventory_id=setupdb.test_inventory_id)
+    data = {'name': 'Idempotent'}
+    first = _post(authenticated_client, url, data)
+    assert first.status_code == HTTPStatus.CREATED
+    assert 'Idempotent-Replayed' not in first.headers
+    count = model.query.count()
+
+    repeat = _post(authenticated_client, url, data)
+    assert repeat.status_code == HTTPStatus.CREATED
+    assert repeat.headers['Idempotent-Replayed'] == 'true'
+    assert repeat.json == first.json
+    assert model.query.count() == count
+
+    # Without a key (or with another one) a new item is created
+    assert _post(authenticated_client, url, data, key=None).status_code == HTTPStatus.CREATED
+    assert _post(authenticated_client, url, data, key='other').status_code == HTTPStatus.CREATED
+    assert model.query.count() == count + 2
+
+
+def test_error_responses_stored(authenticated_client, setupdb):
+    """Test that client errors are replayed too."""
+    url = url_for('stuffrapi.post_thing', inventory_id=setupdb.test_inventory_bad_id)
+    first = _post(authenticated_client, url, {'name': 'Nowhere'})
+    assert first.status_code == HTTPStatus.NOT_FOUND
+    repeat = _post(authenticated_client, url, {'name': 'Nowhere'})
+    assert repeat.status_code == HTTPStatus.NOT_FOUND
+    assert repeat.headers['Idempotent-Replayed'] == 'true'
+
+
+def test_key_reused_for_different_request(authenticated_client):
+    """Test that a key can't be used for a different request."""
+    url = url_for('stuffrapi.post_inventory')
+    assert _post(authenticated_client, url, {'name': 'First'}).status_code == HTTPStatus.CREATED
+    response = _post(authenticated_client, url, {'name': 'Second'})
+    assert response.status_code == HTTPStatus.UNPROCESSABLE_ENTITY
+
+
+@pytest.mark.use_alt_user
+def test_keys_per_user(authenticated_client, setupdb):
+    """Test that users can't see responses to other users' keys."""
+    other_id = models.IdempotencyKey.claim(setupdb.test_user_id, TEST_KEY, 'x',
+                                           datetime.timedelta(hours=1),
+                                           datetime.timedelta(minutes=1))[0]
+    models.IdempotencyKey.store_response(other_id, 201, '{"id": 999}', 'application/json')
+    response = _post(authenticated_client, url_for('stuffrapi.post_inventory'), {'name': 'Mine'})
+    assert response.status_code == HTTPStatus.CREATED
+    assert 'Idempotent-Replayed' not in response.headers
+
+
+def test_expired_key(authenticated_client):
+    """Test that expired keys can be used again."""
+    url = url_for('stuffrapi.post_inventory')
+    first = _post(authenticated_client, url, {'name': 'Expiring'})
+    models.IdempotencyKey.query.update({'date_expires': models.utc_now()})
+    db.session.commit()
+    repeat = _post(authenticated_client, url, {'name': 'Expiring'})
+    assert repeat.status_code == HTTPStatus.CREATED
+    assert repeat.json['id'] != first.json['id']
+    assert models.IdempotencyKey.query.count() == 1
+
+
+def test_invalid_key(authenticated_client):
+    """Test that overly long keys are rejected."""
+    response = _post(authenticated_client, url_for('stuffrapi.post_inventory'),
+                     {'name': 'Bad key'}, key='k' * 256)
+    assert response.status_code == HTTPStatus.BAD_REQUEST
+
+
+@pytest.mark.options(STUFFR_IDEMPOTENCY_WAIT=0.2)
+def test_request_in_progress(app, authenticated_client, setupdb):
+    """Test that a duplicate of a request in progress is not handled."""
+    url = url_for('stuffrapi.post_inventory')
+    data = {'name': 'Slow'}
+    count = models.Inventory.query.count()
+    # Claim the key with the fingerprint of the same request, as if it was in progress
+    with app.test_request_context(
+            url, method='POST', data=json.dumps(data)):
+        fingerprint = idempotency.request_fingerprint()
+    record_id = models.IdempotencyKey.claim(setupdb.test_user_id, TEST_KEY, fingerprint,
+                                            datetime.timedelta(hours=1),
+                                            datetime.timedelta(minutes=1))[0]
+    response = _post(authenticated_client, url, data)
+    assert response.status_code == HTTPStatus.CONFLICT
+    assert response.headers['Retry-After'] == '1'
+    assert models.Inventory.query.count() == count
+
+    # The duplicate waits for the first request to finish
+    def finish_request():
+        """Store the response of the request in progress."""
+        with app.app_context():
+            models.IdempotencyKey.store_response(record_id, 201, '{"id": 12345}',
+                                                 'application/json')
+            db.session.remove()
+    timer = threading.Timer(0.05, finish_request)
+    timer.start()
+    response = _post(authenticated_client, url, data)
+    timer.join()
+    assert response.status_code == HTTPStatus.CREATED
+    assert response.json == {'id': 12345}
+    assert models.Inventory.query.count() == count
+
+
+def test_stale_claim(app, authenticated_client, setupdb):
+    """Test that a claim left by a request that died is taken over after its lease."""
+    url = url_for('stuffrapi.post_inventory')
+    data = {'name': 'Retried'}
+    with app.test_request_context(url, method='POST', data=json.dumps(data)):
+        fingerprint = idempotency.request_fingerprint()
+    models.IdempotencyKey.claim(setupdb.test_user_id, TEST_KEY, fingerprint,
+                                datetime.timedelta(hours=1), datetime.timedelta(minutes=1))
+    lease = datetime.timedelta(seconds=app.config['STUFFR_IDEMPOTENCY_LEASE'])
+    models.IdempotencyKey.query.update(
+        {'date_created': models.utc_now() - lease - datetime.timedelta(seconds=1)})
+    db.session.commit()
+    response = _post(authenticated_client, url, data)
+    assert response.status_code == HTTPStatus.CREATED
+    repeat = _post(authenticated_client, url, data)
+    assert repeat.headers['Idempotent-Replayed'] == 'true'
+    assert repeat.json['id'] == response.json['id']
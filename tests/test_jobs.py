@@ -0,0 +1,164 @@
+"""Test cases for background jobs."""
+
+import threading
+import time
+import pytest
+
+from database import db
+from stuffrapp import jobs
+from stuffrapp.api import models
+
+
+pytestmark = pytest.mark.jobs
+
+# Arguments of test jobs, in the order they ran
+job_calls = []
+
+
+@jobs.handler('test_record')
+def record_job(value):
+    """Test job that records its argument."""
+    job_calls.append(value)
+
+
+@jobs.handler('test_fail')
+def failing_job():
+    """Test job that always fails."""
+    raise RuntimeError('Job failed')
+
+
+# Utility functions
+####################
+
+def _make_all_visible():
+    """Make all jobs visible to workers now."""
+    models.Job.query.update({'date_visible': models.utc_now()})
+    db.session.commit()
+
+
+# Test fixtures
+################
+
+@pytest.fixture
+def worker(app, setupdb):  # pylint: disable=unused-argument
+    """Worker for an empty job queue."""
+    # Remove setup jobs for the test users
+    models.Job.query.delete()
+    db.session.commit()
+    job_calls.clear()
+    return jobs.Worker(app)
+
+
+# The tests
+#############
+
+def test_enqueue_in_transaction(worker):
+    """Test that jobs are only queued if the transaction is committed."""
+    jobs.enqueue('test_record', value=1)
+    db.session.rollback()
+    assert models.Job.query.count() == 0
+    jobs.enqueue('test_record', value=2)
+    db.session.commit()
+    assert worker.run_pending() == 1
+    assert job_calls == [2]
+    assert models.Job.get_queue_stats() == {'pending': 0, 'running': 0,
+                                            'finished': 1, 'failed': 0}
+
+
+def test_enqueue_unknown_job(worker):  # pylint: disable=unused-argument
+    """Test that jobs without a handler are rejected."""
+    with pytest.raises(ValueError):
+        jobs.enqueue('no_such_job')
+
+
+def test_priority(worker):
+    """Test that jobs run in order of priority, then age."""
+    jobs.enqueue('test_record', value='low', priority=-1)
+    jobs.enqueue('test_record', value='normal 1')
+    jobs.enqueue('test_record', value='high', priority=5)
+    jobs.enqueue('test_record', value='normal 2')
+    jobs.enqueue('test_record', value='delayed', priority=10, delay=3600)
+    db.session.commit()
+    assert worker.run_pending() == 4
+    assert job_calls == ['high', 'normal 1', 'normal 2', 'low']
+
+
+def test_retry(worker):
+    """Test that failed jobs are retried with backoff, then given up on."""
+    jobs.enqueue('test_fail', max_attempts=2)
+    db.session.commit()
+    start = models.utc_now()
+    assert worker.run_pending() == 1
+    job = models.Job.query.one()
+    assert job.attempts == 1
+    assert 'Job failed' in job.last_error
+    assert job.date_visible >= start + worker.get_retry_delay(1)
+    assert job.date_failed is None
+    # Not visible until the retry delay is over
+    assert worker.run_pending() == 0
+
+    _make_all_visible()
+    assert worker.run_pending() == 1
+    job = models.Job.query.one()
+    assert job.attempts == 2
+    assert job.date_failed is not None
+    assert models.Job.get_queue_stats()['failed'] == 1
+
+
+def test_visibility_timeout(worker):  # pylint: disable=unused-argument
+    """Test that a job is retried if its worker dies."""
+    jobs.enqueue('test_record', value=1, timeout=60)
+    db.session.commit()
+    # Claimed by a worker that never finishes the job
+    job = models.Job.claim_next('crashed', 10)
+    assert job.date_visible > models.utc_now()
+    assert models.Job.get_queue_stats()['running'] == 1
+    assert models.Job.claim_next('other', 10) is None
+
+    _make_all_visible()
+    job = models.Job.claim_next('other', 10)
+    assert job.attempts == 2
+    assert job.claim_token == 'other'
+
+
+def test_crashed_attempts(worker):  # pylint: disable=unused-argument
+    """Test that a job that keeps crashing its worker is given up on."""
+    jobs.enqueue('test_record', value=1, max_attempts=2)
+    db.session.commit()
+    for attempt in range(2):
+        job = models.Job.claim_next(f'crashed {attempt}', 10)
+        assert job.attempts == attempt + 1
+        _make_all_visible()
+    assert models.Job.claim_next('other', 10) is None
+    job = models.Job.query.one()
+    assert job.date_failed is not None
+    assert job.claim_token is None
+    assert models.Job.get_queue_stats()['failed'] == 1
+
+
+def test_concurrency_limit(worker):
+    """Test that no more than the concurrency limit of jobs run at once."""
+    worker.concurrency = 1
+    jobs.enqueue('test_record', value=1)
+    jobs.enqueue('test_record', value=2)
+    db.session.commit()
+    assert models.Job.claim_next('running', worker.concurrency) is not None
+    assert not worker.run_one()
+    assert job_calls == []
+
+
+def test_worker_threads(worker):
+    """Test running jobs in a worker thread until stopped."""
+    worker.poll_interval = 0.01
+    for i in range(3):
+        jobs.enqueue('test_record', value=i)
+    db.session.commit()
+    thread = threading.Thread(target=worker.run, args=(1,))
+    thread.start()
+    deadline = time.monotonic() + 5
+    while len(job_calls) < 3 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    worker.stop()
+    thread.join(5)
+    assert job_calls == [0, 1, 2]
+    assert not thread.is_alive()
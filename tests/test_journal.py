@@ -0,0 +1,168 @@
+"""Test cases for the journal of changes to things and inventories."""
+
+import datetime
+from http import HTTPStatus
+import pytest
+from flask import url_for
+
+from database import db
+from stuffrapp.api import errors, models
+from tests.conftest import CommonViewTests, post_as_json
+
+
+pytestmark = pytest.mark.journal
+
+
+# Utility functions
+####################
+
+def _entries(user_id, after_id=0):
+    """Return (entity, entity_id, operation, changes) of a user's entries."""
+    return [(e['entity'], e['entity_id'], e['operation'], e['changes'])
+            for e in models.JournalEntry.get_entries(user_id, after_id, 1000)]
+
+
+def _last_id():
+    """Return the ID of the latest journal entry."""
+    return db.session.query(db.func.max(models.JournalEntry.id)).scalar() or 0
+
+
+# The tests
+#############
+
+class TestJournalEntryModel:
+    """Tests for the journal entries written by the model write methods."""
+
+    def test_write_methods(self, setupdb):
+        """Test that each write adds an entry with the changed fields."""
+        user_id = setupdb.test_user_id
+        inventory = models.Inventory.create_new_inventory({'name': 'New'}, user_id)
+        thing = models.Thing.create_new_thing({'name': 'New', 'location': 'Here'},
+                                              inventory.id, user_id)
+        changes = models.Thing.update_thing(thing.id, {'details': 'More'}, user_id)
+        models.Thing.delete_thing(thing.id, user_id)
+
+        entries = models.JournalEntry.get_entries(user_id, 0, 10)
+        assert [e['id'] for e in entries] == sorted(e['id'] for e in entries)
+        assert [(e['entity'], e['entity_id'], e['operation'], e['changes']) for e in entries] == [
+            ('inventory', inventory.id, 'created',
+             {'name': 'New', 'date_created': inventory.date_created.isoformat()}),
+            ('thing', thing.id, 'created', {
+                'inventory_id': inventory.id, 'name': 'New', 'location': 'Here',
+                'details': None, 'date_created': thing.date_created.isoformat(),
+                'date_modified': thing.date_created.isoformat(), 'date_deleted': None}),
+            ('thing', thing.id, 'updated',
+             {'details': 'More', 'date_modified': changes['date_modified'].isoformat()}),
+            ('thing', thing.id, 'deleted', {'date_deleted': thing.date_deleted.isoformat(),
+                                            'date_modified': thing.date_deleted.isoformat()})]
+
+    def test_failed_writes(self, setupdb):
+        """Test that writes that fail add no entries."""
+        last_id = _last_id()
+        with pytest.raises(errors.UserPermissionError):
+            models.Thing.update_thing(setupdb.test_thing_id, {'name': 'No'},
+                                      setupdb.test_alt_user_id)
+        with pytest.raises(errors.InvalidDataError):
+            models.Thing.create_new_thing({}, setupdb.test_inventory_id, setupdb.test_user_id)
+        # Nothing to change
+        models.Thing.update_thing(setupdb.test_thing_id, {}, setupdb.test_user_id)
+        assert _last_id() == last_id
+
+    def test_get_entries(self, setupdb):
+        """Test reading a user's entries after an entry."""
+        user_id = setupdb.test_user_id
+        for name in ('One', 'Two', 'Three'):
+            models.Thing.update_thing(setupdb.test_thing_id, {'name': name}, user_id)
+        models.Inventory.create_new_inventory({'name': 'Other'}, setupdb.test_alt_user_id)
+        entries = models.JournalEntry.get_entries(user_id, 0, 10)
+        assert [e['changes']['name'] for e in entries] == ['One', 'Two', 'Three']
+        after_first = models.JournalEntry.get_entries(user_id, entries[0]['id'], 1)
+        assert [e['changes']['name'] for e in after_first] == ['Two']
+        assert models.JournalEntry.get_entries(user_id, entries[-1]['id'], 10) == []
+
+    def test_compact(self, setupdb):
+        """Test merging old entries of the same item."""
+        user_id = setupdb.test_user_id
+        thing = models.Thing.create_new_thing({'name': 'Old'}, setupdb.test_inventory_id,
+                                              user_id)
+        models.Thing.update_thing(thing.id, {'name': 'Older'}, user_id)
+        models.Thing.update_thing(setupdb.test_thing_id, {'location': 'Old'}, user_id)
+        models.Thing.update_thing(thing.id, {'location': 'Compacted'}, user_id)
+        through_id = _last_id()
+        models.Thing.update_thing(thing.id, {'name': 'New'}, user_id)
+        before = models.JournalEntry.get_entries(user_id, 0, 10)
+
+        assert models.JournalEntry.compact(through_id) == 2
+        after = models.JournalEntry.get_entries(user_id, 0, 10)
+        assert [e['id'] for e in after] == [e['id'] for e in before[2:]]
+        assert (after[1]['operation'], after[1]['changes']) == ('created', dict(
+            before[0]['changes'], name='Older', location='Compacted',
+            date_modified=before[3]['changes']['date_modified']))
+        assert after[0] == before[2]
+        assert after[2] == before[4]
+        # Already compacted
+        assert models.JournalEntry.compact(through_id) == 0
+
+    def test_compact_deleted(self, setupdb):
+        """Test that an item created and deleted in the compacted range stays deleted."""
+        user_id = setupdb.test_user_id
+        thing = models.Thing.create_new_thing({'name': 'Gone'}, setupdb.test_inventory_id,
+                                              user_id)
+        models.Thing.update_thing(thing.id, {'location': 'Away'}, user_id)
+        models.Thing.delete_thing(thing.id, user_id)
+        assert models.JournalEntry.compact(_last_id()) == 2
+
+        entries = [e for e in models.JournalEntry.get_entries(user_id, 0, 10)
+                   if e['entity_id'] == thing.id]
+        assert [e['operation'] for e in entries] == ['deleted']
+        row = models.Thing.query.get(thing.id)
+        assert entries[0]['changes']['location'] == row.location
+        assert entries[0]['changes']['date_deleted'] == row.date_deleted.isoformat()
+        assert entries[0]['changes']['date_modified'] == row.date_modified.isoformat()
+
+    def test_ids_not_reused(self, setupdb):
+        """Test that entry IDs keep increasing after entries are removed."""
+        models.Thing.update_thing(setupdb.test_thing_id, {'name': 'One'}, setupdb.test_user_id)
+        last_id = _last_id()
+        models.JournalEntry.query.delete()
+        db.session.commit()
+        models.Thing.update_thing(setupdb.test_thing_id, {'name': 'Two'}, setupdb.test_user_id)
+        assert _last_id() > last_id
+
+    def test_get_last_id(self, setupdb):
+        """Test finding the last entry before a date."""
+        now = models.utc_now()
+        assert models.JournalEntry.get_last_id(now) is None
+        models.Thing.update_thing(setupdb.test_thing_id, {'name': 'One'}, setupdb.test_user_id)
+        assert models.JournalEntry.get_last_id(now) is None
+        later = models.utc_now() + datetime.timedelta(seconds=1)
+        assert models.JournalEntry.get_last_id(later) == _last_id()
+
+
+class TestGetJournal(CommonViewTests):
+    """Tests for reading the journal."""
+
+    view_name = 'stuffrapi.get_journal'
+    method = 'get'
+
+    def test_get_journal(self, authenticated_client, setupdb):
+        """Test reading the journal in pages."""
+        url = url_for('stuffrapi.post_thing', inventory_id=setupdb.test_inventory_id)
+        for name in ('One', 'Two', 'Three'):
+            post_as_json(authenticated_client.post, url, {'name': name})
+        response = authenticated_client.get(url_for(self.view_name, limit=2))
+        assert response.status_code == HTTPStatus.OK
+        assert response.json['more'] is True
+        entries = response.json['entries']
+        assert [e['changes']['name'] for e in entries] == ['One', 'Two']
+        assert entries[0]['operation'] == 'created'
+
+        response = authenticated_client.get(url_for(self.view_name, after=entries[-1]['id']))
+        assert response.json['more'] is False
+        assert [e['changes']['name'] for e in response.json['entries']] == ['Three']
+
+    @pytest.mark.parametrize('limit', [0, -1, 1001])
+    def test_invalid_limit(self, authenticated_client, limit):
+        """Test limits that are out of range."""
+        response = authenticated_client.get(url_for(self.view_name, limit=limit))
+        assert response.status_code == HTTPStatus.BAD_REQUEST
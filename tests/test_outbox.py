@@ -0,0 +1,227 @@
+"""Test cases for the outgoing email queue.
+
+Messages are delivered to a DummySMTP server running in a background thread.
+"""
+
+import asyncore
+import datetime
+import threading
+import time
+import pytest
+from flask_mail import Message
+
+from database import db
+from stuffrapp import outbox
+from stuffrapp.api import models
+from stuffrapp.devsmtp import DummySMTP
+
+
+pytestmark = pytest.mark.outbox
+
+
+class RejectingSMTP(DummySMTP):
+    """SMTP server that permanently rejects all messages."""
+
+    def process_message(self, *args, **kwargs):
+        """Reject the message."""
+        return '550 No such user'
+
+
+class SMTPThread:
+    """Runs an SMTP server in a background thread."""
+
+    def __init__(self, server_class=DummySMTP):
+        """Start the server on a free local port."""
+        self.socket_map = {}
+        self.server = server_class(('127.0.0.1', 0), None, map=self.socket_map)
+        self.port = self.server.socket.getsockname()[1]
+        self.thread = threading.Thread(
+            target=asyncore.loop, kwargs={'timeout': 0.01, 'map': self.socket_map})
+        self.thread.start()
+
+    @property
+    def received(self):
+        """Messages received by the server."""
+        return self.server.received
+
+    def close(self):
+        """Stop the server."""
+        for channel in list(self.socket_map.values()):
+            channel.close()
+        self.thread.join(5)
+
+
+# Utility functions
+####################
+
+def _make_message(i=0):
+    """Create a test message."""
+    return Message(f'Test {i}', sender='stuffr@example.com',
+                   recipients=[f'user{i}@example.com'], body='Testing')
+
+
+def _queue_messages(count):
+    """Queue count test messages."""
+    for i in range(count):
+        outbox.queue_message(_make_message(i))
+
+
+def _make_all_due():
+    """Make all pending messages due to be retried now."""
+    models.OutboxEmail.query.update({'date_next_attempt': models.utc_now()})
+    db.session.commit()
+
+
+# Test fixtures
+################
+
+@pytest.fixture
+def sender(app, setupdb):  # pylint: disable=unused-argument
+    """Sender for a freshly created outbox."""
+    new_sender = outbox.OutboxSender(app)
+    app.extensions['stuffr_outbox'] = new_sender
+    yield new_sender
+    new_sender.stop(5)
+    outbox.init_app(app)
+
+
+@pytest.fixture
+def smtp_server(app):
+    """Run an SMTP server and send mail to it."""
+    mail = app.extensions['mail']
+    old_settings = (mail.suppress, mail.server, mail.port)
+    server = SMTPThread()
+    mail.suppress, mail.server, mail.port = False, '127.0.0.1', server.port
+    yield server
+    server.close()
+    mail.suppress, mail.server, mail.port = old_settings
+
+
+# The tests
+#############
+
+def test_security_mail_task(app):
+    """Test that Flask-Security sends email through the outbox."""
+    assert app.extensions['security']._send_mail_task is outbox.send_mail_task
+
+
+@pytest.mark.options(STUFFR_MAIL_SENDER_THREAD=False)
+def test_email_queued(sender, smtp_server):
+    """Test that email is queued and sent later."""
+    outbox.send_mail_task(_make_message())
+    assert models.OutboxEmail.get_queue_stats()['pending'] == 1
+    assert smtp_server.received == []
+
+    assert sender.deliver_pending() == 1
+    mailfrom, rcpttos, data = smtp_server.received[0]
+    assert mailfrom == 'stuffr@example.com'
+    assert rcpttos == ['user0@example.com']
+    assert b'Subject: Test 0' in data
+    stats = models.OutboxEmail.get_queue_stats()
+    assert stats['pending'] == 0
+    assert stats['sent'] == 1
+    assert stats['oldest_pending'] is None
+
+
+def test_suppressed_email_not_queued(app, sender):  # pylint: disable=unused-argument
+    """Test that suppressed email is not stored in the outbox."""
+    with app.extensions['mail'].record_messages() as sent:
+        outbox.send_mail_task(_make_message())
+    assert len(sent) == 1
+    assert models.OutboxEmail.query.count() == 0
+
+
+def test_batches_reuse_connection(sender, smtp_server):
+    """Test that all due messages are sent over one connection."""
+    sender.batch_size = 2
+    _queue_messages(5)
+    assert sender.deliver_pending() == 5
+    assert len(smtp_server.received) == 5
+    assert sender.stats['batches'] == 3
+    assert sender.stats['connections'] == 1
+
+
+def test_retry_when_server_down(app, sender, smtp_server):
+    """Test that messages are retried with backoff if the server is down."""
+    _queue_messages(3)
+    mail = app.extensions['mail']
+    mail.port = 1
+    start = models.utc_now()
+    assert sender.deliver_pending() == 0
+    emails = models.OutboxEmail.query.all()
+    assert all(e.attempts == 1 and e.last_error for e in emails)
+    assert all(e.date_next_attempt >= start + sender.get_retry_delay(1) for e in emails)
+    # Not due yet
+    assert sender.deliver_pending() == 0
+    assert models.OutboxEmail.query.first().attempts == 1
+
+    mail.port = smtp_server.port
+    _make_all_due()
+    assert sender.deliver_pending() == 3
+    assert len(smtp_server.received) == 3
+
+
+def test_give_up_after_max_attempts(app, sender, smtp_server):  # pylint: disable=unused-argument
+    """Test that a message is marked as failed after too many attempts."""
+    sender.max_attempts = 2
+    _queue_messages(1)
+    app.extensions['mail'].port = 1
+    sender.deliver_pending()
+    _make_all_due()
+    sender.deliver_pending()
+    stats = models.OutboxEmail.get_queue_stats()
+    assert stats['pending'] == 0
+    assert stats['failed'] == 1
+    assert sender.stats == {'sent': 0, 'retried': 1, 'failed': 1,
+                            'batches': 2, 'connections': 0}
+
+
+def test_permanent_error(app, sender):
+    """Test that messages rejected by the server are not retried."""
+    server = SMTPThread(RejectingSMTP)
+    mail = app.extensions['mail']
+    old_settings = (mail.suppress, mail.server, mail.port)
+    mail.suppress, mail.server, mail.port = False, '127.0.0.1', server.port
+    try:
+        _queue_messages(2)
+        assert sender.deliver_pending() == 0
+    finally:
+        server.close()
+        mail.suppress, mail.server, mail.port = old_settings
+    email = models.OutboxEmail.query.first()
+    assert email.date_failed is not None
+    assert '550' in email.last_error
+    assert sender.stats['failed'] == 2
+    # Rejecting a message does not close the connection
+    assert sender.stats['connections'] == 1
+
+
+def test_retry_delay(sender):
+    """Test exponential backoff of retries."""
+    sender.retry_delay = 10
+    sender.retry_max_delay = 60
+    delays = [sender.get_retry_delay(a).total_seconds() for a in range(1, 6)]
+    assert delays == [10, 20, 40, 60, 60]
+
+
+@pytest.mark.options(STUFFR_MAIL_SENDER_THREAD=True)
+def test_sender_thread(sender, smtp_server):
+    """Test that queueing a message wakes up the sender thread."""
+    outbox.send_mail_task(_make_message())
+    deadline = time.monotonic() + 5
+    while not smtp_server.received and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert len(smtp_server.received) == 1
+
+
+def test_claims_are_exclusive(sender):
+    """Test that claimed messages cannot be claimed again until the lease ends."""
+    _queue_messages(3)
+    lease = datetime.timedelta(minutes=1)
+    first = models.OutboxEmail.claim_batch('first', 2, lease)
+    second = models.OutboxEmail.claim_batch('second', 2, lease)
+    assert len(first) == 2
+    assert len(second) == 1
+    assert not {e.id for e in first} & {e.id for e in second}
+    assert models.OutboxEmail.claim_batch('third', 2, lease) == []
+    assert sender.stats['sent'] == 0
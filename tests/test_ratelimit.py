@@ -0,0 +1,138 @@
+"""Test cases for API rate limiting and admission control."""
+
+import threading
+from http import HTTPStatus
+import pytest
+from flask import url_for
+
+from stuffrapp.api import ratelimit
+from tests.conftest import post_as_json
+
+
+pytestmark = pytest.mark.ratelimit
+
+
+# Test fixtures
+################
+
+@pytest.fixture
+def limiter(app):
+    """Replace the app's rate limiter with one with low limits."""
+    old_limiter = ratelimit.get_limiter()
+    new_limiter = ratelimit.RateLimiter(app)
+    new_limiter.rate = 0.1
+    new_limiter.burst = 3
+    new_limiter.costs = {'stuffrapi.get_things': 2}
+    app.extensions['stuffr_rate_limiter'] = new_limiter
+    yield new_limiter
+    app.extensions['stuffr_rate_limiter'] = old_limiter
+
+
+# The tests
+#############
+
+@pytest.mark.parametrize('backend_type', ['memory', 'sqlite'])
+def test_token_bucket(tmpdir, backend_type):
+    """Test taking tokens from a bucket."""
+    if backend_type == 'memory':
+        backend = ratelimit.MemoryBackend()
+    else:
+        backend = ratelimit.SQLiteBackend(str(tmpdir.join('limits.db')))
+    assert [backend.consume('a', 1, 1, 3) for _ in range(3)] == [0, 0, 0]
+    assert 0.9 < backend.consume('a', 1, 1, 3) <= 1
+    # Costs more than remaining tokens, wait for refill
+    assert 1.9 < backend.consume('a', 2, 1, 3) <= 2
+    # Other buckets are not affected
+    assert backend.consume('b', 3, 1, 3) == 0
+
+
+def test_sqlite_backend_shared(tmpdir):
+    """Test that SQLite buckets are shared between backends, e.g. in other processes."""
+    path = str(tmpdir.join('limits.db'))
+    first = ratelimit.SQLiteBackend(path)
+    second = ratelimit.SQLiteBackend(path)
+    assert first.consume('a', 2, 1, 3) == 0
+    assert second.consume('a', 2, 1, 3) > 0
+
+
+def test_rate_limited(authenticated_client, limiter):  # pylint: disable=unused-argument
+    """Test that requests over the limit are rejected with Retry-After."""
+    url = url_for('stuffrapi.get_inventories')
+    for _ in range(3):
+        assert authenticated_client.get(url).status_code == HTTPStatus.OK
+    response = authenticated_client.get(url)
+    assert response.status_code == HTTPStatus.TOO_MANY_REQUESTS
+    assert 0 < int(response.headers['Retry-After']) <= 10
+    # Anonymous clients have their own limit
+    response = authenticated_client.open_(url)
+    assert response.status_code == HTTPStatus.UNAUTHORIZED
+
+
+def test_endpoint_cost(authenticated_client, setupdb, limiter):  # pylint: disable=unused-argument
+    """Test that expensive endpoints use more of the limit."""
+    url = url_for('stuffrapi.get_things', inventory_id=setupdb.test_inventory_id)
+    assert authenticated_client.get(url).status_code == HTTPStatus.OK
+    assert authenticated_client.get(url).status_code == HTTPStatus.TOO_MANY_REQUESTS
+    # Cheaper requests can use what's left
+    url = url_for('stuffrapi.get_inventories')
+    assert authenticated_client.get(url).status_code == HTTPStatus.OK
+
+
+def test_batch_cost(authenticated_client, setupdb, limiter):  # pylint: disable=unused-argument
+    """Test that batches cost the sum of their operations' costs."""
+    limiter.burst = 4
+    things_path = url_for('stuffrapi.get_things', inventory_id=setupdb.test_inventory_id)
+    inventories_path = url_for('stuffrapi.get_inventories')
+    operations = [{'method': 'GET', 'path': things_path},
+                  {'method': 'GET', 'path': inventories_path}]
+    url = url_for('stuffrapi.post_batch')
+    response = post_as_json(authenticated_client.post, url, {'operations': operations})
+    assert response.status_code == HTTPStatus.OK
+    # Only one token left
+    response = post_as_json(authenticated_client.post, url, {'operations': operations[1:]})
+    assert response.status_code == HTTPStatus.OK
+    response = post_as_json(authenticated_client.post, url, {'operations': operations[1:]})
+    assert response.status_code == HTTPStatus.TOO_MANY_REQUESTS
+
+
+@pytest.mark.usefixtures('limiter')
+def test_batch_over_limit(authenticated_client, setupdb):
+    """Test that batches costing more than a full bucket are rejected."""
+    things_path = url_for('stuffrapi.get_things', inventory_id=setupdb.test_inventory_id)
+    response = post_as_json(authenticated_client.post, url_for('stuffrapi.post_batch'),
+                            {'operations': [{'method': 'GET', 'path': things_path}] * 2})
+    assert response.status_code == HTTPStatus.REQUEST_ENTITY_TOO_LARGE
+    assert 'Retry-After' not in response.headers
+    # Nothing was taken from the bucket
+    url = url_for('stuffrapi.get_inventories')
+    assert authenticated_client.get(url).status_code == HTTPStatus.OK
+
+
+def test_concurrency_cap(authenticated_client, limiter):
+    """Test that requests over the concurrency cap are rejected."""
+    limiter.rate = None
+    limiter.slots = threading.BoundedSemaphore(1)
+    url = url_for('stuffrapi.get_inventories')
+    # Another request in progress
+    limiter.slots.acquire()
+    response = authenticated_client.get(url)
+    assert response.status_code == HTTPStatus.SERVICE_UNAVAILABLE
+    assert response.headers['Retry-After'] == str(limiter.overload_retry_after)
+    limiter.slots.release()
+
+    # Slots are released after each request
+    for _ in range(3):
+        assert authenticated_client.get(url).status_code == HTTPStatus.OK
+
+
+def test_streamed_response_slot(authenticated_client, setupdb, limiter):
+    """Test that streamed responses keep their slot until they are closed."""
+    limiter.rate = None
+    limiter.slots = threading.BoundedSemaphore(1)
+    url = url_for('stuffrapi.export_inventory', inventory_id=setupdb.test_inventory_id)
+    response = authenticated_client.get(url, buffered=False)
+    assert response.status_code == HTTPStatus.OK
+    assert not limiter.slots.acquire(blocking=False)
+    response.close()
+    assert limiter.slots.acquire(blocking=False)
+    limiter.slots.release()
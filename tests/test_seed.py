@@ -0,0 +1,54 @@
+"""Test cases for generating seed data."""
+
+import pytest
+
+from stuffrapp import seed
+from stuffrapp.api import models
+
+
+pytestmark = pytest.mark.seed
+
+
+# The tests
+#############
+
+@pytest.mark.usefixtures('setupdb')
+def test_seed_database():
+    """Test that seeding creates the requested rows."""
+    users_before = models.User.total_count()
+    things_before = models.Thing.total_count()
+    created = seed.seed_database(3, 2, 5, batch_size=4)
+    assert created == {'users': 3, 'inventories': 6, 'things': 30}
+    assert models.User.total_count() == users_before + 3
+    assert models.Thing.total_count() == things_before + 30
+    seed_user = models.User.query.filter_by(email=seed.SEED_EMAIL_TEMPLATE.format(0)).one()
+    assert seed_user.inventories.count() == 2
+
+
+@pytest.mark.usefixtures('setupdb')
+def test_seed_resume():
+    """Test that running seed again only adds missing rows."""
+    seed.seed_database(2, 1, 3)
+    # Simulate a run interrupted partway through an inventory
+    models.Thing.query.filter(
+        models.Thing.id == models.Thing.query.order_by(models.Thing.id.desc()).first().id
+    ).delete()
+    models.Thing.query.session.commit()
+
+    created = seed.seed_database(3, 1, 3)
+    assert created == {'users': 1, 'inventories': 1, 'things': 4}
+    assert seed.seed_row_counts() == {'users': 3, 'inventories': 3, 'things': 9}
+    # Nothing left to do
+    created = seed.seed_database(3, 1, 3)
+    assert created == {'users': 0, 'inventories': 0, 'things': 0}
+
+
+def test_generated_content_deterministic():
+    """Test that the same parameters generate the same content."""
+    pools = seed.build_text_pools(0)
+    assert pools == seed.build_text_pools(0)
+    first = seed.generate_thing_row(pools, 1, 10, None)
+    assert first == seed.generate_thing_row(pools, 1, 10, None)
+    assert first != seed.generate_thing_row(pools, 1, 11, None)
+    assert all(len(n) <= 128 for n in pools['name'])
+    assert all(len(n) <= 128 for n in pools['location'])
@@ -0,0 +1,100 @@
+"""Test cases for preparing the app for a pre-forking server."""
+
+import gc
+import os
+import pytest
+import sqlalchemy
+
+from database import db
+from stuffrapp import server
+from stuffrapp.api import models
+
+
+pytestmark = pytest.mark.server
+
+
+@pytest.fixture
+def file_bind(app, setupdb, tmpdir, monkeypatch):  # pylint: disable=redefined-outer-name
+    """Add a bind with a pooled SQLite file database, returning its engine.
+
+    Flask-SQLAlchemy doesn't pool connections to SQLite files, so the pool
+    stands in for one of a database server.
+    """
+    apply_driver_hacks = db.apply_driver_hacks
+
+    def _pooled(flask_app, info, options):
+        apply_driver_hacks(flask_app, info, options)
+        options['poolclass'] = sqlalchemy.pool.QueuePool
+    monkeypatch.setattr(db, 'apply_driver_hacks', _pooled)
+    uri = 'sqlite:///{}'.format(tmpdir.join('bind.db'))
+    monkeypatch.setitem(app.config, 'SQLALCHEMY_BINDS', {'file': uri})
+    engine = db.get_engine(app, bind='file')
+    yield engine
+    engine.dispose()
+    if hasattr(gc, 'unfreeze'):
+        # Frozen by before_fork()
+        gc.unfreeze()
+
+
+# The tests
+#############
+
+def test_recommended_workers():
+    """Test the recommended number of workers for the available cores."""
+    assert server.recommended_workers(1) == (3, server.THREADS_PER_WORKER)
+    assert server.recommended_workers(4) == (9, server.THREADS_PER_WORKER)
+    assert server.recommended_workers()[0] >= 3
+
+
+def test_process_warnings(app, monkeypatch):
+    """Test that settings keeping state in each process are reported with several workers."""
+    monkeypatch.setitem(app.config, 'STUFFR_RATE_LIMIT', 20)
+    monkeypatch.setitem(app.config, 'STUFFR_RATE_LIMIT_DB', None)
+    monkeypatch.setitem(app.config, 'STUFFR_EVENTS_SOCKET_DIR', None)
+    assert server.process_warnings(app, 1) == []
+    assert len(server.process_warnings(app, 3)) == 2
+    monkeypatch.setitem(app.config, 'STUFFR_RATE_LIMIT_DB', '/tmp/limits.db')
+    monkeypatch.setitem(app.config, 'STUFFR_EVENTS_SOCKET_DIR', '/tmp/events')
+    assert server.process_warnings(app, 3) == []
+
+
+def test_warm_pools(app, file_bind):
+    """Test that connections are left open in the pools."""
+    server.warm_pools(app, size=2)
+    assert file_bind.pool.checkedin() == 2
+
+
+def test_dispose_pools(app, file_bind):
+    """Test that pooled connections are closed, except to in-memory databases."""
+    main_pool = db.get_engine(app).pool
+    server.warm_pools(app)
+    server.dispose_pools(app)
+    assert file_bind.pool.checkedin() == 0
+    assert db.get_engine(app).pool is main_pool
+    assert models.User.query.count() == 2
+
+
+def test_before_fork(app, file_bind):
+    """Test that the master process keeps no connections open."""
+    server.before_fork(app)
+    assert file_bind.pool.checkedin() == 0
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='Needs os.fork()')
+def test_after_fork(app, file_bind):
+    """Test that a forked worker opens connections of its own."""
+    server.before_fork(app)
+    pid = os.fork()
+    if pid == 0:
+        # Worker process, must not return into pytest
+        ready = False
+        try:
+            server.after_fork(app, threads=2)
+            ready = file_bind.pool.checkedin() == 2 and \
+                file_bind.execute('SELECT 1').scalar() == 1
+        finally:
+            os._exit(0 if ready else 1)  # pylint: disable=protected-access
+    _, status = os.waitpid(pid, 0)
+    assert os.WEXITSTATUS(status) == 0
+    # The master's pool was not touched by the worker
+    assert file_bind.pool.checkedin() == 0
@@ -0,0 +1,262 @@
+"""Test cases for splitting data between shard databases."""
+
+from http import HTTPStatus
+from unittest import mock
+import pytest
+import sqlalchemy
+from flask import url_for
+
+from database import db
+from stuffrapp import user_store
+from stuffrapp.api import models, shards
+from tests.conftest import TEST_NEW_USER, post_as_json
+
+
+pytestmark = pytest.mark.shards
+
+SHARDS = ['one', 'two']
+
+
+# Utility functions
+####################
+
+def _thing_ids(shard, user_id):
+    """Return the IDs of a user's things stored in a shard."""
+    thing_table = models.Thing.__table__
+    inventory_table = models.Inventory.__table__
+    query = sqlalchemy.select([thing_table.c.id]). \
+        select_from(thing_table.join(inventory_table)). \
+        where(inventory_table.c.user_id == user_id). \
+        order_by(thing_table.c.id)
+    return [row[0] for row in shards.get_engine(shard).execute(query)]
+
+
+def _last_ids(shard, user_id):
+    """Return the IDs of a user's last inventory and its last thing in a shard."""
+    inventory_table = models.Inventory.__table__
+    engine = shards.get_engine(shard)
+    inventory_id = engine.execute(
+        sqlalchemy.select([sqlalchemy.func.max(inventory_table.c.id)]).
+        where(inventory_table.c.user_id == user_id)).scalar()
+    thing_table = models.Thing.__table__
+    thing_id = engine.execute(
+        sqlalchemy.select([sqlalchemy.func.max(thing_table.c.id)]).
+        where(thing_table.c.inventory_id == inventory_id)).scalar()
+    return inventory_id, thing_id
+
+
+def _in_range(shard, item_id):
+    """Return whether an ID is in a shard's range."""
+    first_id = models.UserShard.first_id(shard)
+    return first_id <= item_id < first_id + models.UserShard.ID_RANGE
+
+
+@pytest.fixture
+def sharded(app, setupdb, monkeypatch):  # pylint: disable=redefined-outer-name
+    """Enable two in-memory shards, with the test users' data in the main database."""
+    monkeypatch.setitem(app.config, 'SQLALCHEMY_BINDS', {s: 'sqlite://' for s in SHARDS})
+    monkeypatch.setitem(app.config, 'STUFFR_SHARDS', SHARDS)
+    for shard in SHARDS:
+        shards.create_tables(shard)
+    yield setupdb
+    db.session.remove()
+    for shard in SHARDS:
+        # Drops the in-memory database
+        shards.get_engine(shard).dispose()
+
+
+# The tests
+#############
+
+class TestRouting:
+    """Tests for sending queries to the shard of a user."""
+
+    def test_move_user(self, sharded):
+        """Test that a user's data is read from their shard after moving it."""
+        user_id = sharded.test_user_id
+        names = [t.name for t in models.Thing.get_things_for_inventory(
+            sharded.test_inventory_id, user_id)]
+
+        moved = shards.move_user(user_id, 'one')
+        assert moved == {'inventory': 2, 'thing': 4, 'import_checkpoint': 0,
+                         'journal_entry': 0}
+        assert models.UserShard.get_shard(user_id) == 'one'
+        assert _thing_ids(None, user_id) == []
+        assert len(_thing_ids('one', user_id)) == 4
+        inventory_id, _ = _last_ids('one', user_id)
+        assert [t.name for t in models.Thing.get_things_for_inventory(
+            inventory_id, user_id)] == names
+        # The other user's data stays in the main database
+        assert len(_thing_ids(None, sharded.test_alt_user_id)) == 4
+
+    def test_writes(self, sharded):
+        """Test that new rows get IDs in the range of their shard."""
+        user_id = sharded.test_user_id
+        shards.move_user(user_id, 'two')
+        _, thing_id = _last_ids('two', user_id)
+        inventory = models.Inventory.create_new_inventory({'name': 'Sharded'}, user_id)
+        thing = models.Thing.create_new_thing({'name': 'Sharded'}, inventory.id, user_id)
+        models.Thing.update_thing(thing_id, {'name': 'Moved'}, user_id)
+        models.Thing.delete_thing(thing.id, user_id)
+        assert _in_range('two', inventory.id)
+        assert _in_range('two', thing.id)
+        assert thing.id in _thing_ids('two', user_id)
+        assert models.Thing.get_thing(thing_id, user_id).name == 'Moved'
+        assert models.Thing.get_thing_counts(user_id)['inventories'][inventory.id] == 0
+
+    def test_permissions(self, sharded):
+        """Test that users can't reach the items of users in other shards."""
+        shards.move_user(sharded.test_user_id, 'one')
+        inventory_id, thing_id = _last_ids('one', sharded.test_user_id)
+        with pytest.raises(models.errors.ItemNotFoundError):
+            models.Thing.get_thing(thing_id, sharded.test_alt_user_id)
+        with pytest.raises(models.errors.ItemNotFoundError):
+            models.Inventory.check_user_access(inventory_id, sharded.test_alt_user_id)
+
+    def test_use_shard_flushes(self, sharded):
+        """Test that pending changes are written to the shard they were made in."""
+        session = db.session()
+        thing = models.Thing.query.get(sharded.test_thing_id)
+        thing.name = 'Changed'
+        session.use_shard('one')
+        assert models.Thing.query.filter_by(id=sharded.test_thing_id).count() == 0
+        db.session.commit()
+        session.use_shard(None)
+        assert db.session.query(models.Thing.name). \
+            filter_by(id=sharded.test_thing_id).scalar() == 'Changed'
+
+    def test_assign_new_users(self, sharded):
+        """Test that new users are added to the shard with the fewest users."""
+        first = user_store.create_user(**TEST_NEW_USER)
+        second = user_store.create_user(**dict(TEST_NEW_USER, email='second@example.com'))
+        db.session.commit()
+        assert models.UserShard.get_shard(first.id) == 'one'
+        assert models.UserShard.get_shard(second.id) == 'two'
+        assert models.UserShard.get_shard(sharded.test_user_id) is None
+
+
+class TestMoving:
+    """Tests for moving users between shards."""
+
+    def test_new_ids(self, sharded):
+        """Test that moved rows are given IDs in the range of their new shard."""
+        user_id = sharded.test_user_id
+        shards.move_user(user_id, 'two')
+        models.Thing.create_new_thing({'name': 'Two'}, _last_ids('two', user_id)[0], user_id)
+        shards.move_user(user_id, 'one')
+        assert _thing_ids('two', user_id) == []
+        assert len(_thing_ids('one', user_id)) == 5
+        inventory_id, thing_id = _last_ids('one', user_id)
+        assert models.Thing.get_thing(thing_id, user_id).name == 'Two'
+        in_one = models.Thing.create_new_thing({'name': 'One'}, inventory_id, user_id)
+        assert all(_in_range('one', i) for i in _thing_ids('one', user_id))
+        assert in_one.id > thing_id
+
+    def test_interrupted_move(self, sharded):
+        """Test that rows left by an interrupted move are replaced."""
+        user_id = sharded.test_user_id
+        with mock.patch.object(shards, '_set_shard', side_effect=RuntimeError):
+            with pytest.raises(RuntimeError):
+                shards.move_user(user_id, 'one')
+        assert models.UserShard.get_shard(user_id) is None
+        assert len(_thing_ids(None, user_id)) == len(_thing_ids('one', user_id)) == 4
+        shards.move_user(user_id, 'one')
+        assert len(_thing_ids('one', user_id)) == 4
+        assert _thing_ids(None, user_id) == []
+
+    def test_journal(self, sharded):
+        """Test that journal entries are renumbered in the new shard."""
+        user_id = sharded.test_user_id
+        for name in ('One', 'Two'):
+            models.Thing.update_thing(sharded.test_thing_id, {'name': name}, user_id)
+        old_entries = models.JournalEntry.get_entries(user_id, 0, 10)
+        shards.move_user(user_id, 'one')
+        entries = models.JournalEntry.get_entries(user_id, 0, 10)
+        assert [e['changes'] for e in entries] == [e['changes'] for e in old_entries]
+        assert all(_in_range('one', e['id']) for e in entries)
+        assert {e['entity_id'] for e in entries} == {_last_ids('one', user_id)[1]}
+        # Reading after an entry from before the move starts over
+        assert models.JournalEntry.get_entries(user_id, old_entries[0]['id'], 10) == entries
+        assert models.JournalEntry.get_entries(user_id, entries[0]['id'], 10) == entries[1:]
+
+    def test_write_after_move(self, sharded):
+        """Test that a write with a stale shard map entry goes to the new shard."""
+        user_id = sharded.test_user_id
+        shards.move_user(user_id, 'one')
+        # As read by a request before the move
+        db.session.info.setdefault(models.UserShard.SESSION_KEY, {})[user_id] = None
+        inventory = models.Inventory.create_new_inventory({'name': 'After move'}, user_id)
+        assert _in_range('one', inventory.id)
+        assert _last_ids('one', user_id)[0] == inventory.id
+        assert _last_ids(None, user_id) == (None, None)
+
+    def test_unknown_shard(self, sharded):
+        """Test moving a user to a shard that doesn't exist."""
+        with pytest.raises(shards.ShardError):
+            shards.move_user(sharded.test_user_id, 'three')
+
+    def test_plan_rebalance(self, sharded):
+        """Test planning moves out of the main database, then between shards."""
+        user_id, alt_user_id = sharded.test_user_id, sharded.test_alt_user_id
+        assert sorted(shards.plan_rebalance()) == sorted(
+            [(alt_user_id, None, 'one'), (user_id, None, 'two')])
+
+        shards.move_user(user_id, 'one')
+        shards.move_user(alt_user_id, 'one')
+        assert shards.plan_rebalance() in (
+            [(user_id, 'one', 'two')], [(alt_user_id, 'one', 'two')])
+        shards.move_user(user_id, 'two')
+        assert shards.plan_rebalance() == []
+
+    def test_plan_rebalance_disabled(self, setupdb):
+        """Test that rebalancing needs shards."""
+        with pytest.raises(shards.ShardError):
+            shards.plan_rebalance()
+
+
+class TestAggregation:
+    """Tests for counting rows in all shards."""
+
+    def test_count_rows(self, sharded):
+        """Test that rows are counted in every database."""
+        tables = [models.Inventory.__table__, models.Thing.__table__]
+        before = shards.count_rows(tables)
+        shards.move_user(sharded.test_user_id, 'one')
+        shards.move_user(sharded.test_alt_user_id, 'two')
+        assert shards.count_rows(tables) == before == [4, 8]
+
+    def test_stats(self, sharded, authenticated_client):
+        """Test that admin stats include all shards."""
+        shards.move_user(sharded.test_user_id, 'one')
+        response = authenticated_client.get(url_for('stuffrapi.admin_stats'))
+        assert (response.json['numInventories'], response.json['numThings']) == (4, 8)
+
+
+class TestViews:
+    """Tests for views using data in a shard."""
+
+    def test_things(self, sharded, authenticated_client):
+        """Test reading and adding things of a user in a shard."""
+        shards.move_user(sharded.test_user_id, 'one')
+        url = url_for('stuffrapi.get_things',
+                      inventory_id=_last_ids('one', sharded.test_user_id)[0])
+        assert len(authenticated_client.get(url).json) == 2
+        response = post_as_json(authenticated_client.post, url, {'name': 'Sharded'})
+        assert response.status_code == HTTPStatus.CREATED
+        assert response.json['id'] in _thing_ids('one', sharded.test_user_id)
+
+    def test_batch_transaction(self, sharded, authenticated_client):
+        """Test that a batch transaction is rolled back in the shard."""
+        shards.move_user(sharded.test_user_id, 'one')
+        things_path = url_for('stuffrapi.get_things',
+                              inventory_id=_last_ids('one', sharded.test_user_id)[0])
+        operations = [{'method': 'POST', 'path': things_path, 'body': {'name': 'Batch'}},
+                      {'method': 'POST', 'path': things_path, 'body': {}}]
+        post_as_json(authenticated_client.post, url_for('stuffrapi.post_batch'),
+                     {'operations': operations, 'transaction': True})
+        assert len(_thing_ids('one', sharded.test_user_id)) == 4
+
+        response = post_as_json(authenticated_client.post, url_for('stuffrapi.post_batch'),
+                                {'operations': operations[:1], 'transaction': True})
+        assert response.json['results'][0]['status'] == HTTPStatus.CREATED
+        assert len(_thing_ids('one', sharded.test_user_id)) == 5
@@ -2,7 +2,10 @@
 
 from http import HTTPStatus
 import pytest
-from flask import url_for
+from flask import current_app, url_for
+
+from stuffrapp.api import models
+from database import db
 
 
 pytestmark = pytest.mark.simple_views
@@ -79,3 +82,83 @@ def test_show_invalid_thing(session_client, setupdb):
                   thing_id=setupdb.test_thing_id)
     response = session_client.get(url)
     assert response.status_code == HTTPStatus.BAD_REQUEST
+
+
+@pytest.mark.options(STUFFR_SIMPLE_PAGE_SIZE=1)
+def test_things_pagination(session_client, setupdb):
+    """Test that things are split into pages."""
+    things = models.Thing.query.filter_by(
+        inventory_id=setupdb.test_inventory_id).order_by(models.Thing.id).all()
+    assert len(things) > 1
+    url = url_for('simple_interface.list_things', inventory_id=setupdb.test_inventory_id)
+    for page, thing in enumerate(things, start=1):
+        response = session_client.get(url, query_string={'page': page})
+        assert response.status_code == HTTPStatus.OK
+        html = response.data.decode()
+        assert thing.name in html
+        assert all(t.name not in html for t in things if t is not thing)
+        assert f'Page {page} of {len(things)}' in html
+
+
+@pytest.mark.options(STUFFR_SIMPLE_PAGE_SIZE=1)
+def test_inventories_pagination(session_client, setupdb):
+    """Test that inventories are split into pages."""
+    url = url_for('simple_interface.list_inventories')
+    inventories = models.Inventory.query.filter_by(user_id=setupdb.test_user_id).all()
+    response = session_client.get(url, query_string={'page': 2})
+    assert response.status_code == HTTPStatus.OK
+    assert f'Page 2 of {len(inventories)}' in response.data.decode()
+
+
+@pytest.mark.parametrize('view_name, param_names', views_parameters)
+def test_conditional_requests(session_client, setupdb, view_name, param_names):
+    """Test that unchanged pages are not sent again."""
+    view_params = {k: getattr(setupdb, v) for k, v in param_names.items()}
+    url = url_for(view_name, **view_params)
+    response = session_client.get(url)
+    etag = response.headers['ETag']
+    last_modified = response.headers['Last-Modified']
+    assert 'private' in response.headers['Cache-Control']
+
+    response = session_client.get(url, headers={'If-None-Match': etag})
+    assert response.status_code == HTTPStatus.NOT_MODIFIED
+    assert response.data == b''
+    response = session_client.get(url, headers={'If-Modified-Since': last_modified})
+    assert response.status_code == HTTPStatus.NOT_MODIFIED
+
+    # Changing the thing changes the page
+    thing = models.Thing.query.get(setupdb.test_thing_id)
+    thing.name = 'Renamed thing'
+    db.session.commit()
+    response = session_client.get(url, headers={'If-None-Match': etag})
+    assert response.status_code == HTTPStatus.OK
+    assert response.headers['ETag'] != etag
+    assert 'Renamed thing' in response.data.decode()
+
+
+def test_inventories_conditional_request(session_client):
+    """Test that an unchanged inventory list is not sent again."""
+    url = url_for('simple_interface.list_inventories')
+    etag = session_client.get(url).headers['ETag']
+    response = session_client.get(url, headers={'If-None-Match': etag})
+    assert response.status_code == HTTPStatus.NOT_MODIFIED
+
+
+def test_thing_rows_cached(session_client, setupdb):
+    """Test that rendered thing rows are reused."""
+    cache = current_app.extensions['stuffr_fragment_cache']
+    cache.clear()
+    url = url_for('simple_interface.list_things', inventory_id=setupdb.test_inventory_id)
+    session_client.get(url)
+    num_rows = len(cache)
+    assert num_rows > 0
+    hits = cache.hits
+
+    # Modified things are rendered again, the others are reused
+    thing = models.Thing.query.get(setupdb.test_thing_id)
+    thing.name = 'Cache test rename'
+    db.session.commit()
+    response = session_client.get(url)
+    assert 'Cache test rename' in response.data.decode()
+    assert cache.hits == hits + num_rows - 1
+    assert len(cache) == num_rows + 1
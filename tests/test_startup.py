@@ -0,0 +1,81 @@
+"""Test cases and benchmarks for server startup.
+
+Each measurement runs in a fresh interpreter, since imports are cached after
+the first time. Startup time depends on the machine running the tests, so
+it is only compared to the budgets when the STUFFR_BENCHMARKS environment
+variable is set. The best of several runs is used to reduce noise.
+"""
+
+import json
+import os
+import subprocess
+import sys
+import pytest
+
+
+pytestmark = pytest.mark.startup
+
+# Budgets in seconds
+IMPORT_BUDGET = 2.0
+CREATE_APP_BUDGET = 0.5
+NUM_RUNS = 3
+# Timing budgets are only checked when asked for
+benchmark = pytest.mark.skipif(not os.environ.get('STUFFR_BENCHMARKS'),
+                               reason='Set STUFFR_BENCHMARKS to check startup times')
+# Modules only needed for development or CLI commands
+DEV_MODULES = {'alembic', 'flask_migrate', 'flask_debugtoolbar', 'smtpd', 'asyncore'}
+
+STARTUP_SCRIPT = '''
+import json, sys, time
+start = time.perf_counter()
+import stuffrapp
+imported = time.perf_counter()
+import wsgi
+created = time.perf_counter()
+print(json.dumps({'import': imported - start, 'create_app': created - imported,
+                  'modules': sorted(sys.modules)}))
+'''
+
+
+def _measure_startup():
+    """Start the WSGI app in a new interpreter and return its timings."""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, STUFFR_SETTINGS=os.devnull)
+    output = subprocess.check_output([sys.executable, '-c', STARTUP_SCRIPT],
+                                     cwd=root, env=env)
+    return json.loads(output.decode().splitlines()[-1])
+
+
+@pytest.fixture(scope='module')
+def startup_run():
+    """Timings and loaded modules of one run of server startup."""
+    return _measure_startup()
+
+
+@pytest.fixture(scope='module')
+def startup_runs(startup_run):  # pylint: disable=redefined-outer-name
+    """Timings for several runs of server startup."""
+    return [startup_run] + [_measure_startup() for _ in range(NUM_RUNS - 1)]
+
+
+# The tests
+#############
+
+def test_no_dev_modules(startup_run):  # pylint: disable=redefined-outer-name
+    """Test that serving the app does not load development tools."""
+    assert DEV_MODULES.isdisjoint(startup_run['modules'])
+
+
+@benchmark
+def test_import_time(startup_runs):  # pylint: disable=redefined-outer-name
+    """Test that importing the app stays within budget."""
+    best = min(r['import'] for r in startup_runs)
+    assert best < IMPORT_BUDGET, f'Import time: {best:.3f}s (budget {IMPORT_BUDGET}s)'
+
+
+@benchmark
+def test_create_app_time(startup_runs):  # pylint: disable=redefined-outer-name
+    """Test that creating the app stays within budget."""
+    best = min(r['create_app'] for r in startup_runs)
+    assert best < CREATE_APP_BUDGET, \
+        f'create_app time: {best:.3f}s (budget {CREATE_APP_BUDGET}s)'
@@ -0,0 +1,299 @@
+"""Test cases for write transactions with concurrent writers."""
+
+from collections import namedtuple
+import sqlite3
+import threading
+import time
+import pytest
+import sqlalchemy
+
+from database import db
+from stuffrapp import user_store
+from stuffrapp.api import errors, events, models, transactions
+from tests.conftest import TEST_NEW_USER
+
+
+pytestmark = pytest.mark.transactions
+
+FileDatabase = namedtuple('FileDatabase', ['path', 'user_id', 'inventory_id'])
+
+
+# Utility functions
+####################
+
+def _lock(path):
+    """Take the write lock of a database file, returning the connection holding it."""
+    connection = sqlite3.connect(path, timeout=0, isolation_level=None,
+                                 check_same_thread=False)
+    connection.execute('BEGIN IMMEDIATE')
+    return connection
+
+
+def _thing_names(inventory_id):
+    """Return the names of the things in an inventory."""
+    db.session.commit()
+    return sorted(name for name, in db.session.query(models.Thing.name).
+                  filter_by(inventory_id=inventory_id))
+
+
+def _run_threads(app, target, num_threads):
+    """Run target(thread number) in threads with app contexts, returning the errors."""
+    raised = []
+
+    def run(number):
+        """Thread main function."""
+        with app.app_context():
+            try:
+                target(number)
+            except Exception as e:  # pylint: disable=broad-except
+                raised.append(e)
+            finally:
+                db.session.remove()
+    threads = [threading.Thread(target=run, args=(n,)) for n in range(num_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return raised
+
+
+@pytest.fixture
+def file_db(app, tmpdir, monkeypatch):  # pylint: disable=redefined-outer-name
+    """Return a function that switches the app to a SQLite file database.
+
+    The function takes the busy timeout of the database's connections, and
+    returns the database's path and the IDs of a user and their inventory.
+    """
+    def use_file_db(timeout=5.0):
+        db.session.remove()
+        path = str(tmpdir.join('stuffr.db'))
+        monkeypatch.setitem(app.config, 'SQLALCHEMY_DATABASE_URI',
+                            f'sqlite:///{path}?timeout={timeout}')
+        db.create_all()
+        user = user_store.create_user(**TEST_NEW_USER)
+        db.session.commit()
+        inventory = models.Inventory.create_new_inventory({'name': 'Concurrent'}, user.id)
+        return FileDatabase(path, user.id, inventory.id)
+    yield use_file_db
+    db.session.remove()
+    db.get_engine(app).dispose()
+    app.extensions['stuffr_count_cache'].clear()
+
+
+@pytest.fixture
+def group_commit(app, monkeypatch):  # pylint: disable=redefined-outer-name
+    """Enable group commit, returning a function creating the app's committer.
+
+    The function takes the committer's window and group size.
+    """
+    monkeypatch.setitem(app.config, 'STUFFR_GROUP_COMMIT', True)
+
+    def use_committer(window=0.002, max_size=50):
+        monkeypatch.setitem(app.config, 'STUFFR_GROUP_COMMIT_WINDOW', window)
+        monkeypatch.setitem(app.config, 'STUFFR_GROUP_COMMIT_SIZE', max_size)
+        committer = transactions.GroupCommitter(app)
+        monkeypatch.setitem(app.extensions, 'stuffr_group_commit', committer)
+        return committer
+    return use_committer
+
+
+# The tests
+#############
+
+class TestWrite:
+    """Tests for running writes in transactions."""
+
+    def test_begin_immediate(self, file_db):
+        """Test that the write lock is taken before the work reads anything."""
+        database = file_db()
+        other = sqlite3.connect(database.path, timeout=0, isolation_level=None)
+
+        def work():
+            models.Inventory.query.get(database.inventory_id)
+            with pytest.raises(sqlite3.OperationalError):
+                other.execute('BEGIN IMMEDIATE')
+        transactions.write(work, models.Inventory)
+        # Released once committed
+        other.execute('BEGIN IMMEDIATE')
+        other.rollback()
+
+    def test_retry_busy(self, app, file_db, monkeypatch):
+        """Test that a write is retried until another writer's lock is released."""
+        database = file_db(timeout=0.05)
+        monkeypatch.setitem(app.config, 'STUFFR_WRITE_RETRIES', 3)
+        monkeypatch.setitem(app.config, 'STUFFR_WRITE_RETRY_DELAY', 0.05)
+        blocker = _lock(database.path)
+        timer = threading.Timer(0.1, blocker.rollback)
+        timer.start()
+        thing = models.Thing.create_new_thing({'name': 'Waited'}, database.inventory_id,
+                                              database.user_id)
+        timer.join()
+        assert thing.id is not None
+        assert _thing_names(database.inventory_id) == ['Waited']
+
+    def test_busy_error(self, app, file_db, monkeypatch):
+        """Test that the error is raised once the retries run out."""
+        database = file_db(timeout=0.01)
+        monkeypatch.setitem(app.config, 'STUFFR_WRITE_RETRIES', 1)
+        blocker = _lock(database.path)
+        with pytest.raises((sqlite3.OperationalError, sqlalchemy.exc.OperationalError)) \
+                as raised:
+            models.Thing.create_new_thing({'name': 'Locked'}, database.inventory_id,
+                                          database.user_id)
+        assert transactions.is_busy(raised.value)
+        blocker.rollback()
+        assert _thing_names(database.inventory_id) == []
+
+    def test_rerun_work(self, setupdb):
+        """Test that work is run again after a busy error, without its earlier changes."""
+        attempts = []
+
+        def work():
+            thing = models.Thing(name='Retried', inventory_id=setupdb.test_inventory_id)
+            db.session.add(thing)
+            db.session.flush()
+            attempts.append(thing.id)
+            if len(attempts) == 1:
+                raise sqlalchemy.exc.OperationalError(
+                    'INSERT', {}, sqlite3.OperationalError('database is locked'))
+        transactions.write(work, models.Thing)
+        assert len(attempts) == 2
+        assert models.Thing.query.filter_by(name='Retried').count() == 1
+
+    def test_other_error(self, setupdb):
+        """Test that other errors roll back the work without retrying it."""
+        attempts = []
+
+        def work():
+            attempts.append(models.Thing.query.get(setupdb.test_thing_id))
+            attempts[0].name = 'Rolled back'
+            raise errors.InvalidDataError('Bad')
+        with pytest.raises(errors.InvalidDataError):
+            transactions.write(work, models.Thing)
+        assert len(attempts) == 1
+        assert models.Thing.query.get(setupdb.test_thing_id).name != 'Rolled back'
+
+    @pytest.mark.parametrize('flush', [False, True], ids=['pending', 'flushed'])
+    def test_uncommitted_changes(self, setupdb, flush):
+        """Test that changes made before a write are neither committed nor lost."""
+        db.session.add(models.Thing(name='Before', inventory_id=setupdb.test_inventory_id))
+        if flush:
+            db.session.flush()
+        with pytest.raises(RuntimeError):
+            models.Thing.create_new_thing({'name': 'Write'}, setupdb.test_inventory_id,
+                                          setupdb.test_user_id)
+        db.session.rollback()
+        assert models.Thing.query.filter(models.Thing.name.in_(['Before', 'Write'])). \
+            count() == 0
+
+
+class TestGroupCommit:
+    """Tests for committing concurrent writes together."""
+
+    def test_group(self, app, file_db, group_commit):
+        """Test that concurrent writes are committed in one transaction."""
+        database = file_db()
+        committer = group_commit(window=5, max_size=4)
+        created = []
+
+        def create(number):
+            thing = models.Thing.create_new_thing(
+                {'name': f'Grouped {number}'}, database.inventory_id, database.user_id)
+            created.append((thing.id, thing.name))
+        assert _run_threads(app, create, 4) == []
+        assert (committer.groups, committer.writes) == (1, 4)
+        assert sorted(name for _, name in created) == _thing_names(database.inventory_id)
+        assert len({thing_id for thing_id, _ in created}) == 4
+
+    def test_failed_write(self, app, file_db, group_commit):
+        """Test that a failing write doesn't roll back the others in its group."""
+        database = file_db()
+        committer = group_commit(window=5, max_size=3)
+        subscription = app.extensions['stuffr_events'].subscribe(database.user_id)
+
+        def create(number):
+            name = None if number == 1 else f'Grouped {number}'
+            models.Thing.create_new_thing({'name': name}, database.inventory_id,
+                                          database.user_id)
+        raised = _run_threads(app, create, 3)
+        assert [type(e) for e in raised] == [errors.InvalidDataError]
+        assert committer.groups == 1
+        assert _thing_names(database.inventory_id) == ['Grouped 0', 'Grouped 2']
+        published = ''.join(subscription.get(0))
+        assert published.count('event: thing.created') == 2
+        app.extensions['stuffr_events'].unsubscribe(subscription)
+
+    def test_detached_result(self, file_db, group_commit):
+        """Test that objects written by the committer keep their values."""
+        database = file_db()
+        group_commit()
+        thing = models.Thing.create_new_thing({'name': 'Detached'}, database.inventory_id,
+                                              database.user_id)
+        assert sqlalchemy.inspect(thing).detached
+        assert (thing.name, thing.inventory_id) == ('Detached', database.inventory_id)
+        models.Thing.update_thing(thing.id, {'location': 'Here'}, database.user_id)
+        assert models.Thing.get_thing(thing.id, database.user_id).location == 'Here'
+
+    def test_nested(self, setupdb, group_commit):
+        """Test that writes in a savepoint are run there, not in a group."""
+        committer = group_commit()
+        transactions.begin(db.session.connection(), immediate=False)
+        db.session.begin_nested()
+        thing_id = models.Thing.create_new_thing(
+            {'name': 'Nested'}, setupdb.test_inventory_id, setupdb.test_user_id).id
+        db.session.rollback()
+        assert committer.writes == 0
+        assert models.Thing.query.filter_by(id=thing_id).count() == 0
+
+    def test_events_kept(self, app, setupdb):
+        """Test that rolling back a write's savepoint keeps the group's other events."""
+        session = db.session()
+        new_write = transactions._Write  # pylint: disable=protected-access
+        pending = [
+            new_write(lambda: events.record(setupdb.test_user_id, 'thing.created', {'id': 2}),
+                      ()),
+            new_write(lambda: 1 / 0, ())
+        ]
+        events.record(setupdb.test_user_id, 'thing.created', {'id': 1})
+        run_group = transactions.GroupCommitter._run_group  # pylint: disable=protected-access
+        run_group(session, pending)
+        assert isinstance(pending[1].error, ZeroDivisionError)
+        assert [e[2] for e in session.info[events.SESSION_KEY]] == ['{"id": 1}', '{"id": 2}']
+        session.info.pop(transactions.WRITE_KEY)
+        session.rollback()
+
+
+class TestStress:
+    """Concurrent writers, printing the writes per second."""
+
+    NUM_THREADS = 8
+    WRITES_PER_THREAD = 25
+
+    def _measure(self, app, database):
+        """Create things in concurrent threads, returning the writes per second."""
+        def create(number):
+            for write in range(self.WRITES_PER_THREAD):
+                models.Thing.create_new_thing({'name': f'Stress {number} {write}'},
+                                              database.inventory_id, database.user_id)
+        start = time.perf_counter()
+        raised = _run_threads(app, create, self.NUM_THREADS)
+        elapsed = time.perf_counter() - start
+        assert raised == []
+        total = self.NUM_THREADS * self.WRITES_PER_THREAD
+        assert len(_thing_names(database.inventory_id)) == total
+        return total / elapsed
+
+    def test_plain(self, app, file_db):
+        """Test that each write is committed on its own, without busy errors."""
+        writes_per_second = self._measure(app, file_db())
+        print(f'Plain commits: {writes_per_second:.0f} writes/s')
+
+    def test_group_commit(self, app, file_db, group_commit):
+        """Test that writes are committed in groups."""
+        database = file_db()
+        committer = group_commit()
+        writes_per_second = self._measure(app, database)
+        print(f'Group commit: {writes_per_second:.0f} writes/s, '
+              f'{committer.writes / committer.groups:.1f} writes per group')
+        assert committer.writes == self.NUM_THREADS * self.WRITES_PER_THREAD
+        assert committer.groups < committer.writes